@@ -31,7 +31,14 @@ export class BasicLambdaToDynamodbStack extends cdk.Stack {
 
         if (props.sendEmail) {
             this.lambdaFunction.addToRolePolicy(new iam.PolicyStatement({
-                actions: ['ses:SendEmail', 'ses:SendRawEmail'],
+                actions: [
+                    'ses:SendEmail',
+                    'ses:SendRawEmail',
+                    'ses:SendBulkTemplatedEmail',
+                    'ses:CreateTemplate',
+                    'ses:UpdateTemplate',
+                    'ses:GetSendQuota',
+                ],
                 resources: ['*'],
                 effect: iam.Effect.ALLOW,
             }));
@@ -146,6 +146,7 @@ export class FfSmartAppTheOneWeAreWorkingOnStack extends cdk.Stack {
                 healthReportMgr.lambdaFunction,
                 tokenMgr.lambdaFunction,
             ],
+            sessionTable: storageStack.sessionsDynamoDbTable,
             userPoolArn: cognitoStack.userPool.userPoolArn,
         });
     }
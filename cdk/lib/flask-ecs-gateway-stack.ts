@@ -5,12 +5,14 @@ import * as cdk from 'aws-cdk-lib';
 import * as lambda from "aws-cdk-lib/aws-lambda";
 import * as ecs from 'aws-cdk-lib/aws-ecs';
 import * as iam from "aws-cdk-lib/aws-iam";
+import * as DynamoDB from "aws-cdk-lib/aws-dynamodb";
 import * as elbv2 from 'aws-cdk-lib/aws-elasticloadbalancingv2'; // Import ELBv2 for Application Load Balancer
 
 
 interface FlaskEcsGatewayStackProps extends cdk.StackProps {
     environVars: { [key: string]: string };
     lambda_resources: lambda.Function[];
+    sessionTable: DynamoDB.ITable;
     userPoolArn: string;
 }
 
@@ -105,5 +107,6 @@ export class FlaskEcsGatewayStack extends cdk.Stack {
         for (const lambda_function of props.lambda_resources) {
             lambda_function.grantInvoke(taskDef.taskRole);
         }
+        props.sessionTable.grantReadWriteData(taskDef.taskRole);
     }
 }
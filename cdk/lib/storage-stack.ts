@@ -21,8 +21,47 @@ export class StorageStack extends cdk.Stack {
                 name: 'type',
                 type: DynamoDB.AttributeType.STRING
             },
+            // sensor events are removed once their retention period has passed
+            timeToLiveAttribute: 'expires_at',
         });
 
+        // sparse index of the fridges with items below their desired quantity, only fridges with a reorder_flag are in it
+        this.masterDynamoDbTable.addGlobalSecondaryIndex({
+            indexName: 'reorder-index',
+            partitionKey: {
+                name: 'reorder_flag',
+                type: DynamoDB.AttributeType.STRING
+            },
+            sortKey: {
+                name: 'pk',
+                type: DynamoDB.AttributeType.STRING
+            },
+            projectionType: DynamoDB.ProjectionType.INCLUDE,
+            nonKeyAttributes: ['reorder_items'],
+        });
+
+        // sparse index of the orders due for delivery on each day across every restaurant, for the delivery company.
+        // Only the orders' delivery entries have a delivery_day.
+        // CloudFormation can only create one global secondary index on a table per update, so a table that has neither
+        // index yet has to be deployed twice, first with -c skipDeliveryIndex=true to add reorder-index, then without
+        // it to add this one
+        const skipDeliveryIndex = String(this.node.tryGetContext('skipDeliveryIndex')) === 'true';
+        if (!skipDeliveryIndex) {
+            this.masterDynamoDbTable.addGlobalSecondaryIndex({
+                indexName: 'delivery-index',
+                partitionKey: {
+                    name: 'delivery_day',
+                    type: DynamoDB.AttributeType.STRING
+                },
+                sortKey: {
+                    name: 'pk',
+                    type: DynamoDB.AttributeType.STRING
+                },
+                projectionType: DynamoDB.ProjectionType.INCLUDE,
+                nonKeyAttributes: ['order_id', 'date_ordered', 'delivery_date', 'items'],
+            });
+        }
+
 
         this.sessionsDynamoDbTable = new DynamoDB.Table(this, 'analysis-and-design-ecs-session-table', {
             partitionKey: {
@@ -30,6 +69,7 @@ export class StorageStack extends cdk.Stack {
                 type: DynamoDB.AttributeType.STRING,
             },
             tableName: 'analysis-and-design-ecs-session-table',
+            timeToLiveAttribute: 'expires_at',
             removalPolicy: cdk.RemovalPolicy.DESTROY,
         });
 
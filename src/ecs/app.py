@@ -1,4 +1,3 @@
-import boto3
 from flask import (
     Flask, 
     jsonify,
@@ -10,11 +9,14 @@ from flask import (
 )
 from flask_session import Session
 
+from lib.session import DynamoDBSessionInterface
+
 from lib.utils import (
     get_user_role
 )
 from lib.globals import (
     dynamodb_session_table,
+    dynamodb_resource,
     region, 
     user_pool_id, 
     client_id, 
@@ -34,13 +36,14 @@ from routes.forgot_password_route import forgot_password_route
 
 # init app
 app = Flask(__name__)
-app.config['SESSION_TYPE'] = 'filesystem'
-app.config['SESSION_DYNAMODB'] = boto3.resource('dynamodb', region_name=region)
-app.config['SESSION_DYNAMODB_TABLE'] = dynamodb_session_table
 app.config['SESSION_PERMANENT'] = False
 
-# init session
-Session(app)
+# init session, shared between containers through DynamoDB, or on local disk when no table is configured
+if dynamodb_session_table:
+    app.session_interface = DynamoDBSessionInterface(dynamodb_resource.Table(dynamodb_session_table))
+else:
+    app.config['SESSION_TYPE'] = 'filesystem'
+    Session(app)
 
 # register route blueprints
 app.register_blueprint(inventory_route)
@@ -0,0 +1,178 @@
+"""
+Load test for the ECS app against stubbed Lambda and Cognito backends.
+
+Starts benchmarks.stub_app under the chosen server, signs in each simulated user, then has every user request
+--path in a loop for --duration seconds and reports requests/sec and latency percentiles. A --write-ratio share of
+requests sign in again instead, which rewrites the session.
+
+With --session dynamodb the sessions are stored in DynamoDB; unless --dynamodb-endpoint is given a local moto server
+is started for them (needs moto[server]).
+
+Run from src/ecs:
+    python benchmarks/load_test.py --server dev
+    python benchmarks/load_test.py --server gunicorn --users 50
+    python benchmarks/load_test.py --server gunicorn --session dynamodb --session-cache-size 0
+"""
+import argparse
+import http.cookiejar
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+ECS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_server(server, port, env):
+    """
+    Starts the stub app under the development server or gunicorn.
+    :param server: 'dev' or 'gunicorn'.
+    :param port: Port to listen on.
+    :param env: Environment for the server process.
+    :return: The server process.
+    """
+    if server == 'dev':
+        command = [sys.executable, '-m', 'flask', '--app', 'benchmarks.stub_app', 'run', '--port', str(port)]
+    else:
+        env = {**env, 'GUNICORN_BIND': f'127.0.0.1:{port}', 'GUNICORN_LOG_LEVEL': 'warning'}
+        command = [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py', 'benchmarks.stub_app:app']
+
+    process = subprocess.Popen(command, cwd=ECS_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port, process, server)
+    return process
+
+
+def wait_for_port(port, process, name):
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+
+    process.terminate()
+    raise RuntimeError(f'{name} server did not start on port {port}')
+
+
+def start_dynamodb(port, table_name):
+    """
+    Starts a moto server and creates the session table on it.
+    :return: (process, endpoint url)
+    """
+    process = subprocess.Popen([sys.executable, '-m', 'moto.server', '-p', str(port)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    endpoint = f'http://127.0.0.1:{port}'
+    wait_for_port(port, process, 'moto')
+
+    import boto3
+    boto3.client('dynamodb', region_name='eu-west-1', endpoint_url=endpoint, aws_access_key_id='bench',
+                 aws_secret_access_key='bench').create_table(
+        TableName=table_name,
+        KeySchema=[{'AttributeName': 'session_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'session_id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    return process, endpoint
+
+
+def run_user(base_url, path, stop_at, write_ratio, latencies, errors, lock):
+    """
+    Signs in and requests path until stop_at, recording each request's latency.
+    """
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    credentials = urllib.parse.urlencode({'accessToken': 'bench', 'username': 'bench', 'userData': '{}'}).encode()
+    opener.open(f'{base_url}/update-credentials', data=credentials).read()
+
+    user_latencies = []
+    user_errors = 0
+    while time.time() < stop_at:
+        start = time.perf_counter()
+        try:
+            if random.random() < write_ratio:
+                request = urllib.request.Request(f'{base_url}/update-credentials', data=credentials)
+            else:
+                request = urllib.request.Request(f'{base_url}{path}')
+
+            with opener.open(request, timeout=30) as response:
+                response.read()
+            user_latencies.append(time.perf_counter() - start)
+        except (urllib.error.URLError, OSError):
+            user_errors += 1
+
+    with lock:
+        latencies.extend(user_latencies)
+        errors.append(user_errors)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=['dev', 'gunicorn'], default='gunicorn')
+    parser.add_argument('--users', type=int, default=20, help='concurrent simulated users')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run for')
+    parser.add_argument('--path', default='/inventory')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per stubbed backend call')
+    parser.add_argument('--workers', type=int, help='gunicorn workers (default from gunicorn.conf.py)')
+    parser.add_argument('--session', choices=['filesystem', 'dynamodb'], default='filesystem')
+    parser.add_argument('--dynamodb-endpoint', help='DynamoDB endpoint for sessions (default: start moto)')
+    parser.add_argument('--session-cache-size', type=int, default=1024, help='sessions cached per process')
+    parser.add_argument('--write-ratio', type=float, default=0.1, help='share of requests that rewrite the session')
+    args = parser.parse_args()
+
+    env = {**os.environ, 'BENCH_BACKEND_LATENCY': str(args.latency)}
+    if args.workers:
+        env['GUNICORN_WORKERS'] = str(args.workers)
+
+    dynamodb_process = None
+    if args.session == 'dynamodb':
+        env.update({'BENCH_SESSION': 'dynamodb', 'BENCH_SESSION_CACHE_SIZE': str(args.session_cache_size),
+                    'BENCH_SESSION_TABLE': 'bench-session-table'})
+        if args.dynamodb_endpoint:
+            env['BENCH_DYNAMODB_ENDPOINT'] = args.dynamodb_endpoint
+        else:
+            env.update({'AWS_ACCESS_KEY_ID': 'bench', 'AWS_SECRET_ACCESS_KEY': 'bench'})
+            dynamodb_process, env['BENCH_DYNAMODB_ENDPOINT'] = start_dynamodb(args.port + 1, 'bench-session-table')
+
+    process = start_server(args.server, args.port, env)
+    try:
+        latencies, errors, lock = [], [], threading.Lock()
+        stop_at = time.time() + args.duration
+        users = [threading.Thread(target=run_user,
+                                  args=(f'http://127.0.0.1:{args.port}', args.path, stop_at, args.write_ratio,
+                                        latencies, errors, lock))
+                 for _ in range(args.users)]
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        if dynamodb_process is not None:
+            dynamodb_process.terminate()
+
+    latencies.sort()
+    if not latencies:
+        print('No successful requests')
+        return
+
+    print(f'server={args.server} session={args.session} users={args.users} duration={args.duration}s '
+          f'backend_latency={args.latency}s')
+    print(f'requests: {len(latencies)}  errors: {sum(errors)}')
+    print(f'requests/sec: {len(latencies) / args.duration:.1f}')
+    print(f'p50: {percentile(latencies, 0.50) * 1000:.1f} ms  p99: {percentile(latencies, 0.99) * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+The ECS app with Lambda and Cognito replaced by stubs that sleep for BENCH_BACKEND_LATENCY seconds per call.
+
+Serve it from src/ecs, e.g. `gunicorn --config gunicorn.conf.py benchmarks.stub_app:app`.
+
+Sessions are kept on local disk unless BENCH_SESSION=dynamodb, in which case they are stored in the
+BENCH_SESSION_TABLE table at BENCH_DYNAMODB_ENDPOINT, caching up to BENCH_SESSION_CACHE_SIZE per process.
+"""
+import io
+import json
+import os
+import time
+
+import boto3
+
+import lib.globals
+from lib.session import DynamoDBSessionInterface
+
+BACKEND_LATENCY = float(os.environ.get('BENCH_BACKEND_LATENCY', 0.05))
+RESTAURANT_ID = 'bench'
+
+
+class StubLambdaClient:
+    def invoke(self, FunctionName, InvocationType, Payload):
+        time.sleep(BACKEND_LATENCY)
+        payload = json.loads(Payload)
+
+        if payload.get('action') == 'view_inventory':
+            body = {
+                'additional_details': {
+                    'is_front_door_open': True,
+                    'items': [
+                        {
+                            'item_name': f'item {index}',
+                            'desired_quantity': 10,
+                            'item_list': [{'current_quantity': 4, 'expiry_date': int(time.time()) + 86400,
+                                           'date_added': 0, 'date_removed': 0}]
+                        }
+                        for index in range(20)
+                    ]
+                }
+            }
+        elif payload.get('action') == 'consume_items':
+            body = {
+                'additional_details': {
+                    'items': {item['item_name']: {'consumed': item['quantity'], 'shortfall': 0}
+                              for item in payload['body']['items']},
+                    'not_found': []
+                }
+            }
+        else:
+            body = {'role': 'Chef'}
+
+        return {'Payload': io.BytesIO(json.dumps({'statusCode': 200, 'body': body}).encode('utf-8'))}
+
+
+class StubCognitoClient:
+    def get_user(self, AccessToken):
+        time.sleep(BACKEND_LATENCY)
+        return {'Username': RESTAURANT_ID, 'UserAttributes': []}
+
+
+class StubTokenVerifier:
+    def verify(self, access_token):
+        # Access tokens are just the username, e.g. "bench".
+        return {'username': access_token, 'sub': access_token, 'custom:restaurant_id': RESTAURANT_ID}
+
+
+# Replace the clients before the app and routes import them.
+lib.globals.lambda_client = StubLambdaClient()
+lib.globals.cognito_client = StubCognitoClient()
+lib.globals.token_verifier = StubTokenVerifier()
+
+from app import app  # noqa: E402
+
+if os.environ.get('BENCH_SESSION') == 'dynamodb':
+    session_table = boto3.resource('dynamodb', region_name=lib.globals.region,
+                                   endpoint_url=os.environ['BENCH_DYNAMODB_ENDPOINT']).Table(
+        os.environ.get('BENCH_SESSION_TABLE', 'bench-session-table'))
+    app.session_interface = DynamoDBSessionInterface(session_table,
+                                                     cache_size=int(os.environ.get('BENCH_SESSION_CACHE_SIZE', 1024)))
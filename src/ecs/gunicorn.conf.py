@@ -0,0 +1,25 @@
+import multiprocessing
+import os
+
+# Production server settings for the ECS container, run with `gunicorn --config gunicorn.conf.py app:app`.
+# Requests spend almost all their time waiting on Lambda and Cognito, so each worker serves many of them at once
+# on a thread pool rather than one at a time.
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:80')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+
+# Import the app once in the master so workers fork with it already loaded.
+preload_app = True
+
+# Lambda calls can be slow on a cold start, so allow for them before a worker is considered stuck.
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+
+# ECS sends SIGTERM and waits 30 seconds before SIGKILL; finish in-flight requests inside that window.
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 25))
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
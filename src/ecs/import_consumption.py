@@ -0,0 +1,65 @@
+"""
+Takes a day of point-of-sale consumption out of a restaurant's inventory from the command line.
+
+The file holds item_name, quantity, timestamp records as CSV (optionally with a header row) or NDJSON, and is read
+from stdin when the path is '-'. Records are totalled per item before anything is sent, then applied through the
+fridge_mgr lambda's consume_items action, earliest expiring stock first.
+
+Run from src/ecs:
+    python import_consumption.py sales.csv --restaurant my-restaurant
+    python import_consumption.py sales.ndjson --restaurant my-restaurant --dry-run
+    python import_consumption.py bar-sales.csv --restaurant my-restaurant --fridge bar
+"""
+import argparse
+import json
+import sys
+import time
+
+from lib.consumption import read_consumption, apply_consumption
+from lib.globals import lambda_client, fridge_mgr_lambda
+from lib.utils import DEFAULT_FRIDGE_ID
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file', help="CSV or NDJSON file of sales, or '-' for stdin")
+    parser.add_argument('--restaurant', required=True, help='Restaurant to take the stock from')
+    parser.add_argument('--fridge', default=DEFAULT_FRIDGE_ID, help="Fridge to take the stock from, the restaurant's "
+                                                                    'default fridge by default')
+    parser.add_argument('--format', choices=['csv', 'ndjson'], help='File format, detected from the file by default')
+    parser.add_argument('--function', default=fridge_mgr_lambda,
+                        help='fridge_mgr lambda name, FRIDGE_MGR_NAME by default')
+    parser.add_argument('--dry-run', action='store_true', help='Only print the totals per item')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.file == '-':
+        consumption = read_consumption(sys.stdin.buffer, args.format)
+    else:
+        with open(args.file, 'rb') as stream:
+            consumption = read_consumption(stream, args.format)
+
+    print(f'Read {consumption.records} records for {len(consumption.totals)} items in '
+          f'{time.perf_counter() - started:.2f}s, {consumption.rejected} rejected', file=sys.stderr)
+    for error in consumption.errors:
+        print(error, file=sys.stderr)
+
+    if args.dry_run:
+        json.dump(consumption.totals, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return 0
+
+    if not args.function:
+        parser.error('--function or FRIDGE_MGR_NAME must be set')
+
+    if not consumption.totals:
+        return 1
+
+    result = apply_consumption(lambda_client, args.function, args.restaurant, consumption, args.fridge)
+    json.dump(result, sys.stdout, indent=2, sort_keys=True)
+    print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
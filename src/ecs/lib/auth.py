@@ -0,0 +1,206 @@
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+
+
+class InvalidTokenException(Exception):
+    pass
+
+
+# DER prefix of the DigestInfo structure for SHA-256, used by RSASSA-PKCS1-v1_5 (RFC 8017, section 9.2).
+SHA256_DIGEST_INFO = bytes.fromhex('3031300d060960864801650304020105000420')
+
+
+def base64url_decode(value):
+    """
+    Decodes a base64url string with or without padding.
+    :param value: base64url encoded string.
+    :return: Decoded bytes.
+    """
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+def verify_rs256(signing_input, signature, n, e):
+    """
+    Verifies an RS256 (RSASSA-PKCS1-v1_5 with SHA-256) signature.
+    :param signing_input: Bytes that were signed.
+    :param signature: Signature bytes.
+    :param n: RSA modulus.
+    :param e: RSA public exponent.
+    :return: True if the signature is valid.
+    """
+    key_length = (n.bit_length() + 7) // 8
+    if len(signature) != key_length:
+        return False
+
+    encoded = pow(int.from_bytes(signature, 'big'), e, n).to_bytes(key_length, 'big')
+
+    digest_info = SHA256_DIGEST_INFO + hashlib.sha256(signing_input).digest()
+    padding_length = key_length - len(digest_info) - 3
+    if padding_length < 8:
+        return False
+
+    expected = b'\x00\x01' + b'\xff' * padding_length + b'\x00' + digest_info
+    return hmac.compare_digest(encoded, expected)
+
+
+class TokenVerifier:
+    """
+    Verifies Cognito access tokens locally against the user pool's JWKS.
+
+    Keys are cached and refreshed every refresh_interval seconds, or sooner when a token is signed with an
+    unknown key. When jwks_file is set the keys are read from that file instead of Cognito.
+    """
+
+    def __init__(self, region, user_pool_id, client_id, jwks_file=None, refresh_interval=3600,
+                 min_refresh_interval=60, leeway=0, clock=time.time):
+        self.issuer = f'https://cognito-idp.{region}.amazonaws.com/{user_pool_id}'
+        self.client_id = client_id
+        self.jwks_file = jwks_file
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.leeway = leeway
+        self.clock = clock
+
+        self.keys = {}
+        self.keys_loaded_at = None
+        self.lock = threading.Lock()
+
+    def fetch_jwks(self):
+        """
+        Reads the JWKS from jwks_file, or downloads it from the user pool.
+        :return: Parsed JWKS document.
+        """
+        if self.jwks_file:
+            with open(self.jwks_file) as jwks_file:
+                return json.load(jwks_file)
+
+        with urllib.request.urlopen(f'{self.issuer}/.well-known/jwks.json', timeout=5) as response:
+            return json.loads(response.read())
+
+    def refresh_keys(self, force=False):
+        """
+        Reloads the signing keys if they are stale, or when forced and not refreshed too recently.
+        :param force: Reload even if the keys are not stale, e.g. for an unknown key id.
+        """
+        with self.lock:
+            now = self.clock()
+            if self.keys_loaded_at is not None:
+                age = now - self.keys_loaded_at
+                if age < self.min_refresh_interval or (not force and age < self.refresh_interval):
+                    return
+
+            try:
+                jwks = self.fetch_jwks()
+            except (OSError, ValueError):
+                # Keep serving the keys we already have rather than rejecting every token.
+                self.keys_loaded_at = now
+                return
+
+            self.keys = {
+                key['kid']: (int.from_bytes(base64url_decode(key['n']), 'big'),
+                             int.from_bytes(base64url_decode(key['e']), 'big'))
+                for key in jwks.get('keys', [])
+                if key.get('kty') == 'RSA' and 'kid' in key
+            }
+            self.keys_loaded_at = now
+
+    def get_key(self, kid):
+        """
+        Gets the public key for a key id, refreshing the JWKS if needed.
+        :param kid: Key id from the token header.
+        :return: (n, e) tuple, or None if the key is unknown.
+        """
+        self.refresh_keys()
+        if kid not in self.keys:
+            self.refresh_keys(force=True)
+
+        return self.keys.get(kid)
+
+    def verify(self, access_token):
+        """
+        Verifies an access token's signature, expiry, issuer, client id and token use.
+        :param access_token: Encoded Cognito access token.
+        :return: The token's claims if valid, otherwise None.
+        """
+        try:
+            header_segment, payload_segment, signature_segment = access_token.split('.')
+            header = json.loads(base64url_decode(header_segment))
+            claims = json.loads(base64url_decode(payload_segment))
+            signature = base64url_decode(signature_segment)
+        except (AttributeError, ValueError):
+            return None
+
+        if not isinstance(header, dict) or not isinstance(claims, dict) or header.get('alg') != 'RS256':
+            return None
+
+        key = self.get_key(header.get('kid'))
+        if key is None:
+            return None
+
+        if not verify_rs256(f'{header_segment}.{payload_segment}'.encode(), signature, *key):
+            return None
+
+        if not isinstance(claims.get('exp'), (int, float)) or claims['exp'] + self.leeway <= self.clock():
+            return None
+
+        if claims.get('iss') != self.issuer or claims.get('token_use') != 'access':
+            return None
+
+        if claims.get('client_id') != self.client_id:
+            return None
+
+        return claims
+
+
+class ExpiringCache:
+    """
+    Small thread safe LRU cache whose entries expire ttl seconds after they are stored.
+    """
+
+    def __init__(self, max_size=1024, ttl=3600, clock=time.time):
+        """
+        :param max_size: Most entries kept, the least recently used are dropped first.
+        :param ttl: Seconds an entry is kept for.
+        :param clock: Returns the current unix time.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Gets a cached value.
+        :param key: Key of the value.
+        :return: The value, or None if it is not cached or has expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            if entry[1] <= self.clock():
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        """
+        Caches a value.
+        :param key: Key of the value.
+        :param value: Value to cache.
+        """
+        with self.lock:
+            self.entries[key] = (value, self.clock() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
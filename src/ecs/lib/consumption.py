@@ -0,0 +1,224 @@
+import csv
+import hashlib
+import io
+import json
+
+from lib.utils import make_lambda_request, DEFAULT_FRIDGE_ID
+
+# larger imports are split over several fridge_mgr calls to stay well under the lambda payload limit
+MAX_ITEMS_PER_REQUEST = 500
+MAX_REPORTED_ERRORS = 20
+# sales are sent grouped by the hour they were made in, so fridge_mgr skips the stock that had expired when they were
+# made. Expiry dates fall on the hour, so a sale is never grouped with one on the other side of an expiry
+SALE_GROUPING_SECONDS = 3600
+# how many times the items of a batch that fridge_mgr could not apply, because the fridge kept changing, are sent
+UNAPPLIED_ATTEMPTS = 3
+
+
+class ConsumptionImport:
+    """
+    Running totals of consumption records read from a point-of-sale export.
+    """
+
+    def __init__(self):
+        self.totals = {}
+        self.sales = {}
+        self.records = 0
+        self.errors = []
+        self.rejected = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        # SHA-256 of the file read, so importing the same file again does not take the stock twice
+        self.file_hash = None
+
+    def add(self, line_number, item_name, quantity, timestamp):
+        """
+        Adds one record to the totals, or counts it as rejected if it is invalid.
+        :param line_number: Line of the record in the file, used in error messages.
+        :param item_name: Name of the item consumed.
+        :param quantity: Quantity consumed, a positive whole number.
+        :param timestamp: Unix timestamp of the sale.
+        """
+        try:
+            item_name = str(item_name).strip().lower()
+            quantity = int(quantity)
+            timestamp = int(timestamp)
+            if not item_name or quantity <= 0 or timestamp <= 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            self.reject(line_number, 'expected item_name, a positive quantity and a unix timestamp')
+            return
+
+        self.totals[item_name] = self.totals.get(item_name, 0) + quantity
+        sales = self.sales.setdefault(item_name, {})
+        hour = timestamp - timestamp % SALE_GROUPING_SECONDS
+        sales[hour] = sales.get(hour, 0) + quantity
+        self.records += 1
+        if self.first_timestamp is None or timestamp < self.first_timestamp:
+            self.first_timestamp = timestamp
+        if self.last_timestamp is None or timestamp > self.last_timestamp:
+            self.last_timestamp = timestamp
+
+    def reject(self, line_number, reason):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f'Line {line_number}: {reason}')
+
+    def batches(self):
+        """
+        Splits the sales into fridge_mgr consume_items requests, each item's sales grouped by the hour they were made.
+        :return: Lists of {'item_name', 'quantity', 'consumed_at'}.
+        """
+        items = [{'item_name': item_name, 'quantity': quantity, 'consumed_at': hour}
+                 for item_name, sales in sorted(self.sales.items()) for hour, quantity in sorted(sales.items())]
+        return [items[offset:offset + MAX_ITEMS_PER_REQUEST] for offset in range(0, len(items), MAX_ITEMS_PER_REQUEST)]
+
+
+def read_consumption(stream, file_format=None):
+    """
+    Reads and totals consumption records per item from a CSV or NDJSON stream, one line at a time.
+
+    CSV rows are item_name,quantity,timestamp, with an optional header row. NDJSON lines are objects with the same
+    keys. The format is taken from the first non-blank character when not given.
+    :param stream: Text stream, or binary stream of UTF-8.
+    :param file_format: 'csv', 'ndjson', or None to detect it.
+    :return: ConsumptionImport with the totals.
+    """
+    if not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+
+    file_hash = hashlib.sha256()
+    stream = hash_lines(stream, file_hash)
+
+    # peek at the first line to detect the format and any header, then carry on with the same stream
+    first_line = ''
+    line_number = 0
+    for first_line in stream:
+        line_number += 1
+        if first_line.strip():
+            break
+
+    consumption = ConsumptionImport()
+    if not first_line.strip():
+        consumption.file_hash = file_hash.hexdigest()
+        return consumption
+
+    if file_format is None:
+        file_format = 'ndjson' if first_line.lstrip().startswith('{') else 'csv'
+
+    if file_format == 'ndjson':
+        read_ndjson(consumption, first_line, line_number, stream)
+    elif file_format == 'csv':
+        read_csv(consumption, first_line, line_number, stream)
+    else:
+        raise ValueError(f'Unknown consumption file format: {file_format}')
+
+    consumption.file_hash = file_hash.hexdigest()
+    return consumption
+
+
+def hash_lines(stream, file_hash):
+    for line in stream:
+        file_hash.update(line.encode('utf-8'))
+        yield line
+
+
+def read_ndjson(consumption, first_line, line_number, stream):
+    add_ndjson_line(consumption, line_number, first_line)
+    for line in stream:
+        line_number += 1
+        if line.strip():
+            add_ndjson_line(consumption, line_number, line)
+
+
+def add_ndjson_line(consumption, line_number, line):
+    try:
+        record = json.loads(line)
+        consumption.add(line_number, record['item_name'], record['quantity'], record['timestamp'])
+    except (ValueError, KeyError, TypeError):
+        consumption.reject(line_number, 'expected a JSON object with item_name, quantity and timestamp')
+
+
+def read_csv(consumption, first_line, line_number, stream):
+    rows = csv.reader(stream)
+    first_row = next(csv.reader([first_line]), [])
+    if [column.strip().lower() for column in first_row] != ['item_name', 'quantity', 'timestamp']:
+        add_csv_row(consumption, line_number, first_row)
+
+    for row in rows:
+        line_number += 1
+        if row:
+            add_csv_row(consumption, line_number, row)
+
+
+def add_csv_row(consumption, line_number, row):
+    if len(row) != 3:
+        consumption.reject(line_number, 'expected item_name,quantity,timestamp')
+        return
+
+    consumption.add(line_number, *row)
+
+
+def apply_consumption(lambda_client, function_name, restaurant_id, consumption, fridge_id=DEFAULT_FRIDGE_ID):
+    """
+    Takes the totalled consumption out of a restaurant's inventory, with one fridge_mgr consume_items call per batch
+    of items.
+
+    Each call has an idempotency key made from the file's hash and the batch's position, so importing a file again
+    after a failure only takes the batches that were not taken the first time. Items fridge_mgr could not apply
+    because the fridge kept changing are sent again under their own keys.
+    :param lambda_client: Client of the lambda.
+    :param function_name: Name of the fridge_mgr lambda.
+    :param restaurant_id: Restaurant to take the stock from.
+    :param consumption: ConsumptionImport from read_consumption.
+    :param fridge_id: Fridge to take the stock from.
+    :return: Dict with the 'items' consumed and their shortfall, the names 'not_found' in the inventory, and the
+    names 'unapplied' because the fridge kept changing.
+    :raises RuntimeError: If fridge_mgr rejects a batch; earlier batches will already have been applied.
+    """
+    result = {'items': {}, 'not_found': [], 'unapplied': []}
+    for index, items in enumerate(consumption.batches()):
+        for attempt in range(UNAPPLIED_ATTEMPTS):
+            idempotency_key = None
+            if consumption.file_hash is not None:
+                idempotency_key = f'consume_items#{fridge_id}#{consumption.file_hash}#{index}#{attempt}'
+
+            details = consume_items(lambda_client, function_name, restaurant_id, fridge_id, items, idempotency_key)
+
+            # an item's sales can be split over two batches
+            for item_name, counts in details['items'].items():
+                totals = result['items'].setdefault(item_name, {'consumed': 0, 'shortfall': 0})
+                totals['consumed'] += counts['consumed']
+                totals['shortfall'] += counts['shortfall']
+            result['not_found'].extend(item_name for item_name in details['not_found']
+                                       if item_name not in result['not_found'])
+
+            unapplied = details.get('unapplied', [])
+            items = [item for item in items if item['item_name'] in unapplied]
+            if not items:
+                break
+
+        result['unapplied'].extend(item_name for item_name in dict.fromkeys(item['item_name'] for item in items)
+                                   if item_name not in result['unapplied'])
+
+    return result
+
+
+def consume_items(lambda_client, function_name, restaurant_id, fridge_id, items, idempotency_key):
+    payload = {
+        "httpMethod": "POST",
+        "action": "consume_items",
+        "body": {
+            "restaurant_name": restaurant_id,
+            "fridge_id": fridge_id,
+            "items": items
+        }
+    }
+    if idempotency_key is not None:
+        payload['body']['idempotency_key'] = idempotency_key
+
+    response = make_lambda_request(lambda_client, payload, function_name)
+    if response['statusCode'] != 200:
+        raise RuntimeError(response['body']['details'])
+
+    return response['body']['additional_details']
@@ -0,0 +1,235 @@
+import json
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError, BotoCoreError
+
+
+class DynamoDBEventStore:
+    """
+    Keeps the latest events of each restaurant in one item of a DynamoDB table, so every gunicorn worker of every ECS
+    task can read the events published by the others.
+
+    The item is keyed events#{restaurant_id} in the session table and holds at most max_events events. It expires
+    through the table's TTL once nothing has been published for ttl seconds.
+    """
+
+    def __init__(self, table, max_events=20, ttl=3600, clock=time.time):
+        """
+        :param table: DynamoDB table with a session_id partition key and TTL on expires_at.
+        :param max_events: Number of events kept per restaurant.
+        :param ttl: Seconds the events are kept after the latest one.
+        :param clock: Returns the current unix time.
+        """
+        self.table = table
+        self.max_events = max_events
+        self.ttl = ttl
+        self.clock = clock
+
+    def get_key(self, restaurant_id):
+        return {'session_id': f'events#{restaurant_id}'}
+
+    def append(self, restaurant_id, event_id, message):
+        """
+        Adds an event to a restaurant's events, dropping the oldest once there are more than max_events.
+        :param restaurant_id: Restaurant the event belongs to.
+        :param event_id: Unique id of the event.
+        :param message: Server-sent event message.
+        """
+        response = self.table.update_item(
+            Key=self.get_key(restaurant_id),
+            UpdateExpression='SET #events = list_append(if_not_exists(#events, :empty), :event), expires_at = :expires',
+            ExpressionAttributeNames={'#events': 'events'},
+            ExpressionAttributeValues={
+                ':empty': [],
+                ':event': [{'id': event_id, 'message': message}],
+                ':expires': int(self.clock()) + self.ttl
+            },
+            ReturnValues='UPDATED_NEW'
+        )
+
+        excess = len(response['Attributes']['events']) - self.max_events
+        if excess > 0:
+            self.table.update_item(
+                Key=self.get_key(restaurant_id),
+                UpdateExpression='REMOVE ' + ', '.join(f'#events[{index}]' for index in range(excess)),
+                ExpressionAttributeNames={'#events': 'events'}
+            )
+
+    def read(self, restaurant_id):
+        """
+        Gets a restaurant's latest events.
+        :param restaurant_id: Restaurant the events belong to.
+        :return: List of {'id', 'message'}, oldest first.
+        """
+        return self.table.get_item(Key=self.get_key(restaurant_id)).get('Item', {}).get('events', [])
+
+
+class EventBroker:
+    """
+    Fans out inventory and door events to the server-sent event streams open in this process.
+
+    Each restaurant has its own set of subscribers. Every open stream holds a server thread, so the number of streams
+    is capped and each one is closed after max_stream_seconds; browsers reconnect on their own.
+
+    Without a store only events published by this process are seen. With a store every event is also written to it,
+    and a poller thread reads the events of the restaurants with open streams every poll_seconds, passing on those
+    published by other workers and tasks. A stream that missed events, because more were published between two polls
+    than the store keeps, is sent a resync event so the page reloads.
+    """
+
+    def __init__(self, max_streams=32, max_stream_seconds=300, heartbeat_seconds=15, queue_size=100, store=None,
+                 poll_seconds=2, logger=None):
+        self.max_streams = max_streams
+        self.max_stream_seconds = max_stream_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.queue_size = queue_size
+        self.store = store
+        self.poll_seconds = poll_seconds
+        self.logger = logger
+        self.subscribers = {}
+        self.stream_count = 0
+        self.lock = threading.Lock()
+        # ids of the latest event seen for each restaurant with open streams, and of events published here
+        self.last_seen = {}
+        self.published_here = OrderedDict()
+        self.poller = None
+
+    def subscribe(self, restaurant_id):
+        """
+        Registers a new stream for a restaurant.
+        :param restaurant_id: Restaurant to receive events for.
+        :return: Queue the stream reads events from, or None if too many streams are already open.
+        """
+        with self.lock:
+            if self.stream_count >= self.max_streams:
+                return None
+
+            events = queue.Queue(maxsize=self.queue_size)
+            self.subscribers.setdefault(restaurant_id, set()).add(events)
+            self.stream_count += 1
+
+            # started on the first stream rather than at import, gunicorn forks its workers after preloading the app
+            if self.store is not None and self.poller is None:
+                self.poller = threading.Thread(target=self.poll, daemon=True)
+                self.poller.start()
+            return events
+
+    def unsubscribe(self, restaurant_id, events):
+        with self.lock:
+            subscribers = self.subscribers.get(restaurant_id, set())
+            if events in subscribers:
+                subscribers.discard(events)
+                self.stream_count -= 1
+            if not subscribers:
+                self.subscribers.pop(restaurant_id, None)
+                self.last_seen.pop(restaurant_id, None)
+
+    def publish(self, restaurant_id, event, data):
+        """
+        Sends an event to every stream open for a restaurant, in this process and, with a store, in every other.
+        :param restaurant_id: Restaurant the event belongs to.
+        :param event: Event name, e.g. 'item' or 'door'.
+        :param data: JSON serialisable event data.
+        """
+        message = f'event: {event}\ndata: {json.dumps(data, default=str)}\n\n'
+
+        if self.store is not None:
+            event_id = uuid.uuid4().hex
+            with self.lock:
+                self.published_here[event_id] = None
+                while len(self.published_here) > 1000:
+                    self.published_here.popitem(last=False)
+            try:
+                self.store.append(restaurant_id, event_id, message)
+            except (ClientError, BotoCoreError) as e:
+                # the streams in this process still get the event
+                if self.logger is not None:
+                    self.logger.warning(f'Could not share event for {restaurant_id}: {e}')
+
+        self.deliver(restaurant_id, message)
+
+    def deliver(self, restaurant_id, message):
+        """
+        Sends a message to the streams open in this process for a restaurant.
+        :param restaurant_id: Restaurant the message belongs to.
+        :param message: Server-sent event message.
+        """
+        with self.lock:
+            subscribers = list(self.subscribers.get(restaurant_id, ()))
+
+        for events in subscribers:
+            try:
+                events.put_nowait(message)
+            except queue.Full:
+                # The client has stopped reading, let it reload the whole page when it catches up.
+                pass
+
+    def poll_restaurant(self, restaurant_id):
+        """
+        Passes on the events published for a restaurant by other processes since it was last polled.
+        :param restaurant_id: Restaurant with open streams.
+        """
+        stored = self.store.read(restaurant_id)
+        ids = [event['id'] for event in stored]
+
+        with self.lock:
+            if restaurant_id not in self.subscribers:
+                return
+            first_poll = restaurant_id not in self.last_seen
+            last_seen = self.last_seen.get(restaurant_id)
+            if ids:
+                self.last_seen[restaurant_id] = ids[-1]
+            elif first_poll:
+                self.last_seen[restaurant_id] = None
+            published_here = set(self.published_here)
+
+        # streams opened after these events already have them in the page they loaded
+        if first_poll:
+            return
+
+        if last_seen is not None and last_seen not in ids:
+            # more events were published than the store keeps, the pages reload to catch up
+            self.deliver(restaurant_id, 'event: resync\ndata: {}\n\n')
+            return
+
+        for event in stored[ids.index(last_seen) + 1 if last_seen is not None else 0:]:
+            if event['id'] not in published_here:
+                self.deliver(restaurant_id, event['message'])
+
+    def poll(self):
+        """
+        Polls the store for the restaurants with open streams, for as long as the process runs.
+        """
+        while True:
+            time.sleep(self.poll_seconds)
+            with self.lock:
+                restaurant_ids = list(self.subscribers)
+
+            for restaurant_id in restaurant_ids:
+                try:
+                    self.poll_restaurant(restaurant_id)
+                except (ClientError, BotoCoreError) as e:
+                    if self.logger is not None:
+                        self.logger.warning(f'Could not read events for {restaurant_id}: {e}')
+
+    def stream(self, restaurant_id, events):
+        """
+        Generates the server-sent event stream for a subscription, unsubscribing when it ends.
+        :param restaurant_id: Restaurant the subscription belongs to.
+        :param events: Queue returned by subscribe.
+        """
+        try:
+            # Reconnect a few seconds after the stream is closed.
+            yield 'retry: 3000\n\n'
+            stop_at = time.time() + self.max_stream_seconds
+            while time.time() < stop_at:
+                try:
+                    yield events.get(timeout=self.heartbeat_seconds)
+                except queue.Empty:
+                    yield ': heartbeat\n\n'
+        finally:
+            self.unsubscribe(restaurant_id, events)
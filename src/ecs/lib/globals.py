@@ -4,6 +4,9 @@ import logging
 
 from flask import session
 
+from lib.auth import TokenVerifier
+from lib.events import EventBroker, DynamoDBEventStore
+
 # Global variables
 dynamodb_session_table = os.environ.get('DYNAMODB_TABLE')
 fridge_mgr_lambda = os.environ.get('FRIDGE_MGR_NAME')
@@ -20,7 +23,20 @@ lambda_client = boto3.client('lambda', region_name=region)
 cognito_client = boto3.client('cognito-idp', region_name=region)
 dynamodb_resource = boto3.resource('dynamodb', region_name=region)
 
+# Access tokens are verified locally against the user pool's signing keys instead of calling Cognito per request.
+token_verifier = TokenVerifier(region, user_pool_id, client_id, jwks_file=os.environ.get('COGNITO_JWKS_FILE'))
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Live inventory and door updates for open inventory pages. Each stream holds a server thread, so keep the cap well
+# under the number of threads per worker. The events are shared through the session table so a stream sees changes
+# made through any worker or task; without the table only changes made through the same worker are seen.
+event_broker = EventBroker(
+    max_streams=int(os.environ.get('SSE_MAX_STREAMS', 8)),
+    store=DynamoDBEventStore(dynamodb_resource.Table(dynamodb_session_table)) if dynamodb_session_table else None,
+    poll_seconds=float(os.environ.get('SSE_POLL_SECONDS', 2)),
+    logger=logger
+)
+
 flask_session = session
\ No newline at end of file
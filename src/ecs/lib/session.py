@@ -0,0 +1,191 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+
+class DynamoDBSession(CallbackDict, SessionMixin):
+    """
+    Server side session, the cookie only holds the session id and the version of the data it last saw.
+    """
+
+    def __init__(self, initial=None, sid=None, version=0, new=False):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.version = version
+        self.new = new
+        self.modified = False
+        self.accessed = False
+
+    def __getitem__(self, key):
+        self.accessed = True
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.accessed = True
+        return super().get(key, default)
+
+    def setdefault(self, key, default=None):
+        self.accessed = True
+        return super().setdefault(key, default)
+
+
+class DynamoDBSessionInterface(SessionInterface):
+    """
+    Stores sessions in DynamoDB so any container behind the load balancer can serve any user.
+
+    Each process keeps a small cache of the sessions it has served, keyed by session id. The cookie carries the version
+    of the session, so a cached copy is only used when it is the latest version, otherwise the item is read again.
+    Items are written only when the session changes, or to push expires_at back once half the lifetime has passed, and
+    DynamoDB's TTL removes them once expires_at has passed.
+    """
+
+    serializer = session_json_serializer
+
+    def __init__(self, table, cache_size=1024, clock=time.time):
+        """
+        :param table: DynamoDB table with a session_id partition key and TTL on expires_at.
+        :param cache_size: Number of sessions to cache in this process.
+        :param clock: Returns the current unix time.
+        """
+        self.table = table
+        self.cache_size = cache_size
+        self.clock = clock
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_signer(self, app):
+        if not app.secret_key:
+            return None
+
+        return Signer(app.secret_key, salt='dynamodb-session')
+
+    def parse_cookie(self, app, value):
+        """
+        Splits a session cookie into its session id and version.
+        :return: (sid, version), or (None, 0) if the cookie is invalid.
+        """
+        signer = self.get_signer(app)
+        try:
+            if signer is not None:
+                value = signer.unsign(value).decode('utf-8')
+
+            sid, version = value.rsplit('.', 1)
+            return sid, int(version)
+
+        except (BadSignature, ValueError):
+            return None, 0
+
+    def cache_get(self, sid, version):
+        with self.lock:
+            entry = self.cache.get(sid)
+            if entry is None or entry[0] != version or entry[2] <= self.clock():
+                return None
+
+            self.cache.move_to_end(sid)
+            return entry
+
+    def cache_put(self, sid, version, data, expires_at):
+        with self.lock:
+            self.cache[sid] = (version, data, expires_at)
+            self.cache.move_to_end(sid)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def cache_delete(self, sid):
+        with self.lock:
+            self.cache.pop(sid, None)
+
+    def load(self, sid, version):
+        """
+        Gets a session's data, from the cache if it holds this version, otherwise from DynamoDB.
+        :return: (version, data, expires_at), or None if the session does not exist or has expired.
+        """
+        entry = self.cache_get(sid, version)
+        if entry is not None:
+            return entry
+
+        response = self.table.get_item(Key={'session_id': sid}, ConsistentRead=True)
+        item = response.get('Item')
+        # TTL deletion can lag by hours, so expired items are ignored rather than trusted.
+        if item is None or int(item['expires_at']) <= self.clock():
+            return None
+
+        entry = (int(item['version']), item['data'], int(item['expires_at']))
+        self.cache_put(sid, *entry)
+        return entry
+
+    def open_session(self, app, request):
+        value = request.cookies.get(self.get_cookie_name(app))
+        if not value:
+            return DynamoDBSession(sid=secrets.token_urlsafe(32), new=True)
+
+        sid, version = self.parse_cookie(app, value)
+        if sid is None:
+            return DynamoDBSession(sid=secrets.token_urlsafe(32), new=True)
+
+        entry = self.load(sid, version)
+        if entry is None:
+            # Never reuse an id the client chose, so a session cannot be fixed in advance.
+            return DynamoDBSession(sid=secrets.token_urlsafe(32), new=True)
+
+        stored_version, data, expires_at = entry
+        session = DynamoDBSession(self.serializer.loads(data), sid=sid, version=stored_version)
+        session.expires_at = expires_at
+        return session
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session:
+            if session.modified:
+                self.table.delete_item(Key={'session_id': session.sid})
+                self.cache_delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure, samesite=samesite,
+                                       httponly=httponly)
+            return
+
+        lifetime = int(app.permanent_session_lifetime.total_seconds())
+        now = self.clock()
+        expires_at = getattr(session, 'expires_at', 0)
+
+        # Unchanged sessions are only rewritten to push expires_at back, once less than half the lifetime is left.
+        if not session.modified and not session.new and expires_at - now > lifetime / 2:
+            return
+
+        if session.modified or session.new:
+            session.version += 1
+
+        data = self.serializer.dumps(dict(session))
+        expires_at = int(now) + lifetime
+        self.table.put_item(Item={
+            'session_id': session.sid,
+            'version': session.version,
+            'data': data,
+            'expires_at': expires_at
+        })
+        self.cache_put(session.sid, session.version, data, expires_at)
+
+        value = f'{session.sid}.{session.version}'
+        signer = self.get_signer(app)
+        if signer is not None:
+            value = signer.sign(value).decode('utf-8')
+
+        response.set_cookie(name, value, expires=self.get_expiration_time(app, session), httponly=httponly,
+                            domain=domain, path=path, secure=secure, samesite=samesite)
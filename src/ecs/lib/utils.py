@@ -1,13 +1,27 @@
 import json
 import os
-from flask import flash
+import re
+from flask import flash, render_template
 from botocore.exceptions import ClientError, BotoCoreError
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
+from lib.auth import ExpiringCache
 from lib.globals import (
-    users_mgr_lambda
+    users_mgr_lambda,
+    token_verifier,
+    event_broker
 )
 
+# fridge_mgr's id for a restaurant's first fridge, which requests without a fridge_id are for.
+DEFAULT_FRIDGE_ID = 'main'
+# fridge_mgr takes fridge ids of lowercase letters, digits and hyphens, starting with a letter or digit.
+FRIDGE_ID_LENGTH = 32
+
+# Restaurant ids looked up from Cognito for tokens without a custom:restaurant_id claim, keyed by user sub. Entries
+# expire after an hour, the lifetime of an access token, so a user moved to another restaurant is picked up.
+restaurant_id_cache = ExpiringCache(max_size=1024, ttl=3600)
+
 
 def create_user(cognito_client, username, email, restaurant_id, user_pool_id):
     """
@@ -101,6 +115,25 @@ def get_email_by_username(cognito_client, user_pool_id, username):
     return email
 
 
+def get_emails_by_usernames(cognito_client, user_pool_id, usernames, max_workers=10):
+    """
+    Gets the emails for several usernames at once, the lookups are made in parallel.
+    :param cognito_client: Client for cognito.
+    :param user_pool_id: ID of the user pool.
+    :param usernames: Usernames in question.
+    :param max_workers: Most lookups to make at the same time.
+    :return: Dict of username to email, the email is None if the user was not found.
+    """
+    usernames = list(dict.fromkeys(usernames))
+    if not usernames:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(usernames))) as executor:
+        emails = executor.map(lambda username: get_email_by_username(cognito_client, user_pool_id, username),
+                              usernames)
+        return dict(zip(usernames, emails))
+
+
 def delete_user_by_username(cognito_client, user_pool_id, username):
     """
     Deletes a cognito user.
@@ -142,22 +175,9 @@ def is_user_signed_in(cognito_client, access_token, username):
     :param access_token: Access token for current sign in session.
     :return: True if valid.
     """
+    claims = token_verifier.verify(access_token)
 
-    try:
-        user_details = cognito_client.get_user(
-            AccessToken=access_token
-        )
-
-        if 'Username' in user_details and user_details['Username'] == username:
-            return True
-        else:
-            return False
-
-    except ClientError as ignore:
-        return False
-
-    except BotoCoreError as ignore:
-        return False
+    return claims is not None and claims.get('username') == username
 
 
 def get_restaurant_id(cognito_client, access_token):
@@ -167,6 +187,19 @@ def get_restaurant_id(cognito_client, access_token):
     :param access_token: Users access token.
     :return: The current users restaurant_id, admin users have their username returned.
     """
+    claims = token_verifier.verify(access_token)
+    if claims is None:
+        return None
+
+    if 'custom:restaurant_id' in claims:
+        return claims['custom:restaurant_id']
+
+    # Access tokens only carry custom attributes when a pre token generation trigger adds them, so fall back to
+    # Cognito once per user.
+    restaurant_id = restaurant_id_cache.get(claims.get('sub'))
+    if restaurant_id is not None:
+        return restaurant_id
+
     try:
         user_details = cognito_client.get_user(
             AccessToken=access_token
@@ -177,10 +210,14 @@ def get_restaurant_id(cognito_client, access_token):
 
         for attribute in user_details['UserAttributes']:
             if 'custom:restaurant_id' == attribute['Name']:
-                return attribute['Value']
+                restaurant_id = attribute['Value']
+                break
         else:
             # If there is no restaurant id, then the current user must be a restaurant
-            return user_details['Username']
+            restaurant_id = user_details['Username']
+
+        restaurant_id_cache.put(claims['sub'], restaurant_id)
+        return restaurant_id
 
     except ClientError as ignore:
         return None
@@ -247,31 +284,29 @@ def get_admin_settings(username, lambda_client, function_name):
     return make_lambda_request(lambda_client, payload, function_name)
 
 
-def get_order_data(lambda_client, function_name, restaurant_id):
+def get_due_deliveries(lambda_client, function_name, restaurant_id, to_day):
     """
-    Gets the order data for the current restaurant.
+    Gets the orders of the current restaurant due for delivery by a day, including those overdue.
     :param lambda_client: Client of the lambda.
-    :param function_name: ID of the restaurant.
+    :param function_name: Name of the orders lambda.
     :param restaurant_id: Current restaurant_id.
-    :return: The order data.
+    :param to_day: Last delivery day, as YYYY-MM-DD.
+    :return: The orders due, by delivery day.
     """
 
     try:
         payload = json.dumps({
             "httpMethod": "GET",
-            "action": "get_all_orders",
+            "action": "get_deliveries",
             "body": {
-                "restaurant_id": restaurant_id
+                "restaurant_id": restaurant_id,
+                "to_day": to_day
             }
         })
 
         response = make_lambda_request(lambda_client, payload, function_name)
         if response['statusCode'] == 200:
-            orders = response['body']['items']
-            for order in orders:
-                order['date_ordered'] = datetime.fromtimestamp(order['date_ordered']).strftime('%Y-%m-%d')
-                order['delivery_date'] = datetime.fromtimestamp(order['delivery_date']).strftime('%Y-%m-%d')
-            return orders
+            return response['body']['items']
         else:
             return []
 
@@ -280,6 +315,70 @@ def get_order_data(lambda_client, function_name, restaurant_id):
         return []
 
 
+def get_order_page(lambda_client, function_name, restaurant_id, limit, cursor=None):
+    """
+    Gets one page of the orders for the current restaurant, oldest first.
+    :param lambda_client: Client of the lambda.
+    :param function_name: Name of the orders lambda.
+    :param restaurant_id: Current restaurant_id.
+    :param limit: Most orders on the page.
+    :param cursor: next_cursor of the page before, None for the first page.
+    :return: The orders on the page and the cursor of the next page, None if it is the last.
+    """
+
+    try:
+        body = {
+            "restaurant_id": restaurant_id,
+            "limit": limit
+        }
+        if cursor:
+            body["cursor"] = cursor
+
+        payload = json.dumps({
+            "httpMethod": "GET",
+            "action": "get_all_orders",
+            "body": body
+        })
+
+        response = make_lambda_request(lambda_client, payload, function_name)
+        if response['statusCode'] == 200:
+            return response['body']['items'], response['body'].get('next_cursor')
+        else:
+            return [], None
+
+    except Exception as e:
+        print(e)
+        return [], None
+
+
+def get_door_state(lambda_client, function_name, restaurant_id):
+    """
+    Gets the door state for a restaurant, without loading its inventory.
+    :param lambda_client: Client of the lambda.
+    :param function_name: Name of the fridge_mgr lambda.
+    :param restaurant_id: Current restaurant_id.
+    :return: Dict with is_front_door_open and is_back_door_open, or None if it could not be read.
+    """
+    try:
+        payload = {
+            "httpMethod": "GET",
+            "action": "get_door_state",
+            "body": {
+                "restaurant_name": restaurant_id
+            }
+        }
+
+        response = make_lambda_request(lambda_client, payload, function_name)
+        if response['statusCode'] == 200:
+            return response['body']['additional_details']
+        else:
+            return None
+
+    except Exception as e:
+        print(e)
+        return None
+
+
 def validate_token(token, lambda_client, restaurant_id, token_mgr_lambda):
     """
     Validates a token.
@@ -310,4 +409,217 @@ def validate_token(token, lambda_client, restaurant_id, token_mgr_lambda):
     except Exception as e:
         print(e)
         flash('Invalid or expired token.', 'danger')
-        return False
\ No newline at end of file
+        return False
+
+
+def decorate_inventory_item(item, today):
+    """
+    Adds the expiry and ordering flags shown on the inventory page to an inventory item.
+    :param item: Inventory item from fridge_mgr.
+    :param today: Current date.
+    :return: The same item.
+    """
+    for detail in item['item_list']:
+        # Convert expiry_date from timestamp to date object for comparison
+        expiry_date = datetime.fromtimestamp(detail['expiry_date']).date()
+        detail['is_expired'] = expiry_date < today
+        detail['expiry_date_formatted'] = expiry_date.strftime('%Y-%m-%d')
+
+    # Calculate the total non-expired quantity
+    item['total_non_expired_quantity'] = sum(
+        detail['current_quantity'] for detail in item['item_list']
+        if not detail['is_expired']
+    )
+
+    # Determine if an order is needed for non-expired items
+    item['is_order_needed'] = item['total_non_expired_quantity'] < item['desired_quantity']
+
+    for detail in item['item_list']:
+        # Show quantity buttons if the current quantity is greater than 0
+        detail['show_quantity_buttons'] = detail['current_quantity'] > 0
+
+        # Determine if no order is required for expired items
+        detail['no_order_required'] = detail['is_expired'] and \
+            item['total_non_expired_quantity'] >= item['desired_quantity']
+
+    return item
+
+
+def get_fridge_id_for_name(fridge_name):
+    """
+    Gets the id to give a new fridge from its name.
+    :param fridge_name: Name of the fridge.
+    :return: Fridge id of at most FRIDGE_ID_LENGTH lowercase letters, digits and hyphens, empty if the name has no
+             letters or digits.
+    """
+    slug = re.sub(r'[^a-z0-9]+', '-', fridge_name.lower()).strip('-')
+    return slug[:FRIDGE_ID_LENGTH].rstrip('-')
+
+
+def render_inventory_item(item, fridge_id=DEFAULT_FRIDGE_ID):
+    """
+    Renders the inventory page card for a single item.
+    :param item: Inventory item from fridge_mgr.
+    :param fridge_id: Fridge the item is in.
+    :return: HTML for the item's card.
+    """
+    return render_template('inventory-item.html', item=decorate_inventory_item(item, datetime.now().date()),
+                           fridge_id=fridge_id)
+
+
+def publish_fridge_change(restaurant_id, response, item_name=None, fridge_id=DEFAULT_FRIDGE_ID):
+    """
+    Sends the item or door state changed by a successful fridge_mgr request to the restaurant's open inventory pages,
+    which only apply changes to the fridge they show.
+    :param restaurant_id: Restaurant the change belongs to.
+    :param response: fridge_mgr response.
+    :param item_name: Name of the item changed, used if fridge_mgr does not return it.
+    :param fridge_id: Fridge the change was made to.
+    :return: The published event data, empty if nothing changed.
+    """
+    if response['statusCode'] != 200:
+        return {}
+
+    details = response['body'].get('additional_details', {})
+    if 'is_front_door_open' in details:
+        change = {'fridge_id': fridge_id, 'is_front_door_open': details['is_front_door_open'],
+                  'is_back_door_open': details['is_back_door_open']}
+        event_broker.publish(restaurant_id, 'door', change)
+        return change
+
+    if 'item' in details:
+        change = {
+            'fridge_id': fridge_id,
+            'item_name': details['item']['item_name'] if details['item'] else details.get('item_name', item_name),
+            'html': render_inventory_item(details['item'], fridge_id) if details['item'] else None
+        }
+        event_broker.publish(restaurant_id, 'item', change)
+        return change
+
+    return {}
+
+
+def get_sensor_summary(lambda_client, function_name, restaurant_id, start, end, bucket_seconds,
+                       fridge_id=DEFAULT_FRIDGE_ID):
+    """
+    Gets a restaurant's fridge sensor readings between two times, downsampled into buckets.
+    :param lambda_client: Client of the lambda.
+    :param function_name: Name of the fridge_mgr lambda.
+    :param restaurant_id: Current restaurant_id.
+    :param start: Start unix timestamp.
+    :param end: End unix timestamp.
+    :param bucket_seconds: Length of each bucket in seconds.
+    :param fridge_id: Fridge the readings are from.
+    :return: List of buckets, or None if they could not be read.
+    """
+    try:
+        payload = {
+            "httpMethod": "GET",
+            "action": "get_sensor_summary",
+            "body": {
+                "restaurant_name": restaurant_id,
+                "fridge_id": fridge_id,
+                "start": start,
+                "end": end,
+                "bucket_seconds": bucket_seconds
+            }
+        }
+
+        response = make_lambda_request(lambda_client, payload, function_name)
+        if response['statusCode'] == 200:
+            return response['body']['additional_details']['buckets']
+        else:
+            return None
+
+    except Exception as e:
+        print(e)
+        return None
+
+
+def get_expiring(lambda_client, function_name, restaurant_id, days, fridge_id=DEFAULT_FRIDGE_ID):
+    """
+    Gets the stock of a fridge that has expired or will expire within a number of days.
+    :param lambda_client: Client of the lambda.
+    :param function_name: Name of the fridge_mgr lambda.
+    :param restaurant_id: Current restaurant_id.
+    :param days: Number of days ahead to look.
+    :param fridge_id: Fridge to look in.
+    :return: Dict with the expired and expiring batches and quantities per item, or None if they could not be read.
+    """
+    try:
+        payload = {
+            "httpMethod": "GET",
+            "action": "get_expiring",
+            "body": {
+                "restaurant_name": restaurant_id,
+                "fridge_id": fridge_id,
+                "days": days
+            }
+        }
+
+        response = make_lambda_request(lambda_client, payload, function_name)
+        if response['statusCode'] == 200:
+            return response['body']['additional_details']
+        else:
+            return None
+
+    except Exception as e:
+        print(e)
+        return None
+
+
+def get_fridges(lambda_client, function_name, restaurant_id):
+    """
+    Gets the fridges of a restaurant.
+    :param lambda_client: Client of the lambda.
+    :param function_name: Name of the fridge_mgr lambda.
+    :param restaurant_id: Current restaurant_id.
+    :return: List of dicts with fridge_id and fridge_name, the default fridge first, or None if they could not be read.
+    """
+    try:
+        payload = {
+            "httpMethod": "GET",
+            "action": "list_fridges",
+            "body": {
+                "restaurant_name": restaurant_id
+            }
+        }
+
+        response = make_lambda_request(lambda_client, payload, function_name)
+        if response['statusCode'] == 200:
+            return response['body']['additional_details']['fridges']
+        else:
+            return None
+
+    except Exception as e:
+        print(e)
+        return None
+
+
+def get_all_fridges_stock(lambda_client, function_name, restaurant_id):
+    """
+    Gets a restaurant's stock of each item summed over all of its fridges.
+    :param lambda_client: Client of the lambda.
+    :param function_name: Name of the fridge_mgr lambda.
+    :param restaurant_id: Current restaurant_id.
+    :return: Dict with the fridges and the items with their totals and quantity per fridge, or None if it could not
+    be read.
+    """
+    try:
+        payload = {
+            "httpMethod": "GET",
+            "action": "view_all_fridges",
+            "body": {
+                "restaurant_name": restaurant_id
+            }
+        }
+
+        response = make_lambda_request(lambda_client, payload, function_name)
+        if response['statusCode'] == 200:
+            return response['body']['additional_details']
+        else:
+            return None
+
+    except Exception as e:
+        print(e)
+        return None
@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timezone
 import time
 from flask import (
     Blueprint, 
@@ -12,9 +12,11 @@ from flask import (
     render_template)
 
 from lib.utils import (
-    get_order_data,
+    get_due_deliveries,
+    get_door_state,
     validate_token,
-    make_lambda_request
+    make_lambda_request,
+    publish_fridge_change
 )
 from lib.globals import (
     fridge_mgr_lambda,
@@ -26,6 +28,14 @@ from lib.globals import (
 
 delivery_route = Blueprint('delivery', __name__)
 
+# orders are due the day after they are placed, so everything still to deliver is due by tomorrow
+DELIVERY_LOOKAHEAD = 86400
+
+
+def get_delivery_orders(restaurant_id):
+    to_day = datetime.fromtimestamp(time.time() + DELIVERY_LOOKAHEAD, tz=timezone.utc).strftime('%Y-%m-%d')
+    return get_due_deliveries(lambda_client, order_mgr_lambda, restaurant_id, to_day)
+
 
 @delivery_route.route('/delivery/complete', methods=['GET', 'PATCH'])
 def deliver_complete():
@@ -45,7 +55,7 @@ def delivery(restaurant_id, token):
             close_door(restaurant_id)
         return make_response(jsonify({'success': True}), 200)
 
-    order_data = get_order_data(lambda_client, order_mgr_lambda, restaurant_id)
+    order_data = get_delivery_orders(restaurant_id)
     print("Original order_data:", order_data)
 
     retry_items = session.get('retry_items', None)
@@ -59,11 +69,15 @@ def delivery(restaurant_id, token):
             else:
                 order['items'] = []
 
+    # The door may have been moved from another device, so prefer the stored state over this session's
+    door_state = get_door_state(lambda_client, fridge_mgr_lambda, restaurant_id)
+    is_back_door_open = door_state['is_back_door_open'] if door_state else session.get('is_back_door_open', False)
+
     return render_template('delivery.html', 
             order_data=order_data, 
             restaurant_id=restaurant_id, 
             token=token,
-            is_back_door_open=session.get('is_back_door_open', False))
+            is_back_door_open=is_back_door_open)
 
 
 @delivery_route.route('/delivery/update_retry_items/<restaurant_id>/<token>/', methods=['POST'])
@@ -89,14 +103,14 @@ def complete_order(restaurant_id, token):
         if item['expiry_date'] is None or item['expiry_date'] < int(time.time()):
             return jsonify({'success': False, 'message': 'Invalid expiry date'}), 400
 
-    order_data = get_order_data(lambda_client, order_mgr_lambda, restaurant_id)
+    order_data = get_delivery_orders(restaurant_id)
 
     success, discrepancies = compare_order_data(order_data, submitted_data)
 
     if not success:
         return jsonify({'success': False, 'message': discrepancies}), 400
 
-    success, successfully_added_items = add_items(restaurant_id, submitted_data)
+    success, successfully_added_items = add_items(restaurant_id, token, submitted_data)
 
     if not success:
         for order in order_data:
@@ -186,7 +200,7 @@ def compare_order_data(expected, submitted):
     return success, discrepancies
 
 
-def add_items(restaurant_id, items):
+def add_items(restaurant_id, token, items):
     successfully_added = []
 
     for item in items:
@@ -197,7 +211,9 @@ def add_items(restaurant_id, items):
                 "restaurant_name": restaurant_id,
                 "item_name": item['item_name'],
                 "quantity": int(item['quantity']),
-                "expiry_date": item['expiry_date']
+                "expiry_date": item['expiry_date'],
+                # a retried completion gets back the items it already added rather than adding them again
+                "idempotency_key": f"delivery#{token}#{item['order_id']}#{item['item_name']}"
             }
         }
 
@@ -205,6 +221,7 @@ def add_items(restaurant_id, items):
         if response['statusCode'] != 200:
             flash(f"Failed to add item: {response}", 'error')
             break
+        publish_fridge_change(restaurant_id, response, item['item_name'])
         successfully_added.append(item)
 
     if len(successfully_added) == len(items):
@@ -252,6 +269,7 @@ def open_door(restaurant_id):
     response = make_lambda_request(lambda_client, payload, fridge_mgr_lambda)
     if response['statusCode'] == 200:
         session['is_back_door_open'] = True
+        publish_fridge_change(restaurant_id, response)
     else:
         flash(f"Failed to open door: {response['body']['details']}", 'error')
 
@@ -269,5 +287,6 @@ def close_door(restaurant_id):
     print(response)
     if response['statusCode'] == 200:
         session['is_back_door_open'] = False
+        publish_fridge_change(restaurant_id, response)
     else:
         flash(f"Failed to close door: {response['body']['details']}", 'error')
\ No newline at end of file
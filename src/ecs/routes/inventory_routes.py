@@ -3,22 +3,35 @@ import time
 
 from flask import (
     Blueprint, 
+    Response,
     redirect, 
     url_for, 
     json,
+    jsonify,
     flash, 
+    make_response,
     request,
     render_template)
 
+from lib.consumption import read_consumption, apply_consumption
 from lib.utils import (
     get_user_role, 
     get_restaurant_id,
-    make_lambda_request
+    make_lambda_request,
+    decorate_inventory_item,
+    publish_fridge_change,
+    get_sensor_summary,
+    get_expiring,
+    get_fridges,
+    get_all_fridges_stock,
+    get_fridge_id_for_name,
+    DEFAULT_FRIDGE_ID
 )
 from lib.globals import (
     fridge_mgr_lambda,
     lambda_client, 
     cognito_client,
+    event_broker,
     logger,
     flask_session as session
 )
@@ -33,16 +46,36 @@ def before_request():
     if get_user_role(cognito_client, session['access_token'], lambda_client, session['username']) == 'None':
         return redirect(url_for('error_404'))
 
+def get_fridge_id():
+    """
+    Gets the fridge a request is for, from the page's query string or a form, the default fridge if it names none.
+    """
+    return request.values.get('fridge_id') or DEFAULT_FRIDGE_ID
+
+
+def inventory_url():
+    """
+    Gets the inventory page of the fridge the request is for.
+    """
+    fridge_id = get_fridge_id()
+    return url_for('inventory.inventory', fridge_id=None if fridge_id == DEFAULT_FRIDGE_ID else fridge_id)
+
+
 @inventory_route.route('/inventory')
 def inventory():
+    fridge_id = get_fridge_id()
+    fridges = [{'fridge_id': DEFAULT_FRIDGE_ID, 'fridge_name': 'Main fridge'}]
+
     try:
         restaurant_name = get_restaurant_id(cognito_client, session['access_token'])
-        
+        fridges = get_fridges(lambda_client, fridge_mgr_lambda, restaurant_name) or fridges
+
         lambda_payload = {
             "httpMethod": "POST",
             "action": "view_inventory",
             "body": {
-                "restaurant_name": restaurant_name
+                "restaurant_name": restaurant_name,
+                "fridge_id": fridge_id
             }
         }
 
@@ -53,32 +86,14 @@ def inventory():
             today = datetime.now().date()
 
             for item in items:
-                # Convert expiry_date from timestamp to date object for comparison
-                for detail in item['item_list']:
-                    expiry_date = datetime.fromtimestamp(detail['expiry_date']).date()
-                    detail['is_expired'] = expiry_date < today
-                    detail['expiry_date_formatted'] = expiry_date.strftime('%Y-%m-%d')
-                
-                # Calculate the total non-expired quantity
-                item['total_non_expired_quantity'] = sum(
-                    detail['current_quantity'] for detail in item['item_list']
-                    if not detail['is_expired']
-                )
-
-                # Determine if an order is needed for non-expired items
-                item['is_order_needed'] = item['total_non_expired_quantity'] < item['desired_quantity']
-
-                for detail in item['item_list']:
-                    # Show quantity buttons if the current quantity is greater than 0
-                    detail['show_quantity_buttons'] = detail['current_quantity'] > 0
-
-                    # Determine if no order is required for expired items
-                    detail['no_order_required'] = detail['is_expired'] and item['total_non_expired_quantity'] >= item['desired_quantity']
+                decorate_inventory_item(item, today)
 
             return render_template('inventory.html', 
                     user_role=get_user_role(cognito_client, session['access_token'], lambda_client, session['username']), 
                     items=items, 
-                    is_front_door_open=is_front_door_open)
+                    is_front_door_open=is_front_door_open,
+                    fridges=fridges,
+                    fridge_id=fridge_id)
         else:
             logger.error(f"Lambda function error: {response}")
             flash('Error fetching inventory data', 'error')
@@ -89,12 +104,156 @@ def inventory():
 
     return render_template('inventory.html', 
             user_role=get_user_role(cognito_client, session['access_token'], lambda_client, session['username']), 
-            items=[])
+            items=[],
+            fridges=fridges,
+            fridge_id=fridge_id)
+
+
+@inventory_route.route('/inventory/stock')
+def inventory_stock():
+    """
+    Stock of each item summed over all of the restaurant's fridges, with the quantity in each fridge.
+    """
+    restaurant_name = get_restaurant_id(cognito_client, session['access_token'])
+    stock = get_all_fridges_stock(lambda_client, fridge_mgr_lambda, restaurant_name)
+    if stock is None:
+        flash('Error fetching stock', 'error')
+        stock = {'fridges': [], 'items': []}
+
+    return render_template('inventory-stock.html',
+            user_role=get_user_role(cognito_client, session['access_token'], lambda_client, session['username']),
+            fridges=stock['fridges'],
+            items=stock['items'])
+
+
+@inventory_route.route('/inventory/fridges', methods=['POST'])
+def add_fridge():
+    """
+    Adds a fridge to the restaurant, admins only.
+    """
+    if get_user_role(cognito_client, session['access_token'], lambda_client, session['username']) != 'Admin':
+        flash('Only admins can add fridges', 'error')
+        return redirect(url_for('inventory.inventory'))
+
+    fridge_name = (request.form.get('fridge_name') or '').strip()
+    if not fridge_name:
+        flash('Fridge name must be specified', 'error')
+        return redirect(url_for('inventory.inventory'))
+
+    fridge_id = get_fridge_id_for_name(fridge_name)
+    if not fridge_id:
+        flash('Fridge name must contain a letter or a digit', 'error')
+        return redirect(url_for('inventory.inventory'))
+
+    restaurant_name = get_restaurant_id(cognito_client, session['access_token'])
+    lambda_payload = {
+        "httpMethod": "POST",
+        "action": "add_fridge",
+        "body": {
+            "restaurant_name": restaurant_name,
+            "fridge_id": fridge_id,
+            "fridge_name": fridge_name
+        }
+    }
+
+    response = make_lambda_request(lambda_client, lambda_payload, fridge_mgr_lambda)
+    if response['statusCode'] != 201:
+        flash(f"Failed to add fridge: {response['body']['details']}", 'error')
+        return redirect(url_for('inventory.inventory'))
+
+    flash(f'{fridge_name} added', 'success')
+    return redirect(url_for('inventory.inventory', fridge_id=fridge_id))
+
+
+@inventory_route.route('/inventory/events')
+def inventory_events():
+    """
+    Server-sent event stream of item and door changes for the current restaurant.
+    """
+    restaurant_name = get_restaurant_id(cognito_client, session['access_token'])
+    events = event_broker.subscribe(restaurant_name)
+    if events is None:
+        return make_response('', 503)
+
+    return Response(event_broker.stream(restaurant_name, events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@inventory_route.route('/inventory/sensors')
+def inventory_sensors():
+    """
+    Hourly temperatures and door openings of one of the current restaurant's fridges over the last day.
+    """
+    restaurant_name = get_restaurant_id(cognito_client, session['access_token'])
+    end = int(time.time())
+    buckets = get_sensor_summary(lambda_client, fridge_mgr_lambda, restaurant_name, end - 86400, end, 3600,
+                                 get_fridge_id())
+    if buckets is None:
+        return jsonify({'success': False, 'message': 'Error fetching sensor readings'}), 502
+
+    return jsonify({'success': True, 'buckets': buckets})
+
+
+@inventory_route.route('/inventory/expiring')
+def inventory_expiring():
+    """
+    Stock that has expired, or will expire in the next 3 days, in one of the current restaurant's fridges.
+    """
+    restaurant_name = get_restaurant_id(cognito_client, session['access_token'])
+    expiring = get_expiring(lambda_client, fridge_mgr_lambda, restaurant_name, 3, get_fridge_id())
+    if expiring is None:
+        return jsonify({'success': False, 'message': 'Error fetching expiring items'}), 502
+
+    return jsonify({'success': True, **expiring})
+
+
+def wants_json():
+    """
+    Inventory actions reply with JSON to the inventory page's scripts, and flash and redirect for plain form posts.
+    """
+    return request.accept_mimetypes.best == 'application/json'
+
+
+def inventory_action_response(restaurant_name, response, success_message, failure_message, item_name=None,
+                              status_messages=None):
+    """
+    Publishes a successful change to open inventory pages, then replies with just the changed item or door state as
+    JSON, or flashes a message and redirects back to the inventory.
+    :param restaurant_name: Current user's restaurant.
+    :param response: fridge_mgr response, or None if the request could not be made.
+    :param success_message: Message shown on success.
+    :param failure_message: Message shown on failure, followed by fridge_mgr's details when there are any.
+    :param item_name: Name of the item changed.
+    :param status_messages: (message, category) to show instead of failure_message for specific status codes.
+    :return: Flask response.
+    """
+    status_code = response['statusCode'] if response else 500
+    data = {'success': status_code == 200}
+
+    if status_code == 200:
+        message, category = success_message, 'success'
+        data.update(publish_fridge_change(restaurant_name, response, item_name, get_fridge_id()))
+    elif status_messages and status_code in status_messages:
+        message, category = status_messages[status_code]
+    elif response:
+        message, category = f"{failure_message}: {response['body']['details']}", 'error'
+    else:
+        message, category = failure_message, 'error'
+
+    if wants_json():
+        data.update(message=message, category=category)
+        return jsonify(data), status_code
+
+    if category != 'success' or success_message:
+        flash(message, category)
+    return redirect(inventory_url())
 
 
 @inventory_route.route('/delete-item', methods=['POST'])
 def delete_item():
     item_name = request.form.get('item_name')
+    restaurant_name = None
+    response = None
 
     try:
         expiry_date = int(request.form.get('expiry_date'))
@@ -106,6 +265,7 @@ def delete_item():
             "action": "delete_item",
             "body": {
                 "restaurant_name": restaurant_name,
+                "fridge_id": get_fridge_id(),
                 "item_name": item_name,
                 "current_quantity": current_quantity,
                 "expiry_date": expiry_date
@@ -113,16 +273,13 @@ def delete_item():
         }
 
         response = make_lambda_request(lambda_client, lambda_payload, fridge_mgr_lambda)
-        if response['statusCode'] == 200:
-            flash('Item deleted successfully!', 'success')
-        else:
-            flash(f"Failed to delete item: {response['body']['details']}", 'error')
 
     except Exception as e:
         logger.error(f"An error occurred: {str(e)}")
-        flash('Error deleting item', 'error')
+        response = None
 
-    return redirect(url_for('inventory.inventory'))
+    return inventory_action_response(restaurant_name, response, 'Item deleted successfully!',
+                                     'Failed to delete item' if response else 'Error deleting item', item_name)
 
 
 @inventory_route.route('/update-item', methods=['POST'])
@@ -139,6 +296,7 @@ def update_item():
             "action": "update_item_quantity",
             "body": {
                 "restaurant_name": restaurant_name,
+                "fridge_id": get_fridge_id(),
                 "item_name": item_name,
                 "quantity_change": quantity_change,
                 "expiry_date": expiry_date,
@@ -148,16 +306,95 @@ def update_item():
 
         response = make_lambda_request(lambda_client, lambda_payload, fridge_mgr_lambda)
 
-        if response['statusCode'] == 200:
-            flash('Item updated successfully!', 'success')
-        else:
-            flash(f"Failed to update item: {response['body']['details']}", 'error')
+    except Exception as e:
+        logger.error(f"An error occurred: {str(e)}")
+        response = None
+
+    return inventory_action_response(restaurant_name, response, 'Item updated successfully!',
+                                     'Failed to update item' if response else 'Error updating item', item_name)
+
+
+@inventory_route.route('/consume-item', methods=['POST'])
+def consume_item():
+    item_name = request.form.get('item_name')
+    restaurant_name = None
+    response = None
+
+    try:
+        quantity = int(request.form.get('quantity'))
+        if quantity < 1:
+            return invalid_inputs_response('Quantity used must be greater than 0')
+
+        restaurant_name = get_restaurant_id(cognito_client, session['access_token'])
+
+        lambda_payload = {
+            "httpMethod": "POST",
+            "action": "consume_item",
+            "body": {
+                "restaurant_name": restaurant_name,
+                "fridge_id": get_fridge_id(),
+                "item_name": item_name,
+                "quantity": quantity
+            }
+        }
+
+        response = make_lambda_request(lambda_client, lambda_payload, fridge_mgr_lambda)
 
     except Exception as e:
         logger.error(f"An error occurred: {str(e)}")
-        flash('Error updating item', 'error')
+        response = None
+
+    return inventory_action_response(restaurant_name, response, 'Item used successfully!',
+                                     'Failed to use item' if response else 'Error using item', item_name)
+
+
+@inventory_route.route('/inventory/import-consumption', methods=['POST'])
+def import_consumption():
+    """
+    Takes a point-of-sale export of item_name, quantity, timestamp records, as CSV or NDJSON, out of the inventory.
+    Records are totalled per item while the upload is read, then applied with one fridge_mgr call per 500 items.
+    """
+    upload = request.files.get('consumption_file')
+    if not upload or not upload.filename:
+        return invalid_inputs_response('A CSV or NDJSON file of sales must be uploaded')
+
+    try:
+        consumption = read_consumption(upload.stream)
+        if not consumption.totals:
+            return invalid_inputs_response('No valid sales records found. ' + ' '.join(consumption.errors[:3]))
+
+        restaurant_name = get_restaurant_id(cognito_client, session['access_token'])
+        result = apply_consumption(lambda_client, fridge_mgr_lambda, restaurant_name, consumption, get_fridge_id())
 
-    return redirect(url_for('inventory.inventory'))
+    except Exception as e:
+        logger.error(f"An error occurred: {str(e)}")
+        if wants_json():
+            return jsonify({'success': False, 'message': 'Error importing sales', 'category': 'error'}), 500
+        flash('Error importing sales', 'error')
+        return redirect(inventory_url())
+
+    # every item may have changed, so open pages reload rather than patching cards one by one
+    event_broker.publish(restaurant_name, 'refresh', {'fridge_id': get_fridge_id()})
+
+    short = sorted(item_name for item_name, counts in result['items'].items() if counts['shortfall'])
+    message = f"Imported {consumption.records} sales records for {len(result['items'])} items."
+    if short:
+        message += f" Not enough stock of: {', '.join(short)}."
+    if result['not_found']:
+        message += f" Not in the inventory: {', '.join(result['not_found'])}."
+    if result['unapplied']:
+        message += f" Not taken as the inventory kept changing: {', '.join(result['unapplied'])}."
+    if consumption.rejected:
+        message += f" {consumption.rejected} invalid records skipped."
+    category = 'success' if not (short or result['not_found'] or result['unapplied'] or consumption.rejected) \
+        else 'warning'
+
+    if wants_json():
+        return jsonify({'success': True, 'message': message, 'category': category, 'records': consumption.records,
+                        'rejected': consumption.rejected, 'errors': consumption.errors, **result})
+
+    flash(message, category)
+    return redirect(inventory_url())
 
 
 @inventory_route.route('/update-desired-quantity', methods=['POST'])
@@ -166,8 +403,9 @@ def update_desired_quantity():
     desired_quantity = int(request.form.get('desired_quantity'))
     logger.info(f"Received update desired quantity request for item: {item_name}, Desired Quantity: {desired_quantity}")
 
-    if not validate_inputs(item_name, desired_quantity):
-        return redirect(url_for('inventory.inventory'))
+    input_error = validate_inputs(item_name, desired_quantity)
+    if input_error:
+        return invalid_inputs_response(input_error)
 
     restaurant_name = get_restaurant_id(cognito_client, session['access_token'])
     try:
@@ -176,6 +414,7 @@ def update_desired_quantity():
             "action": "update_desired_quantity",
             "body": {
                 "restaurant_name": restaurant_name,
+                "fridge_id": get_fridge_id(),
                 "item_name": item_name,
                 "desired_quantity": desired_quantity
             }
@@ -186,16 +425,13 @@ def update_desired_quantity():
         response = make_lambda_request(lambda_client, lambda_payload, fridge_mgr_lambda)
         logger.info(f"Lambda response: {response}")
 
-        if response['statusCode'] == 200:
-            flash('Desired quantity updated successfully!', 'success')
-        else:
-            flash(f"Failed to update desired quantity: {response['body']['details']}", 'error')
-
     except Exception as e:
         logger.error(f"An error occurred: {str(e)}")
-        flash('Error updating desired quantity', 'error')
+        response = None
 
-    return redirect(url_for('inventory.inventory'))
+    return inventory_action_response(restaurant_name, response, 'Desired quantity updated successfully!',
+                                     'Failed to update desired quantity' if response
+                                     else 'Error updating desired quantity', item_name)
 
 
 @inventory_route.route('/add-item', methods=['POST'])
@@ -204,8 +440,9 @@ def add_item():
     expiry_date_str = datetime.now().strftime('%Y-%m-%d')
     desired_quantity = int(request.form.get('add_desired_quantity'))
 
-    if not validate_inputs(item_name, desired_quantity):
-        return redirect(url_for('inventory.inventory'))
+    input_error = validate_inputs(item_name, desired_quantity)
+    if input_error:
+        return invalid_inputs_response(input_error)
 
     restaurant_name = get_restaurant_id(cognito_client, session['access_token'])
 
@@ -217,6 +454,7 @@ def add_item():
             "action": "add_new_item",
             "body": {
                 "restaurant_name": restaurant_name,
+                "fridge_id": get_fridge_id(),
                 "item_name": item_name,
                 "expiry_date": expiry_date,
                 "desired_quantity": desired_quantity
@@ -224,18 +462,15 @@ def add_item():
         }
 
         response = make_lambda_request(lambda_client, lambda_payload, fridge_mgr_lambda)
-        if response['statusCode'] == 200:
-            flash('Item added successfully! Your item will show in the next order.', 'success')
-        elif response['statusCode'] == 409:
-            flash('Item already exists', 'warning')
-        else:
-            flash(f"Failed to add item: {response['body']['details']}", 'error')
 
     except Exception as e:
         logger.error(f"An error occurred: {str(e)}")
-        flash('Error adding item', 'error')
+        response = None
 
-    return redirect(url_for('inventory.inventory'))
+    return inventory_action_response(restaurant_name, response,
+                                     'Item added successfully! Your item will show in the next order.',
+                                     'Failed to add item' if response else 'Error adding item', item_name,
+                                     {409: ('Item already exists', 'warning')})
 
 
 @inventory_route.route('/open_door', methods=['POST'])
@@ -246,14 +481,13 @@ def open_door():
         "httpMethod": "POST",
         "action": "open_front_door",
         "body": {
-            "restaurant_name": restaurant_name
+            "restaurant_name": restaurant_name,
+            "fridge_id": get_fridge_id()
         }
     }
 
     response = make_lambda_request(lambda_client, lambda_payload, fridge_mgr_lambda)
-    if response['statusCode'] != 200:
-        flash(f"Failed to open door: {response['body']['details']}", 'error')
-    return redirect(url_for('inventory.inventory'))
+    return inventory_action_response(restaurant_name, response, None, 'Failed to open door')
 
 
 @inventory_route.route('/close_door', methods=['POST'])
@@ -264,27 +498,37 @@ def close_door():
         "httpMethod": "POST",
         "action": "close_front_door",
         "body": {
-            "restaurant_name": restaurant_name
+            "restaurant_name": restaurant_name,
+            "fridge_id": get_fridge_id()
         }
     }
     response = make_lambda_request(lambda_client, lambda_payload, fridge_mgr_lambda)
-    print(response)
-    if response['statusCode'] != 200:
-        flash(f"Failed to close door: {response['body']['details']}", 'error')
-    return redirect(url_for('inventory.inventory'))
+    return inventory_action_response(restaurant_name, response, None, 'Failed to close door')
+
+
+def invalid_inputs_response(message):
+    """
+    Replies to a request that failed validate_inputs.
+    :param message: Reason the inputs are invalid.
+    """
+    if wants_json():
+        return jsonify({'success': False, 'message': message}), 400
+
+    flash(message, 'error')
+    return redirect(inventory_url())
 
 
 def validate_inputs(item_name, desired_quantity):
+    """
+    Checks an item name and desired quantity from a form.
+    :return: The reason the inputs are invalid, or None if they are valid.
+    """
     if not item_name or item_name == '':
-        flash('Item name must be specified', 'error')
-        return False
+        return 'Item name must be specified'
     if len(item_name) > 20:
-        flash('Item name must 20 characters or less', 'error')
-        return False
+        return 'Item name must 20 characters or less'
     if not desired_quantity:
-        flash('Desired quantity must be specified', 'error')
-        return False
+        return 'Desired quantity must be specified'
     if desired_quantity < 1:
-        flash('Desired quantity must be greater than 0', 'error')
-        return False
-    return True
\ No newline at end of file
+        return 'Desired quantity must be greater than 0'
+    return None
@@ -2,12 +2,13 @@ from flask import (
     Blueprint, 
     render_template,
     redirect,
+    request,
     url_for
 )
 
 from lib.utils import (
     get_user_role,
-    get_order_data, 
+    get_order_page,
     get_restaurant_id,
 )
 from lib.globals import (
@@ -20,6 +21,8 @@ from lib.globals import (
 
 orders_route = Blueprint('orders', __name__)
 
+ORDERS_PER_PAGE = 20
+
 @orders_route.before_request
 def before_request():
     if not session.get('access_token'):
@@ -31,9 +34,12 @@ def before_request():
 @orders_route.route('/orders')
 def orders():
     restaurant_name = get_restaurant_id(cognito_client, session['access_token'])
-    orders = get_order_data(lambda_client, order_mgr_lambda, restaurant_name)
+    cursor = request.args.get('cursor')
+    orders, next_cursor = get_order_page(lambda_client, order_mgr_lambda, restaurant_name, ORDERS_PER_PAGE, cursor)
     logger.info(orders)
 
     return render_template('orders.html',
             user_role=get_user_role(cognito_client, session['access_token'], lambda_client, session['username']), 
-            orders=orders)
\ No newline at end of file
+            orders=orders,
+            cursor=cursor,
+            next_cursor=next_cursor)
\ No newline at end of file
@@ -12,7 +12,7 @@ from lib.utils import (
     is_user_signed_in,
     create_user,
     make_lambda_request,
-    get_email_by_username,
+    get_emails_by_usernames,
     delete_user_by_username
 )
 from lib.globals import (
@@ -41,7 +41,8 @@ def register_restaurant():
             'httpMethod': 'POST',
             'action': 'create_new_restaurant_dynamodb_entries',
             'body': {
-                'restaurant_name': username
+                'restaurant_name': username,
+                'email': request.form.get('email', '')
             }
         }
 
@@ -118,6 +119,7 @@ def register_user():
                 'body': {
                     'restaurant_id': restaurant_id,
                     'username': username,
+                    'email': email,
                     'role': role
                 }
             }
@@ -184,7 +186,8 @@ def manage_users():
         "httpMethod": "GET",
         "action": "get_all_users",
         "body": {
-            "restaurant_id": session['username']
+            "restaurant_id": session['username'],
+            "fields": ['username', 'role', 'email']
         }
     })
 
@@ -193,9 +196,14 @@ def manage_users():
     users = []
 
     if response['statusCode'] == 200:
+        # users stored before emails were kept with them are looked up in one parallel batch
+        missing_emails = get_emails_by_usernames(cognito_client, user_pool_id,
+                                                 [user['username'] for user in response['body']['items']
+                                                  if not user.get('email')])
+
         users = [{
             'name': user['username'],
-            'email': get_email_by_username(cognito_client, user_pool_id, user['username']),
+            'email': user.get('email') or missing_emails.get(user['username']),
             'role': user['role']
         } for user in response['body']['items']]
 
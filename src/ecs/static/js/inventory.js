@@ -0,0 +1,171 @@
+// Submits inventory forms in the background and patches the changed item card in place, and applies changes made
+// elsewhere (other tabs, other users, deliveries) as they arrive on the inventory event stream. The stream carries
+// changes to every fridge of the restaurant, only those to the fridge on the page are applied.
+
+var inventoryScript = document.currentScript;
+
+function isDoorOpen() {
+    return document.getElementById('inventoryItems').querySelector('.table-card') !== null ||
+        document.getElementById('addItemSection') !== null;
+}
+
+function isThisFridge(change) {
+    return change.fridge_id === inventoryScript.dataset.fridgeId;
+}
+
+function applyItemChange(change) {
+    var container = document.getElementById('inventoryItems');
+    var card = container.querySelector('.table-card[data-item-name="' + CSS.escape(change.item_name) + '"]');
+
+    if (!isDoorOpen() || !isThisFridge(change)) {
+        return;
+    }
+
+    if (change.html === null) {
+        if (card) {
+            card.remove();
+        }
+        return;
+    }
+
+    var template = document.createElement('template');
+    template.innerHTML = change.html.trim();
+    var newCard = template.content.firstChild;
+
+    if (card) {
+        card.replaceWith(newCard);
+    } else {
+        container.appendChild(newCard);
+    }
+}
+
+function applyDoorChange(change) {
+    if (!isThisFridge(change) || change.is_front_door_open === isDoorOpen()) {
+        return;
+    }
+
+    if (change.is_front_door_open) {
+        // The page needs the whole inventory once the door opens
+        window.location.reload();
+        return;
+    }
+
+    document.querySelectorAll('#inventoryItems .table-card').forEach(card => card.remove());
+    var addItemSection = document.getElementById('addItemSection');
+    if (addItemSection) {
+        addItemSection.remove();
+    }
+
+    isFrontDoorOpen = "False";
+    var doorButton = document.getElementById('doorButton');
+    var doorForm = doorButton.form;
+    doorForm.action = doorForm.action.replace('close_door', 'open_door');
+    doorButton.textContent = 'Open Door';
+    doorButton.classList.replace('btn-danger', 'btn-success');
+}
+
+function submitInventoryForm(event) {
+    var form = event.target.closest('form[data-inventory-form]');
+    if (!form) {
+        return;
+    }
+
+    event.preventDefault();
+
+    fetch(form.action, {
+        method: 'POST',
+        headers: {'Accept': 'application/json'},
+        body: new FormData(form)
+    }).then(response => response.json())
+    .then(data => {
+        if (!data.success) {
+            sendFlashMessage(data.message, data.category).then(() => window.location.reload());
+            return;
+        }
+
+        if ('is_front_door_open' in data) {
+            applyDoorChange(data);
+        } else if ('item_name' in data) {
+            applyItemChange(data);
+            if (form.closest('#addItemSection')) {
+                form.reset();
+            }
+        }
+    }).catch(error => {
+        console.error('Error:', error);
+        window.location.reload();
+    });
+}
+
+function listenForInventoryChanges() {
+    var source = new EventSource(inventoryScript.dataset.eventsUrl);
+
+    source.addEventListener('item', event => applyItemChange(JSON.parse(event.data)));
+    source.addEventListener('door', event => applyDoorChange(JSON.parse(event.data)));
+    source.addEventListener('refresh', event => {
+        if (isDoorOpen() && isThisFridge(JSON.parse(event.data))) {
+            window.location.reload();
+        }
+    });
+    // Sent when changes were missed, the page is reloaded to catch up
+    source.addEventListener('resync', () => window.location.reload());
+    source.onerror = function() {
+        // The browser reconnects by itself unless the server refused the stream
+        if (source.readyState === EventSource.CLOSED) {
+            setTimeout(listenForInventoryChanges, 30000);
+        }
+    };
+}
+
+function showSensorSummary() {
+    fetch(inventoryScript.dataset.sensorsUrl, {headers: {'Accept': 'application/json'}})
+    .then(response => response.json())
+    .then(data => {
+        if (!data.success || data.buckets.length === 0) {
+            return;
+        }
+
+        var min = Infinity, max = -Infinity, opens = 0;
+        data.buckets.forEach(bucket => {
+            Object.values(bucket.temperature).forEach(stats => {
+                min = Math.min(min, stats.min);
+                max = Math.max(max, stats.max);
+            });
+            Object.values(bucket.door_opens).forEach(count => opens += count);
+        });
+
+        var summary = 'Last 24 hours: door opened ' + opens + ' times';
+        if (min !== Infinity) {
+            summary += ', temperature ' + min + '°C to ' + max + '°C';
+        }
+        document.getElementById('sensorSummary').textContent = summary;
+    }).catch(error => console.error('Error:', error));
+}
+
+function describeQuantities(quantities) {
+    return Object.entries(quantities).map(([name, quantity]) => name + ' (' + quantity + ')').join(', ');
+}
+
+function showExpiringSummary() {
+    fetch(inventoryScript.dataset.expiringUrl, {headers: {'Accept': 'application/json'}})
+    .then(response => response.json())
+    .then(data => {
+        if (!data.success) {
+            return;
+        }
+
+        var parts = [];
+        if (Object.keys(data.expired_quantities).length > 0) {
+            parts.push('Expired: ' + describeQuantities(data.expired_quantities));
+        }
+        if (Object.keys(data.expiring_quantities).length > 0) {
+            parts.push('Expiring in the next 3 days: ' + describeQuantities(data.expiring_quantities));
+        }
+        document.getElementById('expiringSummary').textContent = parts.join('. ');
+    }).catch(error => console.error('Error:', error));
+}
+
+document.addEventListener('submit', submitInventoryForm);
+listenForInventoryChanges();
+showSensorSummary();
+showExpiringSummary();
@@ -11,9 +11,10 @@
 let cognitoUser;
 let userPool;
 
-async function registerRestaurant(restaurantName) {
+async function registerRestaurant(restaurantName, email) {
     const formData = new FormData();
     formData.append('username', restaurantName);
+    formData.append('email', email);
 
     try {
         const response = await fetch('/register-restaurant', {
@@ -73,7 +74,7 @@ document.getElementById("register").addEventListener("click", async function ()
             let cognitoUser = result.user;
             sessionStorage.setItem('cognitoUser', JSON.stringify(cognitoUser));
 
-            await registerRestaurant(username);
+            await registerRestaurant(username, email);
         }
     });
 });
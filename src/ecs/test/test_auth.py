@@ -0,0 +1,130 @@
+import base64
+import json
+import os
+import tempfile
+import unittest
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+from lib.auth import TokenVerifier, ExpiringCache, verify_rs256
+
+REGION = 'eu-west-1'
+USER_POOL_ID = 'eu-west-1_example'
+CLIENT_ID = 'example-client'
+ISSUER = f'https://cognito-idp.{REGION}.amazonaws.com/{USER_POOL_ID}'
+NOW = 1700000000
+
+
+def base64url_encode(value):
+    return base64.urlsafe_b64encode(value).rstrip(b'=').decode('ascii')
+
+
+def int_to_base64url(value):
+    return base64url_encode(value.to_bytes((value.bit_length() + 7) // 8, 'big'))
+
+
+def sign_token(private_key, kid, claims):
+    header_segment = base64url_encode(json.dumps({'alg': 'RS256', 'kid': kid}).encode())
+    payload_segment = base64url_encode(json.dumps(claims).encode())
+    signature = private_key.sign(f'{header_segment}.{payload_segment}'.encode(), padding.PKCS1v15(), hashes.SHA256())
+    return f'{header_segment}.{payload_segment}.{base64url_encode(signature)}'
+
+
+# Tests tokens are verified against a JWKS the way Cognito signs them
+class TestTokenVerifier(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        cls.other_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    def setUp(self):
+        public_numbers = self.private_key.public_key().public_numbers()
+        jwks = {'keys': [{'kty': 'RSA', 'kid': 'key-1', 'alg': 'RS256', 'use': 'sig',
+                          'n': int_to_base64url(public_numbers.n), 'e': int_to_base64url(public_numbers.e)}]}
+        jwks_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        json.dump(jwks, jwks_file)
+        jwks_file.close()
+        self.addCleanup(os.remove, jwks_file.name)
+
+        self.verifier = TokenVerifier(REGION, USER_POOL_ID, CLIENT_ID, jwks_file=jwks_file.name, clock=lambda: NOW)
+        self.claims = {'sub': 'user-1', 'iss': ISSUER, 'client_id': CLIENT_ID, 'token_use': 'access',
+                       'exp': NOW + 3600, 'username': 'chef'}
+
+    def test_valid_token(self):
+        token = sign_token(self.private_key, 'key-1', self.claims)
+
+        self.assertEqual(self.verifier.verify(token), self.claims)
+
+    def test_tampered_payload(self):
+        header_segment, _, signature_segment = sign_token(self.private_key, 'key-1', self.claims).split('.')
+        payload_segment = base64url_encode(json.dumps({**self.claims, 'username': 'admin'}).encode())
+
+        self.assertIsNone(self.verifier.verify(f'{header_segment}.{payload_segment}.{signature_segment}'))
+
+    def test_signed_with_another_key(self):
+        token = sign_token(self.other_key, 'key-1', self.claims)
+
+        self.assertIsNone(self.verifier.verify(token))
+
+    def test_unknown_kid(self):
+        token = sign_token(self.private_key, 'key-2', self.claims)
+
+        self.assertIsNone(self.verifier.verify(token))
+
+    def test_expired(self):
+        token = sign_token(self.private_key, 'key-1', {**self.claims, 'exp': NOW})
+
+        self.assertIsNone(self.verifier.verify(token))
+
+    def test_wrong_audience(self):
+        token = sign_token(self.private_key, 'key-1', {**self.claims, 'client_id': 'another-client'})
+
+        self.assertIsNone(self.verifier.verify(token))
+
+    def test_wrong_issuer_or_token_use(self):
+        self.assertIsNone(self.verifier.verify(
+            sign_token(self.private_key, 'key-1', {**self.claims, 'iss': 'https://example.com'})))
+        self.assertIsNone(self.verifier.verify(
+            sign_token(self.private_key, 'key-1', {**self.claims, 'token_use': 'id'})))
+
+    def test_malformed_token(self):
+        self.assertIsNone(self.verifier.verify('not-a-token'))
+        self.assertIsNone(self.verifier.verify(None))
+
+    def test_verify_rs256_rejects_wrong_length_signature(self):
+        public_numbers = self.private_key.public_key().public_numbers()
+        signature = self.private_key.sign(b'message', padding.PKCS1v15(), hashes.SHA256())
+
+        self.assertTrue(verify_rs256(b'message', signature, public_numbers.n, public_numbers.e))
+        self.assertFalse(verify_rs256(b'message', signature[1:], public_numbers.n, public_numbers.e))
+
+
+# Tests the cache entries are dropped once they expire or the cache is full
+class TestExpiringCache(unittest.TestCase):
+
+    def test_entries_expire(self):
+        now = [0]
+        cache = ExpiringCache(max_size=10, ttl=60, clock=lambda: now[0])
+        cache.put('user-1', 'restaurant')
+
+        now[0] = 59
+        self.assertEqual(cache.get('user-1'), 'restaurant')
+        now[0] = 60
+        self.assertIsNone(cache.get('user-1'))
+
+    def test_least_recently_used_dropped(self):
+        cache = ExpiringCache(max_size=2, ttl=60)
+        cache.put('user-1', 'a')
+        cache.put('user-2', 'b')
+        cache.get('user-1')
+        cache.put('user-3', 'c')
+
+        self.assertEqual(cache.get('user-1'), 'a')
+        self.assertIsNone(cache.get('user-2'))
+        self.assertEqual(len(cache.entries), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
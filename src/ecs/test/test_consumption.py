@@ -0,0 +1,59 @@
+import io
+import unittest
+from unittest.mock import patch
+
+from lib.consumption import read_consumption, apply_consumption
+
+SALES = b'item_name,quantity,timestamp\nmilk,2,7300\nmilk,1,3700\nMilk,1,7199\neggs,6,3600\n'
+
+
+def consumed(items):
+    return {'statusCode': 200, 'body': {'additional_details': {
+        'items': {item['item_name']: {'consumed': item['quantity'], 'shortfall': 0} for item in items},
+        'not_found': [], 'unapplied': []}}}
+
+
+# Tests sales are sent grouped by the hour they were sold in, under keys that stay the same for the same file
+class TestApplyConsumption(unittest.TestCase):
+
+    def test_sales_grouped_by_hour(self):
+        consumption = read_consumption(io.BytesIO(SALES))
+
+        self.assertEqual(consumption.totals, {'milk': 4, 'eggs': 6})
+        self.assertEqual(consumption.batches(), [[
+            {'item_name': 'eggs', 'quantity': 6, 'consumed_at': 3600},
+            {'item_name': 'milk', 'quantity': 2, 'consumed_at': 3600},
+            {'item_name': 'milk', 'quantity': 2, 'consumed_at': 7200}
+        ]])
+
+    @patch('lib.consumption.make_lambda_request')
+    def test_same_file_gets_same_keys(self, mock_make_lambda_request):
+        mock_make_lambda_request.side_effect = lambda client, payload, name: consumed(payload['body']['items'])
+
+        apply_consumption(None, 'fridge_mgr', 'restaurant', read_consumption(io.BytesIO(SALES)))
+        apply_consumption(None, 'fridge_mgr', 'restaurant', read_consumption(io.BytesIO(SALES)))
+        apply_consumption(None, 'fridge_mgr', 'restaurant', read_consumption(io.BytesIO(SALES + b'ham,1,3600\n')))
+
+        keys = [entry.args[1]['body']['idempotency_key'] for entry in mock_make_lambda_request.call_args_list]
+        self.assertEqual(keys[0], keys[1])
+        self.assertNotEqual(keys[0], keys[2])
+        self.assertTrue(keys[0].startswith('consume_items#main#') and keys[0].endswith('#0#0'))
+
+    @patch('lib.consumption.make_lambda_request')
+    def test_unapplied_items_sent_again(self, mock_make_lambda_request):
+        first = consumed([{'item_name': 'milk', 'quantity': 4}])
+        first['body']['additional_details']['unapplied'] = ['eggs']
+        mock_make_lambda_request.side_effect = [first, consumed([{'item_name': 'eggs', 'quantity': 6}])]
+
+        result = apply_consumption(None, 'fridge_mgr', 'restaurant', read_consumption(io.BytesIO(SALES)))
+
+        self.assertEqual(result['items'], {'milk': {'consumed': 4, 'shortfall': 0},
+                                           'eggs': {'consumed': 6, 'shortfall': 0}})
+        self.assertEqual(result['unapplied'], [])
+        retry = mock_make_lambda_request.call_args_list[1].args[1]['body']
+        self.assertEqual(retry['items'], [{'item_name': 'eggs', 'quantity': 6, 'consumed_at': 3600}])
+        self.assertTrue(retry['idempotency_key'].endswith('#0#1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import queue
+import unittest
+
+from lib.events import EventBroker
+
+
+class FakeEventStore:
+
+    def __init__(self, max_events=20):
+        self.max_events = max_events
+        self.events = {}
+
+    def append(self, restaurant_id, event_id, message):
+        events = self.events.setdefault(restaurant_id, [])
+        events.append({'id': event_id, 'message': message})
+        del events[:-self.max_events]
+
+    def read(self, restaurant_id):
+        return list(self.events.get(restaurant_id, []))
+
+
+def drain(events):
+    messages = []
+    while True:
+        try:
+            messages.append(events.get_nowait())
+        except queue.Empty:
+            return messages
+
+
+# Tests events published by one worker reach the streams open in another
+class TestSharedEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.store = FakeEventStore(max_events=3)
+        # the poller threads are not started, the tests poll by hand
+        self.publisher = EventBroker(store=self.store)
+        self.subscriber = EventBroker(store=self.store)
+        self.subscriber.poller = self.publisher.poller = 'not started'
+        self.events = self.subscriber.subscribe('restaurant')
+
+    def test_event_from_other_worker_delivered(self):
+        self.subscriber.poll_restaurant('restaurant')
+        self.publisher.publish('restaurant', 'door', {'fridge_id': 'fridge-1'})
+        self.subscriber.poll_restaurant('restaurant')
+
+        messages = drain(self.events)
+        self.assertEqual(len(messages), 1)
+        self.assertIn('event: door', messages[0])
+
+        # nothing new, nothing sent again
+        self.subscriber.poll_restaurant('restaurant')
+        self.assertEqual(drain(self.events), [])
+
+    def test_own_events_not_delivered_twice(self):
+        self.subscriber.poll_restaurant('restaurant')
+        self.subscriber.publish('restaurant', 'item', {'item_name': 'milk'})
+        self.subscriber.poll_restaurant('restaurant')
+
+        self.assertEqual(len(drain(self.events)), 1)
+
+    def test_events_before_first_poll_skipped(self):
+        self.publisher.publish('restaurant', 'door', {'fridge_id': 'fridge-1'})
+        self.subscriber.poll_restaurant('restaurant')
+
+        self.assertEqual(drain(self.events), [])
+
+    def test_missed_events_resync(self):
+        self.publisher.publish('restaurant', 'door', {'fridge_id': 'fridge-1'})
+        self.subscriber.poll_restaurant('restaurant')
+        for _ in range(4):
+            self.publisher.publish('restaurant', 'door', {'fridge_id': 'fridge-1'})
+        self.subscriber.poll_restaurant('restaurant')
+
+        messages = drain(self.events)
+        self.assertEqual(len(messages), 1)
+        self.assertIn('event: resync', messages[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+import unittest
+
+from lib.utils import get_fridge_id_for_name
+
+
+# Tests fridge ids made from fridge names are ones fridge_mgr accepts
+class TestFridgeIdForName(unittest.TestCase):
+
+    def test_spaces_become_hyphens(self):
+        self.assertEqual(get_fridge_id_for_name('Bar Fridge'), 'bar-fridge')
+
+    def test_other_characters_replaced(self):
+        self.assertEqual(get_fridge_id_for_name("  Chef's #2 / Walk-in!  "), 'chef-s-2-walk-in')
+        self.assertEqual(get_fridge_id_for_name('Café fridge'), 'caf-fridge')
+
+    def test_truncated(self):
+        fridge_id = get_fridge_id_for_name('The very long name of the fridge in the back kitchen')
+
+        self.assertEqual(fridge_id, 'the-very-long-name-of-the-fridge')
+        self.assertEqual(get_fridge_id_for_name('a' * 31 + ' b'), 'a' * 31)
+
+    def test_no_letters_or_digits(self):
+        self.assertEqual(get_fridge_id_for_name('!!!'), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+"""
+Size and CPU benchmark for storing restaurant documents as DynamoDB maps or as compressed binary documents.
+
+Builds a fridge, orders and tokens item of the given size and, for each DOCUMENT_ENCODING, reports the item size and
+the read and write capacity units one strongly consistent get_item and one put_item of it consume, and the CPU time
+spent encoding and serialising it for a write and deserialising and decoding it after a read. Sizes follow DynamoDB's
+item size rules, the same way the service bills them, so no table is needed.
+
+Run from the repository root:
+    python -m src.fridge_mgr.benchmarks.document_benchmark
+    python -m src.fridge_mgr.benchmarks.document_benchmark --items 200 --batches 10 --orders 100
+"""
+import argparse
+import base64
+import json
+import math
+import random
+import time
+from decimal import Decimal
+
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer, Binary
+
+from src.fridge_mgr.src import documents
+
+RESTAURANT = 'bench'
+
+
+def generate_documents(item_count, batch_count, order_count, token_count):
+    now = int(time.time())
+    names = [f'ingredient {index}' for index in range(item_count)]
+
+    items = []
+    for name in names:
+        batches = [{'expiry_date': now + random.randint(-86400, 30 * 86400), 'date_added': now - random.randint(0, 86400),
+                    'current_quantity': random.randint(1, 20), 'date_removed': 0} for _ in range(batch_count)]
+        items.append({'item_name': name, 'desired_quantity': 10, 'item_list': batches,
+                      'total_quantity': sum(batch['current_quantity'] for batch in batches),
+                      'non_expired_quantity': 0, 'next_expiry': now + 86400})
+    fridge = {'pk': RESTAURANT, 'type': 'fridge', 'version': 1, 'items': items,
+              'expiry_index': sorted([batch['expiry_date'], item['item_name'], batch['date_added'],
+                                      batch['current_quantity']]
+                                     for item in items for batch in item['item_list'])}
+
+    orders = {'pk': RESTAURANT, 'type': 'orders', 'orders': [
+        {'id': str(random.getrandbits(64)), 'date_ordered': now, 'delivery_date': now + 86400,
+         'items': [{'item_name': name, 'quantity': random.randint(1, 10)} for name in random.sample(names, 10)]}
+        for _ in range(order_count)
+    ]}
+
+    tokens = {'pk': RESTAURANT, 'type': 'tokens', 'tokens': [
+        {'token': str(random.getrandbits(64)), 'expiry_date': now + 259200, 'id_type': 'order',
+         'object_id': str(random.getrandbits(64))}
+        for _ in range(token_count)
+    ]}
+
+    return [fridge, orders, tokens]
+
+
+def attribute_size(value):
+    """
+    Gets the size of a serialised attribute value by DynamoDB's item size rules.
+    :param value: Value as serialised by TypeSerializer.
+    :return: Size in bytes.
+    """
+    (kind, data), = value.items()
+    if kind == 'S':
+        return len(data.encode('utf-8'))
+    if kind == 'N':
+        digits = len(data.lstrip('-').replace('.', '').strip('0')) or 1
+        return math.ceil(digits / 2) + 1
+    if kind == 'B':
+        return len(bytes(data))
+    if kind in ('BOOL', 'NULL'):
+        return 1
+    if kind == 'L':
+        return 3 + sum(attribute_size(element) + 1 for element in data)
+    return 3 + sum(len(name.encode('utf-8')) + attribute_size(element) + 1 for name, element in data.items())
+
+
+def to_wire(value):
+    if isinstance(value, (bytes, Binary)):
+        return base64.b64encode(bytes(value)).decode('ascii')
+    raise TypeError(type(value).__name__)
+
+
+def from_wire(item):
+    if documents.DOCUMENT_ATTRIBUTE in item:
+        item[documents.DOCUMENT_ATTRIBUTE] = {'B': base64.b64decode(item[documents.DOCUMENT_ATTRIBUTE]['B'])}
+    return item
+
+
+def measure(document, repeats):
+    serializer = TypeSerializer()
+    deserializer = TypeDeserializer()
+
+    started = time.process_time()
+    for _ in range(repeats):
+        stored = {key: serializer.serialize(value) for key, value in documents.encode_document(document).items()}
+        wire = json.dumps(stored, default=to_wire)
+    write_seconds = (time.process_time() - started) / repeats
+
+    started = time.process_time()
+    for _ in range(repeats):
+        read = from_wire(json.loads(wire))
+        decoded = documents.decode_document({key: deserializer.deserialize(value) for key, value in read.items()})
+    read_seconds = (time.process_time() - started) / repeats
+
+    assert decoded == document
+    size = sum(len(name.encode('utf-8')) + attribute_size(value) for name, value in stored.items())
+    return {'bytes': size, 'wire': len(wire), 'rcu': math.ceil(size / 4096), 'wcu': math.ceil(size / 1024),
+            'write_ms': write_seconds * 1000, 'read_ms': read_seconds * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--batches', type=int, default=5)
+    parser.add_argument('--orders', type=int, default=50)
+    parser.add_argument('--tokens', type=int, default=50)
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    generated = generate_documents(args.items, args.batches, args.orders, args.tokens)
+    # both encodings are compared on values as they come back from DynamoDB
+    generated = [json.loads(json.dumps(document), parse_float=Decimal, parse_int=Decimal) for document in generated]
+
+    print(f'{args.items} items of {args.batches} batches, {args.orders} orders, {args.tokens} tokens')
+    print(f"{'document':<8} {'encoding':<8} {'bytes':>9} {'wire':>9} {'RCU':>5} {'WCU':>5} {'write ms':>9} "
+          f"{'read ms':>9}")
+    for document in generated:
+        for encoding in ['map', 'zlib']:
+            documents.DOCUMENT_ENCODING = encoding
+            result = measure(document, args.repeats)
+            print(f"{document['type']:<8} {encoding:<8} {result['bytes']:>9} {result['wire']:>9} {result['rcu']:>5} "
+                  f"{result['wcu']:>5} {result['write_ms']:>9.2f} {result['read_ms']:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
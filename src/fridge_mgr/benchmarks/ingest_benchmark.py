@@ -0,0 +1,99 @@
+"""
+Throughput benchmark for sensor event ingestion against an in-memory DynamoDB (moto).
+
+Compares storing each event with its own put_item, as one door action call per event did, with the batched
+ingest_sensor_events action, and reports events/sec for each. A --duplicate-ratio share of each batch repeats an
+earlier event, as a fridge resending after a dropped connection would.
+
+Run from the repository root:
+    python -m src.fridge_mgr.benchmarks.ingest_benchmark
+    python -m src.fridge_mgr.benchmarks.ingest_benchmark --events 20000 --batch-size 500
+"""
+import argparse
+import os
+import random
+import time
+
+import boto3
+from moto import mock_dynamodb
+
+from src.fridge_mgr.src.sensor_events import ingest_sensor_events, get_sensor_summary, parse_sensor_event
+
+RESTAURANT = 'bench'
+
+
+def create_table():
+    dynamodb = boto3.resource('dynamodb', region_name='eu-west-2')
+    table = dynamodb.create_table(
+        TableName='bench-table',
+        KeySchema=[{'AttributeName': 'pk', 'KeyType': 'HASH'}, {'AttributeName': 'type', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': 'pk', 'AttributeType': 'S'},
+                              {'AttributeName': 'type', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    table.put_item(Item={'pk': RESTAURANT, 'type': 'door_state', 'is_front_door_open': False,
+                         'is_back_door_open': False, 'last_changed': 0})
+    return table
+
+
+def generate_events(count, start, duplicate_ratio):
+    events = []
+    for index in range(count):
+        if events and random.random() < duplicate_ratio:
+            events.append(dict(random.choice(events)))
+        elif index % 10 == 0:
+            events.append({'sensor_id': 'door-1', 'event_type': 'door', 'timestamp': start + index,
+                           'door': random.choice(['front', 'back']), 'is_open': index % 20 == 0})
+        else:
+            events.append({'sensor_id': f'temp-{index % 3}', 'event_type': 'temperature', 'timestamp': start + index,
+                           'value': round(random.uniform(2, 6), 1)})
+    return events
+
+
+def run_single(table, events):
+    started = time.perf_counter()
+    for event in map(parse_sensor_event, events):
+        table.put_item(Item={'pk': f'{RESTAURANT}#single', 'type': f"{event['timestamp']:012d}#{event['sensor_id']}",
+                             **event})
+    return time.perf_counter() - started
+
+
+def run_batched(table, events, batch_size):
+    started = time.perf_counter()
+    for offset in range(0, len(events), batch_size):
+        response = ingest_sensor_events(table, RESTAURANT, {'events': events[offset:offset + batch_size]})
+        assert response['statusCode'] == 200, response
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=5000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.05)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+
+    start = int(time.time()) - args.events
+    events = generate_events(args.events, start, args.duplicate_ratio)
+
+    with mock_dynamodb():
+        table = create_table()
+        single_seconds = run_single(table, events)
+        batched_seconds = run_batched(table, events, args.batch_size)
+
+        started = time.perf_counter()
+        summary = get_sensor_summary(table, RESTAURANT, {'start': start, 'end': start + args.events})
+        summary_seconds = time.perf_counter() - started
+
+    print(f'{len(events)} events, batches of {args.batch_size}')
+    print(f'put_item per event: {len(events) / single_seconds:10.0f} events/s')
+    print(f'ingest_sensor_events: {len(events) / batched_seconds:8.0f} events/s')
+    print(f"summary of {len(summary['body']['additional_details']['buckets'])} hourly buckets in "
+          f'{summary_seconds * 1000:.0f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+Synthetic hot-tenant benchmark for write sharding the fridge, against an in-memory DynamoDB (moto).
+
+One restaurant gets a stream of deliveries and consumptions spread over its items, first with its fridge in one item
+and then spread over --shards shards with set_write_shards. moto has no partition limits, so for each run the
+benchmark reports the write units each operation puts on the hottest fridge partition, and from that the sustained
+writes/sec the restaurant can reach before the hottest partition hits DynamoDB's limit of 1000 WCU/s. It also reports
+how many of --concurrency simultaneous requests would conflict on the same fridge item and have to retry.
+
+Run from the repository root:
+    python -m src.fridge_mgr.benchmarks.shard_benchmark
+    python -m src.fridge_mgr.benchmarks.shard_benchmark --items 300 --writes 2000 --shards 8
+"""
+import argparse
+import math
+import os
+import random
+import time
+from collections import Counter
+
+import boto3
+from boto3.dynamodb.types import TypeSerializer
+from moto import mock_dynamodb
+
+from src.fridge_mgr.benchmarks.document_benchmark import attribute_size
+from src.fridge_mgr.src import inventory_utils
+from src.fridge_mgr.src.inventory_utils import (add_new_item, add_delivery_item, consume_item, set_write_shards,
+                                                get_shard, get_shard_key)
+
+RESTAURANT = 'bench'
+PARTITION_WCU_PER_SECOND = 1000
+
+
+class CountingTable:
+    """
+    Passes calls through to a table, adding up the write units of every fridge item written per partition key.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.serializer = TypeSerializer()
+        self.partition_wcu = Counter()
+
+    def __getattr__(self, name):
+        return getattr(self.table, name)
+
+    def put_item(self, Item, **kwargs):
+        if Item.get('type') == 'fridge':
+            size = sum(len(name) + attribute_size(self.serializer.serialize(value)) for name, value in Item.items())
+            self.partition_wcu[Item['pk']] += math.ceil(size / 1024)
+        return self.table.put_item(Item=Item, **kwargs)
+
+
+def create_table():
+    dynamodb = boto3.resource('dynamodb', region_name='eu-west-2')
+    return dynamodb.create_table(
+        TableName='bench-table',
+        KeySchema=[{'AttributeName': 'pk', 'KeyType': 'HASH'}, {'AttributeName': 'type', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': 'pk', 'AttributeType': 'S'},
+                              {'AttributeName': 'type', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+
+def run(table, names, writes):
+    counting = CountingTable(table)
+    expiry_date = int(time.time()) + 7 * 86400
+
+    started = time.perf_counter()
+    for index in range(writes):
+        name = random.choice(names)
+        if index % 2:
+            response = consume_item(counting, RESTAURANT, {'item_name': name, 'quantity': 1})
+        else:
+            response = add_delivery_item(counting, RESTAURANT, {'item_name': name, 'quantity': 2,
+                                                                'expiry_date': expiry_date})
+        assert response['statusCode'] in (200, 409), response
+    seconds = time.perf_counter() - started
+
+    return writes / seconds, counting.partition_wcu
+
+
+def count_conflicts(names, shards, concurrency, rounds=1000):
+    conflicts = 0
+    for _ in range(rounds):
+        touched = Counter(get_shard(name, shards) for name in random.sample(names, concurrency))
+        conflicts += sum(count - 1 for count in touched.values())
+    return conflicts / (rounds * concurrency)
+
+
+def report(label, names, writes, shards, concurrency, ops_per_second, partition_wcu):
+    hottest = max(partition_wcu.values())
+    print(f'{label}: {len(partition_wcu)} fridge partitions written, {sum(partition_wcu.values()) / writes:.1f} WCU per '
+          f'write, hottest partition {hottest / writes:.1f} WCU per write')
+    print(f'    sustained writes/s before throttling: {writes * PARTITION_WCU_PER_SECOND / hottest:8.0f}')
+    print(f'    conflicting requests at {concurrency} concurrent: {count_conflicts(names, shards, concurrency):8.1%}')
+    print(f'    in process (moto): {ops_per_second:8.0f} writes/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=200)
+    parser.add_argument('--writes', type=int, default=1000)
+    parser.add_argument('--shards', type=int, default=8)
+    parser.add_argument('--concurrency', type=int, default=10)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    names = [f'ingredient {index}' for index in range(args.items)]
+
+    with mock_dynamodb():
+        table = create_table()
+        expiry_date = int(time.time()) + 7 * 86400
+        for name in names:
+            add_new_item(table, RESTAURANT, {'item_name': name, 'desired_quantity': 10, 'quantity': 50,
+                                             'expiry_date': expiry_date})
+
+        ops_per_second, partition_wcu = run(table, names, args.writes)
+        report('1 shard', names, args.writes, 1, args.concurrency, ops_per_second, partition_wcu)
+
+        response = set_write_shards(table, RESTAURANT, {'write_shards': args.shards})
+        assert response['statusCode'] == 200, response
+        inventory_utils.shard_settings_cache.clear()
+
+        ops_per_second, partition_wcu = run(table, names, args.writes)
+        assert set(partition_wcu) <= {get_shard_key(RESTAURANT, shard) for shard in range(args.shards)}
+        report(f'{args.shards} shards', names, args.writes, args.shards, args.concurrency, ops_per_second,
+               partition_wcu)
+
+
+if __name__ == '__main__':
+    main()
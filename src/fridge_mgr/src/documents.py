@@ -0,0 +1,134 @@
+import json
+import os
+import zlib
+from decimal import Decimal
+
+from boto3.dynamodb.types import Binary
+from botocore.exceptions import ClientError
+
+# The fridge, orders and tokens items of a restaurant are large nested documents. With DOCUMENT_ENCODING=zlib their
+# nested attributes are written as one compressed JSON binary attribute, which is far smaller on the wire and in the
+# table than DynamoDB maps and lists. Items in either form are always read back the same way, so the setting can be
+# changed at any time and documents are converted the next time they are written.
+#
+# This module is copied into every lambda that reads these documents, keep the copies the same.
+DOCUMENT_ENCODING = os.environ.get('DOCUMENT_ENCODING', 'map')
+DOCUMENT_ATTRIBUTE = 'document'
+DOCUMENT_SCHEMA_VERSION = 1
+
+# attributes used by key conditions, indexes and condition expressions are never encoded
+ENCODED_ATTRIBUTES = {
+    'fridge': ['items', 'expiry_index'],
+    'orders': ['orders'],
+    'tokens': ['tokens']
+}
+
+DOCUMENT_WRITE_ATTEMPTS = 3
+
+
+def is_encoded(item):
+    """
+    Checks whether an item is stored as a compressed document.
+    :param item: Item as read from DynamoDB, or None.
+    :return: True if the item holds an encoded document.
+    """
+    return item is not None and DOCUMENT_ATTRIBUTE in item
+
+
+def encodes_documents():
+    """
+    Checks whether documents are written compressed.
+    :return: True if DOCUMENT_ENCODING is zlib.
+    """
+    return DOCUMENT_ENCODING == 'zlib'
+
+
+def to_json(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f'{type(value).__name__} cannot be stored in a document')
+
+
+def encode_document(item):
+    """
+    Gets an item in the form it should be written in, with its nested attributes compressed if documents are encoded.
+    :param item: Decoded item.
+    :return: Item to write, the given item is not changed.
+    """
+    attributes = ENCODED_ATTRIBUTES.get(item.get('type'))
+    if not encodes_documents() or attributes is None:
+        return item
+
+    encoded = {key: value for key, value in item.items() if key not in attributes}
+    document = {key: item[key] for key in attributes if key in item}
+    encoded[DOCUMENT_ATTRIBUTE] = Binary(zlib.compress(
+        json.dumps(document, default=to_json, separators=(',', ':')).encode('utf-8')))
+    encoded['schema_version'] = DOCUMENT_SCHEMA_VERSION
+    return encoded
+
+
+def decode_document(item):
+    """
+    Gets an item with its nested attributes, whichever form it was stored in.
+    :param item: Item as read from DynamoDB, or None.
+    :return: Decoded item, the given item if it was not encoded.
+    :raises ValueError: If the document was written with a newer schema version.
+    """
+    if not is_encoded(item):
+        return item
+
+    schema_version = item.get('schema_version', DOCUMENT_SCHEMA_VERSION)
+    if schema_version > DOCUMENT_SCHEMA_VERSION:
+        raise ValueError(f"{item.get('type')} document has schema version {schema_version}, "
+                         f'at most {DOCUMENT_SCHEMA_VERSION} can be read')
+
+    decoded = {key: value for key, value in item.items() if key not in (DOCUMENT_ATTRIBUTE, 'schema_version')}
+    decoded.update(json.loads(zlib.decompress(bytes(item[DOCUMENT_ATTRIBUTE])).decode('utf-8'), parse_float=Decimal))
+    return decoded
+
+
+def put_document(table, item, previous):
+    """
+    Writes a whole document, only if it has not changed since it was read.
+    :param table: DynamoDB table.
+    :param item: Decoded item to write.
+    :param previous: Item as it was read from DynamoDB, before decoding.
+    :return: None.
+    :raises ClientError: ConditionalCheckFailedException if the document was changed after it was read.
+    """
+    if is_encoded(previous):
+        condition = {
+            'ConditionExpression': '#document = :previous',
+            'ExpressionAttributeValues': {':previous': previous[DOCUMENT_ATTRIBUTE]}
+        }
+    else:
+        condition = {'ConditionExpression': 'attribute_not_exists(#document)'}
+
+    table.put_item(Item=encode_document(item), ExpressionAttributeNames={'#document': DOCUMENT_ATTRIBUTE},
+                   **condition)
+
+
+def append_to_document(table, key, attribute, values):
+    """
+    Appends to a list in a document by rewriting the whole document, retrying if it is changed in the meantime.
+    :param table: DynamoDB table.
+    :param key: Key of the document.
+    :param attribute: Name of the list.
+    :param values: Values to append.
+    :return: True, or False if there is no such document.
+    :raises ClientError: If the document could not be written.
+    """
+    for attempt in range(DOCUMENT_WRITE_ATTEMPTS):
+        previous = table.get_item(Key=key, ConsistentRead=True).get('Item')
+        if previous is None:
+            return False
+
+        item = decode_document(previous)
+        item[attribute] = list(item.get(attribute, [])) + list(values)
+        try:
+            put_document(table, item, previous)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException' or \
+                    attempt == DOCUMENT_WRITE_ATTEMPTS - 1:
+                raise
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+from .documents import to_json
+
+# Requests that change stock, orders or tokens can carry an idempotency_key in their body. The first request with a
+# key runs and its successful response is kept for IDEMPOTENCY_TTL seconds, a retry with the same key gets that
+# response back without running again. A retry that arrives while the first request is still running is refused with
+# a 409 rather than run twice, and failed requests are not kept, so they can be retried.
+#
+# This module is copied into every lambda that takes idempotency keys, keep the copies the same.
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 86400))
+IDEMPOTENCY_KEY = '{restaurant}#idempotency#{key}'
+IDEMPOTENCY_ATTRIBUTE = 'idempotency_key'
+# a request still marked as running after this long is taken to have died, and the key can be used again
+IN_PROGRESS_TIMEOUT = 60
+
+
+def get_request_hash(action, body):
+    """
+    Gets a fingerprint of a request, so a key sent again with a different request is not answered with the wrong
+    response.
+    :param action: Action of the request.
+    :param body: Body of the request.
+    :return: Hex digest of the action and body, without the idempotency key.
+    """
+    request = {key: value for key, value in body.items() if key != IDEMPOTENCY_ATTRIBUTE}
+    return hashlib.sha256(json.dumps([action, request], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def run_idempotent(table, restaurant, action, body, operation):
+    """
+    Runs a request once for its idempotency key, returning the response of the first run to any retry.
+    :param table: DynamoDB table.
+    :param restaurant: Restaurant the request is for, keys are only unique per restaurant.
+    :param action: Action of the request.
+    :param body: Body of the request, the request runs every time if it has no idempotency_key.
+    :param operation: Function running the request, returning its response.
+    :return: Response of the request.
+    """
+    idempotency_key = body.get(IDEMPOTENCY_ATTRIBUTE)
+    if idempotency_key is None:
+        return operation()
+
+    key = {'pk': IDEMPOTENCY_KEY.format(restaurant=restaurant, key=idempotency_key), 'type': 'idempotency'}
+    request_hash = get_request_hash(action, body)
+    now = int(time.time())
+
+    try:
+        table.put_item(
+            Item={**key, 'status': 'in_progress', 'request_hash': request_hash, 'expires_at': now + IN_PROGRESS_TIMEOUT},
+            ConditionExpression='attribute_not_exists(pk) OR expires_at < :now',
+            ExpressionAttributeValues={':now': now}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return get_previous_response(table, key, request_hash)
+
+    try:
+        response = operation()
+    except Exception:
+        table.delete_item(Key=key)
+        raise
+
+    if 200 <= response['statusCode'] <= 299:
+        table.put_item(Item={**key, 'status': 'done', 'request_hash': request_hash,
+                             'response': json.dumps(response, default=to_json),
+                             'expires_at': int(time.time()) + IDEMPOTENCY_TTL})
+    else:
+        table.delete_item(Key=key)
+    return response
+
+
+def get_previous_response(table, key, request_hash):
+    """
+    Gets the response to give a request whose idempotency key has already been used.
+    :param table: DynamoDB table.
+    :param key: Key of the idempotency entry.
+    :param request_hash: Result of get_request_hash for the request.
+    :return: Response of the first request, or why it cannot be given.
+    """
+    entry = table.get_item(Key=key, ConsistentRead=True).get('Item')
+
+    if entry is None:
+        # the first request failed and was forgotten since the key was checked
+        return {'statusCode': 409, 'body': {'details': 'Request with this idempotency key failed, please try again'}}
+
+    if entry['request_hash'] != request_hash:
+        return {'statusCode': 400, 'body': {'details': 'Idempotency key was already used for a different request'}}
+
+    if entry['status'] != 'done':
+        return {'statusCode': 409, 'body': {'details': 'Request with this idempotency key is still running'}}
+
+    return json.loads(entry['response'])
@@ -4,11 +4,21 @@ import json
 import logging
 from .inventory_utils import (view_inventory, delete_item, add_new_item,
                               add_delivery_item, update_item_quantity, modify_door_state,
-                              get_low_stock, update_desired_quantity, generate_response)
+                              get_low_stock, update_desired_quantity, generate_response,
+                              mark_restaurant_mutated, get_door_state, consume_item, consume_items,
+                              recompute_totals, get_expiring, get_history, compact_history, set_write_shards,
+                              resolve_fridge_key, list_fridges, add_fridge, view_all_fridges,
+                              DOOR_ACTIONS, ConcurrentUpdateError)
+from .sensor_events import ingest_sensor_events, get_sensor_summary
+from .idempotency import run_idempotent
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# actions that change stock levels, and so change what the nightly order run needs to do
+MUTATING_ACTIONS = ["add_new_item", "add_delivery_item", "update_item_quantity", "consume_item", "consume_items",
+                    "delete_item", "update_desired_quantity"]
+
 
 def handler(event, context):
     """
@@ -27,28 +37,88 @@ def handler(event, context):
         dynamodb = boto3.resource('dynamodb')
         table = dynamodb.Table(master_db_name)
 
-        pk = body.get('restaurant_name')
+        restaurant = body.get('restaurant_name')
         action = event.get('action')
 
-        if action == "view_inventory":
-            return view_inventory(table, pk)
-        elif action == "add_new_item":
-            return add_new_item(table, pk, body)
-        elif action == "add_delivery_item":
-            return add_delivery_item(table, pk, body)
-        elif action == "update_item_quantity":
-            return update_item_quantity(table, pk, body)
-        elif action == "delete_item":
-            return delete_item(table, pk, body)
-        elif action in ["open_back_door", "close_back_door", "open_front_door", "close_front_door"]:
-            return modify_door_state(table, pk, body, action)
+        # these are for the restaurant as a whole, every other action is for one fridge, the restaurant's default
+        # fridge unless the body names another
+        if action == "list_fridges":
+            return list_fridges(table, restaurant)
+        elif action == "add_fridge":
+            return add_fridge(table, restaurant, body)
+        elif action == "view_all_fridges":
+            return view_all_fridges(table, restaurant)
         elif action == "get_low_stock":
-            return get_low_stock(table, pk)
-        elif action == "update_desired_quantity":
-            return update_desired_quantity(table, pk, body)
+            return get_low_stock(table, restaurant)
+
+        pk = resolve_fridge_key(table, restaurant, body)
+        if pk is None:
+            return generate_response(404, f"Fridge {body.get('fridge_id')} not found")
+
+        if action in MUTATING_ACTIONS:
+            # a retried stock change with the same idempotency key is answered without changing the stock again
+            response = run_idempotent(table, restaurant, action, body, lambda: run_action(table, pk, body, action))
         else:
-            raise ValueError(f"Invalid action specified: {action}")
+            response = run_action(table, pk, body, action)
+
+        if action in MUTATING_ACTIONS and response['statusCode'] == 200:
+            mark_restaurant_mutated(table, restaurant)
+
+        return response
+
+    except ConcurrentUpdateError as e:
+        logger.warning(str(e))
+        return generate_response(409, f"{str(e)}, please try again")
 
     except Exception as e:
         logger.error(f"An error occurred: {str(e)}")
         return generate_response(500, f"An error occurred: {str(e)}")
+
+
+def run_action(table, pk, body, action):
+    """
+    Runs an action on one fridge.
+    :param table: DynamoDB table.
+    :param pk: Key of the fridge.
+    :param body: Request body.
+    :param action: Action to run.
+    :return: Response of the action.
+    """
+    if action == "view_inventory":
+        response = view_inventory(table, pk)
+    elif action == "add_new_item":
+        response = add_new_item(table, pk, body)
+    elif action == "add_delivery_item":
+        response = add_delivery_item(table, pk, body)
+    elif action == "update_item_quantity":
+        response = update_item_quantity(table, pk, body)
+    elif action == "consume_item":
+        response = consume_item(table, pk, body)
+    elif action == "consume_items":
+        response = consume_items(table, pk, body)
+    elif action == "delete_item":
+        response = delete_item(table, pk, body)
+    elif action in DOOR_ACTIONS:
+        response = modify_door_state(table, pk, body, action)
+    elif action == "get_door_state":
+        response = get_door_state(table, pk, body)
+    elif action == "ingest_sensor_events":
+        response = ingest_sensor_events(table, pk, body)
+    elif action == "get_sensor_summary":
+        response = get_sensor_summary(table, pk, body)
+    elif action == "recompute_totals":
+        response = recompute_totals(table, pk)
+    elif action == "get_expiring":
+        response = get_expiring(table, pk, body)
+    elif action == "get_history":
+        response = get_history(table, pk, body)
+    elif action == "compact_history":
+        response = compact_history(table, pk)
+    elif action == "set_write_shards":
+        response = set_write_shards(table, pk, body)
+    elif action == "update_desired_quantity":
+        response = update_desired_quantity(table, pk, body)
+    else:
+        raise ValueError(f"Invalid action specified: {action}")
+
+    return response
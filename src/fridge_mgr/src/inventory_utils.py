@@ -1,10 +1,78 @@
+import bisect
+import heapq
 import logging
+import re
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
 
+from .documents import encode_document, decode_document
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# door actions, and the door_state flag each one sets
+DOOR_ACTIONS = {
+    'open_back_door': ('is_back_door_open', True),
+    'close_back_door': ('is_back_door_open', False),
+    'open_front_door': ('is_front_door_open', True),
+    'close_front_door': ('is_front_door_open', False)
+}
+
+# door events are kept in their own partition, {restaurant}#door_events, so they never grow the restaurant's items
+DOOR_EVENTS_SUFFIX = '#door_events'
+
+# fridges with items below their desired quantity carry this flag, which puts them in the sparse reorder-index
+REORDER_FLAG = 'reorder'
+
+# removed batches are moved out of the fridge into an append-only history, partitioned by the month they were removed
+# in, {restaurant}#history#{YYYY-MM}, so the live fridge item only ever holds stock that is still there. Each of a
+# restaurant's other fridges has its own history under its fridge key
+HISTORY_PARTITION = '{restaurant}#history#{month}'
+MAX_HISTORY_DAYS = 366
+# a fridge write and the history of the batches it removes go in one transaction, which holds at most 100 items
+MAX_TRANSACTION_HISTORY = 99
+
+# the global expiry index has a partition per day, expiry#{YYYY-MM-DD}, with an entry per restaurant listing the
+# batches that expire that day, so one sweep can read what expires across every restaurant
+EXPIRY_DAY_PARTITION = 'expiry#{day}'
+EXPIRY_DAY_RETENTION_DAYS = 30
+
+# default window for get_expiring, matching the going to expire window of the expiry emails
+EXPIRING_DAYS = 3
+
+# large restaurants can spread their fridge over several items with set_write_shards, so their stock writes are shared
+# between partitions. Shard 0 is the restaurant's own fridge item and records the shard count, shard n is stored under
+# {restaurant}#shard#{n}, and each inventory item lives in the shard picked by a hash of its name
+SHARD_SEPARATOR = '#shard#'
+MAX_WRITE_SHARDS = 16
+SHARD_SETTINGS_CACHE_SECONDS = 300
+shard_settings_cache = {}
+
+# a restaurant can have several fridges. Its first fridge is its own fridge item, every other fridge is kept under
+# {restaurant}#fridge#{fridge_id} with its own door state, sensor events, history and shards, so writes to one fridge
+# never contend with another. The restaurant's fridges item lists the fridges added after the first
+DEFAULT_FRIDGE_ID = 'main'
+DEFAULT_FRIDGE_NAME = 'Main fridge'
+FRIDGE_SEPARATOR = '#fridge#'
+FRIDGE_ID_PATTERN = re.compile(r'^[a-z0-9][a-z0-9-]{0,31}$')
+MAX_FRIDGES = 20
+FRIDGE_FAN_OUT_WORKERS = 8
+known_fridges = set()
+
+# how many times consume_item re-reads the fridge when another write lands between its read and its write
+CONSUME_ATTEMPTS = 3
+
+
+class ConcurrentUpdateError(Exception):
+    """
+    Raised when the fridge item was changed by another request after it was read.
+    """
+
 
 def get_current_time_gmt():
     """
@@ -33,6 +101,858 @@ def generate_response(status_code, message, additional_details=None):
     }
 
 
+def get_visible_item(stored_item):
+    """
+    Gets an inventory item as view_inventory would show it, so callers can update just that item.
+    :param stored_item: Inventory item.
+    :return: Copy of the item without removed batches, or None if no batches are left.
+    """
+    item_list = [detail for detail in stored_item['item_list'] if detail.get('date_removed', 0) == 0]
+    if not item_list:
+        return None
+
+    return {**stored_item, 'item_list': item_list}
+
+
+def load_fridge(table, pk, consistent_read=True):
+    """
+    Gets a restaurant's fridge item, or one shard of it.
+    :param table: DynamoDB table.
+    :param pk: Primary key, or shard key.
+    :param consistent_read: Whether the read must see every earlier write.
+    :return: Fridge item, or None if the restaurant has no fridge.
+    """
+    read_options = {'ConsistentRead': True} if consistent_read else {}
+    return decode_document(table.get_item(Key={'pk': pk, 'type': 'fridge'}, **read_options).get('Item'))
+
+
+def get_shard_key(pk, shard):
+    """
+    Gets the partition key of one shard of a restaurant's records.
+    :param pk: Primary key, or the partition key of the unsharded records.
+    :param shard: Shard number, 0 is the unsharded key itself.
+    :return: Partition key.
+    """
+    return pk if shard == 0 else f'{pk}{SHARD_SEPARATOR}{shard}'
+
+
+def get_restaurant(pk):
+    """
+    Gets the fridge a fridge shard belongs to.
+    :param pk: Primary key, or shard key.
+    :return: Primary key of the restaurant, or the partition key of the fridge for a restaurant's other fridges.
+    """
+    return pk.split(SHARD_SEPARATOR)[0]
+
+
+def get_shard(name, shards):
+    """
+    Picks the shard a record is kept in, the same one every time for the same name.
+    :param name: Item name or sensor id.
+    :param shards: Number of shards.
+    :return: Shard number.
+    """
+    return zlib.crc32(str(name).lower().encode('utf-8')) % shards if shards > 1 else 0
+
+
+def cache_shard_settings(pk, fridge):
+    """
+    Remembers a restaurant's shard counts from its own fridge item for a few minutes.
+    :param pk: Primary key.
+    :param fridge: The restaurant's shard 0 fridge item, or None.
+    :return: (write_shards, event_shards).
+    """
+    fridge = fridge or {}
+    settings = (int(fridge.get('write_shards', 1)), int(fridge.get('event_shards', fridge.get('write_shards', 1))))
+    shard_settings_cache[pk] = (settings, time.monotonic() + SHARD_SETTINGS_CACHE_SECONDS)
+    return settings
+
+
+def get_shard_settings(table, pk):
+    """
+    Gets how many shards a restaurant's fridge is spread over, and how many its event records have ever been spread
+    over, from the cache or its own fridge item.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :return: (write_shards, event_shards).
+    """
+    cached = shard_settings_cache.get(pk)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+
+    fridge = table.get_item(Key={'pk': pk, 'type': 'fridge'},
+                            ProjectionExpression='write_shards, event_shards').get('Item')
+    return cache_shard_settings(pk, fridge)
+
+
+def load_item_fridge(table, pk, item_name):
+    """
+    Gets the fridge shard an item is kept in, which is the restaurant's own fridge item unless it is sharded.
+
+    Every shard records the shard count it was written with, so a shard picked with a count cached before the fridge
+    was resharded is noticed, and the count is read again.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :param item_name: Name of the item.
+    :return: Fridge shard item, or None if the restaurant has no fridge.
+    """
+    cached = shard_settings_cache.get(pk)
+    if cached and cached[1] > time.monotonic():
+        write_shards = cached[0][0]
+        fridge = load_fridge(table, get_shard_key(pk, get_shard(item_name, write_shards)))
+        if fridge is not None and fridge.get('write_shards', 1) == write_shards:
+            return fridge
+
+    fridge = load_fridge(table, pk)
+    write_shards, _ = cache_shard_settings(pk, fridge)
+    shard = get_shard(item_name, write_shards)
+    if fridge is None or shard == 0:
+        return fridge
+
+    return load_fridge(table, get_shard_key(pk, shard))
+
+
+def load_fridge_shards(table, pk, consistent_read=True):
+    """
+    Gets every shard of a restaurant's fridge, reading the shards after the first in one batch.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :param consistent_read: Whether the reads must see every earlier write.
+    :return: List of fridge shard items in shard order, empty if the restaurant has no fridge.
+    """
+    fridge = load_fridge(table, pk, consistent_read)
+    write_shards, _ = cache_shard_settings(pk, fridge)
+    if fridge is None:
+        return []
+    if write_shards == 1:
+        return [fridge]
+
+    keys = [{'pk': get_shard_key(pk, shard), 'type': 'fridge'} for shard in range(1, write_shards)]
+    shards = {}
+    while keys:
+        response = table.meta.client.batch_get_item(
+            RequestItems={table.name: {'Keys': keys, 'ConsistentRead': consistent_read}})
+        for shard in response['Responses'].get(table.name, []):
+            shards[shard['pk']] = decode_document(shard)
+        keys = response.get('UnprocessedKeys', {}).get(table.name, {}).get('Keys', [])
+
+    return [fridge] + [shards[get_shard_key(pk, shard)] for shard in range(1, write_shards)
+                       if get_shard_key(pk, shard) in shards]
+
+
+def merge_fridge_shards(pk, shards):
+    """
+    Combines the shards of a fridge into one fridge item, for reads that need every item.
+    :param pk: Primary key.
+    :param shards: Result of load_fridge_shards.
+    :return: Fridge item, or None if the restaurant has no fridge.
+    """
+    if len(shards) <= 1:
+        return shards[0] if shards else None
+
+    fridge = {key: value for key, value in shards[0].items()
+              if key not in ('items', 'expiry_index', 'expiry_days', 'version')}
+    fridge['items'] = [stored_item for shard in shards for stored_item in shard.get('items', [])]
+    if all(shard.get('expiry_index') is not None for shard in shards):
+        fridge['expiry_index'] = list(heapq.merge(*(shard['expiry_index'] for shard in shards)))
+    return fridge
+
+
+def save_fridge(table, item, removed_items=()):
+    """
+    Writes a fridge item back, only if no other request has written it since it was read.
+
+    Removed batches are moved into the restaurant's history in the same transaction. The fridge item only holds live
+    stock, and a write that loses to another one leaves no history behind. Every write bumps the item's version, so a
+    read-modify-write never silently overwrites another one. It also refreshes each item's stock totals, the fridge's
+    reorder flag and its expiry index, so they always match its batches. The global expiry index is then brought up to
+    date for the days whose batches changed, and the days the fridge no longer has batches for are deleted from it.
+    :param table: DynamoDB table.
+    :param item: Fridge item as returned by load_fridge and then modified.
+    :param removed_items: Items taken out of the fridge entirely, whose removed batches still need archiving.
+    :return: None.
+    :raises ConcurrentUpdateError: If the fridge was changed after it was read.
+    """
+    records = compact_fridge(item, removed_items)
+
+    previous_expiry_index = item.get('expiry_index') or []
+    written_days = get_written_expiry_days(item)
+    prepare_fridge(item)
+    days = sorted(group_by_expiry_day(item['expiry_index']))
+    # days that are going away stay listed until their entries are deleted, so a failed delete is retried
+    item['expiry_days'] = sorted(written_days.union(days))
+
+    version = item.get('version')
+    item['version'] = (version or 0) + 1
+    in_transaction = 0 < len(records) <= MAX_TRANSACTION_HISTORY
+    try:
+        if in_transaction:
+            table.meta.client.transact_write_items(TransactItems=[
+                {'Put': {'TableName': table.name, 'Item': encode_document(item), **get_version_condition(version)}}
+            ] + [{'Put': {'TableName': table.name, 'Item': get_history_item(item.get('pk'), record)}}
+                 for record in records])
+        else:
+            table.put_item(Item=encode_document(item), **get_version_condition(version))
+    except ClientError as e:
+        item['version'] = version
+        if e.response['Error']['Code'] in ('ConditionalCheckFailedException', 'TransactionCanceledException'):
+            raise ConcurrentUpdateError(f"Inventory for {item.get('pk')} was changed by another request")
+        raise
+
+    # only compacting an old fridge removes more batches than a transaction holds, their removal times were already
+    # stored so the history keys are the same if this is retried
+    if not in_transaction:
+        archive_batches(table, item.get('pk'), records)
+
+    if sync_expiry_days(table, item.get('pk'), previous_expiry_index, item['expiry_index'], written_days) and \
+            item['expiry_days'] != days:
+        forget_expiry_days(table, item, days)
+
+
+def get_version_condition(version):
+    """
+    Gets the condition for writing a fridge item only if it still has the version that was read.
+    :param version: Version of the item when it was read, None if it has never been versioned.
+    :return: Condition arguments for the write.
+    """
+    if version is None:
+        return {'ConditionExpression': 'attribute_not_exists(version)'}
+    return {'ConditionExpression': 'version = :version', 'ExpressionAttributeValues': {':version': version}}
+
+
+def prepare_fridge(item):
+    """
+    Brings a fridge item's stock totals, reorder flag and expiry index up to date with its batches.
+    :param item: Fridge item, or fridge shard item.
+    :return: None.
+    """
+    current_time = get_current_time_gmt()
+    for stored_item in item.get('items', []):
+        update_item_totals(stored_item, current_time)
+    update_reorder_flag(item)
+    update_expiry_index(item)
+
+
+def compact_fridge(item, removed_items=()):
+    """
+    Takes the removed batches out of a fridge's items.
+    :param item: Fridge item.
+    :param removed_items: Items already taken out of the fridge, whose removed batches are collected too.
+    :return: History records of the removed batches, with the quantity taken out of the fridge when each was removed.
+    """
+    archived = []
+    for stored_item in list(item.get('items', [])) + list(removed_items):
+        live = []
+        for detail in stored_item['item_list']:
+            if detail.get('date_removed', 0) == 0:
+                live.append(detail)
+            else:
+                archived.append({
+                    'item_name': stored_item['item_name'],
+                    'expiry_date': detail['expiry_date'],
+                    'date_added': detail['date_added'],
+                    'date_removed': detail['date_removed'],
+                    'quantity': detail.get('removed_quantity', detail['current_quantity'])
+                })
+        stored_item['item_list'] = live
+
+    return archived
+
+
+def archive_batches(table, pk, records):
+    """
+    Appends removed batches to the restaurant's history, which is shared by all the shards of its fridge.
+    :param table: DynamoDB table.
+    :param pk: Primary key, or shard key.
+    :param records: History records from compact_fridge.
+    :return: None.
+    """
+    if not records:
+        return
+
+    with table.batch_writer() as batch:
+        for record in records:
+            batch.put_item(Item=get_history_item(pk, record))
+
+
+def get_history_item(pk, record):
+    """
+    Gets the history entry of a removed batch.
+    :param pk: Primary key, or shard key.
+    :param record: History record from compact_fridge.
+    :return: Item to write.
+    """
+    month = datetime.utcfromtimestamp(int(record['date_removed'])).strftime('%Y-%m')
+    return {
+        'pk': HISTORY_PARTITION.format(restaurant=get_restaurant(pk), month=month),
+        'type': f"{int(record['date_removed']):012d}#{record['item_name']}#{record['date_added']}#"
+                f"{record['expiry_date']}",
+        **record
+    }
+
+
+def get_history(table, pk, body):
+    """
+    Gets the batches removed from a restaurant's fridge between two times, from its history.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :param body: Request data with 'start' and 'end' unix timestamps.
+    :return: API response with the removed batches, oldest removal first.
+    """
+    try:
+        start = int(body['start'])
+        end = int(body['end'])
+    except (KeyError, TypeError, ValueError):
+        return generate_response(400, 'start and end must be unix timestamps')
+
+    if end < start or end - start > MAX_HISTORY_DAYS * 86400:
+        return generate_response(400, f'History covers at most {MAX_HISTORY_DAYS} days')
+
+    batches = []
+    month = datetime.utcfromtimestamp(start).replace(day=1).date()
+    last_month = datetime.utcfromtimestamp(end).replace(day=1).date()
+    while month <= last_month:
+        query_arguments = {
+            'KeyConditionExpression': Key('pk').eq(HISTORY_PARTITION.format(restaurant=pk, month=month.strftime('%Y-%m')))
+                                      & Key('type').between(f'{start:012d}', f'{end:012d}~')
+        }
+
+        while True:
+            response = table.query(**query_arguments)
+            batches.extend({key: value for key, value in entry.items() if key not in ('pk', 'type')}
+                           for entry in response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                break
+            query_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        month = (month + timedelta(days=32)).replace(day=1)
+
+    return generate_response(200, 'History retrieved successfully', {'batches': batches})
+
+
+def compact_history(table, pk):
+    """
+    Moves every removed batch still held in a restaurant's fridge into its history, for fridges written before
+    removed batches were archived on write.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :return: API response with the number of batches archived.
+    """
+    shards = load_fridge_shards(table, pk)
+    if not shards:
+        return generate_response(404, 'Inventory item not found')
+
+    archived = 0
+    for item in shards:
+        archived += sum(1 for stored_item in item['items'] for detail in stored_item['item_list']
+                        if detail.get('date_removed', 0) != 0)
+        save_fridge(table, item)
+    return generate_response(200, f'{archived} removed batches archived', {'archived': archived})
+
+
+def update_item_totals(stored_item, current_time):
+    """
+    Stores an item's stock totals on the item, so stock checks read one number instead of summing every batch.
+
+    non_expired_quantity only holds until the next counted batch expires, which is kept as next_expiry.
+    :param stored_item: Inventory item.
+    :param current_time: Time to count expired batches from.
+    :return: (total_quantity, non_expired_quantity).
+    """
+    total_quantity = 0
+    non_expired_quantity = 0
+    next_expiry = None
+    for detail in stored_item['item_list']:
+        if detail.get('date_removed', 0) != 0:
+            continue
+
+        total_quantity += detail['current_quantity']
+        # batches without an expiry date never expire
+        if detail['expiry_date'] is None or detail['expiry_date'] > current_time:
+            non_expired_quantity += detail['current_quantity']
+            if detail['expiry_date'] is not None and detail['current_quantity'] > 0 and \
+                    (next_expiry is None or detail['expiry_date'] < next_expiry):
+                next_expiry = detail['expiry_date']
+
+    stored_item['total_quantity'] = total_quantity
+    stored_item['non_expired_quantity'] = non_expired_quantity
+    stored_item['next_expiry'] = next_expiry
+    return total_quantity, non_expired_quantity
+
+
+def update_reorder_flag(item):
+    """
+    Flags a fridge that has items below their desired quantity, along with the names of those items, so the nightly
+    order run can query the reorder-index for just those fridges. The flag is removed once nothing is low.
+    :param item: Fridge item, with each item's totals up to date.
+    :return: None.
+    """
+    reorder_items = sorted(stored_item['item_name'] for stored_item in item.get('items', [])
+                           if stored_item['non_expired_quantity'] < stored_item.get('desired_quantity', 0))
+    if reorder_items:
+        item['reorder_flag'] = REORDER_FLAG
+        item['reorder_items'] = reorder_items
+    else:
+        item.pop('reorder_flag', None)
+        item.pop('reorder_items', None)
+
+
+def update_expiry_index(item):
+    """
+    Keeps every in-stock batch of the fridge in one list sorted by expiry date, as [expiry_date, item_name, date_added,
+    current_quantity], so finding what has expired or expires next is a binary search rather than a walk over every
+    batch.
+    :param item: Fridge item.
+    :return: The expiry index.
+    """
+    item['expiry_index'] = sorted(
+        [detail['expiry_date'], stored_item['item_name'], detail['date_added'], detail['current_quantity']]
+        for stored_item in item.get('items', [])
+        for detail in stored_item['item_list']
+        if detail.get('date_removed', 0) == 0 and detail['expiry_date'] is not None and detail['current_quantity'] > 0
+    )
+    return item['expiry_index']
+
+
+def get_expiry_day(expiry_date):
+    return datetime.utcfromtimestamp(int(expiry_date)).strftime('%Y-%m-%d')
+
+
+def group_by_expiry_day(expiry_index):
+    days = {}
+    for entry in expiry_index:
+        days.setdefault(get_expiry_day(entry[0]), []).append(entry)
+    return days
+
+
+def get_written_expiry_days(item):
+    """
+    Gets the days a fridge may have entries for in the global expiry index.
+    :param item: Fridge item, or fridge shard item.
+    :return: Set of days, from the days recorded on the fridge or, for fridges written before these were recorded,
+             from its expiry index.
+    """
+    if 'expiry_days' in item:
+        return set(item['expiry_days'])
+    return set(group_by_expiry_day(item.get('expiry_index') or []))
+
+
+def forget_expiry_days(table, item, days):
+    """
+    Records that a fridge's entries for the days it no longer has batches for have been deleted.
+
+    The version is not bumped, a write that read the fridge before still carries the days and only deletes them again.
+    :param table: DynamoDB table.
+    :param item: Fridge item, as just written.
+    :param days: Days the fridge has entries for.
+    :return: None.
+    """
+    try:
+        table.update_item(
+            Key={'pk': item['pk'], 'type': 'fridge'},
+            UpdateExpression='SET expiry_days = :days',
+            ConditionExpression='version = :version',
+            ExpressionAttributeValues={':days': days, ':version': item['version']}
+        )
+        item['expiry_days'] = days
+    except ClientError as e:
+        # the days stay listed and are deleted again by the next write
+        logger.info(f"Could not update the expiry days of {item['pk']}: {str(e)}")
+
+
+def sync_expiry_days(table, pk, previous_expiry_index, expiry_index, written_days=()):
+    """
+    Rewrites the restaurant's entries in the global expiry index for the days whose batches have changed, and deletes
+    the entries for days written before that no longer have batches.
+
+    The entries are derived from the fridge, so they are written after it; if this fails the fridge is still right
+    and recompute_totals rebuilds them.
+    :param table: DynamoDB table.
+    :param pk: Primary key, or shard key, each shard of a fridge has its own entries.
+    :param previous_expiry_index: The fridge's expiry index before the write.
+    :param expiry_index: The fridge's expiry index after the write.
+    :param written_days: Days the fridge may have entries for, from get_written_expiry_days.
+    :return: True if the entries are up to date.
+    """
+    previous_days = group_by_expiry_day(previous_expiry_index)
+    days = group_by_expiry_day(expiry_index)
+    changed_days = [day for day in previous_days.keys() | days.keys() | set(written_days)
+                    if previous_days.get(day) != days.get(day) or day not in days]
+    if not changed_days:
+        return True
+
+    try:
+        with table.batch_writer() as batch:
+            for day in changed_days:
+                key = {'pk': EXPIRY_DAY_PARTITION.format(day=day), 'type': pk}
+                if day in days:
+                    batch.put_item(Item={
+                        **key,
+                        'batches': days[day],
+                        'expires_at': int(days[day][-1][0]) + EXPIRY_DAY_RETENTION_DAYS * 86400
+                    })
+                else:
+                    batch.delete_item(Key=key)
+    except ClientError as e:
+        logger.warning(f"Could not update the expiry index for {pk}: {str(e)}")
+        return False
+    return True
+
+
+def get_expiring_batches(expiry_index, before):
+    """
+    Gets the batches that expire at or before a time.
+    :param expiry_index: Expiry index of a fridge.
+    :param before: Unix timestamp.
+    :return: Slice of the expiry index, earliest expiry first.
+    """
+    return expiry_index[:bisect.bisect_left(expiry_index, [int(before) + 1])]
+
+
+def get_expiring(table, pk, body):
+    """
+    Gets the stock that has expired, and the stock that will expire within a number of days.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :param body: Request data, optionally the number of 'days' ahead to look, 3 by default.
+    :return: API response with the expired and expiring batches, earliest expiry first, and the quantities per item.
+    """
+    try:
+        days = int(body.get('days', EXPIRING_DAYS))
+    except (TypeError, ValueError):
+        return generate_response(400, 'days must be a whole number')
+
+    item = merge_fridge_shards(pk, load_fridge_shards(table, pk, consistent_read=False))
+    if not item:
+        return generate_response(404, 'Inventory item not found')
+
+    # fridges saved before the index was added build it on the fly
+    expiry_index = item.get('expiry_index')
+    if expiry_index is None:
+        expiry_index = update_expiry_index(item)
+
+    current_time = get_current_time_gmt()
+    expired_count = len(get_expiring_batches(expiry_index, current_time))
+    batches = get_expiring_batches(expiry_index, current_time + days * 86400)
+
+    result = {'expired': [], 'expiring': [], 'expired_quantities': {}, 'expiring_quantities': {}}
+    for position, (expiry_date, item_name, date_added, quantity) in enumerate(batches):
+        state = 'expired' if position < expired_count else 'expiring'
+        result[state].append({'item_name': item_name, 'expiry_date': expiry_date, 'date_added': date_added,
+                              'current_quantity': quantity})
+        result[f'{state}_quantities'][item_name] = result[f'{state}_quantities'].get(item_name, 0) + quantity
+
+    return generate_response(200, 'Expiring items retrieved successfully', result)
+
+
+def get_item_totals(stored_item, current_time):
+    """
+    Gets an item's stock totals, from the stored totals unless they are missing or a batch has expired since.
+    :param stored_item: Inventory item.
+    :param current_time: Time to count expired batches from.
+    :return: (total_quantity, non_expired_quantity).
+    """
+    next_expiry = stored_item.get('next_expiry')
+    if 'total_quantity' in stored_item and (next_expiry is None or next_expiry > current_time):
+        return stored_item['total_quantity'], stored_item['non_expired_quantity']
+
+    return update_item_totals(stored_item, current_time)
+
+
+def recompute_totals(table, pk):
+    """
+    Rebuilds every item's stock totals and the restaurant's expiry index entries from its batches, for items written
+    before these were kept or that have drifted.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :return: API response with the names of the items whose stored totals were wrong.
+    """
+    shards = load_fridge_shards(table, pk)
+    if not shards:
+        return generate_response(404, 'Inventory item not found')
+
+    current_time = get_current_time_gmt()
+    repaired = []
+    for item in shards:
+        for stored_item in item['items']:
+            stored = (stored_item.get('total_quantity'), stored_item.get('non_expired_quantity'))
+            if stored != update_item_totals(stored_item, current_time):
+                repaired.append(stored_item['item_name'])
+
+        # forgetting the stored expiry index rewrites every day of the global expiry index for this shard, and the
+        # days it was written for are deleted unless the shard still has batches for them
+        item['expiry_days'] = sorted(get_written_expiry_days(item))
+        item.pop('expiry_index', None)
+        save_fridge(table, item)
+
+    item_count = sum(len(item['items']) for item in shards)
+    return generate_response(200, f'Totals recomputed for {item_count} items', {'repaired': repaired})
+
+
+def set_write_shards(table, pk, body):
+    """
+    Spreads a restaurant's fridge over a number of shards, moving each item to the shard its name picks.
+
+    Every shard is rewritten in one transaction, conditioned on the versions that were read, so stock written at the
+    same time is never lost, the request fails with a conflict instead.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :param body: Request data, 'write_shards' is the number of shards, 1 to stop sharding.
+    :return: API response with the number of items in each shard.
+    """
+    try:
+        write_shards = int(body.get('write_shards'))
+    except (TypeError, ValueError):
+        return generate_response(400, 'write_shards must be a whole number')
+
+    if not 1 <= write_shards <= MAX_WRITE_SHARDS:
+        return generate_response(400, f'write_shards must be between 1 and {MAX_WRITE_SHARDS}')
+
+    shards = load_fridge_shards(table, pk)
+    if not shards:
+        return generate_response(404, 'Inventory item not found')
+
+    for shard in shards:
+        archive_batches(table, shard['pk'], compact_fridge(shard))
+
+    # shard 0 keeps the restaurant's other fridge attributes, and event records are read from every shard they have
+    # ever been written to
+    _, event_shards = cache_shard_settings(pk, shards[0])
+    new_shards = [{'pk': get_shard_key(pk, shard), 'type': 'fridge', 'items': [], 'write_shards': write_shards}
+                  for shard in range(write_shards)]
+    new_shards[0].update({key: value for key, value in shards[0].items()
+                          if key not in ('pk', 'type', 'items', 'expiry_index', 'expiry_days', 'version',
+                                         'reorder_flag', 'reorder_items', 'write_shards', 'event_shards')})
+    new_shards[0]['event_shards'] = max(event_shards, write_shards)
+    for shard in shards:
+        for stored_item in shard['items']:
+            new_shards[get_shard(stored_item['item_name'], write_shards)]['items'].append(stored_item)
+
+    previous_shards = {shard['pk']: shard for shard in shards}
+    actions = []
+    written_days = {shard_pk: get_written_expiry_days(shard) for shard_pk, shard in previous_shards.items()}
+    for shard in new_shards:
+        prepare_fridge(shard)
+        shard['expiry_days'] = sorted(written_days.get(shard['pk'], set()).union(
+            group_by_expiry_day(shard['expiry_index'])))
+        previous = previous_shards.get(shard['pk'])
+        if previous is None:
+            condition = {'ConditionExpression': 'attribute_not_exists(pk)'}
+        else:
+            condition = get_version_condition(previous.get('version'))
+        shard['version'] = ((previous or {}).get('version') or 0) + 1
+        actions.append({'Put': {'TableName': table.name, 'Item': encode_document(shard), **condition}})
+
+    for shard in shards[write_shards:]:
+        actions.append({'Delete': {'TableName': table.name, 'Key': {'pk': shard['pk'], 'type': 'fridge'},
+                                   **get_version_condition(shard.get('version'))}})
+
+    try:
+        table.meta.client.transact_write_items(TransactItems=actions)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'TransactionCanceledException':
+            raise ConcurrentUpdateError(f'Inventory for {pk} was changed while it was being resharded')
+        raise
+
+    cache_shard_settings(pk, new_shards[0])
+    new_shards_by_pk = {shard['pk']: shard for shard in new_shards}
+    for shard_pk in previous_shards.keys() | new_shards_by_pk.keys():
+        previous_index = (previous_shards.get(shard_pk) or {}).get('expiry_index') or []
+        shard = new_shards_by_pk.get(shard_pk)
+        days = sorted(group_by_expiry_day(shard['expiry_index'])) if shard else []
+        if sync_expiry_days(table, shard_pk, previous_index, shard['expiry_index'] if shard else [],
+                            written_days.get(shard_pk, ())) and shard and shard['expiry_days'] != days:
+            forget_expiry_days(table, shard, days)
+
+    return generate_response(200, f'Inventory spread over {write_shards} shards',
+                             {'write_shards': write_shards, 'items': [len(shard['items']) for shard in new_shards]})
+
+
+def get_fridge_key(pk, fridge_id):
+    """
+    Gets the partition key a restaurant's fridge is kept under.
+    :param pk: Primary key.
+    :param fridge_id: Fridge id, the default fridge is the restaurant's own fridge item.
+    :return: Partition key of the fridge.
+    """
+    return pk if fridge_id in (None, DEFAULT_FRIDGE_ID) else f'{pk}{FRIDGE_SEPARATOR}{fridge_id}'
+
+
+def load_fridge_list(table, pk):
+    """
+    Gets the fridges of a restaurant, its default fridge first.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :return: (fridges item, or None if no fridge has been added, list of dicts with 'fridge_id' and 'fridge_name').
+    """
+    fridges_item = table.get_item(Key={'pk': pk, 'type': 'fridges'}, ConsistentRead=True).get('Item')
+    fridges = [{'fridge_id': DEFAULT_FRIDGE_ID, 'fridge_name': DEFAULT_FRIDGE_NAME}]
+    fridges.extend((fridges_item or {}).get('fridges', []))
+    return fridges_item, fridges
+
+
+def resolve_fridge_key(table, pk, body):
+    """
+    Gets the partition key of the fridge a request is for, the restaurant's default fridge unless it names another.
+    Fridges are never removed, so a fridge found once is remembered for the life of the container.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :param body: Request data, optionally with a 'fridge_id'.
+    :return: Partition key of the fridge, or None if the restaurant has no such fridge.
+    """
+    fridge_id = body.get('fridge_id') or DEFAULT_FRIDGE_ID
+    fridge_key = get_fridge_key(pk, fridge_id)
+    if fridge_id == DEFAULT_FRIDGE_ID or fridge_key in known_fridges:
+        return fridge_key
+
+    _, fridges = load_fridge_list(table, pk)
+    if not any(fridge['fridge_id'] == fridge_id for fridge in fridges):
+        return None
+
+    known_fridges.add(fridge_key)
+    return fridge_key
+
+
+def list_fridges(table, pk):
+    """
+    Lists the fridges of a restaurant.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :return: API response with the fridges, the default fridge first.
+    """
+    _, fridges = load_fridge_list(table, pk)
+    return generate_response(200, 'Fridges retrieved successfully', {'fridges': fridges})
+
+
+def add_fridge(table, pk, body):
+    """
+    Adds a fridge to a restaurant, with an empty inventory and its doors closed.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :param body: Request data, 'fridge_id' of lowercase letters, digits and dashes, and a 'fridge_name'.
+    :return: API response with the restaurant's fridges.
+    :raises ConcurrentUpdateError: If another fridge was added at the same time.
+    """
+    fridge_id = str(body.get('fridge_id', '')).lower()
+    fridge_name = str(body.get('fridge_name') or fridge_id).strip()
+    if not FRIDGE_ID_PATTERN.match(fridge_id):
+        return generate_response(400, 'fridge_id must be up to 32 lowercase letters, digits and dashes')
+    if not fridge_name:
+        return generate_response(400, 'fridge_name must be given')
+
+    if not table.get_item(Key={'pk': pk, 'type': 'fridge'}).get('Item'):
+        return generate_response(404, 'Inventory item not found')
+
+    fridges_item, fridges = load_fridge_list(table, pk)
+    if any(fridge['fridge_id'] == fridge_id for fridge in fridges):
+        return generate_response(409, f'Fridge {fridge_id} already exists')
+    if len(fridges) >= MAX_FRIDGES:
+        return generate_response(400, f'A restaurant can have at most {MAX_FRIDGES} fridges')
+
+    # the fridge's own items come first, so it is never listed without them
+    fridge_key = get_fridge_key(pk, fridge_id)
+    for item in [{'pk': fridge_key, 'type': 'fridge', 'items': [], 'expiry_index': [], 'version': 1},
+                 {'pk': fridge_key, 'type': 'door_state', 'is_front_door_open': False, 'is_back_door_open': False,
+                  'last_changed': 0}]:
+        try:
+            table.put_item(Item=encode_document(item), ConditionExpression='attribute_not_exists(pk)')
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+    version = (fridges_item or {}).get('version')
+    try:
+        table.put_item(Item={'pk': pk, 'type': 'fridges', 'fridges': fridges[1:] + [{'fridge_id': fridge_id,
+                                                                                     'fridge_name': fridge_name}],
+                             'version': (version or 0) + 1},
+                       **get_version_condition(version))
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            raise ConcurrentUpdateError(f'Fridges of {pk} were changed by another request')
+        raise
+
+    known_fridges.add(fridge_key)
+    return generate_response(201, f'Fridge {fridge_name} added successfully',
+                             {'fridges': fridges + [{'fridge_id': fridge_id, 'fridge_name': fridge_name}]})
+
+
+def view_all_fridges(table, pk):
+    """
+    Gets a restaurant's stock of each item across all of its fridges. The fridges are read in parallel, so the view
+    takes about as long as reading the largest one.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :return: API response with the fridges and, per item, the quantities summed over every fridge and each fridge's
+    quantity.
+    """
+    fridges, items = load_restaurant_stock(table, pk)
+    if items is None:
+        return generate_response(404, 'Inventory item not found')
+
+    return generate_response(200, 'Stock retrieved successfully', {'fridges': fridges, 'items': items})
+
+
+def load_restaurant_stock(table, pk):
+    """
+    Reads every fridge of a restaurant in parallel and sums each item's stock over them.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :return: (fridges with their item counts, items sorted by name with the quantities summed over every fridge and
+    each fridge's quantity, or None if the restaurant has no fridge).
+    """
+    _, fridges = load_fridge_list(table, pk)
+
+    def load_fridge_stock(fridge):
+        fridge_key = get_fridge_key(pk, fridge['fridge_id'])
+        return merge_fridge_shards(fridge_key, load_fridge_shards(table, fridge_key, consistent_read=False))
+
+    with ThreadPoolExecutor(max_workers=min(FRIDGE_FAN_OUT_WORKERS, len(fridges))) as executor:
+        fridge_items = list(executor.map(load_fridge_stock, fridges))
+
+    current_time = get_current_time_gmt()
+    stock = {}
+    for fridge, item in zip(fridges, fridge_items):
+        fridge['item_count'] = len((item or {}).get('items', []))
+        for stored_item in (item or {}).get('items', []):
+            total_quantity, non_expired_quantity = get_item_totals(stored_item, current_time)
+            totals = stock.setdefault(stored_item['item_name'], {
+                'item_name': stored_item['item_name'], 'desired_quantity': 0, 'total_quantity': 0,
+                'non_expired_quantity': 0, 'fridges': {}
+            })
+            totals['desired_quantity'] += stored_item.get('desired_quantity', 0)
+            totals['total_quantity'] += total_quantity
+            totals['non_expired_quantity'] += non_expired_quantity
+            totals['fridges'][fridge['fridge_id']] = total_quantity
+
+    if all(item is None for item in fridge_items):
+        return fridges, None
+
+    items = [stock[item_name] for item_name in sorted(stock)]
+    for totals in items:
+        totals['is_low'] = totals['non_expired_quantity'] < totals['desired_quantity']
+    return fridges, items
+
+
+def mark_restaurant_mutated(table, pk):
+    """
+    Stamps the restaurant's admin settings with the time of its latest inventory write, this lets the nightly
+    update_orders run skip restaurants that have not changed since it last processed them.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :return: None.
+    """
+    try:
+        table.update_item(
+            Key={'pk': pk, 'type': 'admin_settings'},
+            UpdateExpression='SET last_mutated = :now',
+            ConditionExpression='attribute_exists(pk)',
+            ExpressionAttributeValues={':now': get_current_time_gmt()}
+        )
+    except ClientError as e:
+        # the write itself succeeded, a missing watermark only costs a redundant nightly run
+        logger.warning(f"Could not mark {pk} as mutated: {str(e)}")
+
+
 def add_new_item(table, pk, body):
     """
     Adds a new item to the inventory if it doesn't exist.
@@ -47,14 +967,13 @@ def add_new_item(table, pk, body):
     quantity = body.get('quantity', 0)  # delivery of new item edge case
     current_time = get_current_time_gmt()
 
-    table_response = table.get_item(Key={'pk': pk, 'type': 'fridge'})
-    item = table_response.get('Item', {'items': []})
+    item = load_item_fridge(table, pk, item_name) or {'pk': pk, 'type': 'fridge', 'items': []}
 
     for stored_item in item['items']:
         if stored_item['item_name'].lower() == item_name:
             return generate_response(409, f'Item {item_name} already exists')
 
-    item['items'].append({
+    new_item = {
         'item_name': item_name,
         'desired_quantity': desired_quantity,
         'item_list': [{
@@ -63,10 +982,11 @@ def add_new_item(table, pk, body):
             'date_added': current_time,
             'date_removed': 0
         }]
-    })
+    }
+    item['items'].append(new_item)
 
-    table.put_item(Item=item)
-    return generate_response(200, f'New item {item_name} added successfully')
+    save_fridge(table, item)
+    return generate_response(200, f'New item {item_name} added successfully', {'item': get_visible_item(new_item)})
 
 
 def add_delivery_item(table, pk, body):
@@ -82,8 +1002,7 @@ def add_delivery_item(table, pk, body):
     expiry_date = body.get('expiry_date')
     current_time = get_current_time_gmt()
 
-    table_response = table.get_item(Key={'pk': pk, 'type': 'fridge'})
-    item = table_response.get('Item')
+    item = load_item_fridge(table, pk, item_name)
 
     if not item:
         return generate_response(404, 'Inventory item not found')
@@ -97,8 +1016,9 @@ def add_delivery_item(table, pk, body):
                 'date_removed': 0
             })
 
-            table.put_item(Item=item)
-            return generate_response(200, f'Delivery item {item_name} added successfully')
+            save_fridge(table, item)
+            return generate_response(200, f'Delivery item {item_name} added successfully',
+                                     {'item': get_visible_item(stored_item)})
 
     # add the item as a new item
     body['desired_quantity'] = quantity
@@ -118,8 +1038,7 @@ def update_item_quantity(table, pk, body):
     expiry_date = body.get('expiry_date')
     date_added = body.get('date_added')
 
-    table_response = table.get_item(Key={'pk': pk, 'type': 'fridge'})
-    item = table_response.get('Item')
+    item = load_item_fridge(table, pk, item_name)
 
     if not item:
         return generate_response(404, 'Inventory item not found')
@@ -131,17 +1050,204 @@ def update_item_quantity(table, pk, body):
                     item_detail['current_quantity'] += quantity_change
                     if item_detail['current_quantity'] < 0: 
                         return generate_response(400, f'Quantity cannot be negative for {item_name}')
+                    if item_detail['current_quantity'] == 0:
+                        # delete_item stamps the batch removed, the history records what this took out
+                        item_detail['removed_quantity'] = -quantity_change
 
-                    table.put_item(Item=item)
+                    save_fridge(table, item)
 
                     # if current_quantity is 0, delete the item
                     if item_detail['current_quantity'] == 0:
                         return delete_item(table, pk, body)
                     else:
-                        return generate_response(200, f'Quantity updated for {item_name}')
+                        return generate_response(200, f'Quantity updated for {item_name}',
+                                                 {'item': get_visible_item(stored_item)})
     return generate_response(404, f'Item {item_name} not found in inventory')
 
 
+def consume_item(table, pk, body):
+    """
+    Takes units of an item out of the inventory, earliest expiring batch first, never from expired batches.
+
+    The whole amount is taken in one write, or nothing is taken if there is not enough unexpired stock. Batches that
+    run out are marked removed. If another request changes the fridge at the same time, the fridge is read again and the
+    consumption retried.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :param body: Request data, 'item_name' and the 'quantity' to take out.
+    :return: API response with the item and the batches taken from.
+    """
+    item_name = str(body.get('item_name', '')).lower()
+    try:
+        quantity = int(body.get('quantity'))
+    except (TypeError, ValueError):
+        return generate_response(400, 'quantity must be a whole number')
+
+    if quantity <= 0:
+        return generate_response(400, 'quantity must be greater than 0')
+
+    for attempt in range(CONSUME_ATTEMPTS):
+        item = load_item_fridge(table, pk, item_name)
+        if not item:
+            return generate_response(404, 'Inventory item not found')
+
+        stored_item = next((stored_item for stored_item in item['items']
+                            if stored_item['item_name'].lower() == item_name), None)
+        if stored_item is None:
+            return generate_response(404, f'Item {item_name} not found in inventory')
+
+        batches, shortfall = take_from_batches(stored_item['item_list'], quantity, get_current_time_gmt())
+        if shortfall:
+            return generate_response(409, f'Only {quantity - shortfall} of {item_name} in stock',
+                                     {'available': quantity - shortfall})
+
+        try:
+            save_fridge(table, item)
+        except ConcurrentUpdateError:
+            logger.info(f"Fridge for {pk} changed while consuming {item_name}, attempt {attempt + 1}")
+            continue
+
+        return generate_response(200, f'{quantity} of {item_name} consumed',
+                                 {'item': get_visible_item(stored_item), 'item_name': stored_item['item_name'],
+                                  'batches': batches})
+
+    raise ConcurrentUpdateError(f'Inventory for {pk} kept changing while consuming {item_name}')
+
+
+def consume_items(table, pk, body):
+    """
+    Takes the quantities used of many items out of the inventory in one write, earliest expiring batch first.
+
+    Meant for a day of sales at once, so an item without enough stock is emptied and its shortfall reported rather
+    than failing the whole import. Each entry can say when its sales were made in 'consumed_at', so stock that expired
+    after the sale but before the import is still used. A sharded fridge gets one write per shard holding any of the
+    items, and a write cannot be undone once made, so items whose shard kept changing are reported as unapplied rather
+    than failing a request that has already taken the other items.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :param body: Request data, 'items' is a list of dicts with 'item_name', 'quantity' and optionally 'consumed_at'.
+    :return: API response with the quantity consumed and short of each item, the names not in the inventory, and the
+    names not applied.
+    """
+    requested = {}
+    for entry in body.get('items') or []:
+        try:
+            item_name = str(entry['item_name']).lower()
+            quantity = int(entry['quantity'])
+            consumed_at = entry.get('consumed_at')
+            consumed_at = None if consumed_at is None else int(consumed_at)
+        except (KeyError, TypeError, ValueError):
+            return generate_response(400, 'items must be a list of item_name and quantity')
+        if quantity <= 0:
+            return generate_response(400, f'quantity for {item_name} must be greater than 0')
+        if consumed_at is not None and consumed_at <= 0:
+            return generate_response(400, f'consumed_at for {item_name} must be a unix timestamp')
+        sales = requested.setdefault(item_name, {})
+        sales[consumed_at] = sales.get(consumed_at, 0) + quantity
+
+    if not requested:
+        return generate_response(400, 'No items to consume')
+
+    # each shard is written once, so on a conflict only the items of the shards not yet written are retried
+    results = {}
+    pending = dict(requested)
+    unapplied = set()
+    for attempt in range(CONSUME_ATTEMPTS):
+        shards = load_fridge_shards(table, pk)
+        if not shards:
+            return generate_response(404, 'Inventory item not found')
+
+        current_time = get_current_time_gmt()
+        unapplied = set()
+        for item in shards:
+            stored_items = {stored_item['item_name'].lower(): stored_item for stored_item in item['items']}
+            shard_results = {}
+            for item_name, sales in pending.items():
+                if item_name in stored_items:
+                    shard_results[item_name] = take_sales(stored_items[item_name]['item_list'], sales, current_time)
+
+            if not shard_results:
+                continue
+            try:
+                save_fridge(table, item)
+            except ConcurrentUpdateError:
+                logger.info(f"Fridge for {item['pk']} changed while consuming items, attempt {attempt + 1}")
+                unapplied.update(shard_results)
+                continue
+
+            results.update(shard_results)
+            for item_name in shard_results:
+                del pending[item_name]
+
+        if not unapplied:
+            break
+
+    if unapplied and not results:
+        raise ConcurrentUpdateError(f'Inventory for {pk} kept changing while consuming items')
+    if unapplied:
+        logger.warning(f"Fridge for {pk} kept changing, {len(unapplied)} items were not consumed")
+
+    return generate_response(200, f'{len(results)} items consumed', {
+        'items': results,
+        'not_found': sorted(set(pending) - unapplied),
+        'unapplied': sorted(unapplied)
+    })
+
+
+def take_sales(item_list, sales, current_time):
+    """
+    Takes an item's sales from its batches in place, in the order they were made.
+    :param item_list: Batches of an item.
+    :param sales: Dict of when sales were made, None for now, to the quantity sold.
+    :param current_time: Current time, sales cannot be made later than it.
+    :return: Dict of the quantity consumed and the shortfall.
+    """
+    consumed = 0
+    shortfall = 0
+    for consumed_at in sorted(sales, key=lambda sale_time: (sale_time is None, sale_time or 0)):
+        sale_time = current_time if consumed_at is None else min(consumed_at, current_time)
+        _, short = take_from_batches(item_list, sales[consumed_at], current_time, sale_time)
+        consumed += sales[consumed_at] - short
+        shortfall += short
+
+    return {'consumed': consumed, 'shortfall': shortfall}
+
+
+def take_from_batches(item_list, quantity, current_time, consumed_at=None):
+    """
+    Takes a quantity from an item's batches in place, earliest expiry first, then oldest delivery first.
+
+    Batches that had expired when the stock was used are left alone, they are thrown away rather than used.
+    :param item_list: Batches of an item.
+    :param quantity: Quantity to take.
+    :param current_time: Time to mark emptied batches as removed.
+    :param consumed_at: Time the stock was used to skip expired batches, current_time if not given.
+    :return: (batches taken from with the quantity taken and left, quantity that could not be taken).
+    """
+    if consumed_at is None:
+        consumed_at = current_time
+
+    in_stock = [detail for detail in item_list if detail.get('date_removed', 0) == 0 and detail['current_quantity'] > 0
+                and (detail['expiry_date'] is None or detail['expiry_date'] > consumed_at)]
+    in_stock.sort(key=lambda detail: (detail['expiry_date'] is None, detail['expiry_date'] or 0, detail['date_added']))
+
+    batches = []
+    for detail in in_stock:
+        if quantity == 0:
+            break
+
+        taken = min(quantity, detail['current_quantity'])
+        detail['current_quantity'] -= taken
+        if detail['current_quantity'] == 0:
+            detail['date_removed'] = current_time
+            detail['removed_quantity'] = taken
+        quantity -= taken
+        batches.append({'expiry_date': detail['expiry_date'], 'date_added': detail['date_added'], 'consumed': taken,
+                        'remaining': detail['current_quantity']})
+
+    return batches, quantity
+
+
 def delete_item(table, pk, body):
     """
     Deletes an item entirely from the inventory.
@@ -154,94 +1260,174 @@ def delete_item(table, pk, body):
     current_quantity = body.get('current_quantity', 0)
     expiry_date = body.get('expiry_date')
 
-    table_response = table.get_item(Key={'pk': pk, 'type': 'fridge'})
-    item = table_response.get('Item')
+    item = load_item_fridge(table, pk, item_name)
 
     if not item:
         return generate_response(404, 'Inventory item not found')
 
     for stored_item in item['items']:
         if stored_item['item_name'] == item_name:
+            # removed batches are stamped rather than dropped, save_fridge moves them into the history
+            current_time = get_current_time_gmt()
             for detail in stored_item['item_list']:
-                if detail['current_quantity'] == 0:
-                    detail['date_removed'] = get_current_time_gmt()
-            if current_quantity == 0:
-                stored_item['item_list'] = [detail for detail in stored_item['item_list']
-                                            if not detail['current_quantity'] == current_quantity]
-            else:
-                stored_item['item_list'] = [detail for detail in stored_item['item_list']
-                                            if not (detail['expiry_date'] == expiry_date and
-                                                    detail['current_quantity'] == current_quantity)]
-                if not stored_item['item_list']:
-                    item['items'] = [i for i in item['items'] if i['item_name'] != item_name]
-            table.put_item(Item=item)
-            return generate_response(200, f'Item {item_name} updated successfully')
+                if detail.get('date_removed', 0) != 0:
+                    continue
+                if detail['current_quantity'] == 0 or (current_quantity != 0 and
+                                                       detail['expiry_date'] == expiry_date and
+                                                       detail['current_quantity'] == current_quantity):
+                    detail['date_removed'] = current_time
+
+            removed_items = []
+            if current_quantity != 0 and get_visible_item(stored_item) is None:
+                item['items'] = [i for i in item['items'] if i['item_name'] != item_name]
+                removed_items.append(stored_item)
+            save_fridge(table, item, removed_items)
+            return generate_response(200, f'Item {item_name} updated successfully',
+                                     {'item': get_visible_item(stored_item), 'item_name': item_name})
 
     return generate_response(404, f'Item {item_name} not found in inventory')
 
 
+def get_door_state_item(table, pk):
+    """
+    Gets a restaurant's door state, falling back to the flags restaurants created before door_state kept on the fridge.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :return: Door state item, or None if the restaurant has no fridge.
+    """
+    door_state = table.get_item(Key={'pk': pk, 'type': 'door_state'}).get('Item')
+    if door_state:
+        return door_state
+
+    fridge = table.get_item(Key={'pk': pk, 'type': 'fridge'}).get('Item')
+    if not fridge:
+        return None
+
+    return {
+        'pk': pk,
+        'type': 'door_state',
+        'is_front_door_open': fridge.get('is_front_door_open', False),
+        'is_back_door_open': fridge.get('is_back_door_open', False),
+        'last_changed': 0
+    }
+
+
+def record_door_event(table, pk, action, current_time):
+    """
+    Adds a door event to the restaurant's door history, ordered by time.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :param action: Door action that happened.
+    :param current_time: Time of the event.
+    :return: None.
+    """
+    table.put_item(Item={
+        'pk': f'{pk}{DOOR_EVENTS_SUFFIX}',
+        'type': f'{current_time:012d}#{uuid.uuid4().hex[:8]}',
+        'action': action,
+        'time': current_time
+    })
+
+
 def modify_door_state(table, pk, body, action):
     """
-    Modifies the state of the door (open/close) in inventory.
+    Modifies the state of the door (open/close), without touching the inventory.
     :param table: DynamoDB table.
     :param pk: Primary key.
     :param body: State details.
     :param action: Specific door action.
     :return: API response with operation result.
     """
-    table_response = table.get_item(Key={'pk': pk, 'type': 'fridge'})
-    item = table_response.get('Item')
+    door, is_open = DOOR_ACTIONS[action]
+    current_time = get_current_time_gmt()
 
-    if not item:
-        return generate_response(404, 'Inventory item not found')
+    for attempt in range(2):
+        try:
+            door_state = table.update_item(
+                Key={'pk': pk, 'type': 'door_state'},
+                UpdateExpression='SET #door = :is_open, last_changed = :now',
+                ConditionExpression='attribute_exists(pk)',
+                ExpressionAttributeNames={'#door': door},
+                ExpressionAttributeValues={':is_open': is_open, ':now': current_time},
+                ReturnValues='ALL_NEW'
+            )['Attributes']
+            break
+
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException' or attempt:
+                raise
+
+            # Restaurants created before door_state get one, copied from their fridge, the first time a door moves
+            door_state = get_door_state_item(table, pk)
+            if not door_state:
+                return generate_response(404, 'Inventory item not found')
+
+            try:
+                table.put_item(Item=door_state, ConditionExpression='attribute_not_exists(pk)')
+            except ClientError as put_error:
+                if put_error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+
+    record_door_event(table, pk, action, current_time)
 
-    # Handle each action separately
-    if action == "open_back_door":
-        item['is_back_door_open'] = True
-    elif action == "close_back_door":
-        item['is_back_door_open'] = False
-    elif action == "open_front_door":
-        item['is_front_door_open'] = True
-    elif action == "close_front_door":
-        item['is_front_door_open'] = False
-
-    table.put_item(Item=item)
     return generate_response(200, 'Door state updated successfully',
-                             {'is_front_door_open': item.get('is_front_door_open', False),
-                              'is_back_door_open': item.get('is_back_door_open', False)})
+                             {'is_front_door_open': door_state.get('is_front_door_open', False),
+                              'is_back_door_open': door_state.get('is_back_door_open', False)})
 
 
-def get_low_stock(table, pk):
+def get_door_state(table, pk, body):
     """
-    Retrieves items that are low in stock.
+    Gets the state of the doors, and optionally the most recent door events.
     :param table: DynamoDB table.
     :param pk: Primary key.
-    :return: API response with low stock items.
+    :param body: Request data, 'events' is the number of recent door events to include.
+    :return: API response with the door state.
     """
     try:
-        dynamo_response = table.get_item(
-            Key={
-                'pk': pk,
-                'type': 'fridge'
-            }
+        event_count = int(body.get('events', 0))
+    except (TypeError, ValueError):
+        return generate_response(400, 'events must be a whole number')
+
+    door_state = get_door_state_item(table, pk)
+    if not door_state:
+        return generate_response(404, 'Inventory item not found')
+
+    details = {
+        'is_front_door_open': door_state.get('is_front_door_open', False),
+        'is_back_door_open': door_state.get('is_back_door_open', False),
+        'last_changed': door_state.get('last_changed', 0)
+    }
+
+    if event_count > 0:
+        events_response = table.query(
+            KeyConditionExpression=Key('pk').eq(f'{pk}{DOOR_EVENTS_SUFFIX}'),
+            ScanIndexForward=False,
+            Limit=event_count
         )
-        item = dynamo_response.get('Item', {'items': []})
+        details['events'] = [{'action': event['action'], 'time': event['time']}
+                             for event in events_response.get('Items', [])]
 
-        low_stock = []
+    return generate_response(200, 'Door state retrieved successfully', details)
 
-        for food_item in item['items']:
-            name = food_item['item_name']
-            desired_quantity = food_item['desired_quantity']
 
-            current_quantity = 0
-            for entry in food_item['item_list']:
-                current_quantity += entry['current_quantity']
+def get_low_stock(table, pk):
+    """
+    Retrieves items that are low in stock across all of a restaurant's fridges, the same way orders_mgr orders them,
+    so the low stock email lists every shortfall that is ordered.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :return: API response with low stock items.
+    """
+    try:
+        _, items = load_restaurant_stock(table, pk)
 
-            if current_quantity < desired_quantity:
+        low_stock = []
+        for totals in items or []:
+            if totals['is_low']:
                 low_stock.append({
-                    'item_name': name,
-                    'desired_quantity': desired_quantity,
-                    'current_quantity': current_quantity
+                    'item_name': totals['item_name'],
+                    'desired_quantity': totals['desired_quantity'],
+                    'current_quantity': totals['non_expired_quantity']
                 })
 
         response = {
@@ -271,8 +1457,7 @@ def update_desired_quantity(table, pk, body):
     item_name = body.get('item_name')
     desired_quantity = body.get('desired_quantity')
 
-    table_response = table.get_item(Key={'pk': pk, 'type': 'fridge'})
-    item = table_response.get('Item')
+    item = load_item_fridge(table, pk, item_name)
 
     if not item:
         return generate_response(404, 'Inventory item not found')
@@ -280,8 +1465,9 @@ def update_desired_quantity(table, pk, body):
     for stored_item in item['items']:
         if stored_item['item_name'] == item_name:
             stored_item['desired_quantity'] = desired_quantity
-            table.put_item(Item=item)
-            return generate_response(200, f'Desired quantity updated for {item_name}')
+            save_fridge(table, item)
+            return generate_response(200, f'Desired quantity updated for {item_name}',
+                                     {'item': get_visible_item(stored_item)})
 
     return generate_response(404, f'Item {item_name} not found in inventory')
 
@@ -294,11 +1480,15 @@ def view_inventory(table, pk):
     :return: API response with inventory details.
     """
     try:
-        table_response = table.get_item(Key={'pk': pk, 'type': 'fridge'})
-        item = table_response.get('Item', {})
+        door_state = table.get_item(Key={'pk': pk, 'type': 'door_state'}).get('Item', {})
+        item = merge_fridge_shards(pk, load_fridge_shards(table, pk, consistent_read=False)) or {}
 
         delete_removed_items(item)
 
+        # door state lives in its own item, older restaurants may still only have the flags on the fridge
+        for flag in ['is_front_door_open', 'is_back_door_open']:
+            item[flag] = door_state.get(flag, item.get(flag, False))
+
         return generate_response(200, 'Inventory retrieved successfully', item)
     except Exception as e:
         return generate_response(500, 'Error retrieving inventory: ' + str(e))
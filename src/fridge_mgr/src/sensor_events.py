@@ -0,0 +1,230 @@
+import os
+from datetime import datetime, timezone, timedelta
+from decimal import Decimal, InvalidOperation
+
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+from .inventory_utils import (generate_response, get_current_time_gmt, record_door_event, get_shard_settings,
+                              get_shard, get_shard_key)
+
+# sensor events are kept in one partition per restaurant per UTC day, {restaurant}#sensors#{YYYY-MM-DD}, so a busy
+# fridge spreads its writes over time and a date range can be read without touching older data. Restaurants with a
+# sharded fridge also spread each day over {restaurant}#sensors#{day}#shard#{n}, picked by sensor. A restaurant's
+# other fridges keep their events under their own fridge key, {restaurant}#fridge#{fridge_id}#sensors#{day}
+SENSOR_PARTITION = '{restaurant}#sensors#{day}'
+SENSOR_EVENT_TYPES = ['door', 'temperature']
+DOORS = {'front': 'is_front_door_open', 'back': 'is_back_door_open'}
+
+MAX_EVENTS_PER_BATCH = 1000
+MAX_SUMMARY_DAYS = 31
+DEFAULT_BUCKET_SECONDS = 3600
+SENSOR_RETENTION_DAYS = int(os.environ.get('SENSOR_RETENTION_DAYS', 90))
+
+
+def get_sensor_partition(restaurant, timestamp, shard=0):
+    """
+    Gets the partition key holding a restaurant's sensor events for the day of a timestamp.
+    :param restaurant: Restaurant name.
+    :param timestamp: Unix timestamp of the event.
+    :param shard: Shard of the day the event is kept in.
+    :return: Partition key.
+    """
+    day = datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime('%Y-%m-%d')
+    return get_shard_key(SENSOR_PARTITION.format(restaurant=restaurant, day=day), shard)
+
+
+def parse_sensor_event(event):
+    """
+    Validates a sensor event from a fridge.
+    :param event: Dict with sensor_id, event_type, timestamp, and door and is_open for door events or value for
+        temperature events.
+    :return: Normalised event, or None if the event is invalid.
+    """
+    try:
+        sensor_id = str(event['sensor_id'])
+        event_type = event['event_type']
+        timestamp = int(event['timestamp'])
+        if not sensor_id or '#' in sensor_id or event_type not in SENSOR_EVENT_TYPES or timestamp <= 0:
+            return None
+
+        parsed = {'sensor_id': sensor_id, 'event_type': event_type, 'timestamp': timestamp}
+        if event_type == 'door':
+            if event['door'] not in DOORS or not isinstance(event['is_open'], bool):
+                return None
+            parsed.update(door=event['door'], is_open=event['is_open'])
+        else:
+            parsed['value'] = Decimal(str(event['value']))
+            if not parsed['value'].is_finite():
+                return None
+
+        return parsed
+
+    except (KeyError, TypeError, ValueError, InvalidOperation):
+        return None
+
+
+def ingest_sensor_events(table, pk, body):
+    """
+    Stores a batch of timestamped sensor events from a restaurant's fridges.
+
+    Each event's key is built from its timestamp, sensor and type, so events repeated within a batch are dropped and
+    events resent in a later batch overwrite themselves instead of being stored twice. The latest door event for each
+    door also updates the restaurant's door state, unless the door has been changed more recently.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :param body: Request data, 'events' is the list of sensor events.
+    :return: API response with the number of events accepted, duplicated and rejected.
+    """
+    events = body.get('events')
+    if not isinstance(events, list) or len(events) > MAX_EVENTS_PER_BATCH:
+        return generate_response(400, f'events must be a list of at most {MAX_EVENTS_PER_BATCH} events')
+
+    write_shards, _ = get_shard_settings(table, pk)
+    unique_events = {}
+    rejected = 0
+    for event in events:
+        parsed = parse_sensor_event(event)
+        if parsed is None:
+            rejected += 1
+            continue
+
+        sort_key = f"{parsed['timestamp']:012d}#{parsed['sensor_id']}#{parsed['event_type']}"
+        if parsed['event_type'] == 'door':
+            sort_key += f"#{parsed['door']}"
+        partition = get_sensor_partition(pk, parsed['timestamp'], get_shard(parsed['sensor_id'], write_shards))
+        unique_events[(partition, sort_key)] = parsed
+
+    expires_at = get_current_time_gmt() + SENSOR_RETENTION_DAYS * 86400
+    latest_door_events = {}
+    with table.batch_writer() as batch:
+        for (partition, sort_key), event in unique_events.items():
+            batch.put_item(Item={'pk': partition, 'type': sort_key, 'expires_at': expires_at, **event})
+
+            if event['event_type'] == 'door':
+                latest = latest_door_events.get(event['door'])
+                if latest is None or event['timestamp'] >= latest['timestamp']:
+                    latest_door_events[event['door']] = event
+
+    for door, event in latest_door_events.items():
+        apply_door_event(table, pk, door, event)
+
+    return generate_response(200, 'Sensor events stored successfully', {
+        'accepted': len(unique_events),
+        'duplicates': len(events) - rejected - len(unique_events),
+        'rejected': rejected
+    })
+
+
+def apply_door_event(table, pk, door, event):
+    """
+    Updates the door state from a sensor, unless the doors have changed since the event.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :param door: 'front' or 'back'.
+    :param event: Latest door event for the door.
+    :return: None.
+    """
+    try:
+        previous = table.update_item(
+            Key={'pk': pk, 'type': 'door_state'},
+            UpdateExpression='SET #door = :is_open, last_changed = :time',
+            ConditionExpression='attribute_exists(pk) AND last_changed <= :time',
+            ExpressionAttributeNames={'#door': DOORS[door]},
+            ExpressionAttributeValues={':is_open': event['is_open'], ':time': event['timestamp']},
+            ReturnValues='UPDATED_OLD'
+        ).get('Attributes', {})
+
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return
+        raise
+
+    # only record the door actually moving, so a resent batch does not repeat history
+    if previous.get(DOORS[door]) != event['is_open']:
+        record_door_event(table, pk, f"{'open' if event['is_open'] else 'close'}_{door}_door", event['timestamp'])
+
+
+def get_sensor_summary(table, pk, body):
+    """
+    Gets a restaurant's sensor events between two times, downsampled into fixed size buckets.
+
+    Each bucket holds the minimum, maximum, and average temperature and reading count per sensor, and the number of
+    times each door was opened.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :param body: Request data with 'start' and 'end' unix timestamps, and optionally 'bucket_seconds' and 'sensor_id'.
+    :return: API response with the buckets in time order.
+    """
+    try:
+        start = int(body['start'])
+        end = int(body['end'])
+        bucket_seconds = int(body.get('bucket_seconds', DEFAULT_BUCKET_SECONDS))
+    except (KeyError, TypeError, ValueError):
+        return generate_response(400, 'start and end must be unix timestamps')
+
+    if end < start or bucket_seconds <= 0:
+        return generate_response(400, 'end must not be before start and bucket_seconds must be positive')
+    if end - start > MAX_SUMMARY_DAYS * 86400:
+        return generate_response(400, f'Sensor summaries cover at most {MAX_SUMMARY_DAYS} days')
+
+    sensor_id = body.get('sensor_id')
+    buckets = {}
+    for event in query_sensor_events(table, pk, start, end):
+        if sensor_id and event['sensor_id'] != sensor_id:
+            continue
+
+        bucket_start = start + (int(event['timestamp']) - start) // bucket_seconds * bucket_seconds
+        bucket = buckets.setdefault(bucket_start, {'start': bucket_start, 'temperature': {}, 'door_opens': {}})
+
+        if event['event_type'] == 'temperature':
+            value = event['value']
+            stats = bucket['temperature'].setdefault(event['sensor_id'], {'min': value, 'max': value, 'total': 0,
+                                                                          'count': 0})
+            stats['min'] = min(stats['min'], value)
+            stats['max'] = max(stats['max'], value)
+            stats['total'] += value
+            stats['count'] += 1
+        elif event['is_open']:
+            bucket['door_opens'][event['door']] = bucket['door_opens'].get(event['door'], 0) + 1
+
+    for bucket in buckets.values():
+        for stats in bucket['temperature'].values():
+            stats['avg'] = round(stats.pop('total') / stats['count'], 2)
+
+    return generate_response(200, 'Sensor summary retrieved successfully', {
+        'bucket_seconds': bucket_seconds,
+        'buckets': [buckets[bucket_start] for bucket_start in sorted(buckets)]
+    })
+
+
+def query_sensor_events(table, pk, start, end):
+    """
+    Reads a restaurant's sensor events between two times from each day's partition, and each shard of it.
+    :param table: DynamoDB table.
+    :param pk: Primary key.
+    :param start: Start unix timestamp, inclusive.
+    :param end: End unix timestamp, inclusive.
+    :return: Generator of sensor events.
+    """
+    _, event_shards = get_shard_settings(table, pk)
+    day = datetime.fromtimestamp(start, tz=timezone.utc).date()
+    last_day = datetime.fromtimestamp(end, tz=timezone.utc).date()
+    while day <= last_day:
+        for shard in range(event_shards):
+            partition = get_shard_key(SENSOR_PARTITION.format(restaurant=pk, day=day.isoformat()), shard)
+            query_arguments = {
+                'KeyConditionExpression': Key('pk').eq(partition) &
+                                          Key('type').between(f'{start:012d}', f'{end:012d}~'),
+                'ProjectionExpression': 'sensor_id, event_type, #ts, door, is_open, #value',
+                'ExpressionAttributeNames': {'#ts': 'timestamp', '#value': 'value'}
+            }
+
+            while True:
+                response = table.query(**query_arguments)
+                yield from response.get('Items', [])
+                if 'LastEvaluatedKey' not in response:
+                    break
+                query_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        day += timedelta(days=1)
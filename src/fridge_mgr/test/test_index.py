@@ -1,8 +1,27 @@
 import json
 import unittest
-from unittest.mock import patch, MagicMock, ANY, Mock
-from src.fridge_mgr.src.inventory_utils import modify_door_state, generate_response, delete_zero_quantity_items, update_item_quantity, add_new_item, add_delivery_item
+from botocore.exceptions import ClientError
+from unittest.mock import patch, MagicMock, ANY, Mock, call
+from src.fridge_mgr.src.inventory_utils import modify_door_state, get_door_state, generate_response, delete_zero_quantity_items, update_item_quantity, add_new_item, add_delivery_item, delete_item, consume_item, consume_items, get_low_stock, recompute_totals, get_item_totals, get_expiring, get_history, compact_history, load_fridge, save_fridge, load_item_fridge, set_write_shards, get_shard, get_shard_key, get_restaurant, shard_settings_cache, add_fridge, view_all_fridges, get_fridge_key, known_fridges, ConcurrentUpdateError
 from src.fridge_mgr.src.index import handler
+from src.fridge_mgr.src.sensor_events import ingest_sensor_events, get_sensor_summary
+from src.fridge_mgr.src.documents import encode_document, decode_document
+from src.fridge_mgr.src.idempotency import run_idempotent, get_request_hash
+
+
+def get_written_fridge(table):
+    # a write that removes batches puts the fridge and their history in one transaction
+    if table.meta.client.transact_write_items.called:
+        return table.meta.client.transact_write_items.call_args.kwargs['TransactItems'][0]['Put']['Item']
+    return table.put_item.call_args.kwargs['Item']
+
+
+def get_written_history(table):
+    if not table.meta.client.transact_write_items.called:
+        return []
+    actions = table.meta.client.transact_write_items.call_args.kwargs['TransactItems']
+    return [action['Put']['Item'] for action in actions[1:]]
+
 class TestDynamoDBHandler(unittest.TestCase):
 
     @patch('boto3.resource')
@@ -29,7 +48,8 @@ class TestDynamoDBHandler(unittest.TestCase):
 
         expected_response = {
             'statusCode': 200,
-            'body': {'details': 'Inventory retrieved successfully', 'additional_details': {'pk': 'restaurant_1', 'type': 'fridge', 'items': []}}
+            'body': {'details': 'Inventory retrieved successfully', 'additional_details': {'pk': 'restaurant_1', 'type': 'fridge', 'items': [],
+                                                                                           'is_front_door_open': False, 'is_back_door_open': False}}
         }
 
         self.assertEqual(response, expected_response)
@@ -42,7 +62,7 @@ class TestModifyDoorStateFunction(unittest.TestCase):
         mock_table = MagicMock()
 
         # Expected return value
-        mock_table.get_item.return_value = {'Item': {'is_front_door_open': False, 'is_back_door_open': True}}
+        mock_table.update_item.return_value = {'Attributes': {'is_front_door_open': False, 'is_back_door_open': True}}
 
         # This is the test data that we will be using
         pk = 'test_pk'
@@ -65,7 +85,7 @@ class TestModifyDoorStateFunction(unittest.TestCase):
         mock_table = MagicMock()
 
         # Expected return value
-        mock_table.get_item.return_value = {'Item': {'is_front_door_open': True, 'is_back_door_open': True}}
+        mock_table.update_item.return_value = {'Attributes': {'is_front_door_open': False, 'is_back_door_open': True}}
 
         # This is the test data that we will be using
         pk = 'test_pk'
@@ -155,9 +175,9 @@ class TestUpdateItemQuantity(unittest.TestCase):
     def test_expected_parameters(self):
         table = MagicMock()
         table.get_item.return_value = {'Item': {'pk': 'test_pk', 'type': 'fridge', 'items': [{'item_name': 'test_name',
-                        'item_list': [{'expiry_date': '01-02-01', 'date_added': '01-01-01', 'current_quantity': 5}]}]}}
+                        'item_list': [{'expiry_date': 1612137600, 'date_added': 1609459200, 'current_quantity': 5}]}]}}
         pk = 'test_pk'
-        body = {'item_name': 'test_name', 'quantity_change': 5, 'expiry_date': '01-02-01', 'date_added': '01-01-01'}
+        body = {'item_name': 'test_name', 'quantity_change': 5, 'expiry_date': 1612137600, 'date_added': 1609459200}
 
         response = update_item_quantity(table, pk, body)
 
@@ -169,7 +189,7 @@ class TestUpdateItemQuantity(unittest.TestCase):
         table = MagicMock()
         table.get_item.return_value = {'Item': {}}
         pk = 'test_pk'
-        body = {'item_name': 'test_name', 'quantity_change': 5, 'expiry_date': '01-02-01', 'date_added': '01-01-01'}
+        body = {'item_name': 'test_name', 'quantity_change': 5, 'expiry_date': 1612137600, 'date_added': 1609459200}
 
         response = update_item_quantity(table, pk, body)
 
@@ -180,9 +200,9 @@ class TestUpdateItemQuantity(unittest.TestCase):
     def test_table_item_no_match(self):
         table = MagicMock()
         table.get_item.return_value = {'Item': {'pk': 'test_pk', 'type': 'fridge', 'items': [{'item_name': 'test_name',
-                        'item_list': [{'expiry_date': '01-02-01', 'date_added': '01-01-01', 'current_quantity': 5}]}]}}
+                        'item_list': [{'expiry_date': 1612137600, 'date_added': 1609459200, 'current_quantity': 5}]}]}}
         pk = 'test_pk'
-        body = {'item_name': 'another_name', 'quantity_change': 5, 'expiry_date': '01-02-01', 'date_added': '01-01-01'}
+        body = {'item_name': 'another_name', 'quantity_change': 5, 'expiry_date': 1612137600, 'date_added': 1609459200}
 
         response = update_item_quantity(table, pk, body)
 
@@ -193,9 +213,9 @@ class TestUpdateItemQuantity(unittest.TestCase):
     def test_zero_quantity(self):
         table = MagicMock()
         table.get_item.return_value = {'Item': {'pk': 'test_pk', 'type': 'fridge', 'items': [{'item_name': 'test_name',
-                        'item_list': [{'expiry_date': '01-02-01', 'date_added': '01-01-01', 'current_quantity': 5}]}]}}
+                        'item_list': [{'expiry_date': 1612137600, 'date_added': 1609459200, 'current_quantity': 5}]}]}}
         pk = 'test_pk'
-        body = {'item_name': 'test_name', 'quantity_change': -5, 'expiry_date': '01-02-01', 'date_added': '01-01-01'}
+        body = {'item_name': 'test_name', 'quantity_change': -5, 'expiry_date': 1612137600, 'date_added': 1609459200}
 
         response = update_item_quantity(table, pk, body)
 
@@ -208,10 +228,10 @@ class TestAddNewItem(unittest.TestCase):
     def test_expected_parameters(self):
         table = MagicMock()
         table.get_item.return_value = {'Item': {'pk': 'test_pk', 'type': 'fridge', 'items': [{'item_name': 'test_name',
-                                       'desired_quantity': 1, 'item_list': [{'expiry_date': '01-01-01',
-                                       'date_added': '01-01-01', 'current_quantity': 1, 'date_removed': '01-01-01'}]}]}}
+                                       'desired_quantity': 1, 'item_list': [{'expiry_date': 1609459200,
+                                       'date_added': 1609459200, 'current_quantity': 1, 'date_removed': 1609459200}]}]}}
         pk = 'test_pk'
-        body = {'item_name': 'new_name', 'desired_quantity': 10, 'expiry_date': '01-02-01', 'quantity': 5}
+        body = {'item_name': 'new_name', 'desired_quantity': 10, 'expiry_date': 1612137600, 'quantity': 5}
 
         response = add_new_item(table, pk, body)
 
@@ -222,9 +242,9 @@ class TestAddNewItem(unittest.TestCase):
     def test_add_existing_item(self):
         table = MagicMock()
         table.get_item.return_value = {'Item': {'pk': 'test_pk', 'type': 'fridge', 'items': [{'item_name': 'test_name',
-                        'item_list': [{'expiry_date': '01-02-01', 'date_added': '01-01-01', 'current_quantity': 5}]}]}}
+                        'item_list': [{'expiry_date': 1612137600, 'date_added': 1609459200, 'current_quantity': 5}]}]}}
         pk = 'test_pk'
-        body = {'item_name': 'test_name', 'desired_quantity': 10, 'expiry_date': '01-02-01', 'quantity': 5}
+        body = {'item_name': 'test_name', 'desired_quantity': 10, 'expiry_date': 1612137600, 'quantity': 5}
 
         response = add_new_item(table, pk, body)
 
@@ -237,12 +257,12 @@ class TestAddDeliveryItem(unittest.TestCase):
     # Test set up
     def setUp(self):
         # Creates a mock DynamoDB table
-        self.dynamodb_table = Mock()
+        self.dynamodb_table = MagicMock()
         self.pk = 'sample_pk'
         self.body = {
             'item_name': 'sample_item',
             'quantity': 5,
-            'expiry_date': '2024-02-02'
+            'expiry_date': 1706832000
         }
     # Tests whether the add_delivery_item function is expected to add a delivered item to an existing inventory item
     def test_add_delivery_item_existing_item(self):
@@ -275,6 +295,855 @@ class TestAddDeliveryItem(unittest.TestCase):
         self.dynamodb_table.put_item.assert_not_called()
 
 
+# Tests that stock writes leave a watermark for the nightly update_orders run
+class TestMarkRestaurantMutated(unittest.TestCase):
+
+    @patch('boto3.resource')
+    def test_mutating_action_marks_restaurant(self, mock_boto3_resource):
+        mock_table = MagicMock()
+        mock_boto3_resource.return_value.Table.return_value = mock_table
+        mock_table.get_item.return_value = {'Item': {'pk': 'restaurant_1', 'type': 'fridge', 'items': []}}
+
+        mock_event = {
+            'body': {'restaurant_name': 'restaurant_1', 'item_name': 'milk', 'desired_quantity': 2},
+            'action': 'add_new_item'
+        }
+
+        response = handler(mock_event, {})
+
+        self.assertEqual(response['statusCode'], 200)
+        mock_table.update_item.assert_called_once_with(
+            Key={'pk': 'restaurant_1', 'type': 'admin_settings'},
+            UpdateExpression='SET last_mutated = :now',
+            ConditionExpression='attribute_exists(pk)',
+            ExpressionAttributeValues={':now': ANY}
+        )
+
+    @patch('boto3.resource')
+    def test_read_action_does_not_mark_restaurant(self, mock_boto3_resource):
+        mock_table = MagicMock()
+        mock_boto3_resource.return_value.Table.return_value = mock_table
+        mock_table.get_item.return_value = {'Item': {'pk': 'restaurant_1', 'type': 'fridge', 'items': []}}
+
+        handler({'body': {'restaurant_name': 'restaurant_1'}, 'action': 'get_low_stock'}, {})
+
+        mock_table.update_item.assert_not_called()
+
+
+# Tests that stock writes return the changed item so the page can update it in place
+class TestChangedItemInResponse(unittest.TestCase):
+
+    def setUp(self):
+        self.table = MagicMock()
+        self.table.get_item.return_value = {'Item': {'pk': 'test_pk', 'type': 'fridge', 'items': [{
+            'item_name': 'milk', 'desired_quantity': 4, 'item_list': [
+                {'expiry_date': 100, 'date_added': 1, 'current_quantity': 2, 'date_removed': 0},
+                {'expiry_date': 50, 'date_added': 1, 'current_quantity': 1, 'date_removed': 20}
+            ]}]}}
+
+    def test_update_returns_visible_item(self):
+        body = {'item_name': 'milk', 'quantity_change': 1, 'expiry_date': 100, 'date_added': 1}
+
+        response = update_item_quantity(self.table, 'test_pk', body)
+
+        self.assertEqual(response['body']['additional_details']['item'], {
+            'item_name': 'milk', 'desired_quantity': 4,
+            'item_list': [{'expiry_date': 100, 'date_added': 1, 'current_quantity': 3, 'date_removed': 0}],
+            'total_quantity': 3, 'non_expired_quantity': 0, 'next_expiry': None
+        })
+
+    def test_delete_last_batch_returns_no_item(self):
+        body = {'item_name': 'milk', 'current_quantity': 2, 'expiry_date': 100}
+        self.table.get_item.return_value['Item']['items'][0]['item_list'].pop()
+
+        response = delete_item(self.table, 'test_pk', body)
+
+        self.assertEqual(response['body']['additional_details'], {'item': None, 'item_name': 'milk'})
+
+
+# Tests that consume_item takes stock earliest expiry first in a single versioned write
+class TestConsumeItem(unittest.TestCase):
+
+    def setUp(self):
+        self.table = MagicMock()
+        self.table.get_item.side_effect = lambda **kwargs: {'Item': {'pk': 'test_pk', 'type': 'fridge', 'version': 3,
+                                                                     'items': [{
+            'item_name': 'milk', 'desired_quantity': 4, 'item_list': [
+                {'expiry_date': 4000000300, 'date_added': 1, 'current_quantity': 5, 'date_removed': 0},
+                {'expiry_date': 4000000100, 'date_added': 2, 'current_quantity': 2, 'date_removed': 0},
+                {'expiry_date': 50, 'date_added': 1, 'current_quantity': 4, 'date_removed': 20},
+                {'expiry_date': 500, 'date_added': 1, 'current_quantity': 3, 'date_removed': 0}
+            ]}]}}
+
+    @patch('src.fridge_mgr.src.inventory_utils.get_current_time_gmt', return_value=1000)
+    def test_consumes_earliest_expiry_first(self, mock_time):
+        response = consume_item(self.table, 'test_pk', {'item_name': 'Milk', 'quantity': 3})
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(response['body']['additional_details']['batches'], [
+            {'expiry_date': 4000000100, 'date_added': 2, 'consumed': 2, 'remaining': 0},
+            {'expiry_date': 4000000300, 'date_added': 1, 'consumed': 1, 'remaining': 4}
+        ])
+        self.table.put_item.assert_not_called()
+        actions = self.table.meta.client.transact_write_items.call_args.kwargs['TransactItems']
+        self.assertEqual(actions[0]['Put']['ConditionExpression'], 'version = :version')
+        self.assertEqual(actions[0]['Put']['ExpressionAttributeValues'], {':version': 3})
+        saved = get_written_fridge(self.table)
+        self.assertEqual(saved['version'], 4)
+        self.assertEqual(saved['items'][0]['item_list'],
+                         [{'expiry_date': 4000000300, 'date_added': 1, 'current_quantity': 4, 'date_removed': 0},
+                          {'expiry_date': 500, 'date_added': 1, 'current_quantity': 3, 'date_removed': 0}])
+        # the emptied batch goes into the history with the quantity this took out of it
+        self.assertIn({'pk': 'test_pk#history#1970-01', 'type': '000000001000#milk#2#4000000100',
+                       'item_name': 'milk', 'expiry_date': 4000000100, 'date_added': 2,
+                       'date_removed': 1000, 'quantity': 2}, get_written_history(self.table))
+
+    @patch('src.fridge_mgr.src.inventory_utils.get_current_time_gmt', return_value=1000)
+    def test_expired_batches_not_consumed(self, mock_time):
+        # the expired batch expires first but is not in stock to use, so only 7 can be taken
+        response = consume_item(self.table, 'test_pk', {'item_name': 'milk', 'quantity': 8})
+
+        self.assertEqual(response['statusCode'], 409)
+        self.assertEqual(response['body']['additional_details'], {'available': 7})
+
+        response = consume_item(self.table, 'test_pk', {'item_name': 'milk', 'quantity': 1})
+
+        self.assertEqual(response['body']['additional_details']['batches'],
+                         [{'expiry_date': 4000000100, 'date_added': 2, 'consumed': 1, 'remaining': 1}])
+
+    def test_not_enough_stock_changes_nothing(self):
+        response = consume_item(self.table, 'test_pk', {'item_name': 'milk', 'quantity': 8})
+
+        self.assertEqual(response['statusCode'], 409)
+        self.assertEqual(response['body']['additional_details'], {'available': 7})
+        self.table.put_item.assert_not_called()
+
+    def test_retries_when_fridge_changes(self):
+        conflict = ClientError({'Error': {'Code': 'TransactionCanceledException'}}, 'TransactWriteItems')
+        self.table.meta.client.transact_write_items.side_effect = [conflict, None]
+
+        response = consume_item(self.table, 'test_pk', {'item_name': 'milk', 'quantity': 2})
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(self.table.get_item.call_count, 2)
+        self.assertEqual(self.table.meta.client.transact_write_items.call_count, 2)
+        # nothing from the attempt that lost is written to the history
+        batch = self.table.batch_writer.return_value.__enter__.return_value
+        self.assertFalse([entry for entry in batch.put_item.call_args_list
+                          if '#history#' in entry.kwargs['Item']['pk']])
+        self.assertEqual([entry['expiry_date'] for entry in get_written_history(self.table)], [4000000100, 50])
+
+    def test_invalid_quantity(self):
+        response = consume_item(self.table, 'test_pk', {'item_name': 'milk', 'quantity': 0})
+
+        self.assertEqual(response['statusCode'], 400)
+
+    def test_bulk_consume_in_one_write(self):
+        body = {'items': [{'item_name': 'milk', 'quantity': 2}, {'item_name': 'MILK', 'quantity': 8},
+                          {'item_name': 'eggs', 'quantity': 1}]}
+
+        response = consume_items(self.table, 'test_pk', body)
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(response['body']['additional_details'], {
+            'items': {'milk': {'consumed': 7, 'shortfall': 3}},
+            'not_found': ['eggs'],
+            'unapplied': []
+        })
+        self.table.meta.client.transact_write_items.assert_called_once()
+
+    @patch('src.fridge_mgr.src.inventory_utils.get_current_time_gmt', return_value=1000)
+    def test_bulk_consume_uses_stock_in_date_when_sold(self, mock_time):
+        # the batch expiring at 500 had not expired when 2 were sold at 400, but had by the sale at 600
+        body = {'items': [{'item_name': 'milk', 'quantity': 2, 'consumed_at': 600},
+                          {'item_name': 'milk', 'quantity': 2, 'consumed_at': 400}]}
+
+        response = consume_items(self.table, 'test_pk', body)
+
+        self.assertEqual(response['body']['additional_details']['items'], {'milk': {'consumed': 4, 'shortfall': 0}})
+        item_list = get_written_fridge(self.table)['items'][0]['item_list']
+        self.assertIn({'expiry_date': 500, 'date_added': 1, 'current_quantity': 1, 'date_removed': 0}, item_list)
+        self.assertEqual([entry['expiry_date'] for entry in get_written_history(self.table)], [4000000100, 50])
+
+    def test_bulk_consume_invalid_consumed_at(self):
+        response = consume_items(self.table, 'test_pk', {'items': [{'item_name': 'milk', 'quantity': 1,
+                                                                    'consumed_at': 'yesterday'}]})
+
+        self.assertEqual(response['statusCode'], 400)
+
+    @patch('src.fridge_mgr.src.inventory_utils.save_fridge')
+    @patch('src.fridge_mgr.src.inventory_utils.load_fridge_shards')
+    def test_bulk_consume_reports_shard_that_kept_changing(self, mock_load_fridge_shards, mock_save_fridge):
+        # the first shard is written on the first attempt, the second conflicts every time
+        mock_load_fridge_shards.side_effect = lambda table, pk: [
+            {'pk': 'test_pk', 'items': [{'item_name': 'milk', 'item_list': [
+                {'expiry_date': None, 'date_added': 1, 'current_quantity': 5, 'date_removed': 0}]}]},
+            {'pk': 'test_pk#shard#1', 'items': [{'item_name': 'eggs', 'item_list': [
+                {'expiry_date': None, 'date_added': 1, 'current_quantity': 5, 'date_removed': 0}]}]}
+        ]
+        mock_save_fridge.side_effect = lambda table, item: \
+            self.raise_conflict() if item['pk'] == 'test_pk#shard#1' else None
+
+        response = consume_items(self.table, 'test_pk', {'items': [{'item_name': 'milk', 'quantity': 2},
+                                                                   {'item_name': 'eggs', 'quantity': 1},
+                                                                   {'item_name': 'ham', 'quantity': 1}]})
+
+        # retrying the request would take the milk again, so it succeeds with the eggs left out
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(response['body']['additional_details'], {
+            'items': {'milk': {'consumed': 2, 'shortfall': 0}},
+            'not_found': ['ham'],
+            'unapplied': ['eggs']
+        })
+        self.assertEqual([entry.args[1]['pk'] for entry in mock_save_fridge.call_args_list],
+                         ['test_pk', 'test_pk#shard#1', 'test_pk#shard#1', 'test_pk#shard#1'])
+
+    @staticmethod
+    def raise_conflict():
+        raise ConcurrentUpdateError('fridge changed')
+
+    def test_bulk_consume_invalid_items(self):
+        response = consume_items(self.table, 'test_pk', {'items': [{'item_name': 'milk'}]})
+
+        self.assertEqual(response['statusCode'], 400)
+        self.table.put_item.assert_not_called()
+
+
+# Tests that stock totals are kept on each item and read instead of the batches while they hold
+class TestItemTotals(unittest.TestCase):
+
+    def setUp(self):
+        self.item = {'item_name': 'milk', 'desired_quantity': 10, 'item_list': [
+            {'expiry_date': 500, 'date_added': 1, 'current_quantity': 2, 'date_removed': 0},
+            {'expiry_date': 100, 'date_added': 1, 'current_quantity': 3, 'date_removed': 0},
+            {'expiry_date': 50, 'date_added': 1, 'current_quantity': 4, 'date_removed': 20}
+        ]}
+
+    def test_totals_recomputed_once_a_batch_expires(self):
+        self.assertEqual(get_item_totals(self.item, 80), (5, 5))
+        self.assertEqual(self.item['next_expiry'], 100)
+
+        # stored totals are used as they are until next_expiry
+        self.item['item_list'].clear()
+        self.assertEqual(get_item_totals(self.item, 99), (5, 5))
+
+        self.item['item_list'].append({'expiry_date': 500, 'date_added': 1, 'current_quantity': 2, 'date_removed': 0})
+        self.assertEqual(get_item_totals(self.item, 100), (2, 2))
+
+    @patch('src.fridge_mgr.src.inventory_utils.get_current_time_gmt', return_value=80)
+    def test_save_stores_totals_and_low_stock_reads_them(self, mock_time):
+        table = MagicMock()
+        table.get_item.return_value = {'Item': {'pk': 'test_pk', 'type': 'fridge', 'items': [self.item]}}
+        update_item_quantity(table, 'test_pk', {'item_name': 'milk', 'quantity_change': 1, 'expiry_date': 500,
+                                                'date_added': 1})
+
+        saved = get_written_fridge(table)['items'][0]
+        self.assertEqual((saved['total_quantity'], saved['non_expired_quantity']), (6, 6))
+
+        saved['item_list'] = []
+        response = get_low_stock(table, 'test_pk')
+        self.assertEqual(response['body']['low_stock'],
+                         [{'item_name': 'milk', 'desired_quantity': 10, 'current_quantity': 6}])
+
+    @patch('src.fridge_mgr.src.inventory_utils.get_current_time_gmt', return_value=80)
+    def test_recompute_reports_repaired_items(self, mock_time):
+        self.item.update(total_quantity=9, non_expired_quantity=9, next_expiry=None)
+        table = MagicMock()
+        table.get_item.return_value = {'Item': {'pk': 'test_pk', 'type': 'fridge', 'items': [self.item]}}
+
+        response = recompute_totals(table, 'test_pk')
+
+        self.assertEqual(response['body']['additional_details'], {'repaired': ['milk']})
+        self.assertEqual(get_written_fridge(table)['items'][0]['total_quantity'], 5)
+
+
+# Tests that door state is kept in its own item and door changes are recorded
+class TestDoorState(unittest.TestCase):
+
+    def test_open_door_updates_door_state_and_records_event(self):
+        table = MagicMock()
+        table.update_item.return_value = {'Attributes': {'is_front_door_open': True, 'is_back_door_open': False}}
+
+        response = modify_door_state(table, 'test_pk', {}, 'open_front_door')
+
+        self.assertEqual(response['statusCode'], 200)
+        table.get_item.assert_not_called()
+        self.assertEqual(table.update_item.call_args.kwargs['Key'], {'pk': 'test_pk', 'type': 'door_state'})
+        self.assertEqual(table.update_item.call_args.kwargs['ExpressionAttributeNames'], {'#door': 'is_front_door_open'})
+        event = table.put_item.call_args.kwargs['Item']
+        self.assertEqual(event['pk'], 'test_pk#door_events')
+        self.assertEqual(event['action'], 'open_front_door')
+
+    def test_door_state_created_from_legacy_fridge_flags(self):
+        table = MagicMock()
+        table.update_item.side_effect = [
+            ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem'),
+            {'Attributes': {'is_front_door_open': True, 'is_back_door_open': True}}
+        ]
+        table.get_item.side_effect = [{}, {'Item': {'is_front_door_open': False, 'is_back_door_open': True}}]
+
+        response = modify_door_state(table, 'test_pk', {}, 'open_front_door')
+
+        self.assertEqual(response['body']['additional_details'], {'is_front_door_open': True, 'is_back_door_open': True})
+        seeded = table.put_item.call_args_list[0].kwargs['Item']
+        self.assertEqual(seeded['type'], 'door_state')
+        self.assertTrue(seeded['is_back_door_open'])
+
+    def test_door_state_not_found(self):
+        table = MagicMock()
+        table.update_item.side_effect = ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+        table.get_item.return_value = {}
+
+        response = modify_door_state(table, 'test_pk', {}, 'close_back_door')
+
+        self.assertEqual(response['statusCode'], 404)
+        table.put_item.assert_not_called()
+
+    def test_get_door_state_with_events(self):
+        table = MagicMock()
+        table.get_item.return_value = {'Item': {'is_front_door_open': True, 'is_back_door_open': False, 'last_changed': 5}}
+        table.query.return_value = {'Items': [{'action': 'open_front_door', 'time': 5}]}
+
+        response = get_door_state(table, 'test_pk', {'events': 1})
+
+        self.assertEqual(response['body']['additional_details'], {
+            'is_front_door_open': True, 'is_back_door_open': False, 'last_changed': 5,
+            'events': [{'action': 'open_front_door', 'time': 5}]
+        })
+        self.assertEqual(table.query.call_args.kwargs['Limit'], 1)
+
+    def test_get_door_state_invalid_events(self):
+        table = MagicMock()
+
+        response = get_door_state(table, 'test_pk', {'events': 'all'})
+
+        self.assertEqual(response['statusCode'], 400)
+        table.query.assert_not_called()
+
+
+# Tests for batched fridge sensor ingestion and the downsampled summary
+class TestSensorEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.table = MagicMock()
+        self.batch = self.table.batch_writer.return_value.__enter__.return_value
+
+    def test_ingest_dedupes_and_rejects(self):
+        temperature = {'sensor_id': 's1', 'event_type': 'temperature', 'timestamp': 1700000000, 'value': 4.5}
+        body = {'events': [temperature, dict(temperature),
+                           {'sensor_id': 's1', 'event_type': 'temperature', 'timestamp': 1700000060, 'value': 5},
+                           {'sensor_id': 's1', 'event_type': 'humidity', 'timestamp': 1700000000, 'value': 1},
+                           {'sensor_id': 's1', 'event_type': 'temperature', 'timestamp': 'soon', 'value': 1}]}
+
+        response = ingest_sensor_events(self.table, 'house', body)
+
+        self.assertEqual(response['body']['additional_details'], {'accepted': 2, 'duplicates': 1, 'rejected': 2})
+        self.assertEqual(self.batch.put_item.call_count, 2)
+        item = self.batch.put_item.call_args_list[0].kwargs['Item']
+        self.assertEqual(item['pk'], 'house#sensors#2023-11-14')
+        self.assertEqual(item['type'], '001700000000#s1#temperature')
+        self.table.update_item.assert_not_called()
+
+    def test_latest_door_event_updates_door_state(self):
+        self.table.update_item.return_value = {'Attributes': {'is_front_door_open': False}}
+        body = {'events': [
+            {'sensor_id': 'd1', 'event_type': 'door', 'timestamp': 1700000000, 'door': 'front', 'is_open': True},
+            {'sensor_id': 'd1', 'event_type': 'door', 'timestamp': 1700000005, 'door': 'front', 'is_open': False},
+            {'sensor_id': 'd1', 'event_type': 'door', 'timestamp': 1700000009, 'door': 'front', 'is_open': True}
+        ]}
+
+        ingest_sensor_events(self.table, 'house', body)
+
+        self.table.update_item.assert_called_once()
+        self.assertEqual(self.table.update_item.call_args.kwargs['ExpressionAttributeValues'],
+                         {':is_open': True, ':time': 1700000009})
+        self.assertEqual(self.table.put_item.call_args.kwargs['Item']['action'], 'open_front_door')
+
+    def test_too_many_events(self):
+        response = ingest_sensor_events(self.table, 'house', {'events': [{}] * 1001})
+
+        self.assertEqual(response['statusCode'], 400)
+
+    def test_summary_buckets(self):
+        self.table.query.return_value = {'Items': [
+            {'sensor_id': 's1', 'event_type': 'temperature', 'timestamp': 1699990000, 'value': 4},
+            {'sensor_id': 's1', 'event_type': 'temperature', 'timestamp': 1699990100, 'value': 6},
+            {'sensor_id': 'd1', 'event_type': 'door', 'timestamp': 1699993700, 'door': 'front', 'is_open': True}
+        ]}
+
+        response = get_sensor_summary(self.table, 'house', {'start': 1699990000, 'end': 1699997200})
+
+        buckets = response['body']['additional_details']['buckets']
+        self.assertEqual(buckets[0], {'start': 1699990000, 'temperature': {'s1': {'min': 4, 'max': 6, 'count': 2, 'avg': 5}},
+                                      'door_opens': {}})
+        self.assertEqual(buckets[1]['door_opens'], {'front': 1})
+        self.table.query.assert_called_once()
+
+    def test_summary_range_limit(self):
+        response = get_sensor_summary(self.table, 'house', {'start': 0, 'end': 32 * 86400})
+
+        self.assertEqual(response['statusCode'], 400)
+
+
+# Tests that fridges with low stock are flagged for the sparse reorder index
+class TestReorderFlag(unittest.TestCase):
+
+    def setUp(self):
+        self.table = MagicMock()
+        self.fridge = {'pk': 'test_pk', 'type': 'fridge', 'reorder_flag': 'reorder', 'reorder_items': ['eggs'],
+                       'items': [
+            {'item_name': 'milk', 'desired_quantity': 3, 'item_list': [
+                {'expiry_date': None, 'date_added': 1, 'current_quantity': 2, 'date_removed': 0}]},
+            {'item_name': 'eggs', 'desired_quantity': 1, 'item_list': [
+                {'expiry_date': None, 'date_added': 1, 'current_quantity': 5, 'date_removed': 0}]}
+        ]}
+        self.table.get_item.return_value = {'Item': self.fridge}
+
+    def test_flag_follows_the_items_below_desired_quantity(self):
+        update_item_quantity(self.table, 'test_pk', {'item_name': 'milk', 'quantity_change': -1, 'expiry_date': None,
+                                                     'date_added': 1})
+
+        saved = self.table.put_item.call_args.kwargs['Item']
+        self.assertEqual(saved['reorder_flag'], 'reorder')
+        self.assertEqual(saved['reorder_items'], ['milk'])
+
+    def test_flag_removed_when_nothing_is_low(self):
+        update_item_quantity(self.table, 'test_pk', {'item_name': 'milk', 'quantity_change': 1, 'expiry_date': None,
+                                                     'date_added': 1})
+
+        saved = self.table.put_item.call_args.kwargs['Item']
+        self.assertNotIn('reorder_flag', saved)
+        self.assertNotIn('reorder_items', saved)
+
+
+# Tests the fridge keeps an expiry sorted index of batches and get_expiring reads ranges of it
+class TestExpiryIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.table = MagicMock()
+        self.fridge = {'pk': 'test_pk', 'type': 'fridge', 'items': [
+            {'item_name': 'milk', 'desired_quantity': 1, 'item_list': [
+                {'expiry_date': 300000, 'date_added': 1, 'current_quantity': 2, 'date_removed': 0},
+                {'expiry_date': 50, 'date_added': 1, 'current_quantity': 4, 'date_removed': 0}]},
+            {'item_name': 'eggs', 'desired_quantity': 1, 'item_list': [
+                {'expiry_date': 100000, 'date_added': 2, 'current_quantity': 5, 'date_removed': 0},
+                {'expiry_date': 60, 'date_added': 1, 'current_quantity': 3, 'date_removed': 30},
+                {'expiry_date': 900000, 'date_added': 1, 'current_quantity': 1, 'date_removed': 0}]}
+        ]}
+        self.table.get_item.return_value = {'Item': self.fridge}
+
+    @patch('src.fridge_mgr.src.inventory_utils.get_current_time_gmt', return_value=1000)
+    def test_index_saved_in_expiry_order(self, mock_time):
+        update_item_quantity(self.table, 'test_pk', {'item_name': 'milk', 'quantity_change': 1,
+                                                     'expiry_date': 300000, 'date_added': 1})
+
+        self.assertEqual(get_written_fridge(self.table)['expiry_index'], [
+            [50, 'milk', 1, 4], [100000, 'eggs', 2, 5], [300000, 'milk', 1, 3], [900000, 'eggs', 1, 1]
+        ])
+
+    @patch('src.fridge_mgr.src.inventory_utils.get_current_time_gmt', return_value=1000)
+    def test_expired_and_expiring_ranges(self, mock_time):
+        response = get_expiring(self.table, 'test_pk', {'days': 4})
+
+        details = response['body']['additional_details']
+        self.assertEqual(details['expired'],
+                         [{'item_name': 'milk', 'expiry_date': 50, 'date_added': 1, 'current_quantity': 4}])
+        self.assertEqual(details['expiring_quantities'], {'eggs': 5, 'milk': 2})
+        self.assertEqual(details['expired_quantities'], {'milk': 4})
+
+
+# Tests the global expiry index is rewritten only for the days whose batches changed
+class TestExpiryDays(unittest.TestCase):
+
+    def setUp(self):
+        self.table = MagicMock()
+        self.batch = self.table.batch_writer.return_value.__enter__.return_value
+        self.fridge = {'pk': 'test_pk', 'type': 'fridge', 'items': [
+            {'item_name': 'milk', 'desired_quantity': 1, 'item_list': [
+                {'expiry_date': 86400, 'date_added': 1, 'current_quantity': 2, 'date_removed': 0},
+                {'expiry_date': 172800, 'date_added': 1, 'current_quantity': 4, 'date_removed': 0}]}
+        ]}
+        self.fridge['expiry_index'] = [[86400, 'milk', 1, 2], [172800, 'milk', 1, 4]]
+        self.table.get_item.return_value = {'Item': self.fridge}
+
+    def test_only_changed_day_rewritten(self):
+        update_item_quantity(self.table, 'test_pk', {'item_name': 'milk', 'quantity_change': -1,
+                                                     'expiry_date': 172800, 'date_added': 1})
+
+        self.batch.put_item.assert_called_once_with(Item={
+            'pk': 'expiry#1970-01-03', 'type': 'test_pk', 'batches': [[172800, 'milk', 1, 3]],
+            'expires_at': 172800 + 30 * 86400
+        })
+        self.batch.delete_item.assert_not_called()
+
+    def test_emptied_day_deleted(self):
+        update_item_quantity(self.table, 'test_pk', {'item_name': 'milk', 'quantity_change': -2,
+                                                     'expiry_date': 86400, 'date_added': 1})
+
+        self.batch.delete_item.assert_any_call(Key={'pk': 'expiry#1970-01-02', 'type': 'test_pk'})
+        self.table.update_item.assert_any_call(
+            Key={'pk': 'test_pk', 'type': 'fridge'}, UpdateExpression='SET expiry_days = :days',
+            ConditionExpression='version = :version',
+            ExpressionAttributeValues={':days': ['1970-01-03'], ':version': 1})
+
+    def test_failed_delete_retried(self):
+        self.table.batch_writer.return_value.__exit__.return_value = False
+        self.batch.delete_item.side_effect = [
+            ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'BatchWriteItem'), None]
+
+        # emptying the batch writes the fridge, then deletes the item with another write
+        update_item_quantity(self.table, 'test_pk', {'item_name': 'milk', 'quantity_change': -2,
+                                                     'expiry_date': 86400, 'date_added': 1})
+
+        # the day stayed listed on the fridge after the first delete failed, so the second write deleted it
+        self.assertEqual(self.batch.delete_item.call_args_list,
+                         [call(Key={'pk': 'expiry#1970-01-02', 'type': 'test_pk'})] * 2)
+        self.assertEqual(self.fridge['expiry_days'], ['1970-01-03'])
+
+    @patch('src.fridge_mgr.src.inventory_utils.get_current_time_gmt', return_value=80)
+    def test_recompute_deletes_stale_days(self, mock_time):
+        # an entry for the 5th was left behind, e.g. by a write whose index update failed
+        self.fridge['expiry_days'] = ['1970-01-02', '1970-01-03', '1970-01-05']
+
+        recompute_totals(self.table, 'test_pk')
+
+        self.assertEqual(self.batch.put_item.call_count, 2)
+        self.batch.delete_item.assert_called_once_with(Key={'pk': 'expiry#1970-01-05', 'type': 'test_pk'})
+        self.assertEqual(self.fridge['expiry_days'], ['1970-01-02', '1970-01-03'])
+
+
+# Tests that removed batches are moved out of the fridge into the month partitioned history
+class TestHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.table = MagicMock()
+        self.table.get_item.return_value = {'Item': {'pk': 'test_pk', 'type': 'fridge', 'version': 1, 'items': [{
+            'item_name': 'milk', 'desired_quantity': 4, 'item_list': [
+                {'expiry_date': 100, 'date_added': 1, 'current_quantity': 2, 'date_removed': 0},
+                {'expiry_date': 50, 'date_added': 1, 'current_quantity': 1, 'date_removed': 2678400}
+            ]}]}}
+
+    def test_compact_history_archives_removed_batches(self):
+        response = compact_history(self.table, 'test_pk')
+
+        self.assertEqual(response['body']['additional_details'], {'archived': 1})
+        self.assertEqual(get_written_history(self.table), [{
+            'pk': 'test_pk#history#1970-02', 'type': '000002678400#milk#1#50', 'item_name': 'milk',
+            'expiry_date': 50, 'date_added': 1, 'date_removed': 2678400, 'quantity': 1}])
+        self.assertEqual(len(get_written_fridge(self.table)['items'][0]['item_list']), 1)
+
+    @patch('src.fridge_mgr.src.inventory_utils.MAX_TRANSACTION_HISTORY', 0)
+    def test_large_compaction_archived_after_write(self):
+        history = self.table.batch_writer.return_value.__enter__.return_value.put_item
+
+        compact_history(self.table, 'test_pk')
+
+        self.table.put_item.assert_called_once()
+        history.assert_any_call(Item={'pk': 'test_pk#history#1970-02', 'type': '000002678400#milk#1#50',
+                                'item_name': 'milk', 'expiry_date': 50, 'date_added': 1,
+                                'date_removed': 2678400, 'quantity': 1})
+
+    def test_no_history_when_write_fails(self):
+        conflict = ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')
+        self.table.put_item.side_effect = conflict
+
+        with patch('src.fridge_mgr.src.inventory_utils.MAX_TRANSACTION_HISTORY', 0):
+            with self.assertRaises(ConcurrentUpdateError):
+                compact_history(self.table, 'test_pk')
+
+        self.table.batch_writer.assert_not_called()
+
+    @patch('src.fridge_mgr.src.inventory_utils.get_current_time_gmt', return_value=1000)
+    def test_emptied_batch_records_quantity_taken(self, mock_time):
+        update_item_quantity(self.table, 'test_pk', {'item_name': 'milk', 'quantity_change': -2,
+                                                     'expiry_date': 100, 'date_added': 1})
+
+        self.assertIn({'pk': 'test_pk#history#1970-01', 'type': '000000001000#milk#1#100', 'item_name': 'milk',
+                       'expiry_date': 100, 'date_added': 1, 'date_removed': 1000, 'quantity': 2},
+                      get_written_history(self.table))
+
+    @patch('src.fridge_mgr.src.inventory_utils.get_current_time_gmt', return_value=1000)
+    def test_deleting_last_batch_archives_it(self, mock_time):
+        self.table.get_item.return_value['Item']['items'][0]['item_list'].pop()
+
+        delete_item(self.table, 'test_pk', {'item_name': 'milk', 'current_quantity': 2, 'expiry_date': 100})
+
+        self.assertEqual(get_written_history(self.table), [{
+            'pk': 'test_pk#history#1970-01', 'type': '000000001000#milk#1#100', 'item_name': 'milk',
+            'expiry_date': 100, 'date_added': 1, 'date_removed': 1000, 'quantity': 2}])
+        self.assertEqual(get_written_fridge(self.table)['items'], [])
+
+    def test_get_history_reads_each_month(self):
+        self.table.query.return_value = {'Items': [{'pk': 'test_pk#history#1970-01', 'type': 'x', 'quantity': 1}]}
+
+        response = get_history(self.table, 'test_pk', {'start': 1000, 'end': 2678400})
+
+        self.assertEqual(self.table.query.call_count, 2)
+        self.assertEqual(response['body']['additional_details']['batches'], [{'quantity': 1}, {'quantity': 1}])
+
+    def test_get_history_rejects_bad_range(self):
+        response = get_history(self.table, 'test_pk', {'start': 10, 'end': 5})
+
+        self.assertEqual(response['statusCode'], 400)
+
+
+# Tests that the fridge can be stored as a compressed document and is read back the same
+class TestEncodedFridge(unittest.TestCase):
+
+    def setUp(self):
+        self.table = MagicMock()
+        self.fridge = {'pk': 'test_pk', 'type': 'fridge', 'version': 2, 'items': [{
+            'item_name': 'milk', 'desired_quantity': 4, 'item_list': [
+                {'expiry_date': 100, 'date_added': 1, 'current_quantity': 2, 'date_removed': 0}
+            ]}]}
+
+    @patch('src.fridge_mgr.src.documents.DOCUMENT_ENCODING', 'zlib')
+    def test_save_writes_document(self):
+        save_fridge(self.table, self.fridge)
+
+        written = self.table.put_item.call_args.kwargs['Item']
+        self.assertNotIn('items', written)
+        self.assertEqual((written['version'], written['reorder_flag'], written['schema_version']), (3, 'reorder', 1))
+        self.assertEqual(decode_document(written)['items'], self.fridge['items'])
+
+    @patch('src.fridge_mgr.src.inventory_utils.get_current_time_gmt', return_value=50)
+    def test_encoded_fridge_is_read_in_map_mode(self, mock_time):
+        with patch('src.fridge_mgr.src.documents.DOCUMENT_ENCODING', 'zlib'):
+            self.table.get_item.return_value = {'Item': encode_document(self.fridge)}
+
+        response = get_low_stock(self.table, 'test_pk')
+        save_fridge(self.table, load_fridge(self.table, 'test_pk'))
+
+        self.assertEqual(response['body']['low_stock'],
+                         [{'item_name': 'milk', 'desired_quantity': 4, 'current_quantity': 2}])
+        self.assertIn('items', self.table.put_item.call_args.kwargs['Item'])
+
+    def test_newer_schema_is_not_read(self):
+        with patch('src.fridge_mgr.src.documents.DOCUMENT_ENCODING', 'zlib'):
+            stored = encode_document(self.fridge)
+        stored['schema_version'] = 2
+
+        with self.assertRaises(ValueError):
+            decode_document(stored)
+
+
+# Tests that a sharded fridge keeps each item in the shard its name picks
+class TestWriteShards(unittest.TestCase):
+
+    def setUp(self):
+        shard_settings_cache.clear()
+        self.table = MagicMock()
+        self.table.name = 'master'
+        self.fridges = {}
+        self.table.get_item.side_effect = lambda Key, **kwargs: (
+            {'Item': self.fridges[Key['pk']]} if Key['pk'] in self.fridges else {})
+
+    def test_shard_keys(self):
+        self.assertEqual(get_shard_key('test_pk', 0), 'test_pk')
+        self.assertEqual(get_shard_key('test_pk', 2), 'test_pk#shard#2')
+        self.assertEqual(get_restaurant('test_pk#shard#2'), 'test_pk')
+        self.assertEqual(get_shard('Milk', 4), get_shard('milk', 4))
+        self.assertEqual(get_shard('milk', 1), 0)
+
+    def test_item_read_from_its_shard(self):
+        shard = get_shard('milk', 4)
+        self.fridges['test_pk'] = {'pk': 'test_pk', 'type': 'fridge', 'write_shards': 4, 'items': []}
+        self.fridges[get_shard_key('test_pk', shard)] = {'pk': get_shard_key('test_pk', shard), 'type': 'fridge',
+                                                         'write_shards': 4, 'items': []}
+
+        self.assertEqual(load_item_fridge(self.table, 'test_pk', 'milk')['pk'], get_shard_key('test_pk', shard))
+        # the shard count is cached, so the next read goes straight to the shard
+        self.table.get_item.reset_mock()
+        load_item_fridge(self.table, 'test_pk', 'milk')
+        self.assertEqual(self.table.get_item.call_count, 1)
+
+    def test_stale_shard_count_is_noticed(self):
+        self.fridges['test_pk'] = {'pk': 'test_pk', 'type': 'fridge', 'write_shards': 1, 'items': []}
+        shard_settings_cache['test_pk'] = ((4, 4), float('inf'))
+
+        fridge = load_item_fridge(self.table, 'test_pk', 'milk')
+
+        self.assertEqual(fridge['pk'], 'test_pk')
+        self.assertEqual(shard_settings_cache['test_pk'][0], (1, 1))
+
+    def test_set_write_shards_moves_items_in_one_transaction(self):
+        names = ['milk', 'eggs', 'ham', 'bread', 'cheese']
+        self.fridges['test_pk'] = {'pk': 'test_pk', 'type': 'fridge', 'version': 7, 'items': [
+            {'item_name': name, 'desired_quantity': 1, 'item_list': [
+                {'expiry_date': None, 'date_added': 1, 'current_quantity': 2, 'date_removed': 0}]}
+            for name in names]}
+
+        response = set_write_shards(self.table, 'test_pk', {'write_shards': 3})
+
+        self.assertEqual(response['statusCode'], 200)
+        actions = self.table.meta.client.transact_write_items.call_args.kwargs['TransactItems']
+        self.assertEqual(len(actions), 3)
+        self.assertEqual(actions[0]['Put']['ExpressionAttributeValues'], {':version': 7})
+        self.assertEqual(actions[1]['Put']['ConditionExpression'], 'attribute_not_exists(pk)')
+        for shard, action in enumerate(actions):
+            item = action['Put']['Item']
+            self.assertEqual((item['pk'], item['write_shards']), (get_shard_key('test_pk', shard), 3))
+            self.assertTrue(all(get_shard(stored['item_name'], 3) == shard for stored in item['items']))
+        self.assertEqual(sum(len(action['Put']['Item']['items']) for action in actions), len(names))
+        self.assertEqual(actions[0]['Put']['Item']['event_shards'], 3)
+
+    def test_set_write_shards_range(self):
+        response = set_write_shards(self.table, 'test_pk', {'write_shards': 17})
+
+        self.assertEqual(response['statusCode'], 400)
+
+
+class TestFridges(unittest.TestCase):
+
+    def setUp(self):
+        shard_settings_cache.clear()
+        known_fridges.clear()
+        self.table = MagicMock()
+        self.items = {}
+        self.table.get_item.side_effect = lambda Key, **kwargs: (
+            {'Item': self.items[(Key['pk'], Key['type'])]} if (Key['pk'], Key['type']) in self.items else {})
+
+    def add_stock(self, pk, item_name, quantity, desired_quantity=5):
+        fridge = self.items.setdefault((pk, 'fridge'), {'pk': pk, 'type': 'fridge', 'items': []})
+        fridge['items'].append({'item_name': item_name, 'desired_quantity': desired_quantity, 'item_list': [
+            {'expiry_date': None, 'date_added': 1, 'current_quantity': quantity, 'date_removed': 0}]})
+
+    def test_add_fridge(self):
+        self.add_stock('test_pk', 'milk', 1)
+
+        response = add_fridge(self.table, 'test_pk', {'fridge_id': 'walk-in', 'fridge_name': 'Walk in'})
+
+        self.assertEqual(response['statusCode'], 201)
+        written = [call.kwargs['Item'] for call in self.table.put_item.call_args_list]
+        self.assertEqual([(item['pk'], item['type']) for item in written],
+                         [('test_pk#fridge#walk-in', 'fridge'), ('test_pk#fridge#walk-in', 'door_state'),
+                          ('test_pk', 'fridges')])
+        self.assertEqual(written[2]['fridges'], [{'fridge_id': 'walk-in', 'fridge_name': 'Walk in'}])
+        self.assertEqual(self.table.put_item.call_args.kwargs['ConditionExpression'],
+                         'attribute_not_exists(version)')
+
+    def test_add_fridge_rejects_duplicates_and_bad_ids(self):
+        self.add_stock('test_pk', 'milk', 1)
+        self.items[('test_pk', 'fridges')] = {'pk': 'test_pk', 'type': 'fridges', 'version': 1,
+                                              'fridges': [{'fridge_id': 'walk-in', 'fridge_name': 'Walk in'}]}
+
+        self.assertEqual(add_fridge(self.table, 'test_pk', {'fridge_id': 'walk-in'})['statusCode'], 409)
+        self.assertEqual(add_fridge(self.table, 'test_pk', {'fridge_id': 'main'})['statusCode'], 409)
+        self.assertEqual(add_fridge(self.table, 'test_pk', {'fridge_id': 'bar#1'})['statusCode'], 400)
+        self.table.put_item.assert_not_called()
+
+    @patch('boto3.resource')
+    def test_requests_go_to_the_named_fridge(self, mock_boto3_resource):
+        mock_boto3_resource.return_value.Table.return_value = self.table
+        self.add_stock('test_pk#fridge#bar', 'lime', 3)
+        self.items[('test_pk', 'fridges')] = {'pk': 'test_pk', 'type': 'fridges', 'version': 1,
+                                              'fridges': [{'fridge_id': 'bar', 'fridge_name': 'Bar'}]}
+
+        response = handler({'action': 'view_inventory',
+                            'body': {'restaurant_name': 'test_pk', 'fridge_id': 'bar'}}, {})
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(response['body']['additional_details']['items'][0]['item_name'], 'lime')
+
+        response = handler({'action': 'view_inventory',
+                            'body': {'restaurant_name': 'test_pk', 'fridge_id': 'cellar'}}, {})
+        self.assertEqual(response['statusCode'], 404)
+
+    def test_view_all_fridges_sums_stock(self):
+        self.add_stock('test_pk', 'milk', 1)
+        self.add_stock('test_pk', 'lime', 4)
+        self.add_stock(get_fridge_key('test_pk', 'bar'), 'lime', 3)
+        self.items[('test_pk', 'fridges')] = {'pk': 'test_pk', 'type': 'fridges', 'version': 1,
+                                              'fridges': [{'fridge_id': 'bar', 'fridge_name': 'Bar'}]}
+
+        response = view_all_fridges(self.table, 'test_pk')
+
+        self.assertEqual(response['statusCode'], 200)
+        details = response['body']['additional_details']
+        self.assertEqual([fridge['item_count'] for fridge in details['fridges']], [2, 1])
+        self.assertEqual(details['items'], [
+            {'item_name': 'lime', 'desired_quantity': 10, 'total_quantity': 7, 'non_expired_quantity': 7,
+             'fridges': {'main': 4, 'bar': 3}, 'is_low': True},
+            {'item_name': 'milk', 'desired_quantity': 5, 'total_quantity': 1, 'non_expired_quantity': 1,
+             'fridges': {'main': 1}, 'is_low': True}
+        ])
+
+    @patch('boto3.resource')
+    def test_low_stock_covers_every_fridge(self, mock_boto3_resource):
+        mock_boto3_resource.return_value.Table.return_value = self.table
+        self.add_stock('test_pk', 'milk', 6)
+        self.add_stock('test_pk', 'lime', 4)
+        self.add_stock(get_fridge_key('test_pk', 'bar'), 'lime', 3)
+        self.add_stock(get_fridge_key('test_pk', 'bar'), 'ice', 9, desired_quantity=20)
+        self.items[('test_pk', 'fridges')] = {'pk': 'test_pk', 'type': 'fridges', 'version': 1,
+                                              'fridges': [{'fridge_id': 'bar', 'fridge_name': 'Bar'}]}
+
+        # the low stock email asks about the restaurant, not one of its fridges
+        response = handler({'action': 'get_low_stock', 'body': {'restaurant_name': 'test_pk'}}, {})
+
+        self.assertEqual(response['body']['low_stock'], [
+            {'item_name': 'ice', 'desired_quantity': 20, 'current_quantity': 9},
+            {'item_name': 'lime', 'desired_quantity': 10, 'current_quantity': 7}
+        ])
+
+
+class TestIdempotency(unittest.TestCase):
+
+    def setUp(self):
+        self.table = MagicMock()
+        self.body = {'item_name': 'milk', 'quantity': 2, 'idempotency_key': 'delivery#1'}
+        self.operation = MagicMock(return_value=generate_response(200, 'Delivery item milk added successfully'))
+
+    def test_first_request_runs_and_keeps_response(self):
+        response = run_idempotent(self.table, 'restaurant', 'add_delivery_item', self.body, self.operation)
+
+        self.assertEqual(response['statusCode'], 200)
+        self.operation.assert_called_once()
+        self.assertEqual(self.table.put_item.call_args_list[0].kwargs['Item']['status'], 'in_progress')
+        stored = self.table.put_item.call_args_list[1].kwargs['Item']
+        self.assertEqual(stored['pk'], 'restaurant#idempotency#delivery#1')
+        self.assertEqual(stored['status'], 'done')
+        self.assertEqual(json.loads(stored['response']), response)
+
+    def test_retry_gets_kept_response(self):
+        run_idempotent(self.table, 'restaurant', 'add_delivery_item', self.body, self.operation)
+        stored = self.table.put_item.call_args_list[1].kwargs['Item']
+        self.table.put_item.side_effect = ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')
+        self.table.get_item.return_value = {'Item': stored}
+
+        response = run_idempotent(self.table, 'restaurant', 'add_delivery_item', dict(self.body), self.operation)
+
+        self.assertEqual(response['statusCode'], 200)
+        self.operation.assert_called_once()
+
+    def test_key_reused_for_other_request_or_still_running(self):
+        self.table.put_item.side_effect = ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')
+        self.table.get_item.return_value = {'Item': {'status': 'in_progress', 'request_hash': 'other'}}
+
+        response = run_idempotent(self.table, 'restaurant', 'add_delivery_item', self.body, self.operation)
+        self.assertEqual(response['statusCode'], 400)
+
+        self.table.get_item.return_value['Item']['request_hash'] = get_request_hash('add_delivery_item', self.body)
+        response = run_idempotent(self.table, 'restaurant', 'add_delivery_item', self.body, self.operation)
+        self.assertEqual(response['statusCode'], 409)
+        self.operation.assert_not_called()
+
+    def test_failed_request_is_forgotten(self):
+        self.operation.return_value = generate_response(404, 'Inventory item not found')
+
+        response = run_idempotent(self.table, 'restaurant', 'add_delivery_item', self.body, self.operation)
+
+        self.assertEqual(response['statusCode'], 404)
+        self.table.delete_item.assert_called_once_with(
+            Key={'pk': 'restaurant#idempotency#delivery#1', 'type': 'idempotency'})
+
+    def test_request_without_key_always_runs(self):
+        del self.body['idempotency_key']
+
+        run_idempotent(self.table, 'restaurant', 'add_delivery_item', self.body, self.operation)
+
+        self.operation.assert_called_once()
+        self.table.put_item.assert_not_called()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -4,7 +4,7 @@ import json
 from boto3.dynamodb.conditions import Key
 from datetime import datetime
 import logging
-from .utils import unix_to_readable, get_health_and_safety_email, get_filtered_items, send_email_with_attachment, create_csv_content
+from .utils import unix_to_readable, get_health_and_safety_email, get_filtered_items, send_email_with_attachment, create_csv_content, get_temperature_summary
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -36,13 +36,16 @@ def handler(event, context):
             
         filtered_items = get_filtered_items(table, restaurant_name, start_date, end_date)
         csv_content = create_csv_content(filtered_items)
-        send_email_with_attachment(email, restaurant_name, body['startDate'], body['endDate'], filtered_items)
+        temperature_summary = get_temperature_summary(table, restaurant_name, start_date, end_date)
+        send_email_with_attachment(email, restaurant_name, body['startDate'], body['endDate'], filtered_items,
+                                   temperature_summary)
 
         response = {
             'statusCode': 200,
             'body': json.dumps({
                 'message': 'Health and Safety Report Sent!',
-                'csv_data': csv_content
+                'csv_data': csv_content,
+                'temperature_summary': temperature_summary
             })
         }
 
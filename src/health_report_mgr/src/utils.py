@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import boto3
 import logging
 from boto3.dynamodb.conditions import Key, Attr
@@ -7,10 +7,14 @@ import csv
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
+from .documents import decode_document
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# fridge_mgr's name for the restaurant's own fridge, its other fridges are listed on the restaurant's fridges item
+DEFAULT_FRIDGE_NAME = 'Main fridge'
+
 def unix_to_readable(timestamp):
     """
     Converts a UNIX timestamp to a readable date-time string.
@@ -43,29 +47,75 @@ def get_health_and_safety_email(table, restaurant_name):
         logger.error(f"Error getting health and safety email: {e}")
         return None
 
+def get_fridge_shards(table, fridge):
+    """
+    Gets every shard of a fridge that fridge_mgr has spread over several items.
+    :param table: DynamoDB table object.
+    :param fridge: The restaurant's own fridge item.
+    :return: List of the fridge and its other shards.
+    """
+    shards = [fridge]
+    for shard in range(1, int(fridge.get('write_shards', 1))):
+        response = table.get_item(Key={'pk': f"{fridge['pk']}#shard#{shard}", 'type': 'fridge'})
+        if 'Item' in response:
+            shards.append(decode_document(response['Item']))
+    return shards
+
+
+def get_event_shards(table, fridge_key):
+    """
+    Gets how many shards fridge_mgr has ever spread a fridge's sensor events over, each day of events is kept in that
+    many partitions.
+    :param table: DynamoDB table object.
+    :param fridge_key: Partition key of the fridge.
+    :return: Number of event shards, 1 if the fridge has never been sharded.
+    """
+    fridge = table.get_item(Key={'pk': fridge_key, 'type': 'fridge'},
+                            ProjectionExpression='write_shards, event_shards').get('Item') or {}
+    return int(fridge.get('event_shards', fridge.get('write_shards', 1)))
+
+
+def get_fridges(table, restaurant_name):
+    """
+    Gets the fridges of a restaurant, fridge_mgr keeps every fridge after the first under its own key.
+    :param table: DynamoDB table object.
+    :param restaurant_name: Name of the restaurant.
+    :return: List of (fridge name, partition key of the fridge), the restaurant's own fridge first.
+    """
+    fridges = [(DEFAULT_FRIDGE_NAME, restaurant_name)]
+    fridges_item = table.get_item(Key={'pk': restaurant_name, 'type': 'fridges'}).get('Item', {})
+    for fridge in fridges_item.get('fridges', []):
+        fridges.append((fridge['fridge_name'], f"{restaurant_name}#fridge#{fridge['fridge_id']}"))
+    return fridges
+
+
 def get_filtered_items(table, restaurant_name, start_date, end_date):
     """
-    Filters and retrieves items from DynamoDB based on date range and quantity.
+    Filters and retrieves items from DynamoDB based on date range and quantity, from every fridge of the restaurant.
     :param table: DynamoDB table object.
     :param restaurant_name: Name of the restaurant.
     :param start_date: Start of the date range (UNIX timestamp).
     :param end_date: End of the date range (UNIX timestamp).
     :return: List of filtered items.
     """
-    database_response = table.query(
-        KeyConditionExpression=Key('pk').eq(restaurant_name) & Key('type').eq('fridge')
-    )
-    data = database_response['Items']
+    data = []
+    for fridge_name, fridge_key in get_fridges(table, restaurant_name):
+        database_response = table.query(
+            KeyConditionExpression=Key('pk').eq(fridge_key) & Key('type').eq('fridge')
+        )
+        data.extend((fridge_name, shard) for item in database_response['Items']
+                    for shard in get_fridge_shards(table, decode_document(item)))
     logger.info(f"Database response: {data}")
 
     filtered_items = []
-    for item in data:
+    for fridge_name, item in data:
         for sub_item in item['items']:
             for detail in sub_item['item_list']:
                 date_added = int(detail['date_added'])
                 current_quantity = int(detail['current_quantity'])
                 if start_date <= date_added <= end_date and current_quantity != 0:
                     filtered_item = {
+                        'fridge': fridge_name,
                         'item_name': sub_item['item_name'],
                         'date_removed': unix_to_readable(detail['date_removed']),
                         'date_added': unix_to_readable(detail['date_added']),
@@ -76,6 +126,84 @@ def get_filtered_items(table, restaurant_name, start_date, end_date):
     return filtered_items
 
 
+def get_temperature_summary(table, restaurant_name, start_date, end_date):
+    """
+    Summarises fridge temperature readings per day, fridge and sensor, from the day partitions fridge_mgr stores them
+    in.
+    :param table: DynamoDB table object.
+    :param restaurant_name: Name of the restaurant.
+    :param start_date: Start of the date range (UNIX timestamp).
+    :param end_date: End of the date range (UNIX timestamp).
+    :return: List of dicts with date, fridge, sensor_id, min, max, avg and count, ordered by date, fridge and sensor.
+    """
+    summary = {}
+    for fridge_name, fridge_key in get_fridges(table, restaurant_name):
+        summarise_fridge_temperatures(table, fridge_name, fridge_key, start_date, end_date, summary)
+
+    return [{'date': date, 'fridge': fridge_name, 'sensor_id': sensor_id, 'min': stats['min'], 'max': stats['max'],
+             'avg': round(stats['total'] / stats['count'], 2), 'count': stats['count']}
+            for (date, fridge_name, sensor_id), stats in sorted(summary.items())]
+
+
+def summarise_fridge_temperatures(table, fridge_name, fridge_key, start_date, end_date, summary):
+    """
+    Adds one fridge's temperature readings to a temperature summary, from every shard of each day's partition.
+    :param table: DynamoDB table object.
+    :param fridge_name: Name of the fridge.
+    :param fridge_key: Partition key of the fridge.
+    :param start_date: Start of the date range (UNIX timestamp).
+    :param end_date: End of the date range (UNIX timestamp).
+    :param summary: Dict of (date, fridge name, sensor_id) to reading stats, updated in place.
+    """
+    event_shards = get_event_shards(table, fridge_key)
+    day = datetime.fromtimestamp(start_date, tz=timezone.utc).date()
+    last_day = datetime.fromtimestamp(end_date, tz=timezone.utc).date()
+    while day <= last_day:
+        for shard in range(event_shards):
+            partition = f'{fridge_key}#sensors#{day.isoformat()}'
+            if shard:
+                partition += f'#shard#{shard}'
+            query_arguments = {
+                'KeyConditionExpression': Key('pk').eq(partition) &
+                                          Key('type').between(f'{start_date:012d}', f'{end_date:012d}~'),
+                'FilterExpression': Attr('event_type').eq('temperature'),
+                'ProjectionExpression': 'sensor_id, #value',
+                'ExpressionAttributeNames': {'#value': 'value'}
+            }
+
+            while True:
+                response = table.query(**query_arguments)
+                for reading in response.get('Items', []):
+                    value = float(reading['value'])
+                    stats = summary.setdefault((day.isoformat(), fridge_name, reading['sensor_id']),
+                                               {'min': value, 'max': value, 'total': 0.0, 'count': 0})
+                    stats['min'] = min(stats['min'], value)
+                    stats['max'] = max(stats['max'], value)
+                    stats['total'] += value
+                    stats['count'] += 1
+
+                if 'LastEvaluatedKey' not in response:
+                    break
+                query_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        day += timedelta(days=1)
+
+
+def create_temperature_csv_content(temperature_summary):
+    """
+    Creates CSV content from a temperature summary.
+    :param temperature_summary: Summary from get_temperature_summary.
+    :return: String containing CSV formatted data.
+    """
+    csv_output = io.StringIO()
+    writer = csv.writer(csv_output)
+    writer.writerow(['Date', 'Fridge', 'Sensor', 'Min Temperature', 'Max Temperature', 'Average Temperature', 'Readings'])
+    for row in temperature_summary:
+        writer.writerow([row['date'], row['fridge'], row['sensor_id'], row['min'], row['max'], row['avg'], row['count']])
+
+    return csv_output.getvalue()
+
+
 def create_csv_content(filtered_items):
     """
     Creates CSV content from a list of filtered items.
@@ -84,13 +212,14 @@ def create_csv_content(filtered_items):
     """
     logger.info("Creating CSV content from filtered items.")
     csv_output = io.StringIO()
-    headers = ['Item Name', 'Date Removed', 'Date Added', 'Quantity', 'Expiry Date']
+    headers = ['Fridge', 'Item Name', 'Date Removed', 'Date Added', 'Quantity', 'Expiry Date']
     writer = csv.writer(csv_output)
     writer.writerow(headers)
     
     for item in filtered_items:
         try:
             writer.writerow([
+                item['fridge'],
                 item['item_name'],
                 item['date_removed'],
                 item['date_added'],
@@ -106,7 +235,7 @@ def create_csv_content(filtered_items):
     logger.info("CSV content created successfully.")
     return csv_content
 
-def send_email_with_attachment(email, restaurant_name, start_date, end_date, filtered_items):
+def send_email_with_attachment(email, restaurant_name, start_date, end_date, filtered_items, temperature_summary=None):
     """
     Sends an email with the health and safety report as an attachment.
     :param email: Recipient's email address.
@@ -114,6 +243,7 @@ def send_email_with_attachment(email, restaurant_name, start_date, end_date, fil
     :param start_date: Start date of the report.
     :param end_date: End date of the report.
     :param filtered_items: List of items to include in the report.
+    :param temperature_summary: Daily fridge temperatures, attached as a second CSV when there are any.
     """
     ses = boto3.client('ses')
     email_subject = f'Health & Safety Report for Restaurant: {restaurant_name}'
@@ -131,6 +261,11 @@ def send_email_with_attachment(email, restaurant_name, start_date, end_date, fil
     part['Content-Disposition'] = 'attachment; filename="report.csv"'
     msg.attach(part)
 
+    if temperature_summary:
+        part = MIMEApplication(create_temperature_csv_content(temperature_summary), Name='temperatures.csv')
+        part['Content-Disposition'] = 'attachment; filename="temperatures.csv"'
+        msg.attach(part)
+
     ses.send_raw_email(
         Source=msg['From'],
         Destinations=[msg['To']],
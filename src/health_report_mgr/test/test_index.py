@@ -5,7 +5,9 @@ from boto3.dynamodb.conditions import Key
 import unittest
 from unittest.mock import Mock, patch
 from src.health_report_mgr.src.index import handler
-from src.health_report_mgr.src.utils import get_health_and_safety_email, get_filtered_items, send_email_with_attachment
+from src.health_report_mgr.src.utils import get_health_and_safety_email, get_filtered_items, send_email_with_attachment, get_temperature_summary, create_csv_content
+from src.fridge_mgr.src.sensor_events import ingest_sensor_events
+from src.fridge_mgr.src.inventory_utils import shard_settings_cache
 
 class TestDynamoDBFunctions(unittest.TestCase):
     # Test the functions related to the DyanmoDB operations
@@ -38,6 +40,7 @@ class TestDynamoDBFunctions(unittest.TestCase):
     #Tests the get_filtered_items function to ensure it can retrieve and filter items from a DynamoDB table based on provided date criteria.
     def test_get_filtered_items(self, mock_boto3):
         mock_table = Mock()
+        mock_table.get_item.return_value = {}
         #The mock table is set up to return a list of each item with details
         mock_table.query.return_value = {
             'Items': [
@@ -89,6 +92,68 @@ class TestSendEmailWithAttachmentFunction (unittest.TestCase):
         mock_create_csv_content.assert_called_with(filtered_items)
 
 
+class TestTemperatureSummary(unittest.TestCase):
+    # test readings are summarised per day and sensor, reading one partition per day
+    def test_summary_per_day_and_sensor(self):
+        mock_table = MagicMock()
+        mock_table.get_item.return_value = {}
+        mock_table.query.side_effect = [
+            {'Items': [{'sensor_id': 's1', 'value': 3}, {'sensor_id': 's1', 'value': 5}]},
+            {'Items': [{'sensor_id': 's1', 'value': 4}]}
+        ]
+
+        summary = get_temperature_summary(mock_table, 'TestRestaurant', 1609459200, 1609545600)
+
+        self.assertEqual(summary, [
+            {'date': '2021-01-01', 'fridge': 'Main fridge', 'sensor_id': 's1', 'min': 3.0, 'max': 5.0, 'avg': 4.0,
+             'count': 2},
+            {'date': '2021-01-02', 'fridge': 'Main fridge', 'sensor_id': 's1', 'min': 4.0, 'max': 4.0, 'avg': 4.0,
+             'count': 1}
+        ])
+        self.assertEqual(mock_table.query.call_count, 2)
+
+    # test readings fridge_mgr spread over the shards of a sharded fridge are all reported
+    def test_sharded_fridge(self):
+        partitions = {}
+        mock_table = MagicMock()
+        mock_table.get_item.side_effect = lambda Key, **kwargs: \
+            {'Item': {'write_shards': 4}} if Key == {'pk': 'TestRestaurant', 'type': 'fridge'} else {}
+        mock_table.batch_writer.return_value.__enter__.return_value.put_item.side_effect = \
+            lambda Item: partitions.setdefault(Item['pk'], []).append(Item)
+        mock_table.query.side_effect = lambda KeyConditionExpression, **kwargs: \
+            {'Items': partitions.get(KeyConditionExpression.get_expression()['values'][0]
+                                     .get_expression()['values'][1], [])}
+        shard_settings_cache.clear()
+
+        events = [{'sensor_id': f's{sensor}', 'event_type': 'temperature', 'timestamp': 1609459200 + reading,
+                   'value': sensor + reading} for sensor in range(8) for reading in range(2)]
+        ingest_sensor_events(mock_table, 'TestRestaurant', {'events': events})
+        summary = get_temperature_summary(mock_table, 'TestRestaurant', 1609459200, 1609462800)
+
+        self.assertGreater(len(partitions), 1)
+        self.assertEqual([(row['sensor_id'], row['count'], row['avg']) for row in summary],
+                         [(f's{sensor}', 2, sensor + 0.5) for sensor in range(8)])
+
+
+class TestMultipleFridges(unittest.TestCase):
+    # test every fridge of the restaurant is reported, each row naming its fridge
+    def test_items_of_every_fridge(self):
+        mock_table = MagicMock()
+        mock_table.get_item.return_value = {'Item': {'fridges': [{'fridge_id': 'bar', 'fridge_name': 'Bar'}]}}
+        mock_table.query.side_effect = lambda KeyConditionExpression: {'Items': [{
+            'pk': 'TestRestaurant', 'type': 'fridge', 'items': [{'item_name': 'Milk', 'item_list': [
+                {'date_added': '1609459200', 'date_removed': '0', 'current_quantity': '1', 'expiry_date': '1609824800'}
+            ]}]
+        }]}
+
+        items = get_filtered_items(mock_table, 'TestRestaurant', 1609459200, 1609824800)
+
+        self.assertEqual([item['fridge'] for item in items], ['Main fridge', 'Bar'])
+        self.assertEqual(mock_table.query.call_args.kwargs['KeyConditionExpression'],
+                         Key('pk').eq('TestRestaurant#fridge#bar') & Key('type').eq('fridge'))
+        self.assertTrue(create_csv_content(items).startswith('Fridge,Item Name'))
+
+
 if __name__ == '__main__':
     unittest.main()
 
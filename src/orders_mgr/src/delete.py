@@ -1,5 +1,10 @@
 from botocore.exceptions import ClientError
 from .custom_exceptions import BadRequestException, NotFoundException
+from .documents import decode_document, encodes_documents, is_encoded, put_document
+from .utils import delete_delivery_entry, get_delivery_entry_key, get_cancellation_reason
+
+# how many times delete_order re-reads the orders when another write lands between its read and its write
+DELETE_ATTEMPTS = 3
 
 
 def delete_order(event, table):
@@ -12,6 +17,7 @@ def delete_order(event, table):
     :raises NotFoundException: Thrown if restaurant not found or order does not exist
     :return: 200 - Successful.
         404 - Restaurant or order does not exist.
+        409 - Orders kept changing.
         500 - Internal Server Error.
     """
     response = {
@@ -31,29 +37,25 @@ def delete_order(event, table):
     order_to_delete = event['body']['order_id']
 
     try:
-        table_response = table.get_item(Key={'pk': restaurant_name, 'type': 'orders'})
-
-        if 'Item' not in table_response:
-            raise NotFoundException('Restaurant does not exist.')
-
-        all_orders = table_response['Item']['orders']
-        if not any(order['id'] == order_to_delete for order in all_orders):
-            raise NotFoundException('Order does not exist.')
-
-        updated_orders = [order for order in all_orders if order['id'] != order_to_delete]
-        table.update_item(
-            Key={
-                'pk': restaurant_name,
-                'type': 'orders'
-            },
-            UpdateExpression="SET #ord = :val",
-            ExpressionAttributeNames={
-                '#ord': 'orders'
-            },
-            ExpressionAttributeValues={
-                ':val': updated_orders
+        for attempt in range(DELETE_ATTEMPTS):
+            table_response = table.get_item(Key={'pk': restaurant_name, 'type': 'orders'}, ConsistentRead=True)
+
+            if 'Item' not in table_response:
+                raise NotFoundException('Restaurant does not exist.')
+
+            item = decode_document(table_response['Item'])
+            all_orders = item['orders']
+            index = next((index for index, order in enumerate(all_orders) if order['id'] == order_to_delete), None)
+            if index is None:
+                raise NotFoundException('Order does not exist.')
+
+            if remove_order(table, restaurant_name, table_response['Item'], item, index, order_to_delete):
+                break
+        else:
+            response = {
+                'statusCode': 409,
+                'body': 'Orders kept changing while deleting the order, please try again.'
             }
-        )
 
     except NotFoundException as e:
         response = {
@@ -67,4 +69,59 @@ def delete_order(event, table):
             'body': 'Error accessing DynamoDB: ' + str(e)
         }
 
-    return response
\ No newline at end of file
+    return response
+
+
+def remove_order(table, restaurant_name, orders_item, item, index, order_id):
+    """
+    Removes an order from a restaurant's orders along with its delivery entry, only if the orders have not moved since
+    they were read. The order is removed by its position rather than by rewriting the list, so an order created in the
+    meantime is kept.
+
+    Encoded orders documents are rewritten whole, so the delivery entry is deleted first. If the rewrite then fails the
+    order is left without an entry, which backfill_deliveries writes again, rather than a removed order with one.
+
+    :param table: MasterDB table resource.
+    :param restaurant_name: Name of restaurant.
+    :param orders_item: The restaurant's orders entry as it was read.
+    :param item: The orders entry decoded.
+    :param index: Position of the order in the orders.
+    :param order_id: Id of the order, as it was requested.
+    :return: True if the order was removed, False if the orders changed since they were read.
+    """
+    order = item['orders'][index]
+    try:
+        if encodes_documents() or is_encoded(orders_item):
+            delete_delivery_entry(table, restaurant_name, order)
+            put_document(table, {**item, 'orders': item['orders'][:index] + item['orders'][index + 1:]}, orders_item)
+        else:
+            table.meta.client.transact_write_items(TransactItems=[
+                {
+                    'Update': {
+                        'TableName': table.name,
+                        'Key': {
+                            'pk': restaurant_name,
+                            'type': 'orders'
+                        },
+                        'UpdateExpression': f'REMOVE #ord[{index}] DELETE #ids :ids',
+                        'ConditionExpression': f'#ord[{index}].#id = :order_id',
+                        'ExpressionAttributeNames': {
+                            '#ord': 'orders',
+                            '#ids': 'order_ids',
+                            '#id': 'id'
+                        },
+                        'ExpressionAttributeValues': {
+                            ':ids': {order_id},
+                            ':order_id': order['id']
+                        }
+                    }
+                },
+                {'Delete': {'TableName': table.name, 'Key': get_delivery_entry_key(restaurant_name, order)}}
+            ])
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException' and \
+                get_cancellation_reason(e) != 'ConditionalCheckFailed':
+            raise
+        return False
+
+    return True
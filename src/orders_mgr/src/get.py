@@ -1,16 +1,22 @@
+from datetime import datetime
 from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
 from .custom_exceptions import BadRequestException
+from .documents import decode_document
+from .utils import get_order_sort_key, get_since_sort_key, format_order, delivery_entry_to_order, query_all, \
+    DELIVERY_PREFIX, DELIVERY_ENTRY, DELIVERY_INDEX, DELIVERY_RANGE_END
 
 
 def get_all_orders(event, table):
     """
-    Returns all the orders for a given restaurant_id.
+    Returns the orders for a given restaurant_id, with their days formatted. The body can limit them to orders created
+    at or after since (unix time), and page through them oldest first with limit and the next_cursor of the previous
+    page as cursor.
 
     :param event: Event passed to lambda.
     :param table: Client for Master DB.
     :raises BadRequestException: Thrown if format is not as expected.
-    :return: 200 - list of items containing all the orders.
+    :return: 200 - list of items containing the orders, and next_cursor if there are more.
         404 - Orders not found.
         500 - Internal error.
     """
@@ -21,6 +27,18 @@ def get_all_orders(event, table):
         raise BadRequestException('Bad request restaurant_id not found in body.')
 
     restaurant_name = event['body']['restaurant_id']
+    since = event['body'].get('since')
+    limit = event['body'].get('limit')
+    cursor = event['body'].get('cursor')
+
+    if since is not None and (not isinstance(since, (int, float)) or isinstance(since, bool) or since < 0):
+        raise BadRequestException('Bad request since must be a unix time.')
+
+    if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0):
+        raise BadRequestException('Bad request limit must be a positive integer.')
+
+    if cursor is not None and not isinstance(cursor, str):
+        raise BadRequestException('Bad request cursor must be a string.')
 
     try:
         table_response = table.query(
@@ -28,13 +46,27 @@ def get_all_orders(event, table):
         )
 
         # Can throw key error if not found
-        orders = table_response['Items'][0]['orders']
+        orders = decode_document(table_response['Items'][0])['orders']
+
+        body = {}
+        if since is None and limit is None and cursor is None:
+            body['items'] = [format_order(order) for order in orders]
+        else:
+            # ids sort in the order orders were created, so a page starts right after the last id of the one before
+            keyed_orders = sorted(((get_order_sort_key(order), order) for order in orders), key=lambda keyed: keyed[0])
+            if since is not None:
+                keyed_orders = [(key, order) for key, order in keyed_orders if key >= get_since_sort_key(since)]
+            if cursor is not None:
+                keyed_orders = [(key, order) for key, order in keyed_orders if key > cursor]
+
+            if limit is not None and len(keyed_orders) > limit:
+                keyed_orders = keyed_orders[:limit]
+                body['next_cursor'] = keyed_orders[-1][0]
+            body['items'] = [format_order(order) for key, order in keyed_orders]
 
         response = {
             'statusCode': 200,
-            'body': {
-                'items': orders
-            }
+            'body': body
         }
 
     except KeyError as ignore:
@@ -83,7 +115,7 @@ def get_order(event, table):
         )
 
         # Can throw key error if not found
-        orders = table_response['Items'][0]['orders']
+        orders = decode_document(table_response['Items'][0])['orders']
 
         order_in_question = None
         for order in orders:
@@ -93,7 +125,7 @@ def get_order(event, table):
 
         response = {
             'statusCode': 200,
-            'body': order_in_question
+            'body': format_order(order_in_question) if order_in_question is not None else None
         }
 
     except KeyError as ignore:
@@ -108,4 +140,102 @@ def get_order(event, table):
             'body': 'Error accessing DynamoDB: ' + str(e)
         }
 
-    return response
\ No newline at end of file
+    return response
+
+
+def get_day_parameter(event, name):
+    """
+    Gets a day from the body of an event.
+
+    :param event: Event passed to lambda.
+    :param name: Name of the day in the body.
+    :raises BadRequestException: Thrown if the day is not a YYYY-MM-DD date.
+    :return: The day, None if the body does not have it.
+    """
+    day = event['body'].get(name)
+    if day is None:
+        return None
+
+    try:
+        datetime.strptime(day, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        raise BadRequestException(f'Bad request {name} must be a YYYY-MM-DD date.')
+    return day
+
+
+def get_deliveries(event, table):
+    """
+    Returns a restaurant's orders due for delivery from from_day to to_day (YYYY-MM-DD), both included. Without
+    from_day the orders overdue are included, without to_day every later order is.
+
+    :param event: Event passed to lambda.
+    :param table: Client for Master DB.
+    :raises BadRequestException: Thrown if format is not as expected.
+    :return: 200 - list of items containing the orders due, by delivery day.
+        500 - Internal error.
+    """
+    if 'body' not in event or 'restaurant_id' not in event['body']:
+        raise BadRequestException('Bad request restaurant_id not found in body.')
+
+    restaurant_name = event['body']['restaurant_id']
+    from_day = get_day_parameter(event, 'from_day')
+    to_day = get_day_parameter(event, 'to_day')
+
+    lower = DELIVERY_PREFIX + (from_day or '')
+    if to_day is None:
+        upper = DELIVERY_PREFIX + DELIVERY_RANGE_END
+    else:
+        upper = DELIVERY_ENTRY.format(day=to_day, order_id=DELIVERY_RANGE_END)
+
+    try:
+        entries = query_all(table, KeyConditionExpression=Key('pk').eq(restaurant_name) &
+                            Key('type').between(lower, upper))
+
+        response = {
+            'statusCode': 200,
+            'body': {
+                'items': [delivery_entry_to_order(entry) for entry in entries]
+            }
+        }
+
+    except ClientError as e:
+        response = {
+            'statusCode': 500,
+            'body': 'Error accessing DynamoDB: ' + str(e)
+        }
+
+    return response
+
+
+def get_company_deliveries(event, table):
+    """
+    Returns the orders of every restaurant due for delivery on a day, for the delivery company to plan its rounds.
+
+    :param event: Event passed to lambda.
+    :param table: Client for Master DB.
+    :raises BadRequestException: Thrown if format is not as expected.
+    :return: 200 - list of items containing the orders due, by restaurant, each with its restaurant_id.
+        500 - Internal error.
+    """
+    if 'body' not in event or event['body'].get('day') is None:
+        raise BadRequestException('Bad request day not found in body.')
+
+    day = get_day_parameter(event, 'day')
+
+    try:
+        entries = query_all(table, IndexName=DELIVERY_INDEX, KeyConditionExpression=Key('delivery_day').eq(day))
+
+        response = {
+            'statusCode': 200,
+            'body': {
+                'items': [delivery_entry_to_order(entry) for entry in entries]
+            }
+        }
+
+    except ClientError as e:
+        response = {
+            'statusCode': 500,
+            'body': 'Error accessing DynamoDB: ' + str(e)
+        }
+
+    return response
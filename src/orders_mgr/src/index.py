@@ -3,12 +3,15 @@ import os
 import boto3
 from boto3.dynamodb.conditions import Key
 from .custom_exceptions import BadRequestException
-from .get import get_all_orders, get_order
-from .post import order_check
+from .get import get_all_orders, get_order, get_deliveries, get_company_deliveries
+from .post import order_check, backfill_deliveries
 from .delete import delete_order
+from .utils import mark_restaurant_mutated
+from .idempotency import run_idempotent
 
 
 def handler(event, context):
+    response = None
 
     # ensures that requests are dicts
     if isinstance(event, str):
@@ -33,12 +36,21 @@ def handler(event, context):
 
         if httpMethod == 'POST':
             if action == 'create_order':
-                response = order_check(dynamodb_client, event_dict, table, __master_db_name__)
+                # a retried check with the same idempotency key is answered without ordering again
+                body = event_dict.get('body', {})
+                response = run_idempotent(table, body.get('restaurant_id'), action, body,
+                                          lambda: order_check(dynamodb_client, event_dict, table, __master_db_name__))
+            elif action == 'backfill_deliveries':
+                response = backfill_deliveries(event_dict, table)
         elif httpMethod == 'GET':
             if action == 'get_all_orders':
                 response = get_all_orders(event_dict, table)
             elif action == 'get_order':
                 response = get_order(event_dict, table)
+            elif action == 'get_deliveries':
+                response = get_deliveries(event_dict, table)
+            elif action == 'get_company_deliveries':
+                response = get_company_deliveries(event_dict, table)
         elif httpMethod == 'DELETE':
             if action == 'delete_order':
                 response = delete_order(event_dict, table)
@@ -48,6 +60,8 @@ def handler(event, context):
                 'statusCode': 400,
                 'body': 'Bad request.'
             }
+        elif response['statusCode'] in [200, 201] and action in ['create_order', 'delete_order']:
+            mark_restaurant_mutated(table, event_dict['body']['restaurant_id'])
 
     except BadRequestException as e:
         response = {
@@ -1,7 +1,13 @@
 from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
 from botocore.exceptions import ClientError
 from .custom_exceptions import NotFoundException, BadRequestException
-from .utils import generate_order_id, get_total_item_quantity, get_expired_item_quantity_fridge
+from .documents import decode_document, encodes_documents, append_to_document, is_encoded, put_document
+from .utils import generate_order_id, get_item_quantity_fridge, get_ordered_quantities, merge_order_items, \
+    get_expiry_index, get_expiring_quantities, get_next_expiry_check_from_index, merge_fridge_shards, \
+    load_other_fridges, merge_fridges, EXPIRY_WARNING_WINDOW, ORDER_CONSOLIDATION, CONSOLIDATION_MODES, \
+    ORDER_ID_ATTEMPTS, CONSOLIDATION_TOKEN_MARGIN, has_valid_token, get_delivery_entry, put_delivery_entry, \
+    get_cancellation_reason, query_all, DELIVERY_PREFIX
 import time
 import json
 
@@ -15,7 +21,8 @@ def order_check(dynamodb_client, event, table, table_name):
     :param table: DynamoDB table resource for specified table_name.
     :param table_name: Name of MasterDB.
     :raises BadRequestException: Thrown if format is not as expected.
-    :return: 201 - Success: Order was created
+    :return: 200 - Success: The open order was consolidated with the shortfall.
+        201 - Success: Order was created
         204 - Success: No order necessary.
         404 - Fridge not found.
         500 - Internal error resulting in entry not being added.
@@ -37,20 +44,38 @@ def order_check(dynamodb_client, event, table, table_name):
         )
 
         # Can throw key error if not found
-        fridge_items = fridge_response['Items'][0]['items']
+        fridge = merge_fridge_shards(table, decode_document(fridge_response['Items'][0]))
+        fridge = merge_fridges([fridge] + load_other_fridges(table, restaurant_name))
+        fridge_items = fridge['items']
 
         # Call orders
         orders_response = table.query(
             KeyConditionExpression=Key('pk').eq(restaurant_name) & Key('type').eq('orders')
         )
 
-        orders = orders_response['Items'][0]['orders']
+        orders_item = orders_response['Items'][0]
+        orders = decode_document(orders_item)['orders']
+
+        # when consolidating, the latest order is the open one. Superseding it replaces its items, so it is not
+        # counted as stock on its way. An order whose token expires soon is about to be removed, so it is left alone
+        current_date = int(time.time())
+        consolidation = ORDER_CONSOLIDATION if orders and ORDER_CONSOLIDATION in CONSOLIDATION_MODES else 'append'
+        if consolidation != 'append' and not has_valid_token(table, restaurant_name, orders[-1]['id'],
+                                                             current_date + CONSOLIDATION_TOKEN_MARGIN):
+            consolidation = 'append'
+        ordered_quantities = get_ordered_quantities(orders[:-1] if consolidation == 'supersede' else orders)
+
+        # expired and going to expire stock are two range reads of the expiry sorted batches
+        expiry_index = get_expiry_index(fridge)
+        expired_quantities = get_expiring_quantities(expiry_index, current_date)
+        # Will expire within the next 3 days
+        expiring_quantities = get_expiring_quantities(expiry_index, current_date + EXPIRY_WARNING_WINDOW)
 
         order_items = []
         expired_items = []
         going_to_expire = []
         for fridge_item in fridge_items:
-            item_quantity = get_total_item_quantity(fridge_item, orders)
+            item_quantity = get_item_quantity_fridge(fridge_item) + ordered_quantities.get(fridge_item['item_name'], 0)
 
             if item_quantity < fridge_item['desired_quantity']:
                 # add item to order
@@ -63,8 +88,7 @@ def order_check(dynamodb_client, event, table, table_name):
                 order_items.append(item_to_order)
 
             # Expired items
-            current_date = int(time.time())
-            expired_item_quantity = get_expired_item_quantity_fridge(fridge_item, current_date)
+            expired_item_quantity = expired_quantities.get(fridge_item['item_name'], 0)
 
             if expired_item_quantity > 0:
                 expired_item = {
@@ -75,9 +99,7 @@ def order_check(dynamodb_client, event, table, table_name):
                 expired_items.append(expired_item)
 
             # Will expire within the next 3 days
-            future_date = current_date + 259200
-            going_to_expire_quantity = get_expired_item_quantity_fridge(fridge_item, future_date)
-            going_to_expire_quantity -= expired_item_quantity
+            going_to_expire_quantity = expiring_quantities.get(fridge_item['item_name'], 0) - expired_item_quantity
 
             if going_to_expire_quantity > 0:
                 expired_item = {
@@ -87,9 +109,14 @@ def order_check(dynamodb_client, event, table, table_name):
 
                 going_to_expire.append(expired_item)
 
-        if order_items:
+        if order_items and consolidation != 'append':
+            response = consolidate_order(table, restaurant_name, orders_item, order_items, consolidation,
+                                         expired_items, going_to_expire)
+
+        # a new order is also created if the open order was delivered while it was being consolidated
+        if response is None and order_items:
             response = create_order(dynamodb_client, table, restaurant_name, order_items, expired_items, table_name)
-        else:
+        elif response is None:
             # return success, no order necessary
             response = {
                 'statusCode': 204,
@@ -99,6 +126,10 @@ def order_check(dynamodb_client, event, table, table_name):
                 }
             }
 
+        # lets update_orders know when it next needs to look at this fridge, even if nothing else changes
+        if isinstance(response.get('body'), dict):
+            response['body']['next_expiry_check'] = get_next_expiry_check_from_index(expiry_index, current_date)
+
     except KeyError as ignore:
         response = {
             'statusCode': 404,
@@ -137,35 +168,25 @@ def create_order(dynamodb_client, table, restaurant_name, order_items, expired_i
     delivery_date = order_date + day_in_secs
 
     try:
-        order_id = generate_order_id(table, restaurant_id)
-        if order_id is None:
-            raise Exception('Order ID could not be generated.')
-
-        dynamodb_client.update_item(
-            TableName=table_name,
-            Key={
-                'pk': {'S': restaurant_id},
-                'type': {'S': 'orders'}
-            },
-            UpdateExpression="SET #ord = list_append(#ord, :new_order)",
-            ExpressionAttributeNames={
-                '#ord': 'orders'
-            },
-            ExpressionAttributeValues={
-                ':new_order': {
-                    'L': [
-                        {
-                            'M': {
-                                'id': {'S': order_id},
-                                'delivery_date': {'N': str(delivery_date)},
-                                'date_ordered': {'N': str(order_date)},
-                                'items': {'L': order_items}
-                            }
+        for attempt in range(ORDER_ID_ATTEMPTS):
+            order_id = generate_order_id()
+            new_order = {
+                'L': [
+                    {
+                        'M': {
+                            'id': {'S': order_id},
+                            'delivery_date': {'N': str(delivery_date)},
+                            'date_ordered': {'N': str(order_date)},
+                            'items': {'L': order_items}
                         }
-                    ]
-                },
-            },
-        )
+                    }
+                ]
+            }
+
+            if write_order(dynamodb_client, table, restaurant_id, order_id, new_order, table_name):
+                break
+        else:
+            raise Exception('Order ID could not be generated.')
 
         response = {
             'statusCode': 201,
@@ -193,4 +214,222 @@ def create_order(dynamodb_client, table, restaurant_name, order_items, expired_i
             'body': 'Exception: ' + str(e)
         }
 
-    return response
\ No newline at end of file
+    return response
+
+
+def consolidate_order(table, restaurant_name, orders_item, order_items, consolidation, expired_items,
+                      going_to_expire):
+    """
+    Adds a shortfall to the restaurant's latest undelivered order, or replaces that order's items with it, instead of
+    creating another order. The order keeps its id and delivery date, so the delivery link already sent for it shows
+    the new items and it stays due on the same day.
+
+    :param table: DynamoDB table resource for specified table_name.
+    :param restaurant_name: Name of restaurant.
+    :param orders_item: The restaurant's orders entry as it was read, the latest order is the open one.
+    :param order_items: Items short, as DynamoDB map values.
+    :param consolidation: 'merge' to add the items to the open order, 'supersede' to replace its items.
+    :param expired_items: Expired item entries from fridge.
+    :param going_to_expire: Item entries from fridge that will expire within the warning window.
+    :return: 200 - Success: open order updated.
+        None if the open order was delivered or removed before it could be updated.
+    """
+    deserializer = TypeDeserializer()
+    new_items = [deserializer.deserialize(item) for item in order_items]
+
+    item = decode_document(orders_item)
+    index = len(item['orders']) - 1
+    open_order = item['orders'][index]
+    now = int(time.time())
+    updated_order = {
+        **open_order,
+        'items': merge_order_items(open_order['items'], new_items) if consolidation == 'merge' else new_items,
+        'date_updated': now
+    }
+
+    try:
+        if encodes_documents() or is_encoded(orders_item):
+            put_document(table, {**item, 'orders': item['orders'][:index] + [updated_order]}, orders_item)
+            put_delivery_entry(table, restaurant_name, updated_order)
+        else:
+            # the order and its delivery entry are rewritten together, so the delivery page never shows stale items
+            table.meta.client.transact_write_items(TransactItems=[
+                {
+                    'Update': {
+                        'TableName': table.name,
+                        'Key': {
+                            'pk': restaurant_name,
+                            'type': 'orders'
+                        },
+                        'UpdateExpression': f'SET #ord[{index}] = :order',
+                        'ConditionExpression': f'#ord[{index}].#id = :order_id',
+                        'ExpressionAttributeNames': {
+                            '#ord': 'orders',
+                            '#id': 'id'
+                        },
+                        'ExpressionAttributeValues': {
+                            ':order': updated_order,
+                            ':order_id': open_order['id']
+                        }
+                    }
+                },
+                {'Put': {'TableName': table.name, 'Item': get_delivery_entry(restaurant_name, updated_order)}}
+            ])
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException' and \
+                get_cancellation_reason(e) != 'ConditionalCheckFailed':
+            raise
+        return None
+
+    return {
+        'statusCode': 200,
+        'body': {
+            'order_id': open_order['id'],
+            'consolidated': consolidation,
+            'expired_items': expired_items,
+            'going_to_expire': going_to_expire
+        }
+    }
+
+
+def write_order(dynamodb_client, table, restaurant_id, order_id, new_order, table_name):
+    """
+    Appends a new order to a restaurant's orders, only if its id is not already taken. The ids of the restaurant's
+    orders are kept in the order_ids set next to the orders, so the check is part of the write rather than a read.
+    The order's delivery entry is written in the same transaction, so an order is never left off the delivery page.
+
+    :param dynamodb_client: The MasterDB client.
+    :param table: DynamoDB table resource for specified table_name.
+    :param restaurant_id: Name of restaurant.
+    :param order_id: Id of the new order.
+    :param new_order: The order as a DynamoDB list value holding one order.
+    :param table_name: Name of MasterDB.
+    :raises NotFoundException: Thrown if restaurant does not exist.
+    :return: True if the order was written, False if its id is already taken.
+    """
+    order = TypeDeserializer().deserialize(new_order)[0]
+    if encodes_documents():
+        # the whole document is rewritten only if it is unchanged, a ULID cannot clash with an order read with it
+        append_order_document(table, restaurant_id, new_order)
+        put_delivery_entry(table, restaurant_id, order)
+        return True
+
+    serializer = TypeSerializer()
+    try:
+        dynamodb_client.transact_write_items(TransactItems=[
+            {
+                'Update': {
+                    'TableName': table_name,
+                    'Key': {
+                        'pk': {'S': restaurant_id},
+                        'type': {'S': 'orders'}
+                    },
+                    'UpdateExpression': "SET #ord = list_append(#ord, :new_order) ADD #ids :new_id",
+                    'ConditionExpression': "attribute_exists(pk) AND NOT contains(#ids, :order_id)",
+                    'ExpressionAttributeNames': {
+                        '#ord': 'orders',
+                        '#ids': 'order_ids'
+                    },
+                    'ExpressionAttributeValues': {
+                        ':new_order': new_order,
+                        ':new_id': {'SS': [order_id]},
+                        ':order_id': {'S': order_id}
+                    }
+                }
+            },
+            {
+                'Put': {
+                    'TableName': table_name,
+                    'Item': {key: serializer.serialize(value)
+                             for key, value in get_delivery_entry(restaurant_id, order).items()}
+                }
+            }
+        ])
+    except ClientError as e:
+        reason = get_cancellation_reason(e)
+        if reason == 'ConditionalCheckFailed':
+            if 'Item' not in table.get_item(Key={'pk': restaurant_id, 'type': 'orders'}, ProjectionExpression='pk'):
+                raise NotFoundException('Restaurant does not exist.')
+            return False
+        # orders written while documents were encoded have no orders list to append to
+        if reason != 'ValidationError' and e.response['Error']['Code'] != 'ValidationException':
+            raise
+        append_order_document(table, restaurant_id, new_order)
+        put_delivery_entry(table, restaurant_id, order)
+
+    return True
+
+
+def append_order_document(table, restaurant_id, new_order):
+    """
+    Adds an order to a restaurant's orders by rewriting the whole orders item, for encoded orders documents.
+
+    :param table: DynamoDB table resource for specified table_name.
+    :param restaurant_id: Name of restaurant.
+    :param new_order: The order as a DynamoDB list value holding one order.
+    :raises NotFoundException: Thrown if restaurant does not exist.
+    :return: None
+    """
+    if not append_to_document(table, {'pk': restaurant_id, 'type': 'orders'}, 'orders',
+                              TypeDeserializer().deserialize(new_order)):
+        raise NotFoundException('Restaurant does not exist.')
+
+
+def backfill_deliveries(event, table):
+    """
+    Writes the delivery entries of a restaurant's orders that have none, for orders created before delivery entries
+    were kept or whose entry could not be written after an encoded orders document. Entries already there are left
+    alone, so it can be run again at any time.
+
+    :param event: Event passed to lambda.
+    :param table: DynamoDB table resource for specified table_name.
+    :raises BadRequestException: Thrown if format is not as expected.
+    :return: 200 - Success, with the number of entries written.
+        404 - Restaurant not found.
+        500 - Internal error.
+    """
+    if 'body' not in event or 'restaurant_id' not in event['body']:
+        raise BadRequestException('Bad request restaurant_id not found in body.')
+
+    restaurant_name = event['body']['restaurant_id']
+
+    try:
+        orders_item = table.get_item(Key={'pk': restaurant_name, 'type': 'orders'}).get('Item')
+        if orders_item is None:
+            return {
+                'statusCode': 404,
+                'body': 'Restaurant does not exist.'
+            }
+
+        entries = query_all(table, KeyConditionExpression=Key('pk').eq(restaurant_name) &
+                            Key('type').begins_with(DELIVERY_PREFIX),
+                            ProjectionExpression='#type', ExpressionAttributeNames={'#type': 'type'})
+        existing = {entry['type'] for entry in entries}
+
+        written = 0
+        for order in decode_document(orders_item)['orders']:
+            entry = get_delivery_entry(restaurant_name, order)
+            if entry['type'] in existing:
+                continue
+
+            try:
+                table.put_item(Item=entry, ConditionExpression='attribute_not_exists(pk)')
+                written += 1
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+
+        response = {
+            'statusCode': 200,
+            'body': {
+                'written': written
+            }
+        }
+
+    except ClientError as e:
+        response = {
+            'statusCode': 500,
+            'body': 'Error accessing DynamoDB: ' + str(e)
+        }
+
+    return response
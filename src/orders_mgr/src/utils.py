@@ -1,72 +1,259 @@
+import bisect
+import heapq
+import logging
+import os
 import secrets
 import time
-from .custom_exceptions import NotFoundException
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+from .documents import decode_document
 
-def generate_order_id(table, restaurant_id):
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# items are reported as going to expire this many seconds before their expiry date
+EXPIRY_WARNING_WINDOW = 259200
+
+# how order_check handles a shortfall while the restaurant still has an undelivered order. 'append' adds a new order
+# every time. 'merge' adds the new shortfall to the latest undelivered order, and 'supersede' replaces that order's
+# items with everything that is short now, so a restaurant only ever has one order open
+ORDER_CONSOLIDATION = os.environ.get('ORDER_CONSOLIDATION', 'append')
+CONSOLIDATION_MODES = ['append', 'merge', 'supersede']
+# update_orders removes an order once its delivery token expires, so an order is only consolidated into while its
+# token stays valid for at least this long, time enough to deliver what is added to it
+CONSOLIDATION_TOKEN_MARGIN = 86400
+
+# fridge_mgr can spread a large restaurant's fridge over shards, the restaurant's own fridge entry records how many
+FRIDGE_SHARD_KEY = '{restaurant}#shard#{shard}'
+
+# fridge_mgr keeps every fridge of a restaurant after its first under its own key, listed on the fridges entry
+FRIDGE_KEY = '{restaurant}#fridge#{fridge_id}'
+
+# order ids are ULIDs, Crockford base32 of a 48 bit millisecond timestamp then 80 random bits
+ORDER_ID_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+ORDER_ID_TIME_LENGTH = 10
+ORDER_ID_RANDOM_LENGTH = 16
+ORDER_ID_ATTEMPTS = 3
+
+# every order also has a delivery entry under its restaurant, so the orders due on a range of days are a range of sort
+# keys. The entries are in the delivery-index too, partitioned by day across every restaurant, for the delivery company
+DELIVERY_PREFIX = 'delivery#'
+DELIVERY_ENTRY = 'delivery#{day}#{order_id}'
+DELIVERY_INDEX = 'delivery-index'
+# sorts after every order id, to end a range of delivery entries after the last one of a day
+DELIVERY_RANGE_END = '~'
+
+def has_valid_token(table, restaurant_id, order_id, valid_until):
+    """
+    Checks whether an order's delivery token from token_mgr is still valid at a time.
+    :param table: DynamoDB table resource.
+    :param restaurant_id: Name of restaurant.
+    :param order_id: Id of the order.
+    :param valid_until: Unix time the token must still be valid at.
+    :return: True if the order has a token expiring after valid_until.
+    """
+    tokens = decode_document(table.get_item(Key={'pk': restaurant_id, 'type': 'tokens'}).get('Item')) or {}
+    return any(token['id_type'] == 'order' and token['object_id'] == order_id and
+               int(token['expiry_date']) > valid_until
+               for token in tokens.get('tokens', []))
+
+
+def encode_base32(value, length):
+    """
+    Encodes a number in Crockford's base32, padded to a fixed length so encoded numbers sort as strings.
+
+    :param value: Non-negative integer.
+    :param length: Number of characters.
+    :return: Encoded number.
+    """
+    characters = []
+    for _ in range(length):
+        value, remainder = divmod(value, 32)
+        characters.append(ORDER_ID_ALPHABET[remainder])
+    return ''.join(reversed(characters))
+
+
+def generate_order_id(timestamp_ms=None):
+    """
+    Creates a new order id, a ULID: the time it was created in milliseconds followed by 80 random bits. Ids sort in
+    the order they were created, create_order makes sure an id is not already taken when it writes the order.
+
+    :param timestamp_ms: Unix time in milliseconds, the current time if not given.
+    :return: order id
+    """
+    if timestamp_ms is None:
+        timestamp_ms = int(time.time() * 1000)
+
+    return encode_base32(timestamp_ms, ORDER_ID_TIME_LENGTH) + encode_base32(secrets.randbits(80),
+                                                                           ORDER_ID_RANDOM_LENGTH)
+
+
+def is_ulid(order_id):
+    """
+    Checks whether an order id was made by generate_order_id, orders created before it have random numeric ids.
+
+    :param order_id: Order id.
+    :return: True if the order id is a ULID.
+    """
+    return len(order_id) == ORDER_ID_TIME_LENGTH + ORDER_ID_RANDOM_LENGTH and \
+        all(character in ORDER_ID_ALPHABET for character in order_id)
+
+
+def get_order_sort_key(order):
+    """
+    Gets a key that sorts orders by the time they were created. It is the id of orders with a ULID, orders created
+    before have the time they were ordered encoded the same way, followed by their numeric id so keys stay unique.
+
+    :param order: Order.
+    :return: Sort key.
+    """
+    if is_ulid(order['id']):
+        return order['id']
+    return encode_base32(int(order['date_ordered']) * 1000, ORDER_ID_TIME_LENGTH) + order['id'].zfill(20)
+
+
+def get_since_sort_key(since):
+    """
+    Gets the lowest sort key of an order created at or after a time.
+
+    :param since: Unix time.
+    :return: Sort key to compare with get_order_sort_key.
     """
-    Creates a new order id for a given restaurant id.
+    return encode_base32(int(since * 1000), ORDER_ID_TIME_LENGTH)
+
+
+def get_day(timestamp):
+    """
+    Gets the day of a unix time, as the orders lambda formats dates for the app.
+
+    :param timestamp: Unix time.
+    :return: Day as YYYY-MM-DD, in UTC.
+    """
+    return datetime.fromtimestamp(int(timestamp), tz=timezone.utc).strftime('%Y-%m-%d')
+
+
+def format_order(order):
+    """
+    Gets an order with the days it was ordered and is to be delivered on added, so the app does not format them.
+
+    :param order: Order.
+    :return: Copy of the order with ordered_day and delivery_day.
+    """
+    return {
+        **order,
+        'ordered_day': get_day(order['date_ordered']),
+        'delivery_day': get_day(order['delivery_date'])
+    }
+
+
+def get_delivery_entry(restaurant_id, order):
+    """
+    Gets the delivery entry of an order.
+
+    :param restaurant_id: Name of restaurant.
+    :param order: Order.
+    :return: Item to write.
+    """
+    delivery_day = get_day(order['delivery_date'])
+    return {
+        'pk': restaurant_id,
+        'type': DELIVERY_ENTRY.format(day=delivery_day, order_id=order['id']),
+        'delivery_day': delivery_day,
+        'order_id': order['id'],
+        'date_ordered': order['date_ordered'],
+        'delivery_date': order['delivery_date'],
+        'items': order['items']
+    }
+
+
+def delivery_entry_to_order(entry):
+    """
+    Gets the order a delivery entry was written for, formatted as format_order does.
+
+    :param entry: Delivery entry, from the table or the delivery-index.
+    :return: Order, with the restaurant_id it is for.
+    """
+    return format_order({
+        'id': entry['order_id'],
+        'restaurant_id': entry['pk'],
+        'date_ordered': entry['date_ordered'],
+        'delivery_date': entry['delivery_date'],
+        'items': entry['items']
+    })
+
+
+def put_delivery_entry(table, restaurant_id, order):
+    """
+    Writes the delivery entry of an order, after an encoded orders document was rewritten without it.
+
+    The order is already written, so a failure does not fail the request, backfill_deliveries writes the entry again.
 
     :param table: DynamoDB table resource for specified table_name.
     :param restaurant_id: Name of restaurant.
-    :raises NotFoundException: Thrown if restaurant does not exist.
-    :return: order id
+    :param order: Order.
+    :return: None
     """
-    dynamo_response = table.get_item(
-        Key={
-            'pk': restaurant_id,
-            'type': 'orders'
-        }
-    )
-    item = dynamo_response.get('Item', None)
+    try:
+        table.put_item(Item=get_delivery_entry(restaurant_id, order))
+    except ClientError as e:
+        logger.warning(f"Could not write the delivery entry of order {order['id']}: {str(e)}")
 
-    if item is None:
-        raise NotFoundException('Restaurant does not exist.')
 
-    response = None
-    count = 3
-    while count > 0:
-        order_id = str(secrets.randbits(64))
-        if is_order_id_valid(order_id, item):
-            response = order_id
-            break
-        count -= 1
-            
-    return response
-        
-        
-def is_order_id_valid(order_id, item):
+def get_cancellation_reason(error):
     """
-    Validates generated order id by checking it doesn't match existing order ids.
+    Gets why the first write of a cancelled transaction failed.
 
-    :param order_id: Generated order id.
-    :param item: Restaurant containing orders.
-    :raises NotFoundException: Thrown if restaurant does not exist.
-    :return: True if order id valid, False if invalid.
+    :param error: ClientError raised by transact_write_items.
+    :return: Code of the reason, e.g. 'ConditionalCheckFailed', or None if the transaction was not cancelled.
     """
-    for index, order in enumerate(item['orders']):
-        if order_id == order['id']:
-            return False
+    if error.response['Error']['Code'] != 'TransactionCanceledException':
+        return None
+    reasons = error.response.get('CancellationReasons') or [{}]
+    return reasons[0].get('Code')
 
-    return True
 
+def delete_delivery_entry(table, restaurant_id, order):
+    """
+    Removes the delivery entry of an order.
 
-def get_expired_item_quantity_fridge(fridge_item, expiry_time):
+    :param table: DynamoDB table resource for specified table_name.
+    :param restaurant_id: Name of restaurant.
+    :param order: Order.
+    :return: None
     """
-    Gets quantity of expired fridge item.
+    table.delete_item(Key=get_delivery_entry_key(restaurant_id, order))
 
-    :param fridge_item: Item to be checked for expired entries.
-    :param expiry_time: The unix time when the food will be considered to have expired.
-    :return: Quantity of expired fridge item.
+
+def get_delivery_entry_key(restaurant_id, order):
     """
-    quantity = 0
-    for entry in fridge_item['item_list']:
-        print(entry['expiry_date'], end=' ')
-        print('<=', end=' ')
-        print(expiry_time, end=' ')
-        print(entry['expiry_date'] <= expiry_time)
-        if entry['expiry_date'] <= expiry_time:
-            quantity += entry['current_quantity']
-    return quantity
+    Gets the key of an order's delivery entry.
+
+    :param restaurant_id: Name of restaurant.
+    :param order: Order.
+    :return: Key of the entry.
+    """
+    return {
+        'pk': restaurant_id,
+        'type': DELIVERY_ENTRY.format(day=get_day(order['delivery_date']), order_id=order['id'])
+    }
+
+
+def query_all(table, **query_arguments):
+    """
+    Gets every item of a query, following it over as many pages as it takes.
+
+    :param table: Client for Master DB.
+    :param query_arguments: Arguments of the query.
+    :return: List of items.
+    """
+    items = []
+    while True:
+        table_response = table.query(**query_arguments)
+        items.extend(table_response.get('Items', []))
+
+        if 'LastEvaluatedKey' not in table_response:
+            return items
+        query_arguments['ExclusiveStartKey'] = table_response['LastEvaluatedKey']
 
 
 def get_item_quantity_fridge(fridge_item):
@@ -76,6 +263,11 @@ def get_item_quantity_fridge(fridge_item):
     :param fridge_item: Item to be checked for unexpired entries.
     :return: Quantity of unexpired fridge item.
     """
+    # fridge_mgr keeps the unexpired quantity on the item, it holds until the next counted batch expires
+    next_expiry = fridge_item.get('next_expiry')
+    if 'non_expired_quantity' in fridge_item and (next_expiry is None or next_expiry > int(time.time())):
+        return fridge_item['non_expired_quantity']
+
     quantity = 0
     for entry in fridge_item['item_list']:
         if entry['expiry_date'] > int(time.time()):
@@ -83,32 +275,206 @@ def get_item_quantity_fridge(fridge_item):
     return quantity
 
 
-def get_item_quantity_orders(order_items, item_name):
+def get_ordered_quantities(orders):
     """
-    Gets quantity of item from order.
+    Gets the quantity of each item on order, so a check reads the orders once rather than once per fridge item.
 
-    :param order_items: Items in order.
-    :param item_name: Name of item being added to order.
-    :return: Quantity of item in order.
+    :param orders: Orders of the restaurant.
+    :return: Dict of item name to quantity across all the orders.
     """
-    for item in order_items:
-        if item['item_name'] == item_name:
-            return item['quantity']
-    return 0
+    quantities = {}
+    for order in orders:
+        for item in order['items']:
+            quantities[item['item_name']] = quantities.get(item['item_name'], 0) + item['quantity']
+    return quantities
 
 
-def get_total_item_quantity(fridge_item, orders):
+def merge_order_items(order_items, new_items):
     """
-    Gets total quantity of item from fridge and order.
+    Adds items to an order's items, adding to the quantity of items already on it.
 
-    :param fridge_item: Item in fridge.
-    :param orders: All orders for restaurant.
-    :return: Combined quantity of item in orders and fridge.
+    :param order_items: Items already on the order.
+    :param new_items: Items to add.
+    :return: New list of the order's items, in the order they were first added.
     """
-    # Count from fridge entry
-    item_quantity = get_item_quantity_fridge(fridge_item)
-    # Count from orders
-    for order in orders:
-        item_quantity += get_item_quantity_orders(order['items'], fridge_item['item_name'])
+    merged = {item['item_name']: dict(item) for item in order_items}
+    for item in new_items:
+        if item['item_name'] in merged:
+            merged[item['item_name']]['quantity'] += item['quantity']
+        else:
+            merged[item['item_name']] = dict(item)
+    return list(merged.values())
+
+
+def mark_restaurant_mutated(table, restaurant_id):
+    """
+    Stamps the restaurant's admin settings with the time of its latest orders write, this lets the nightly
+    update_orders run skip restaurants that have not changed since it last processed them.
+
+    :param table: DynamoDB table resource for specified table_name.
+    :param restaurant_id: Name of restaurant.
+    :return: None
+    """
+    try:
+        table.update_item(
+            Key={
+                'pk': restaurant_id,
+                'type': 'admin_settings'
+            },
+            UpdateExpression='SET last_mutated = :now',
+            ConditionExpression='attribute_exists(pk)',
+            ExpressionAttributeValues={
+                ':now': int(time.time())
+            }
+        )
+    except ClientError as ignore:
+        # the write itself succeeded, a missing watermark only costs a redundant nightly run
+        pass
+
+
+def get_expiry_index(fridge):
+    """
+    Gets the fridge's batches sorted by expiry date, as [expiry_date, item_name, date_added, current_quantity].
+    fridge_mgr keeps this index on the fridge, it is built here for fridges saved before it did.
+
+    :param fridge: The restaurant's fridge entry.
+    :return: The expiry index.
+    """
+    if fridge.get('expiry_index') is not None:
+        return fridge['expiry_index']
+
+    return sorted(
+        [entry['expiry_date'], fridge_item['item_name'], entry.get('date_added', 0), entry['current_quantity']]
+        for fridge_item in fridge['items']
+        for entry in fridge_item['item_list']
+        if entry.get('date_removed', 0) == 0 and entry.get('expiry_date') is not None and entry['current_quantity'] > 0
+    )
+
+
+def get_expiring_quantities(expiry_index, expiry_time):
+    """
+    Gets the quantity of each item that expires at or before a time, with a binary search of the expiry index.
+
+    :param expiry_index: Result of get_expiry_index.
+    :param expiry_time: The unix time when the food will be considered to have expired.
+    :return: Dict of item name to quantity, only items with expiring stock are included.
+    """
+    quantities = {}
+    for _, item_name, _, quantity in expiry_index[:bisect.bisect_left(expiry_index, [int(expiry_time) + 1])]:
+        quantities[item_name] = quantities.get(item_name, 0) + quantity
+    return quantities
+
+
+def get_next_expiry_check_from_index(expiry_index, current_date):
+    """
+    Gets the next time a batch will expire, or will enter the going to expire window, from the expiry index.
+
+    :param expiry_index: Result of get_expiry_index.
+    :param current_date: The current unix time.
+    :return: Unix time of the next expiry boundary, None if no stock will ever cross one.
+    """
+    boundaries = []
+
+    next_expiry = bisect.bisect_left(expiry_index, [int(current_date) + 1])
+    if next_expiry < len(expiry_index):
+        boundaries.append(expiry_index[next_expiry][0])
+
+    next_warning = bisect.bisect_left(expiry_index, [int(current_date) + EXPIRY_WARNING_WINDOW + 1])
+    if next_warning < len(expiry_index):
+        boundaries.append(expiry_index[next_warning][0] - EXPIRY_WARNING_WINDOW)
+
+    return min(boundaries) if boundaries else None
+
+
+def merge_fridge_shards(table, fridge):
+    """
+    Adds the items of the other shards of a sharded fridge to the restaurant's own fridge entry.
+
+    :param table: DynamoDB table resource for specified table_name.
+    :param fridge: The restaurant's own fridge entry.
+    :return: The fridge entry with the items and expiry index of every shard.
+    """
+    write_shards = int(fridge.get('write_shards', 1))
+    if write_shards <= 1:
+        return fridge
+
+    shards = [fridge]
+    for shard in range(1, write_shards):
+        shard_response = table.get_item(
+            Key={
+                'pk': FRIDGE_SHARD_KEY.format(restaurant=fridge['pk'], shard=shard),
+                'type': 'fridge'
+            }
+        )
+        if 'Item' in shard_response:
+            shards.append(decode_document(shard_response['Item']))
+
+    merged = dict(fridge)
+    merged['items'] = [fridge_item for shard_item in shards for fridge_item in shard_item['items']]
+    merged['expiry_index'] = list(heapq.merge(*(get_expiry_index(shard_item) for shard_item in shards)))
+    return merged
+
+
+def load_other_fridges(table, restaurant_id):
+    """
+    Gets the fridges a restaurant has besides its own fridge entry, each with the items of all its shards.
+
+    :param table: DynamoDB table resource for specified table_name.
+    :param restaurant_id: Name of restaurant.
+    :return: List of fridge entries, empty if the restaurant has one fridge.
+    """
+    fridges_response = table.get_item(
+        Key={
+            'pk': restaurant_id,
+            'type': 'fridges'
+        }
+    )
+
+    fridges = []
+    for listed in fridges_response.get('Item', {}).get('fridges', []):
+        fridge_response = table.get_item(
+            Key={
+                'pk': FRIDGE_KEY.format(restaurant=restaurant_id, fridge_id=listed['fridge_id']),
+                'type': 'fridge'
+            }
+        )
+        if 'Item' in fridge_response:
+            fridges.append(merge_fridge_shards(table, decode_document(fridge_response['Item'])))
+    return fridges
+
+
+def merge_fridges(fridges):
+    """
+    Combines a restaurant's fridges into one fridge entry, so an item kept in several fridges is ordered once for the
+    stock and desired quantity of all of them.
+
+    :param fridges: Fridge entries, the restaurant's own fridge entry first.
+    :return: The restaurant's own fridge entry with the items and expiry index of every fridge.
+    """
+    if len(fridges) <= 1:
+        return fridges[0]
+
+    items = {}
+    for fridge in fridges:
+        for fridge_item in fridge['items']:
+            merged_item = items.get(fridge_item['item_name'])
+            if merged_item is None:
+                items[fridge_item['item_name']] = dict(fridge_item)
+                continue
+
+            merged_item['item_list'] = merged_item['item_list'] + fridge_item['item_list']
+            merged_item['desired_quantity'] += fridge_item['desired_quantity']
+            # the stored totals only hold if every fridge's item has them, otherwise they are counted from the batches
+            if 'non_expired_quantity' in merged_item and 'non_expired_quantity' in fridge_item:
+                merged_item['non_expired_quantity'] += fridge_item['non_expired_quantity']
+                next_expiries = [next_expiry for next_expiry in (merged_item.get('next_expiry'),
+                                                                 fridge_item.get('next_expiry'))
+                                 if next_expiry is not None]
+                merged_item['next_expiry'] = min(next_expiries) if next_expiries else None
+            else:
+                merged_item.pop('non_expired_quantity', None)
 
-    return item_quantity
+    merged = dict(fridges[0])
+    merged['items'] = list(items.values())
+    merged['expiry_index'] = list(heapq.merge(*(get_expiry_index(fridge) for fridge in fridges)))
+    return merged
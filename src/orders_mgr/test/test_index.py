@@ -1,13 +1,17 @@
 import unittest
 import time
 from unittest.mock import patch, MagicMock
+from boto3.dynamodb.conditions import Key
 from src.orders_mgr.src.index import handler
 from src.orders_mgr.src.delete import delete_order, ClientError
-from src.orders_mgr.src.post import create_order, NotFoundException, order_check
-from src.orders_mgr.src.get import get_all_orders, get_order
+from src.orders_mgr.src.post import create_order, NotFoundException, order_check, backfill_deliveries
+from src.orders_mgr.src.get import get_all_orders, get_order, get_deliveries, get_company_deliveries
 from src.orders_mgr.src.custom_exceptions import BadRequestException
-from src.orders_mgr.src.utils import (generate_order_id, is_order_id_valid, get_expired_item_quantity_fridge, get_item_quantity_fridge,
-                       get_item_quantity_orders, get_total_item_quantity)
+from src.orders_mgr.src.documents import encode_document, decode_document
+from src.orders_mgr.src.utils import (generate_order_id, is_ulid, get_order_sort_key, get_since_sort_key, get_item_quantity_fridge,
+                       get_expiry_index, get_expiring_quantities, get_next_expiry_check_from_index, merge_fridges,
+                       CONSOLIDATION_TOKEN_MARGIN)
+from src.token_mgr.src.delete import clean_up_old_tokens
 
 
 
@@ -31,7 +35,7 @@ class TestDeleteOrderLambda(unittest.TestCase):
             'Item': {
                 'pk': 'example_restaurant',
                 'type': 'orders',
-                'orders': [{'id': 'existing_order'}, {'id': 'example_order'}]
+                'orders': [{'id': 'existing_order'}, {'id': 'example_order', 'delivery_date': 1700000000}]
             }
         }
 
@@ -40,7 +44,58 @@ class TestDeleteOrderLambda(unittest.TestCase):
 
         #This will pass the test if the status code is 200 and its ran once
         self.assertEqual(response['statusCode'], 200)
-        self.assertEqual(self.table.update_item.call_count, 1)
+        self.assertEqual(self.table.meta.client.transact_write_items.call_count, 1)
+
+    # Testing the order and its delivery entry are removed in one transaction, by the order's position
+    def test_delete_order_removes_delivery_entry_with_order(self):
+        self.table.name = 'master_db'
+        self.table.get_item.return_value = {
+            'Item': {
+                'pk': 'example_restaurant',
+                'type': 'orders',
+                'orders': [{'id': 'existing_order'}, {'id': 'example_order', 'delivery_date': 1700000000}]
+            }
+        }
+
+        delete_order(self.event, self.table)
+
+        update, delete = self.table.meta.client.transact_write_items.call_args.kwargs['TransactItems']
+        self.assertEqual(update['Update']['UpdateExpression'], 'REMOVE #ord[1] DELETE #ids :ids')
+        self.assertEqual(update['Update']['ConditionExpression'], '#ord[1].#id = :order_id')
+        self.assertEqual(delete, {'Delete': {'TableName': 'master_db', 'Key': {
+            'pk': 'example_restaurant', 'type': 'delivery#2023-11-14#example_order'}}})
+        self.table.update_item.assert_not_called()
+        self.table.delete_item.assert_not_called()
+
+    # Testing an order created while deleting moves nothing, and an order removed in the meantime is retried
+    def test_delete_order_retries_when_orders_change(self):
+        self.table.get_item.side_effect = [
+            {'Item': {'pk': 'example_restaurant', 'type': 'orders',
+                      'orders': [{'id': 'old_order', 'delivery_date': 1700000000},
+                                 {'id': 'example_order', 'delivery_date': 1700000000}]}},
+            {'Item': {'pk': 'example_restaurant', 'type': 'orders',
+                      'orders': [{'id': 'example_order', 'delivery_date': 1700000000},
+                                 {'id': 'new_order', 'delivery_date': 1700000000}]}}
+        ]
+        self.table.meta.client.transact_write_items.side_effect = [order_write_failed(), None]
+
+        response = delete_order(self.event, self.table)
+
+        self.assertEqual(response['statusCode'], 200)
+        update = self.table.meta.client.transact_write_items.call_args.kwargs['TransactItems'][0]['Update']
+        self.assertEqual(update['UpdateExpression'], 'REMOVE #ord[0] DELETE #ids :ids')
+
+    # Testing a delete that keeps losing to other writes asks to be tried again
+    def test_delete_order_conflict(self):
+        self.table.get_item.return_value = {
+            'Item': {'pk': 'example_restaurant', 'type': 'orders',
+                     'orders': [{'id': 'example_order', 'delivery_date': 1700000000}]}
+        }
+        self.table.meta.client.transact_write_items.side_effect = order_write_failed()
+
+        response = delete_order(self.event, self.table)
+
+        self.assertEqual(response['statusCode'], 409)
 
     #Testing what happens when the function does not find the order when deleted
     def test_delete_order_not_found(self):
@@ -87,13 +142,20 @@ class TestDeleteOrderLambda(unittest.TestCase):
 
 
 #Testing the create order function with mocking data and responses
+def order_write_failed(reason='ConditionalCheckFailed'):
+    # a transaction whose first write, the order's, failed
+    return ClientError({'Error': {'Code': 'TransactionCanceledException'},
+                        'CancellationReasons': [{'Code': reason}, {'Code': 'None'}]}, 'TransactWriteItems')
+
+
 class TestCreateOrderFunction(unittest.TestCase):
     # This is the mocked setup of all data we will use for these tests
     def setUp(self):
         self.dynamodb_client = MagicMock()
         self.table = MagicMock()
         self.restaurant_name = 'example_restaurant'
-        self.order_items = [{'item_id': 'item1', 'quantity': 2}, {'item_id': 'item2', 'quantity': 3}]
+        self.order_items = [{'M': {'item_name': {'S': 'item1'}, 'quantity': {'N': '2'}}},
+                            {'M': {'item_name': {'S': 'item2'}, 'quantity': {'N': '3'}}}]
         self.expired_items = [{'item_id': 'expired_item', 'quantity': 1}]
         self.table_name = 'example_table'
 
@@ -110,18 +172,22 @@ class TestCreateOrderFunction(unittest.TestCase):
         self.assertEqual(response['body']['order_id'], 'example_order_id')
         self.assertEqual(response['body']['expired_items'], self.expired_items)
 
-        #This verifyies that the update item method on the mocked client has been called only once based on teh parameters chosen
-        self.dynamodb_client.update_item.assert_called_once_with(
-            TableName='example_table',
-            Key={
+        #This verifyies that the order and its delivery entry are written once, in one transaction
+        self.dynamodb_client.transact_write_items.assert_called_once()
+        update, put = self.dynamodb_client.transact_write_items.call_args.kwargs['TransactItems']
+        self.assertEqual(update['Update'], {
+            'TableName': 'example_table',
+            'Key': {
                 'pk': {'S': 'example_restaurant'},
                 'type': {'S': 'orders'}
             },
-            UpdateExpression="SET #ord = list_append(#ord, :new_order)",
-            ExpressionAttributeNames={
-                '#ord': 'orders'
+            'UpdateExpression': "SET #ord = list_append(#ord, :new_order) ADD #ids :new_id",
+            'ConditionExpression': "attribute_exists(pk) AND NOT contains(#ids, :order_id)",
+            'ExpressionAttributeNames': {
+                '#ord': 'orders',
+                '#ids': 'order_ids'
             },
-            ExpressionAttributeValues={
+            'ExpressionAttributeValues': {
                 ':new_order': {
                     'L': [
                         {
@@ -134,8 +200,38 @@ class TestCreateOrderFunction(unittest.TestCase):
                         }
                     ]
                 },
-            },
-        )
+                ':new_id': {'SS': ['example_order_id']},
+                ':order_id': {'S': 'example_order_id'}
+            }
+        })
+        self.assertEqual(put['Put']['TableName'], 'example_table')
+        self.assertEqual(put['Put']['Item']['pk'], {'S': 'example_restaurant'})
+        self.assertEqual(put['Put']['Item']['order_id'], {'S': 'example_order_id'})
+        self.table.put_item.assert_not_called()
+
+    # an id already taken fails the conditional write, and the order is written again with a new id
+    def test_create_order_retries_taken_id(self):
+        self.dynamodb_client.transact_write_items.side_effect = [order_write_failed(), {}]
+        self.table.get_item.return_value = {'Item': {'pk': 'example_restaurant'}}
+
+        with patch('src.orders_mgr.src.post.generate_order_id', side_effect=['taken_id', 'new_id']):
+            response = create_order(self.dynamodb_client, self.table, self.restaurant_name, self.order_items,
+                                    self.expired_items, self.table_name)
+
+        self.assertEqual(response['statusCode'], 201)
+        self.assertEqual(response['body']['order_id'], 'new_id')
+        self.assertEqual(self.dynamodb_client.transact_write_items.call_count, 2)
+
+    # the conditional write also fails when the restaurant has no orders entry
+    def test_create_order_missing_restaurant(self):
+        self.dynamodb_client.transact_write_items.side_effect = order_write_failed()
+        self.table.get_item.return_value = {}
+
+        response = create_order(self.dynamodb_client, self.table, self.restaurant_name, self.order_items,
+                                self.expired_items, self.table_name)
+
+        self.assertEqual(response['statusCode'], 404)
+        self.dynamodb_client.transact_write_items.assert_called_once()
 
     #Testing what happens when an creating an order cannot be found
     def test_create_order_not_found_exception(self):
@@ -165,8 +261,8 @@ class TestCreateOrderFunction(unittest.TestCase):
 class TestOrderCheck(unittest.TestCase):
 
     # Replacing the boto resource function with a mock object
-    @patch('src.orders_mgr.src.post.get_total_item_quantity')
-    @patch('src.orders_mgr.src.post.get_expired_item_quantity_fridge')
+    @patch('src.orders_mgr.src.post.get_item_quantity_fridge')
+    @patch('src.orders_mgr.src.post.get_expiring_quantities')
     @patch('src.orders_mgr.src.post.create_order')
     # This test mocks the dynamodb table with a resturant ID and checks against it that it cant find the fridge and orders response
     def test_order_needed(self, mock_create_order, mock_expired_quantity, mock_total_quantity):
@@ -228,6 +324,38 @@ class TestGetAllOrdersFunction(unittest.TestCase):
 
         self.assertEqual(response['statusCode'], 200)
 
+    # test orders are paged oldest first, the next page starting after the cursor of the one before
+    def test_pages_orders(self):
+        orders = [{'id': generate_order_id(1700000000000 + offset * 1000), 'date_ordered': 1700000000 + offset,
+                   'delivery_date': 1700086400 + offset} for offset in [2, 0, 1]] + \
+            [{'id': '1234567890123456', 'date_ordered': 1690000000, 'delivery_date': 1690086400}]
+        self.table = MagicMock()
+        self.table.query.return_value = {'Items': [{'pk': 'example_restaurant', 'type': 'orders', 'orders': orders}]}
+
+        first = get_all_orders({'body': {'restaurant_id': 'example_restaurant', 'limit': 2}}, self.table)
+        second = get_all_orders({'body': {'restaurant_id': 'example_restaurant', 'limit': 2,
+                                          'cursor': first['body']['next_cursor']}}, self.table)
+
+        self.assertEqual([order['id'] for order in first['body']['items']], [orders[3]['id'], orders[1]['id']])
+        self.assertEqual([order['id'] for order in second['body']['items']], [orders[2]['id'], orders[0]['id']])
+        self.assertNotIn('next_cursor', second['body'])
+
+    # test only orders created at or after since are returned
+    def test_orders_since(self):
+        orders = [{'id': '1234567890123456', 'date_ordered': 1690000000, 'delivery_date': 1690086400},
+                  {'id': generate_order_id(1700000000000), 'date_ordered': 1700000000, 'delivery_date': 1700086400}]
+        self.table = MagicMock()
+        self.table.query.return_value = {'Items': [{'pk': 'example_restaurant', 'type': 'orders', 'orders': orders}]}
+
+        response = get_all_orders({'body': {'restaurant_id': 'example_restaurant', 'since': 1700000000}}, self.table)
+
+        self.assertEqual([order['id'] for order in response['body']['items']], [orders[1]['id']])
+
+    # test a limit that is not a positive integer is rejected
+    def test_bad_limit(self):
+        with self.assertRaises(BadRequestException):
+            get_all_orders({'body': {'restaurant_id': 'example_restaurant', 'limit': 0}}, MagicMock())
+
     # test the function returns an appropriate error message when there is a key error
     def test_key_error(self):
         event = {'body': {'restaurant_id': 'example_restaurant'}}
@@ -310,133 +438,365 @@ class TestGetOrderFunction(unittest.TestCase):
 
 
 class TestGenerateOrderIdFunction(unittest.TestCase):
-    # tests the function returns the correct id
+    # tests the id is the timestamp then the random bits, in Crockford base32
     @patch('src.orders_mgr.src.utils.secrets')
     def test_normal_parameters(self, mock_secrets):
-        self.table = MagicMock()
-        restaurant_id = 'example_restaurant'
         mock_secrets.randbits.return_value = 1234567890123456
 
-        response = generate_order_id(self.table, restaurant_id)
-
-        self.assertEqual(response, '1234567890123456')
-
-    # tests the function returns the correct error message when there is no restaurant id
-    def test_missing_restaurant_id(self):
-        self.table = MagicMock()
-        restaurant_id = 'example_restaurant'
-        self.table.get_item.return_value = {'example': 'example'}
-
-        with self.assertRaises(NotFoundException) as context:
-            generate_order_id(self.table, restaurant_id)
-        self.assertEqual(str(context.exception), 'Restaurant does not exist.')
-
+        response = generate_order_id(1700000000000)
 
-class TestIsOrderIdValidFunction(unittest.TestCase):
-    # tests the function returns true if there is no matching ids
-    def test_id_valid(self):
-        order_id = 1234567890123456
-        self.item = MagicMock()
+        self.assertEqual(response, '01HF7YAT0000000132TMY8NEP0')
+        self.assertEqual(len(response), 26)
+        mock_secrets.randbits.assert_called_once_with(80)
 
-        response = is_order_id_valid(order_id, self.item)
+    # tests ids sort in the order they were created
+    def test_ids_sort_by_time(self):
+        order_ids = [generate_order_id(timestamp) for timestamp in [1700000000999, 1700000001000, 1800000000000]]
 
-        self.assertEqual(response, True)
+        self.assertEqual(sorted(order_ids), order_ids)
+        self.assertTrue(all(is_ulid(order_id) for order_id in order_ids))
+        self.assertFalse(is_ulid('1234567890123456'))
 
-    # tests the function returns false if there is a matching id
-    def test_id_invalid(self):
-        order_id = 1234567890123456
-        self.item = {'orders': [{'id': 1234567890123456}]}
+    # tests orders created before ids were ULIDs sort by the time they were ordered
+    def test_sort_key_of_numeric_id(self):
+        old_order = {'id': '1234567890123456', 'date_ordered': 1700000000}
+        new_order = {'id': generate_order_id(1700000001000), 'date_ordered': 1700000001}
 
-        response = is_order_id_valid(order_id, self.item)
+        self.assertLess(get_order_sort_key(old_order), get_order_sort_key(new_order))
+        self.assertLess(get_since_sort_key(1700000000), get_order_sort_key(old_order))
+        self.assertGreater(get_since_sort_key(1700000001), get_order_sort_key(old_order))
 
-        self.assertEqual(response, False)
 
-
-class TestGetExpiredItemQuantityFridgeFunction(unittest.TestCase):
+class TestGetItemQuantityFridgeFunction(unittest.TestCase):
     # tests the function returns the correct quantity
     def test_normal_parameters(self):
-        mock_time = time.time()-999999
-        self.fridge_item = {'item_list': [{'expiry_date': mock_time, 'current_quantity': 10}]}
+        self.fridge_item = {'item_list': [{'expiry_date': time.time(), 'current_quantity': 10}]}
 
-        response = get_expired_item_quantity_fridge(self.fridge_item, mock_time)
+        response = get_item_quantity_fridge(self.fridge_item)
 
         self.assertEqual(response, 10)
 
     # tests the function returns 0 when there is no matching items
-    def test_zero_expired_item_quantity(self):
-        mock_time = time.time() - 999999
-        self.fridge_item = {'item_list': [{'expiry_date': mock_time+999999, 'current_quantity': 10}]}
+    def test_zero_item_quantity(self):
+        self.fridge_item = {'item_list': [{'expiry_date': time.time() - 999999, 'current_quantity': 10}]}
 
-        response = get_expired_item_quantity_fridge(self.fridge_item, mock_time)
+        response = get_item_quantity_fridge(self.fridge_item)
 
         self.assertEqual(response, 0)
 
-    def test_multiple_expired_item_quantity(self):
-        mock_time = time.time() - 999999
-        self.fridge_item = {'item_list': [{'expiry_date': mock_time, 'current_quantity': 10},
-                                          {'expiry_date': mock_time, 'current_quantity': 15},
-                                          {'expiry_date': mock_time+999999, 'current_quantity': 1}]}
 
-        response = get_expired_item_quantity_fridge(self.fridge_item, mock_time)
+class TestGetItemQuantityFridgeTotals(unittest.TestCase):
+    # tests the stored total is used while no counted batch has expired
+    def test_stored_total_used(self):
+        fridge_item = {'item_list': [], 'non_expired_quantity': 7, 'next_expiry': time.time() + 999}
 
-        self.assertEqual(response, 25)
+        self.assertEqual(get_item_quantity_fridge(fridge_item), 7)
 
-class TestGetItemQuantityFridgeFunction(unittest.TestCase):
-    # tests the function returns the correct quantity
-    def test_normal_parameters(self):
-        self.fridge_item = {'item_list': [{'expiry_date': time.time(), 'current_quantity': 10}]}
+    # tests the batches are counted once the stored total is out of date
+    def test_stale_total_ignored(self):
+        fridge_item = {'item_list': [{'expiry_date': time.time() + 999, 'current_quantity': 2}],
+                       'non_expired_quantity': 7, 'next_expiry': time.time() - 1}
 
-        response = get_item_quantity_fridge(self.fridge_item)
+        self.assertEqual(get_item_quantity_fridge(fridge_item), 2)
 
-        self.assertEqual(response, 10)
 
-    # tests the function returns 0 when there is no matching items
-    def test_zero_item_quantity(self):
-        self.fridge_item = {'item_list': [{'expiry_date': time.time() - 999999, 'current_quantity': 10}]}
+class TestExpiryIndex(unittest.TestCase):
+    def setUp(self):
+        self.fridge = {'items': [
+            {'item_name': 'milk', 'item_list': [{'expiry_date': 1000, 'date_added': 1, 'current_quantity': 5},
+                                                {'expiry_date': 800000, 'date_added': 2, 'current_quantity': 2}]},
+            {'item_name': 'eggs', 'item_list': [{'expiry_date': 400000, 'date_added': 1, 'current_quantity': 3},
+                                                {'expiry_date': 500, 'date_added': 1, 'current_quantity': 0}]}
+        ]}
 
-        response = get_item_quantity_fridge(self.fridge_item)
+    # tests the index is built in expiry order from fridges without one, leaving out empty batches
+    def test_index_built_for_old_fridges(self):
+        self.assertEqual(get_expiry_index(self.fridge),
+                         [[1000, 'milk', 1, 5], [400000, 'eggs', 1, 3], [800000, 'milk', 2, 2]])
 
-        self.assertEqual(response, 0)
+    # tests the stored index is used as it is
+    def test_stored_index_used(self):
+        self.fridge['expiry_index'] = [[5, 'ham', 1, 1]]
 
+        self.assertEqual(get_expiry_index(self.fridge), [[5, 'ham', 1, 1]])
 
-class TestGetItemQuantityOrdersFunction(unittest.TestCase):
-    # tests the function returns the correct quantity
-    def test_normal_parameters(self):
-        order_items = [{'item_name': 'example_name', 'quantity': 10}]
-        item_name = 'example_name'
+    # tests range reads count the stock expired by each time
+    def test_expiring_quantities(self):
+        expiry_index = get_expiry_index(self.fridge)
 
-        response = get_item_quantity_orders(order_items, item_name)
+        self.assertEqual([get_expiring_quantities(expiry_index, expiry_time)
+                          for expiry_time in (0, 1000, 399999, 400000, 900000)],
+                         [{}, {'milk': 5}, {'milk': 5}, {'milk': 5, 'eggs': 3}, {'milk': 7, 'eggs': 3}])
 
-        self.assertEqual(response, 10)
+    # tests the next boundary is the next expiry or start of the going to expire window, ignoring empty batches
+    def test_next_expiry_check(self):
+        expiry_index = get_expiry_index(self.fridge)
 
-    # tests the function returns 0 when there is no matching items
-    def test_no_matching_item_name(self):
-        order_items = [{'item_name': 'another_example_name', 'quantity': 10}]
-        item_name = 'example_name'
+        self.assertEqual([get_next_expiry_check_from_index(expiry_index, current_date)
+                          for current_date in (0, 1000, 300000, 600000, 900000)],
+                         [1000, 140800, 400000, 800000, None])
 
-        response = get_item_quantity_orders(order_items, item_name)
 
-        self.assertEqual(response, 0)
+# Testing that orders stored as a compressed document are rewritten whole
+class TestEncodedOrders(unittest.TestCase):
 
+    def setUp(self):
+        self.table = MagicMock()
+        with patch('src.orders_mgr.src.documents.DOCUMENT_ENCODING', 'zlib'):
+            self.stored = encode_document({'pk': 'example_restaurant', 'type': 'orders',
+                                           'orders': [{'id': 'existing_order'},
+                                                      {'id': 'example_order', 'delivery_date': 1700000000}]})
+        self.table.get_item.return_value = {'Item': self.stored}
 
-class TestGetTotalItemQuantityFunction(unittest.TestCase):  # depends on previous two functions
-    # tests the function returns the correct quantity
-    def test_normal_parameters(self):
-        fridge_item = {'item_list': [{'expiry_date': time.time(), 'current_quantity': 5}], 'item_name': 'example_name'}
-        orders = [{'items': [{'item_name': 'example_name', 'quantity': 10}]}]
+    def test_delete_order_rewrites_document(self):
+        event = {'body': {'restaurant_id': 'example_restaurant', 'order_id': 'example_order'}}
+
+        response = delete_order(event, self.table)
+
+        self.assertEqual(response['statusCode'], 200)
+        self.table.update_item.assert_not_called()
+        self.assertEqual(decode_document(self.table.put_item.call_args.kwargs['Item'])['orders'],
+                         [{'id': 'existing_order'}])
+        self.table.delete_item.assert_called_once_with(
+            Key={'pk': 'example_restaurant', 'type': 'delivery#2023-11-14#example_order'})
+
+    @patch('src.orders_mgr.src.documents.DOCUMENT_ENCODING', 'zlib')
+    def test_create_order_appends_to_document(self):
+        dynamodb_client = MagicMock()
+        order_items = [{'M': {'item_name': {'S': 'milk'}, 'quantity': {'N': '2'}}}]
 
-        response = get_total_item_quantity(fridge_item, orders)
+        with patch('src.orders_mgr.src.post.generate_order_id', return_value='new_order'):
+            response = create_order(dynamodb_client, self.table, 'example_restaurant', order_items, [], 'table')
 
-        self.assertEqual(response, 15)
+        self.assertEqual(response['statusCode'], 201)
+        dynamodb_client.update_item.assert_not_called()
+        orders = decode_document(self.table.put_item.call_args_list[0].kwargs['Item'])['orders']
+        self.assertEqual(orders[-1]['items'], [{'item_name': 'milk', 'quantity': 2}])
+        delivery_entry = self.table.put_item.call_args_list[1].kwargs['Item']
+        self.assertEqual(delivery_entry['order_id'], 'new_order')
+        self.assertEqual(delivery_entry['type'], f"delivery#{delivery_entry['delivery_day']}#new_order")
+
+
+class TestMultipleFridges(unittest.TestCase):
+
+    def setUp(self):
+        self.now = int(time.time())
+        self.main = {'pk': 'restaurant_id', 'type': 'fridge', 'items': [
+            {'item_name': 'lime', 'desired_quantity': 4, 'non_expired_quantity': 1, 'next_expiry': None,
+             'item_list': [{'expiry_date': self.now + 86400 * 10, 'date_added': 1, 'current_quantity': 1}]}
+        ]}
+        self.bar = {'pk': 'restaurant_id#fridge#bar', 'type': 'fridge', 'items': [
+            {'item_name': 'lime', 'desired_quantity': 6, 'non_expired_quantity': 2, 'next_expiry': None,
+             'item_list': [{'expiry_date': self.now + 86400 * 10, 'date_added': 1, 'current_quantity': 2}]},
+            {'item_name': 'mint', 'desired_quantity': 1, 'non_expired_quantity': 1, 'next_expiry': None,
+             'item_list': [{'expiry_date': self.now + 86400 * 10, 'date_added': 1, 'current_quantity': 1}]}
+        ]}
+
+    def test_items_are_combined_by_name(self):
+        merged = merge_fridges([self.main, self.bar])
+
+        self.assertEqual(merged['pk'], 'restaurant_id')
+        lime = next(item for item in merged['items'] if item['item_name'] == 'lime')
+        self.assertEqual((lime['desired_quantity'], get_item_quantity_fridge(lime)), (10, 3))
+        self.assertEqual(len(lime['item_list']), 2)
+        self.assertEqual(len(merged['expiry_index']), 3)
+        # the fridge entries themselves are left as they were read
+        self.assertEqual(self.main['items'][0]['desired_quantity'], 4)
+
+    @patch('src.orders_mgr.src.post.create_order')
+    def test_order_check_orders_for_every_fridge(self, mock_create_order):
+        mock_table = MagicMock()
+        mock_table.query.side_effect = [{'Items': [self.main]}, {'Items': [{'orders': []}]}]
+        mock_table.get_item.side_effect = lambda Key: {
+            ('restaurant_id', 'fridges'): {'Item': {'fridges': [{'fridge_id': 'bar', 'fridge_name': 'Bar'}]}},
+            ('restaurant_id#fridge#bar', 'fridge'): {'Item': self.bar}
+        }.get((Key['pk'], Key['type']), {})
+        mock_create_order.return_value = {'statusCode': 201, 'body': {}}
+
+        order_check(MagicMock(), {'body': {'restaurant_id': 'restaurant_id'}}, mock_table, 'table_name')
+
+        order_items = mock_create_order.call_args.args[3]
+        self.assertEqual(order_items, [{'M': {'item_name': {'S': 'lime'}, 'quantity': {'N': '7'}}}])
+
+
+class TestOrderConsolidation(unittest.TestCase):
+
+    def setUp(self):
+        self.table = MagicMock()
+        fridge = {'pk': 'restaurant_id', 'type': 'fridge', 'items': [
+            {'item_name': 'lime', 'desired_quantity': 10, 'non_expired_quantity': 3, 'next_expiry': None,
+             'item_list': [{'expiry_date': int(time.time()) + 86400 * 10, 'date_added': 1, 'current_quantity': 3}]}
+        ]}
+        self.open_order = {'id': '42', 'date_ordered': 1, 'delivery_date': 2,
+                           'items': [{'item_name': 'lime', 'quantity': 2}]}
+        self.table.query.side_effect = [{'Items': [fridge]},
+                                        {'Items': [{'pk': 'restaurant_id', 'type': 'orders',
+                                                    'orders': [self.open_order]}]}]
+        self.tokens = {'pk': 'restaurant_id', 'type': 'tokens', 'tokens': [
+            {'token': '1', 'id_type': 'order', 'object_id': '42', 'expiry_date': int(time.time()) + 86400 * 2}]}
+        self.table.get_item.side_effect = lambda Key, **kwargs: \
+            {'Item': self.tokens} if Key['type'] == 'tokens' else {}
+        self.event = {'body': {'restaurant_id': 'restaurant_id'}}
+
+    def check(self, consolidation):
+        with patch('src.orders_mgr.src.post.ORDER_CONSOLIDATION', consolidation), \
+                patch('src.orders_mgr.src.post.create_order') as mock_create_order:
+            mock_create_order.return_value = {'statusCode': 201, 'body': {}}
+            result = order_check(MagicMock(), self.event, self.table, 'table_name')
+        return result, mock_create_order
+
+    def test_append_creates_an_order(self):
+        result, mock_create_order = self.check('append')
+
+        self.assertEqual(result['statusCode'], 201)
+        self.assertEqual(mock_create_order.call_args.args[3],
+                         [{'M': {'item_name': {'S': 'lime'}, 'quantity': {'N': '5'}}}])
+
+    def test_merge_adds_the_shortfall_to_the_open_order(self):
+        result, mock_create_order = self.check('merge')
+
+        self.assertEqual((result['statusCode'], result['body']['order_id']), (200, '42'))
+        mock_create_order.assert_not_called()
+        update, put = self.table.meta.client.transact_write_items.call_args.kwargs['TransactItems']
+        update = update['Update']
+        self.assertEqual(update['UpdateExpression'], 'SET #ord[0] = :order')
+        self.assertEqual(update['ExpressionAttributeValues'][':order_id'], '42')
+        self.assertEqual(update['ExpressionAttributeValues'][':order']['items'],
+                         [{'item_name': 'lime', 'quantity': 7}])
+        # the delivery entry is rewritten with the order
+        self.assertEqual(put['Put']['Item']['items'], [{'item_name': 'lime', 'quantity': 7}])
+
+    def test_supersede_replaces_the_open_order(self):
+        self.open_order['items'] = [{'item_name': 'lime', 'quantity': 20}, {'item_name': 'mint', 'quantity': 1}]
+
+        result, mock_create_order = self.check('supersede')
+
+        self.assertEqual(result['statusCode'], 200)
+        update = self.table.meta.client.transact_write_items.call_args.kwargs['TransactItems'][0]['Update']
+        self.assertEqual(update['ExpressionAttributeValues'][':order']['items'], [{'item_name': 'lime', 'quantity': 7}])
+
+    def test_consolidated_order_keeps_its_delivery_date(self):
+        self.check('merge')
+
+        update = self.table.meta.client.transact_write_items.call_args.kwargs['TransactItems'][0]['Update']
+        self.assertEqual(update['ExpressionAttributeValues'][':order']['delivery_date'], 2)
+
+    def test_order_with_expiring_token_gets_a_new_order(self):
+        self.tokens['tokens'][0]['expiry_date'] = int(time.time()) + 3600
+
+        result, mock_create_order = self.check('merge')
+
+        self.assertEqual(result['statusCode'], 201)
+        self.table.meta.client.transact_write_items.assert_not_called()
+        # the open order is still counted as on its way until it is removed
+        self.assertEqual(mock_create_order.call_args.args[3],
+                         [{'M': {'item_name': {'S': 'lime'}, 'quantity': {'N': '5'}}}])
+
+    def test_token_clean_up_keeps_consolidated_order(self):
+        result, _ = self.check('merge')
+        self.assertEqual(result['statusCode'], 200)
+
+        # update_orders cleans up tokens every night, the consolidated order outlives the next run
+        token_table = MagicMock()
+        token_table.get_item.return_value = {'Item': self.tokens}
+        with patch('src.token_mgr.src.delete.time') as mock_time:
+            mock_time.time.return_value = time.time() + CONSOLIDATION_TOKEN_MARGIN
+            cleaned = clean_up_old_tokens(self.event, token_table)
+
+        self.assertEqual(cleaned['body']['objects_removed'], [])
+
+    def test_delivered_open_order_gets_a_new_order(self):
+        self.table.meta.client.transact_write_items.side_effect = order_write_failed()
+
+        result, mock_create_order = self.check('merge')
+
+        self.assertEqual(result['statusCode'], 201)
+        mock_create_order.assert_called_once()
+
+
+# Testing the delivery entries that let due deliveries be fetched as a range
+class TestDeliveries(unittest.TestCase):
+
+    def setUp(self):
+        self.table = MagicMock()
+        self.entry = {'pk': 'example_restaurant', 'type': 'delivery#2023-11-15#example_order',
+                      'delivery_day': '2023-11-15', 'order_id': 'example_order', 'date_ordered': 1700000000,
+                      'delivery_date': 1700086400, 'items': [{'item_name': 'milk', 'quantity': 2}]}
 
-    # tests the function returns the correct quantity when there are no matching items in the order
-    def test_only_fridge_item(self):
-        fridge_item = {'item_list': [{'expiry_date': time.time(), 'current_quantity': 5}], 'item_name': 'example_name'}
-        orders = [{'items': [{'item_name': 'another_example_name', 'quantity': 10}]}]
+    def test_get_deliveries_queries_day_range(self):
+        self.table.query.return_value = {'Items': [self.entry]}
+        event = {'body': {'restaurant_id': 'example_restaurant', 'to_day': '2023-11-15'}}
 
-        response = get_total_item_quantity(fridge_item, orders)
+        response = get_deliveries(event, self.table)
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(response['body']['items'], [{
+            'id': 'example_order', 'restaurant_id': 'example_restaurant', 'date_ordered': 1700000000,
+            'delivery_date': 1700086400, 'items': [{'item_name': 'milk', 'quantity': 2}],
+            'ordered_day': '2023-11-14', 'delivery_day': '2023-11-15'
+        }])
+        self.assertEqual(self.table.query.call_args.kwargs['KeyConditionExpression'],
+                         Key('pk').eq('example_restaurant') &
+                         Key('type').between('delivery#', 'delivery#2023-11-15#~'))
+
+    def test_get_deliveries_rejects_bad_day(self):
+        with self.assertRaises(BadRequestException):
+            get_deliveries({'body': {'restaurant_id': 'example_restaurant', 'from_day': '15/11/2023'}}, self.table)
+
+    def test_get_company_deliveries_follows_pages(self):
+        self.table.query.side_effect = [{'Items': [self.entry], 'LastEvaluatedKey': {'pk': 'example_restaurant'}},
+                                        {'Items': [{**self.entry, 'pk': 'other_restaurant'}]}]
+
+        response = get_company_deliveries({'body': {'day': '2023-11-15'}}, self.table)
+
+        self.assertEqual([order['restaurant_id'] for order in response['body']['items']],
+                         ['example_restaurant', 'other_restaurant'])
+        self.assertEqual(self.table.query.call_args_list[0].kwargs['IndexName'], 'delivery-index')
+        self.assertEqual(self.table.query.call_args_list[1].kwargs['ExclusiveStartKey'], {'pk': 'example_restaurant'})
+
+    def test_get_all_orders_formats_days(self):
+        self.table.query.return_value = {'Items': [{'orders': [{'id': 'example_order', 'date_ordered': 1700000000,
+                                                                'delivery_date': 1700086400, 'items': []}]}]}
+
+        response = get_all_orders({'body': {'restaurant_id': 'example_restaurant'}}, self.table)
+
+        self.assertEqual(response['body']['items'][0]['ordered_day'], '2023-11-14')
+        self.assertEqual(response['body']['items'][0]['delivery_day'], '2023-11-15')
+
+    def test_backfill_writes_missing_entries(self):
+        legacy_order = {'id': '1234', 'date_ordered': 1699000000, 'delivery_date': 1699086400, 'items': []}
+        self.table.get_item.return_value = {'Item': {'pk': 'example_restaurant', 'type': 'orders', 'orders': [
+            legacy_order,
+            {'id': 'example_order', 'date_ordered': 1700000000, 'delivery_date': 1700086400,
+             'items': [{'item_name': 'milk', 'quantity': 2}]}
+        ]}}
+        self.table.query.return_value = {'Items': [{'type': self.entry['type']}]}
+
+        response = backfill_deliveries({'body': {'restaurant_id': 'example_restaurant'}}, self.table)
+
+        self.assertEqual(response, {'statusCode': 200, 'body': {'written': 1}})
+        self.table.put_item.assert_called_once_with(Item={
+            'pk': 'example_restaurant', 'type': 'delivery#2023-11-04#1234', 'delivery_day': '2023-11-04',
+            'order_id': '1234', 'date_ordered': 1699000000, 'delivery_date': 1699086400, 'items': []
+        }, ConditionExpression='attribute_not_exists(pk)')
+
+    def test_backfill_missing_restaurant(self):
+        self.table.get_item.return_value = {}
 
-        self.assertEqual(response, 5)
+        response = backfill_deliveries({'body': {'restaurant_id': 'example_restaurant'}}, self.table)
+
+        self.assertEqual(response['statusCode'], 404)
+
+    @patch('src.orders_mgr.src.documents.DOCUMENT_ENCODING', 'zlib')
+    def test_order_created_when_entry_write_fails(self):
+        # an encoded document cannot be rewritten in a transaction, its entry is written after and left to the backfill
+        self.table.get_item.return_value = {'Item': {'pk': 'example_restaurant', 'type': 'orders', 'orders': []}}
+        self.table.put_item.side_effect = [None, ClientError({'Error': {'Code': 'InternalServerError'}}, 'PutItem')]
+        order_items = [{'M': {'item_name': {'S': 'milk'}, 'quantity': {'N': '2'}}}]
+
+        response = create_order(MagicMock(), self.table, 'example_restaurant', order_items, [], 'table')
+
+        self.assertEqual(response['statusCode'], 201)
 
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 import time
 from botocore.exceptions import ClientError
 from .custom_exceptions import BadRequestException, NotFoundException
+from .documents import decode_document, encodes_documents, is_encoded, put_document
 
 
 def delete_token(event, table):
@@ -35,7 +36,7 @@ def delete_token(event, table):
                 'type': 'tokens'
             }
         )
-        item = dynamo_response.get('Item', None)
+        item = decode_document(dynamo_response.get('Item', None))
 
         if item is None:
             raise NotFoundException('Restaurant does not exist.')
@@ -54,16 +55,19 @@ def delete_token(event, table):
         else:
             raise NotFoundException('Token does not exist.')
 
-        table.update_item(
-            Key={
-                'pk': restaurant_id,
-                'type': 'tokens'
-            },
-            UpdateExpression="SET tokens = :val",
-            ExpressionAttributeValues={
-                ':val': item['tokens']
-            },
-        )
+        if encodes_documents() or is_encoded(dynamo_response['Item']):
+            put_document(table, item, dynamo_response['Item'])
+        else:
+            table.update_item(
+                Key={
+                    'pk': restaurant_id,
+                    'type': 'tokens'
+                },
+                UpdateExpression="SET tokens = :val",
+                ExpressionAttributeValues={
+                    ':val': item['tokens']
+                },
+            )
 
     except NotFoundException as e:
         response = {
@@ -85,7 +89,7 @@ def clean_up_old_tokens(event, table):
     Removes every expired token for a restaurant.
     :param event: Event passed to lambda.
     :param table: MasterDB resource.
-    :return: 200 - Successful clean-up.
+    :return: 200 - Successful clean-up, with the expiry date of the next remaining token to expire.
         404 - Restaurant not found.
         500 - Internal Server Error.
     """
@@ -108,7 +112,7 @@ def clean_up_old_tokens(event, table):
                 'type': 'tokens'
             }
         )
-        item = dynamo_response.get('Item', None)
+        item = decode_document(dynamo_response.get('Item', None))
 
         if item is None:
             raise NotFoundException('Restaurant does not exist.')
@@ -116,6 +120,7 @@ def clean_up_old_tokens(event, table):
         current_time = int(time.time())
 
         new_token_list = []
+        next_expiry = None
         for index, token in enumerate(item['tokens']):
             if current_time > token['expiry_date']:
                 all_removed_objects.append({
@@ -124,22 +129,28 @@ def clean_up_old_tokens(event, table):
                 })
             else:
                 new_token_list.append(token)
+                if next_expiry is None or token['expiry_date'] < next_expiry:
+                    next_expiry = token['expiry_date']
 
-        table.update_item(
-            Key={
-                'pk': restaurant_id,
-                'type': 'tokens'
-            },
-            UpdateExpression="SET tokens = :val",
-            ExpressionAttributeValues={
-                ':val': new_token_list
-            },
-        )
+        if encodes_documents() or is_encoded(dynamo_response['Item']):
+            put_document(table, {**item, 'tokens': new_token_list}, dynamo_response['Item'])
+        else:
+            table.update_item(
+                Key={
+                    'pk': restaurant_id,
+                    'type': 'tokens'
+                },
+                UpdateExpression="SET tokens = :val",
+                ExpressionAttributeValues={
+                    ':val': new_token_list
+                },
+            )
 
         response = {
             'statusCode': 200,
             'body': {
-                'objects_removed': all_removed_objects
+                'objects_removed': all_removed_objects,
+                'next_expiry': next_expiry
             }
         }
 
@@ -5,6 +5,8 @@ from .custom_exceptions import BadRequestException
 from .patch import set_token
 from .post import validate_token
 from .delete import delete_token, clean_up_old_tokens
+from .utils import mark_restaurant_mutated
+from .idempotency import run_idempotent
 
 
 def handler(event, context):
@@ -33,7 +35,10 @@ def handler(event, context):
 
         if httpMethod == 'PATCH':
             if action == 'set_token':
-                response = set_token(event, table)
+                # a retried request with the same idempotency key gets the token already issued
+                body = event_dict.get('body', {})
+                response = run_idempotent(table, body.get('restaurant_id'), action, body,
+                                          lambda: set_token(event, table))
         if httpMethod == 'POST':
             if action == 'validate_token':
                 response = validate_token(event, table)
@@ -46,6 +51,11 @@ def handler(event, context):
         if response is None:
             raise BadRequestException('Bad request.')
 
+        if response['statusCode'] == 200 and (action in ['set_token', 'delete_token'] or
+                                              (action == 'clean_up_old_tokens' and
+                                               response['body']['objects_removed'])):
+            mark_restaurant_mutated(table, event_dict['body']['restaurant_id'])
+
     except BadRequestException as e:
         response = {
             'statusCode': 400,
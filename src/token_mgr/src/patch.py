@@ -2,6 +2,7 @@ import secrets
 import time
 from botocore.exceptions import ClientError
 from .custom_exceptions import BadRequestException, NotFoundException
+from .documents import encodes_documents, append_to_document
 
 
 def set_token(event, table):
@@ -11,6 +12,7 @@ def set_token(event, table):
     :param table: MasterDB resource.
     :raises BadRequestException: Thrown if format is not as expected.
     :return: 200 & token - Success.
+        404 - Restaurant not found.
         500 - Internal Error and failed to create new token.
     """
 
@@ -39,21 +41,32 @@ def set_token(event, table):
         random_number = str(secrets.randbits(64))
         expiry_date_unix_time = int(time.time() + 259200)  # Expires in 3 days
 
-        dynamo_response = table.update_item(
-            Key={
-                'pk': restaurant_id,
-                'type': 'tokens'
-            },
-            UpdateExpression="SET tokens = list_append(tokens, :val)",
-            ExpressionAttributeValues={
-                ':val': [{
-                    'token': random_number,
-                    'expiry_date': expiry_date_unix_time,
-                    'id_type': id_type,
-                    'object_id': object_id
-                }]
-            },
-        )
+        new_tokens = [{
+            'token': random_number,
+            'expiry_date': expiry_date_unix_time,
+            'id_type': id_type,
+            'object_id': object_id
+        }]
+
+        if encodes_documents():
+            append_token_document(table, restaurant_id, new_tokens)
+        else:
+            try:
+                dynamo_response = table.update_item(
+                    Key={
+                        'pk': restaurant_id,
+                        'type': 'tokens'
+                    },
+                    UpdateExpression="SET tokens = list_append(tokens, :val)",
+                    ExpressionAttributeValues={
+                        ':val': new_tokens
+                    },
+                )
+            except ClientError as e:
+                # tokens written while documents were encoded have no tokens list to append to
+                if e.response['Error']['Code'] != 'ValidationException':
+                    raise
+                append_token_document(table, restaurant_id, new_tokens)
 
         response = {
             'statusCode': 200,
@@ -63,6 +76,12 @@ def set_token(event, table):
             }
         }
 
+    except NotFoundException as e:
+        response = {
+            'statusCode': 404,
+            'body': str(e)
+        }
+
     except ClientError as e:
         response = {
             'statusCode': 500,
@@ -70,3 +89,16 @@ def set_token(event, table):
         }
 
     return response
+
+
+def append_token_document(table, restaurant_id, new_tokens):
+    """
+    Adds tokens to a restaurant's tokens by rewriting the whole tokens item, for encoded tokens documents.
+    :param table: MasterDB resource.
+    :param restaurant_id: Name of restaurant.
+    :param new_tokens: Tokens to add.
+    :raises NotFoundException: Thrown if restaurant does not exist.
+    :return: None
+    """
+    if not append_to_document(table, {'pk': restaurant_id, 'type': 'tokens'}, 'tokens', new_tokens):
+        raise NotFoundException('Restaurant does not exist.')
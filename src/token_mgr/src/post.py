@@ -1,6 +1,7 @@
 import time
 from botocore.exceptions import ClientError
 from .custom_exceptions import BadRequestException, NotFoundException, UnauthorizedException
+from .documents import decode_document
 
 def validate_token(event, table):
     """
@@ -33,7 +34,7 @@ def validate_token(event, table):
                 'type': 'tokens'
             }
         )
-        item = dynamo_response.get('Item', None)
+        item = decode_document(dynamo_response.get('Item', None))
 
         if item is None:
             raise NotFoundException('Restaurant does not exist.')
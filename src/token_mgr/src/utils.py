@@ -0,0 +1,27 @@
+import time
+from botocore.exceptions import ClientError
+
+
+def mark_restaurant_mutated(table, restaurant_id):
+    """
+    Stamps the restaurant's admin settings with the time of its latest tokens write, this lets the nightly
+    update_orders run skip restaurants that have not changed since it last processed them.
+    :param table: MasterDB resource.
+    :param restaurant_id: Name of restaurant.
+    :return: None
+    """
+    try:
+        table.update_item(
+            Key={
+                'pk': restaurant_id,
+                'type': 'admin_settings'
+            },
+            UpdateExpression='SET last_mutated = :now',
+            ConditionExpression='attribute_exists(pk)',
+            ExpressionAttributeValues={
+                ':now': int(time.time())
+            }
+        )
+    except ClientError as ignore:
+        # the write itself succeeded, a missing watermark only costs a redundant nightly run
+        pass
@@ -1,11 +1,13 @@
 import unittest
 from unittest.mock import patch, MagicMock
 from unittest.mock import Mock
+from botocore.exceptions import ClientError
 from ..src.index import handler
 from ..src.post import validate_token
 from ..src.patch import set_token
 from ..src.custom_exceptions import BadRequestException
 from ..src.delete import delete_token, clean_up_old_tokens
+from ..src.documents import encode_document, decode_document
 
 
 
@@ -167,5 +169,92 @@ class TestCleanUpOldTokens(unittest.TestCase):
         self.assertEqual(response['statusCode'], 404)
 
 
+# Tests that the clean-up reports when the next remaining token expires
+class TestCleanUpOldTokensNextExpiry(unittest.TestCase):
+
+    def test_next_expiry_of_remaining_tokens(self):
+        table = Mock()
+        table.get_item.return_value = {'Item': {'tokens': [
+            {'expiry_date': 1643086920, 'object_id': 'obj1', 'id_type': 'order'},
+            {'expiry_date': 9999999999, 'object_id': 'obj2', 'id_type': 'order'},
+            {'expiry_date': 9999999990, 'object_id': 'obj3', 'id_type': 'order'}
+        ]}}
+
+        response = clean_up_old_tokens({'body': {'restaurant_id': 'restaurant123'}}, table)
+
+        self.assertEqual(response['body']['objects_removed'], [{'object_id': 'obj1', 'id_type': 'order'}])
+        self.assertEqual(response['body']['next_expiry'], 9999999990)
+
+    def test_no_remaining_tokens(self):
+        table = Mock()
+        table.get_item.return_value = {'Item': {'tokens': []}}
+
+        response = clean_up_old_tokens({'body': {'restaurant_id': 'restaurant123'}}, table)
+
+        self.assertIsNone(response['body']['next_expiry'])
+
+
+# Testing that tokens stored as a compressed document are read and written whole
+class TestEncodedTokens(unittest.TestCase):
+
+    def setUp(self):
+        self.event = {'body': {'restaurant_id': 'example_restaurant', 'request_token': 'old_token'}}
+        self.table = MagicMock()
+        with patch('src.token_mgr.src.documents.DOCUMENT_ENCODING', 'zlib'):
+            self.stored = encode_document({'pk': 'example_restaurant', 'type': 'tokens', 'tokens': [
+                {'token': 'old_token', 'expiry_date': 9999999999, 'object_id': 'order_1', 'id_type': 'order'}
+            ]})
+        self.table.get_item.return_value = {'Item': self.stored}
+
+    def test_validate_encoded_token(self):
+        response = validate_token(self.event, self.table)
+
+        self.assertEqual(response['body'], {'object_id': 'order_1', 'id_type': 'order'})
+
+    def test_delete_rewrites_document(self):
+        response = delete_token(self.event, self.table)
+
+        self.assertEqual(response['statusCode'], 200)
+        self.table.update_item.assert_not_called()
+        written = self.table.put_item.call_args.kwargs
+        self.assertEqual(written['ExpressionAttributeValues'], {':previous': self.stored['document']})
+        self.assertEqual(decode_document(written['Item'])['tokens'], [])
+
+    @patch('src.token_mgr.src.documents.DOCUMENT_ENCODING', 'zlib')
+    def test_set_token_appends_to_document(self):
+        event = {'body': {'restaurant_id': 'example_restaurant', 'id_type': 'order', 'object_id': 'order_2'}}
+
+        response = set_token(event, self.table)
+
+        self.assertEqual(response['statusCode'], 200)
+        written = self.table.put_item.call_args.kwargs['Item']
+        self.assertIn('document', written)
+        tokens = decode_document(written)['tokens']
+        self.assertEqual([token['object_id'] for token in tokens], ['order_1', 'order_2'])
+
+
+class TestSetTokenIdempotency(unittest.TestCase):
+    # a retried set_token with the same idempotency key gets the token already issued, without issuing another
+    @patch('src.token_mgr.src.index.boto3')
+    def test_retry_returns_same_token(self, mock_boto3):
+        table = MagicMock()
+        mock_boto3.resource.return_value.Table.return_value = table
+        event = {'httpMethod': 'PATCH', 'action': 'set_token',
+                 'body': {'restaurant_id': 'example_restaurant', 'id_type': 'order', 'object_id': 'example_id',
+                          'idempotency_key': 'set_token#example_id'}}
+
+        first = handler(event, None)
+        stored = table.put_item.call_args.kwargs['Item']
+        table.put_item.side_effect = ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')
+        table.get_item.return_value = {'Item': stored}
+        second = handler(event, None)
+
+        self.assertEqual(first['statusCode'], 200)
+        self.assertEqual(second['body']['token'], first['body']['token'])
+        token_writes = [call for call in table.update_item.call_args_list
+                        if call.kwargs['Key'] == {'pk': 'example_restaurant', 'type': 'tokens'}]
+        self.assertEqual(len(token_writes), 1)
+
+
 if __name__ == '__main__':
     unittest.main()
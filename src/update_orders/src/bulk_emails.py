@@ -0,0 +1,242 @@
+import json
+import time
+from botocore.exceptions import ClientError, BotoCoreError
+
+# SES accepts at most this many destinations in a single send_bulk_templated_email call
+MAX_DESTINATIONS_PER_CALL = 50
+
+SENDER = 'no-reply@ffsmart.benlewisjones.com'
+
+LOW_STOCK_TEMPLATE = 'ffsmart-low-stock'
+DELIVERY_TEMPLATE = 'ffsmart-delivery'
+EXPIRED_ITEMS_TEMPLATE = 'ffsmart-expired-items'
+
+# the text of these mirrors the plain text bodies generated in utils.py
+EMAIL_TEMPLATES = {
+    LOW_STOCK_TEMPLATE: {
+        'SubjectPart': 'LOW STOCK WARNING',
+        'TextPart': '''
+    Hello {{restaurant_name}},
+
+    The following items are low in stock:
+    {{#each low_stock}}{{item_name}}\tdesired stock: {{desired_quantity}}\tcurrent stock: {{current_quantity}}\r\t{{/each}}
+
+    Thanks
+    '''
+    },
+    DELIVERY_TEMPLATE: {
+        'SubjectPart': 'Your delivery link',
+        'TextPart': '''
+    Hello Driver,
+
+    You have a delivery for {{restaurant_name}}.
+
+    Delivery link: {{delivery_link}}
+
+    Address:
+    {{city}}
+    {{postcode}}
+    {{street_address_1}}
+    {{street_address_2}}
+    {{street_address_3}}
+
+    Good luck!
+    This link will self-destruct in 3 days.
+    '''
+    },
+    EXPIRED_ITEMS_TEMPLATE: {
+        'SubjectPart': 'Food expiration in your fridge',
+        'TextPart': '''
+    Hello {{restaurant_name}},
+
+    The following items have expired:
+    {{#each expired_items}}{{item_name}}: {{quantity}}\r\t{{/each}}
+
+    The following items are about to expire:
+    {{#each going_to_expire}}{{item_name}}: {{quantity}}\r\t{{/each}}
+
+    This has been reported as a part of your health report.
+
+    Thanks
+    '''
+    }
+}
+
+
+class TokenBucket:
+    """
+    Token bucket used to keep the number of emails sent per second under the SES sending rate.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param rate: Tokens added per second, this is the SES max send rate.
+        :param capacity: Most tokens that can be saved up, defaults to one second's worth.
+        :param clock: Function returning the current time in seconds.
+        :param sleep: Function used to wait for tokens.
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.last_refill = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def consume(self, tokens=1):
+        """
+        Takes tokens from the bucket, waiting until enough are available.
+
+        :param tokens: Number of tokens needed. Requests larger than the capacity wait for a full bucket and are then
+            charged in full, leaving the bucket in debt so the requests after them wait until it is paid off.
+        :return: None
+        """
+        tokens = float(tokens)
+        needed = min(tokens, self.capacity)
+        self._refill()
+        while self.tokens < needed:
+            self.sleep((needed - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= tokens
+
+
+class BulkEmailQueue:
+    """
+    Collects templated emails from every restaurant in a run, so they can be sent in as few SES calls as possible.
+    """
+
+    def __init__(self):
+        self.messages = {}
+
+    def add(self, template_name, destinations, template_data, restaurant_id):
+        """
+        Queues a templated email.
+
+        :param template_name: Name of the SES template.
+        :param destinations: Email addresses that should receive this email.
+        :param template_data: Values used to fill in the template.
+        :param restaurant_id: The restaurant the email is for, used when reporting failures.
+        :return: None
+        """
+        destinations = [destination for destination in destinations if destination]
+        if not destinations:
+            return
+
+        self.messages.setdefault(template_name, []).append({
+            'restaurant_id': restaurant_id,
+            'destinations': destinations,
+            'template_data': template_data
+        })
+
+    def __len__(self):
+        return sum(len(messages) for messages in self.messages.values())
+
+    def flush(self, ses_client, sender, bucket, full_batches_only=False):
+        """
+        Sends the queued emails, batching across restaurants.
+
+        :param ses_client: Client of the ses.
+        :param sender: The sender email address, this must be a verified email address.
+        :param bucket: TokenBucket limiting the send rate, one token is used per recipient.
+        :param full_batches_only: Only send batches with MAX_DESTINATIONS_PER_CALL destinations, the rest stay
+        queued. This lets the run send as it goes without making small calls.
+        :return: List of failed destinations, each with the restaurant, template and error.
+        """
+        failures = []
+
+        for template_name, messages in self.messages.items():
+            sent = 0
+            for start in range(0, len(messages), MAX_DESTINATIONS_PER_CALL):
+                batch = messages[start:start + MAX_DESTINATIONS_PER_CALL]
+                if full_batches_only and len(batch) < MAX_DESTINATIONS_PER_CALL:
+                    break
+
+                bucket.consume(sum(len(message['destinations']) for message in batch))
+                failures.extend(send_bulk_batch(ses_client, sender, template_name, batch))
+                sent += len(batch)
+
+            self.messages[template_name] = messages[sent:]
+
+        return failures
+
+
+def send_bulk_batch(ses_client, sender, template_name, batch):
+    """
+    Sends one send_bulk_templated_email call.
+
+    :param ses_client: Client of the ses.
+    :param sender: The sender email address.
+    :param template_name: Name of the SES template.
+    :param batch: Queued messages, no more than MAX_DESTINATIONS_PER_CALL.
+    :return: List of failed destinations.
+    """
+    try:
+        ses_response = ses_client.send_bulk_templated_email(
+            Source=sender,
+            Template=template_name,
+            DefaultTemplateData='{}',
+            Destinations=[{
+                'Destination': {
+                    'ToAddresses': message['destinations']
+                },
+                'ReplacementTemplateData': json.dumps(message['template_data'], default=str)
+            } for message in batch]
+        )
+        statuses = ses_response.get('Status', [])
+
+    except (ClientError, BotoCoreError) as e:
+        statuses = [{'Status': 'Failed', 'Error': str(e)}] * len(batch)
+
+    failures = []
+    for message, status in zip(batch, statuses):
+        if status.get('Status') != 'Success':
+            failures.append({
+                'restaurant_id': message['restaurant_id'],
+                'template': template_name,
+                'destinations': message['destinations'],
+                'error': status.get('Status'),
+                'details': status.get('Error', '')
+            })
+
+    return failures
+
+
+def ensure_email_templates(ses_client):
+    """
+    Creates the SES templates, or updates them if they already exist.
+
+    :param ses_client: Client of the ses.
+    :return: True if every template is ready to use.
+    """
+    try:
+        for template_name, template in EMAIL_TEMPLATES.items():
+            ses_template = dict(template, TemplateName=template_name)
+            try:
+                ses_client.create_template(Template=ses_template)
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'AlreadyExists':
+                    raise
+                ses_client.update_template(Template=ses_template)
+
+        return True
+
+    except (ClientError, BotoCoreError) as ignore:
+        return False
+
+
+def get_send_rate(ses_client, default_rate=1):
+    """
+    Gets the maximum number of emails SES allows to be sent per second.
+
+    :param ses_client: Client of the ses.
+    :param default_rate: Rate used if the quota cannot be read, this is the SES sandbox limit.
+    :return: Emails per second.
+    """
+    try:
+        return ses_client.get_send_quota()['MaxSendRate']
+    except (ClientError, BotoCoreError, KeyError) as ignore:
+        return default_rate
@@ -1,5 +1,6 @@
 from .utils import generate_delivery_email_body, generate_and_send_email, get_cognito_user_email, \
-    generate_expired_items_email_body, generate_low_stock_email_body
+    generate_expired_items_email_body, generate_low_stock_email_body, generate_delivery_link
+from .bulk_emails import LOW_STOCK_TEMPLATE, DELIVERY_TEMPLATE, EXPIRED_ITEMS_TEMPLATE
 
 
 def send_low_stocks_email(ses_client, restaurant, emails, low_stock):
@@ -53,3 +54,58 @@ def send_expired_items(ses_client, restaurant, emails, expires_items, going_to_e
 
     generate_and_send_email(ses_client, subject, body, destination, sender)
 
+
+def queue_low_stocks_email(email_queue, restaurant, emails, low_stock):
+    """
+    Queues the low stock email to be sent in bulk.
+
+    :param email_queue: BulkEmailQueue for this run.
+    :param restaurant: The restaurant setting to the restaurant of interest.
+    :param emails: Emails for head chefs and restaurant admin account.
+    :param low_stock: List of items with low stock.
+    :return: None
+    """
+    email_queue.add(LOW_STOCK_TEMPLATE, emails, {
+        'restaurant_name': restaurant['restaurant_details']['restaurant_name'],
+        'low_stock': low_stock
+    }, restaurant['pk'])
+
+
+def queue_delivery_email(email_queue, restaurant, token):
+    """
+    Queues the delivery email to be sent in bulk.
+
+    :param email_queue: BulkEmailQueue for this run.
+    :param restaurant: The restaurant setting to the restaurant of interest.
+    :param token: Token generated for the order.
+    :return: None
+    """
+    location = restaurant['restaurant_details']['location']
+
+    email_queue.add(DELIVERY_TEMPLATE, [restaurant['delivery_company_email']], {
+        'restaurant_name': restaurant['restaurant_details']['restaurant_name'],
+        'delivery_link': generate_delivery_link(restaurant, token),
+        'city': location['city'],
+        'postcode': location['postcode'],
+        'street_address_1': location['street_address_1'],
+        'street_address_2': location['street_address_2'],
+        'street_address_3': location['street_address_3']
+    }, restaurant['pk'])
+
+
+def queue_expired_items(email_queue, restaurant, emails, expires_items, going_to_expire_items):
+    """
+    Queues the expired items email to be sent in bulk.
+
+    :param email_queue: BulkEmailQueue for this run.
+    :param restaurant: The restaurant of interest.
+    :param emails: Emails to send to.
+    :param expires_items: List containing all the expired items.
+    :param going_to_expire_items: A list of items that are going to expire.
+    :return: None
+    """
+    email_queue.add(EXPIRED_ITEMS_TEMPLATE, emails, {
+        'restaurant_name': restaurant['restaurant_details']['restaurant_name'],
+        'expired_items': expires_items,
+        'going_to_expire': going_to_expire_items
+    }, restaurant['pk'])
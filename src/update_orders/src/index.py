@@ -1,10 +1,15 @@
 import os
+import time
+import uuid
 import boto3
 
-from .emails import send_delivery_email, send_expired_items, send_low_stocks_email
-from .lambda_requests import create_new_order, create_an_order_token, remove_old_tokens, remove_old_objects,\
+from .emails import send_delivery_email, send_expired_items, send_low_stocks_email, queue_delivery_email, \
+    queue_expired_items, queue_low_stocks_email
+from .bulk_emails import BulkEmailQueue, TokenBucket, ensure_email_templates, get_send_rate, SENDER
+from .lambda_requests import create_new_order, create_an_order_token, clean_up_tokens, remove_old_objects,\
     get_list_of_low_stock
-from .utils import list_of_all_pks_and_delivery_emails, get_emails
+from .utils import list_of_all_pks_and_delivery_emails, get_emails, is_restaurant_dirty, mark_restaurant_processed, \
+    get_restaurants_to_reorder, needs_stock_check, get_expiry_sweep
 
 
 def handler(event, data):
@@ -18,27 +23,83 @@ def handler(event, data):
     dynamodb_resource = boto3.resource('dynamodb')
     table = dynamodb_resource.Table(__master_db_name__)
 
+    # taken before anything is read, so a write made while a restaurant is processed is seen by the next run
+    current_time = int(time.time())
     all_items = list_of_all_pks_and_delivery_emails(table)
+    # a retried scheduled event keeps its id, so orders already created by the failed attempt are not created again
+    run_id = event.get('id') or str(uuid.uuid4())
+
+    # templated emails are batched across restaurants, falling back to one email at a time if SES templates
+    # are not enabled or cannot be set up
+    email_queue = None
+    email_bucket = None
+    email_failures = []
+    if os.environ.get('BULK_EMAIL') == 'true' and ensure_email_templates(ses_client):
+        email_queue = BulkEmailQueue()
+        email_bucket = TokenBucket(get_send_rate(ses_client))
+
+    # fridges only carry the reorder flag once fridge_mgr has saved them since it was added, so the index is opt in
+    # until recompute_totals has been run for every restaurant
+    restaurants_to_reorder = None
+    if os.environ.get('REORDER_INDEX') == 'true':
+        restaurants_to_reorder = get_restaurants_to_reorder(table)
+
+    # with the global expiry index, the expiry emails for every restaurant come from one sweep of a few day
+    # partitions, rather than from each restaurant's order check
+    expiry_sweep = None
+    if os.environ.get('EXPIRY_SWEEP') == 'true':
+        expiry_sweep = get_expiry_sweep(table, current_time)
 
     failed_entries = []
+    processed_count = 0
+    stock_checked_count = 0
+    skipped_count = 0
     for restaurant in all_items:
-        emails = get_emails(restaurant, table)
+        # nothing has changed for this restaurant since the last run, so there is nothing new to order or email
+        if not is_restaurant_dirty(restaurant, current_time):
+            skipped_count += 1
+            continue
+
+        processed_count += 1
+
+        # recipients are only looked up once an email to them actually needs sending
+        emails = None
 
         try:
             ##########################
             # Orders
-            orders_response = create_new_order(lambda_client, __orders_mgr_arn__, restaurant)
+            if needs_stock_check(restaurant, restaurants_to_reorder, current_time):
+                stock_checked_count += 1
+                orders_response = create_new_order(lambda_client, __orders_mgr_arn__, restaurant, run_id)
+            else:
+                # nothing is low, nothing has expired and nothing was written since the last run, so there is nothing
+                # to order or to warn about, and the last run's next expiry check still holds
+                orders_response = {
+                    'statusCode': 200,
+                    'body': {
+                        'expired_items': [],
+                        'next_expiry_check': restaurant.get('next_expiry_check')
+                    }
+                }
 
             if 200 > orders_response['statusCode'] > 299:
                 continue
 
             # Email the restaurant with all the expired items
-            if orders_response['body']['expired_items']:
-                send_expired_items(ses_client,
-                                   restaurant,
-                                   emails,
-                                   orders_response['body']['expired_items'],
-                                   orders_response['body']['going_to_expire'])
+            if expiry_sweep is None and orders_response['body']['expired_items']:
+                emails = emails or get_emails(restaurant, table)
+                if email_queue is not None:
+                    queue_expired_items(email_queue,
+                                        restaurant,
+                                        emails,
+                                        orders_response['body']['expired_items'],
+                                        orders_response['body']['going_to_expire'])
+                else:
+                    send_expired_items(ses_client,
+                                       restaurant,
+                                       emails,
+                                       orders_response['body']['expired_items'],
+                                       orders_response['body']['going_to_expire'])
 
             # Order is created, so an email must be sent to the delivery man
             if orders_response['statusCode'] == 201:
@@ -48,19 +109,40 @@ def handler(event, data):
                     restaurant,
                     orders_response['body']['order_id']
                 )
-                send_delivery_email(ses_client, restaurant, token)
+                if email_queue is not None:
+                    queue_delivery_email(email_queue, restaurant, token)
+                else:
+                    send_delivery_email(ses_client, restaurant, token)
 
             ##########################
             # Send email for low stock
-            low_stock = get_list_of_low_stock(lambda_client, __fridge_mgr_arn__, restaurant)
+            low_stock = []
+            if restaurants_to_reorder is None or restaurant['pk'] in restaurants_to_reorder:
+                low_stock = get_list_of_low_stock(lambda_client, __fridge_mgr_arn__, restaurant)
             if low_stock:
-                send_low_stocks_email(ses_client, restaurant, emails, low_stock)
+                emails = emails or get_emails(restaurant, table)
+                if email_queue is not None:
+                    queue_low_stocks_email(email_queue, restaurant, emails, low_stock)
+                else:
+                    send_low_stocks_email(ses_client, restaurant, emails, low_stock)
 
             ############################
             # Clean up all tokens no matter the type
-            old_token_object_ids = remove_old_tokens(lambda_client, __token_mgr_arn__, restaurant)
+            old_token_object_ids, next_token_expiry = clean_up_tokens(lambda_client, __token_mgr_arn__, restaurant)
             remove_old_objects(lambda_client, __orders_mgr_arn__, restaurant, old_token_object_ids)
 
+            ############################
+            # Remember when this restaurant next needs looking at, even if it is never written to
+            next_expiry_check = orders_response['body'].get('next_expiry_check')
+            if next_token_expiry is not None and (next_expiry_check is None or next_token_expiry < next_expiry_check):
+                next_expiry_check = next_token_expiry
+
+            mark_restaurant_processed(table, restaurant, next_expiry_check, current_time)
+
+            # send any full batches now, so a long run does not hold every email until the end
+            if email_queue is not None:
+                email_failures.extend(email_queue.flush(ses_client, SENDER, email_bucket, full_batches_only=True))
+
         except Exception as ignore:
             # If anything goes wrong, this is important for malformed data
             try:
@@ -68,16 +150,40 @@ def handler(event, data):
             except Exception as also_ignored:
                 pass
 
-    if failed_entries:
-        response = {
-            'statusCode': 200,
-            'body': {
-                'failed_entries': failed_entries
-            }
-        }
-    else:
-        response = {
-            'statusCode': 200
+    if expiry_sweep is not None:
+        restaurants = {restaurant['pk']: restaurant for restaurant in all_items}
+        for pk, expiring in expiry_sweep.items():
+            # entries can outlive a deleted restaurant until their TTL removes them
+            if pk not in restaurants:
+                continue
+
+            try:
+                emails = get_emails(restaurants[pk], table)
+                if email_queue is not None:
+                    queue_expired_items(email_queue, restaurants[pk], emails, expiring['expired_items'],
+                                        expiring['going_to_expire'])
+                else:
+                    send_expired_items(ses_client, restaurants[pk], emails, expiring['expired_items'],
+                                       expiring['going_to_expire'])
+            except Exception as ignore:
+                failed_entries.append(pk)
+
+    if email_queue is not None:
+        email_failures.extend(email_queue.flush(ses_client, SENDER, email_bucket))
+
+    response = {
+        'statusCode': 200,
+        'body': {
+            'processed': processed_count,
+            'skipped': skipped_count,
+            'stock_checked': stock_checked_count
         }
+    }
+
+    if failed_entries:
+        response['body']['failed_entries'] = failed_entries
+
+    if email_failures:
+        response['body']['email_failures'] = email_failures
 
     return response
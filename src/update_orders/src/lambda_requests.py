@@ -3,7 +3,7 @@ from .utils import make_lambda_request
 
 def get_list_of_low_stock(lambda_client, lambda_arn, restaurant):
     """
-    Gets the list of low stock items.
+    Gets the list of low stock items, summed over every fridge of the restaurant as its orders are.
 
     :param lambda_client: Client of the lambda.
     :param lambda_arn: Arn of fridge mgr.
@@ -25,20 +25,22 @@ def get_list_of_low_stock(lambda_client, lambda_arn, restaurant):
     return response['body']['low_stock']
 
 
-def create_new_order(lambda_client, lambda_arn, restaurant):
+def create_new_order(lambda_client, lambda_arn, restaurant, run_id):
     """
     Creates a new order.
 
     :param lambda_client: Client of the lambda.
     :param lambda_arn: Arn of order mgr.
     :param restaurant: Admin settings of the restaurant.
+    :param run_id: Id of this run, the same when the run is retried, so a retry does not order twice.
     :return: The lambda's response.
     """
     orders_payload = {
         'httpMethod': 'POST',
         'action': 'create_order',
         'body': {
-            'restaurant_id': restaurant['pk']
+            'restaurant_id': restaurant['pk'],
+            'idempotency_key': f'create_order#{run_id}'
         }
     }
 
@@ -61,7 +63,9 @@ def create_an_order_token(lambda_client, lambda_arn, restaurant, order_id):
         'body': {
             'restaurant_id': restaurant['pk'],
             'id_type': 'order',
-            'object_id': order_id
+            'object_id': order_id,
+            # an order only ever needs one delivery token
+            'idempotency_key': f'set_token#{order_id}'
         }
     }
 
@@ -83,6 +87,19 @@ def remove_old_tokens(lambda_client, lambda_arn, restaurant):
     :param restaurant: Admin settings of the restaurant.
     :return: List containing all the removed objects.
     """
+    return clean_up_tokens(lambda_client, lambda_arn, restaurant)[0]
+
+
+def clean_up_tokens(lambda_client, lambda_arn, restaurant):
+    """
+    Removes the old tokens, and finds out when the next remaining token will expire.
+
+    :param lambda_client: Client of the lambda.
+    :param lambda_arn: Arn of token mgr.
+    :param restaurant: Admin settings of the restaurant.
+    :return: Tuple of the list containing all the removed objects, and the unix time the next token expires
+    (None if there are no tokens left).
+    """
     token_payload = {
         'httpMethod': 'DELETE',
         'action': 'clean_up_old_tokens',
@@ -94,11 +111,13 @@ def remove_old_tokens(lambda_client, lambda_arn, restaurant):
     token_lambda_response = make_lambda_request(lambda_client, token_payload, lambda_arn)
 
     result = []
+    next_expiry = None
 
     if token_lambda_response['statusCode'] == 200:
         result = token_lambda_response['body']['objects_removed']
+        next_expiry = token_lambda_response['body'].get('next_expiry')
 
-    return result
+    return result, next_expiry
 
 
 def remove_old_objects(lambda_client, order_lambda_arn, restaurant, old_tokens):
@@ -1,9 +1,29 @@
 import json
 import os
+from datetime import datetime, timedelta
 import boto3
 from boto3.dynamodb.conditions import Attr, Key
 from botocore.exceptions import ClientError, BotoCoreError
 
+# roles that are sent the low stock and expired items emails
+RECIPIENT_ROLES = ['Admin', 'Head Chef']
+
+# global expiry index maintained by fridge_mgr, a partition per day listing each restaurant's batches expiring that day
+EXPIRY_DAY_PARTITION = 'expiry#{day}'
+# the sweep reads back this far to catch stock that expired since the previous nightly run
+EXPIRY_SWEEP_LOOKBACK = 86400
+EXPIRY_WARNING_WINDOW = 259200
+
+# sparse index of fridges with items below their desired quantity, maintained by fridge_mgr
+REORDER_INDEX = 'reorder-index'
+REORDER_FLAG = 'reorder'
+
+# fridge_mgr can spread a large restaurant's fridge over shards keyed {restaurant}#shard#{n}, and keeps every fridge of
+# a restaurant after its first under {restaurant}#fridge#{fridge_id}, each with its own reorder flag and expiry index
+# entries
+FRIDGE_SHARD_SEPARATOR = '#shard#'
+FRIDGE_SEPARATOR = '#fridge#'
+
 
 def make_lambda_request(lambda_client, payload, function_name):
     """
@@ -59,24 +79,256 @@ def list_of_all_pks_and_delivery_emails(table):
     return all_pks
 
 
+def get_fridge_restaurant(fridge_key):
+    """
+    Gets the restaurant a fridge, or a shard of one, belongs to.
+
+    :param fridge_key: Partition key of a fridge or fridge shard.
+    :return: The restaurant's pk.
+    """
+    return fridge_key.split(FRIDGE_SHARD_SEPARATOR)[0].split(FRIDGE_SEPARATOR)[0]
+
+
+def get_restaurants_to_reorder(table):
+    """
+    Gets the restaurants with items below their desired quantity from the sparse reorder index, so only fridges that
+    are low on stock are read.
+
+    :param table: The resource of the master dynamo table.
+    :return: A dict of each restaurant's pk to the names of its items that are low on stock.
+    """
+    restaurants = {}
+    query_arguments = {
+        'IndexName': REORDER_INDEX,
+        'KeyConditionExpression': Key('reorder_flag').eq(REORDER_FLAG)
+    }
+
+    while True:
+        response = table.query(**query_arguments)
+        for fridge in response.get('Items', []):
+            restaurant = get_fridge_restaurant(fridge['pk'])
+            restaurants.setdefault(restaurant, []).extend(fridge.get('reorder_items', []))
+
+        if 'LastEvaluatedKey' not in response:
+            # an item low in several fridges is listed once
+            return {restaurant: list(dict.fromkeys(items)) for restaurant, items in restaurants.items()}
+        query_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def get_expiry_sweep(table, current_time):
+    """
+    Gets the stock that has expired since the previous run, or will expire in the next 3 days, for every restaurant,
+    by reading the day partitions of the global expiry index instead of each restaurant's fridge.
+
+    :param table: The resource of the master dynamo table.
+    :param current_time: Unix time of the current run.
+    :return: A dict of each restaurant's pk to its 'expired_items' and 'going_to_expire' lists of item names and
+    quantities.
+    """
+    expired = {}
+    going_to_expire = {}
+
+    day = datetime.utcfromtimestamp(current_time - EXPIRY_SWEEP_LOOKBACK).date()
+    last_day = datetime.utcfromtimestamp(current_time + EXPIRY_WARNING_WINDOW).date()
+    while day <= last_day:
+        query_arguments = {
+            'KeyConditionExpression': Key('pk').eq(EXPIRY_DAY_PARTITION.format(day=day.isoformat()))
+        }
+
+        while True:
+            response = table.query(**query_arguments)
+            for entry in response.get('Items', []):
+                restaurant = get_fridge_restaurant(entry['type'])
+                for expiry_date, item_name, _, quantity in entry['batches']:
+                    if current_time - EXPIRY_SWEEP_LOOKBACK < expiry_date <= current_time:
+                        quantities = expired.setdefault(restaurant, {})
+                    elif current_time < expiry_date <= current_time + EXPIRY_WARNING_WINDOW:
+                        quantities = going_to_expire.setdefault(restaurant, {})
+                    else:
+                        continue
+                    quantities[item_name] = quantities.get(item_name, 0) + quantity
+
+            if 'LastEvaluatedKey' not in response:
+                break
+            query_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        day += timedelta(days=1)
+
+    return {
+        pk: {
+            'expired_items': [{'item_name': name, 'quantity': quantity}
+                              for name, quantity in sorted(expired.get(pk, {}).items())],
+            'going_to_expire': [{'item_name': name, 'quantity': quantity}
+                                for name, quantity in sorted(going_to_expire.get(pk, {}).items())]
+        }
+        for pk in expired.keys() | going_to_expire.keys()
+    }
+
+
+def needs_stock_check(restaurant, restaurants_to_reorder, current_time):
+    """
+    Checks if a restaurant's stock needs checking for orders and low stock emails. Without the reorder index every
+    restaurant is checked, with it only the restaurants that are low on stock, have stock that has expired since
+    their last run, have been written to since their last run, or have never been processed are.
+
+    A write can add a batch expiring before the next_expiry_check recorded by the last run, and the reorder flag only
+    counts stock that has not expired, so neither would bring the restaurant back once that batch expires.
+
+    :param restaurant: Admin settings of the restaurant, as returned by the scan.
+    :param restaurants_to_reorder: Result of get_restaurants_to_reorder, None if the index is not used.
+    :param current_time: Unix time of the current run.
+    :return: True if the stock must be checked.
+    """
+    if restaurants_to_reorder is None or restaurant['pk'] in restaurants_to_reorder:
+        return True
+
+    last_processed = restaurant.get('last_processed')
+    if last_processed is None:
+        return True
+
+    # the check finds the restaurant's next expiry boundary, which the last run's value may no longer be
+    last_mutated = restaurant.get('last_mutated')
+    if last_mutated is not None and last_mutated >= last_processed:
+        return True
+
+    next_expiry_check = restaurant.get('next_expiry_check')
+    return next_expiry_check is not None and next_expiry_check <= current_time
+
+
+def is_restaurant_dirty(restaurant, current_time):
+    """
+    Checks if a restaurant needs to be processed by this run, restaurants that have not been written to since they
+    were last processed, and have no stock or tokens that expired in the meantime, have nothing new to do.
+
+    :param restaurant: Admin settings of the restaurant, as returned by the scan.
+    :param current_time: Unix time of the current run.
+    :return: True if the restaurant must be processed.
+    """
+    last_processed = restaurant.get('last_processed')
+    if last_processed is None:
+        return True
+
+    # equal timestamps are treated as dirty, a write in the same second as the last run may have been missed
+    last_mutated = restaurant.get('last_mutated')
+    if last_mutated is not None and last_mutated >= last_processed:
+        return True
+
+    next_expiry_check = restaurant.get('next_expiry_check')
+    return next_expiry_check is not None and next_expiry_check <= current_time
+
+
+def mark_restaurant_processed(table, restaurant, next_expiry_check, run_start):
+    """
+    Records that a restaurant has been processed, along with when it next needs to be looked at regardless of writes.
+
+    :param table: The resource of the master dynamo table.
+    :param restaurant: Admin settings of the restaurant.
+    :param next_expiry_check: Unix time of the next expiry boundary, None if there is not one.
+    :param run_start: Unix time the run started, writes from then on may not have been seen and are picked up by the
+        next run.
+    :return: None
+    """
+    if next_expiry_check is None:
+        update_expression = 'SET last_processed = :now REMOVE next_expiry_check'
+        expression_values = {':now': run_start}
+    else:
+        update_expression = 'SET last_processed = :now, next_expiry_check = :next'
+        expression_values = {':now': run_start, ':next': next_expiry_check}
+
+    table.update_item(
+        Key={
+            'pk': restaurant['pk'],
+            'type': 'admin_settings'
+        },
+        UpdateExpression=update_expression,
+        ExpressionAttributeValues=expression_values
+    )
+
+
 def get_emails(restaurant, table):
     """
     Gets all the head chef and admin account emails.
 
+    users_mgr stores each user's email alongside them, Cognito is only asked for the emails of users stored before
+    that. The result is cached on the restaurant's users entry, users_mgr drops the cache whenever the users change.
+
     :param restaurant: The restaurant of interest.
     :param table: Master DB.
     :return: A list containing all the emails.
     """
-    emails = [get_cognito_user_email(restaurant['pk'])]
-
     dynamo_response = table.query(
         KeyConditionExpression=Key('pk').eq(restaurant['pk']) & Key('type').eq('users')
     )
 
-    for user in dynamo_response['Items'][0]['users']:
-        emails.append(get_cognito_user_email(user['username']))
+    users_entry = dynamo_response['Items'][0]
+    recipients = users_entry.get('recipients')
+
+    if recipients is None:
+        recipients = build_recipients(restaurant, users_entry)
+        save_recipients(table, restaurant, users_entry['users'], recipients)
+
+    return [recipient['email'] for recipient in recipients
+            if recipient.get('email') and recipient['role'] in RECIPIENT_ROLES]
+
+
+def build_recipients(restaurant, users_entry):
+    """
+    Gets the email of the restaurant admin account and every user, from the users entry where stored, otherwise from
+    Cognito.
+
+    :param restaurant: The restaurant of interest.
+    :param users_entry: The restaurant's users entry.
+    :return: A list of recipients, each with a username, email and role.
+    """
+    recipients = [{
+        'username': restaurant['pk'],
+        'email': users_entry.get('admin_email') or get_cognito_user_email(restaurant['pk']),
+        'role': 'Admin'
+    }]
+
+    for user in users_entry['users']:
+        recipients.append({
+            'username': user['username'],
+            'email': user.get('email') or get_cognito_user_email(user['username']),
+            'role': user['role']
+        })
+
+    return recipients
+
+
+def save_recipients(table, restaurant, users, recipients):
+    """
+    Caches the recipients on the restaurant's users entry, as long as the users have not changed since they were read.
+
+    :param table: Master DB.
+    :param restaurant: The restaurant of interest.
+    :param users: The users the recipients were built from.
+    :param recipients: The recipients to cache.
+    :return: True if the cache was saved.
+    """
+    try:
+        table.update_item(
+            Key={
+                'pk': restaurant['pk'],
+                'type': 'users'
+            },
+            UpdateExpression='SET recipients = :recipients',
+            ConditionExpression='#usr = :users',
+            ExpressionAttributeNames={
+                '#usr': 'users'
+            },
+            ExpressionAttributeValues={
+                ':recipients': recipients,
+                ':users': users
+            }
+        )
+
+        return True
+
+    except ClientError as ignore:
+        # the users changed under us, the next run will build the cache again
+        return False
 
-    return emails
 
 def generate_and_send_email(ses_client, subject, body, destinations, sender):
     """
@@ -117,6 +369,17 @@ def generate_and_send_email(ses_client, subject, body, destinations, sender):
         return False
 
 
+def generate_delivery_link(restaurant_admin_settings, token):
+    """
+    Creates the link the delivery driver uses to complete a delivery.
+
+    :param restaurant_admin_settings: The restaurant settings.
+    :param token: Token for the email.
+    :return: The delivery link.
+    """
+    return f'http://FfSmar-Analy-3HyxSmNqsx3Z-1763585782.eu-west-1.elb.amazonaws.com/delivery/{restaurant_admin_settings["pk"]}/{token}'
+
+
 def generate_delivery_email_body(restaurant_admin_settings, token):
     """
     Creates the body of the email sent to the delivery driver.
@@ -125,7 +388,7 @@ def generate_delivery_email_body(restaurant_admin_settings, token):
     :param token: Token for the email.
     :return: The emails body.
     """
-    delivery_link = f'http://FfSmar-Analy-3HyxSmNqsx3Z-1763585782.eu-west-1.elb.amazonaws.com/delivery/{restaurant_admin_settings["pk"]}/{token}'
+    delivery_link = generate_delivery_link(restaurant_admin_settings, token)
 
     return f'''
     Hello Driver,
@@ -3,7 +3,8 @@ import os
 from unittest import mock
 from unittest.mock import patch, MagicMock, Mock
 from src.emails import send_delivery_email, send_expired_items
-from src.utils import get_cognito_user_email, list_of_all_pks_and_delivery_emails, generate_delivery_email_body, generate_expired_items_email_body, make_lambda_request, generate_and_send_email,ClientError
+from src.utils import get_cognito_user_email, list_of_all_pks_and_delivery_emails, generate_delivery_email_body, generate_expired_items_email_body, make_lambda_request, generate_and_send_email,ClientError, is_restaurant_dirty, mark_restaurant_processed, get_emails, get_restaurants_to_reorder, needs_stock_check, get_expiry_sweep
+from src.bulk_emails import TokenBucket, BulkEmailQueue, MAX_DESTINATIONS_PER_CALL
 from src.lambda_requests import create_an_order_token, remove_old_tokens, remove_old_objects, create_new_order
 from unittest.mock import patch
 
@@ -169,7 +170,8 @@ class TestCreateOrderToken(unittest.TestCase):
                 'body': {
                     'restaurant_id': restaurant['pk'],
                     'id_type': 'order',
-                    'object_id': order_id
+                    'object_id': order_id,
+                    'idempotency_key': f'set_token#{order_id}'
                 }
             },
             lambda_arn
@@ -203,7 +205,8 @@ class TestCreateOrderToken(unittest.TestCase):
                 'body': {
                     'restaurant_id': restaurant['pk'],
                     'id_type': 'order',
-                    'object_id': order_id
+                    'object_id': order_id,
+                    'idempotency_key': f'set_token#{order_id}'
                 }
             },
             lambda_arn
@@ -333,7 +336,7 @@ class TestCreateNewOrder(unittest.TestCase):
         lambda_client = Mock()
         lambda_arn = 'example_order_lambda_arn'
         restaurant = {'pk': 'example_restaurant_id'}
-        result = create_new_order(lambda_client, lambda_arn, restaurant)
+        result = create_new_order(lambda_client, lambda_arn, restaurant, 'example_run')
 
         expected_result = {
             'statusCode': 200,
@@ -349,7 +352,8 @@ class TestCreateNewOrder(unittest.TestCase):
                 'httpMethod': 'POST',
                 'action': 'create_order',
                 'body': {
-                    'restaurant_id': restaurant['pk']
+                    'restaurant_id': restaurant['pk'],
+                    'idempotency_key': 'create_order#example_run'
                 }
             },
             lambda_arn
@@ -509,5 +513,251 @@ class TestGenerateAndSendEmail(unittest.TestCase):
         self.assertFalse(result)
 
 
+# Tests which restaurants the nightly run can skip
+class TestIsRestaurantDirty(unittest.TestCase):
+    def test_never_processed(self):
+        self.assertTrue(is_restaurant_dirty({'pk': 'restaurant'}, 1000))
+
+    def test_mutated_since_last_run(self):
+        restaurant = {'pk': 'restaurant', 'last_processed': 500, 'last_mutated': 600}
+        self.assertTrue(is_restaurant_dirty(restaurant, 1000))
+
+    def test_unchanged_since_last_run(self):
+        restaurant = {'pk': 'restaurant', 'last_processed': 500, 'last_mutated': 400, 'next_expiry_check': 2000}
+        self.assertFalse(is_restaurant_dirty(restaurant, 1000))
+
+    def test_expiry_boundary_crossed(self):
+        restaurant = {'pk': 'restaurant', 'last_processed': 500, 'last_mutated': 400, 'next_expiry_check': 900}
+        self.assertTrue(is_restaurant_dirty(restaurant, 1000))
+
+    # a write made while the restaurant was being processed is after the run start, so the next run picks it up
+    def test_write_during_processing_is_seen_next_run(self):
+        table = MagicMock()
+        mark_restaurant_processed(table, {'pk': 'restaurant'}, None, 1000)
+        last_processed = table.update_item.call_args.kwargs['ExpressionAttributeValues'][':now']
+
+        restaurant = {'pk': 'restaurant', 'last_processed': last_processed, 'last_mutated': 1005}
+        self.assertEqual(last_processed, 1000)
+        self.assertTrue(is_restaurant_dirty(restaurant, 2000))
+
+
+# Tests only restaurants in the reorder index, written to since their last run, or with newly expired stock, have
+# their stock checked
+class TestReorderIndex(unittest.TestCase):
+    def test_query_pages_through_index(self):
+        table = MagicMock()
+        table.query.side_effect = [
+            {'Items': [{'pk': 'a', 'reorder_items': ['milk']}], 'LastEvaluatedKey': {'pk': 'a'}},
+            {'Items': [{'pk': 'b', 'reorder_items': ['eggs', 'ham']}]}
+        ]
+
+        self.assertEqual(get_restaurants_to_reorder(table), {'a': ['milk'], 'b': ['eggs', 'ham']})
+        self.assertEqual(table.query.call_args.kwargs['IndexName'], 'reorder-index')
+        self.assertEqual(table.query.call_args.kwargs['ExclusiveStartKey'], {'pk': 'a'})
+
+    def test_fridge_shards_are_merged(self):
+        table = MagicMock()
+        table.query.return_value = {'Items': [{'pk': 'a', 'reorder_items': ['milk']},
+                                              {'pk': 'a#shard#3', 'reorder_items': ['eggs']}]}
+
+        self.assertEqual(get_restaurants_to_reorder(table), {'a': ['milk', 'eggs']})
+
+    def test_fridges_are_merged(self):
+        table = MagicMock()
+        table.query.return_value = {'Items': [{'pk': 'a', 'reorder_items': ['milk']},
+                                              {'pk': 'a#fridge#bar#shard#1', 'reorder_items': ['lime', 'milk']}]}
+
+        self.assertEqual(get_restaurants_to_reorder(table), {'a': ['milk', 'lime']})
+
+    def test_without_index_every_restaurant_is_checked(self):
+        self.assertTrue(needs_stock_check({'pk': 'a', 'last_processed': 500}, None, 1000))
+
+    def test_low_stock_restaurant_is_checked(self):
+        self.assertTrue(needs_stock_check({'pk': 'a', 'last_processed': 500}, {'a': ['milk']}, 1000))
+
+    def test_restaurant_with_enough_stock_is_not_checked(self):
+        restaurant = {'pk': 'a', 'last_processed': 500, 'next_expiry_check': 2000}
+        self.assertFalse(needs_stock_check(restaurant, {'b': ['milk']}, 1000))
+
+    def test_expired_stock_is_checked(self):
+        restaurant = {'pk': 'a', 'last_processed': 500, 'next_expiry_check': 900}
+        self.assertTrue(needs_stock_check(restaurant, {}, 1000))
+
+    def test_item_added_since_last_run_is_checked(self):
+        # the batch added at 600 expires at 1500, after this run but before the old next_expiry_check
+        restaurant = {'pk': 'a', 'last_processed': 500, 'last_mutated': 600, 'next_expiry_check': 2000}
+        self.assertTrue(needs_stock_check(restaurant, {}, 1000))
+
+        restaurant = {'pk': 'a', 'last_processed': 500, 'last_mutated': 600}
+        self.assertTrue(needs_stock_check(restaurant, {}, 1000))
+
+
+# Tests the token bucket waits once the SES send rate is used up
+class TestTokenBucket(unittest.TestCase):
+    def test_consume_waits_for_tokens(self):
+        now = [0.0]
+        sleeps = []
+
+        def fake_sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        bucket = TokenBucket(10, clock=lambda: now[0], sleep=fake_sleep)
+
+        bucket.consume(10)
+        self.assertEqual(sleeps, [])
+
+        bucket.consume(5)
+        self.assertAlmostEqual(sum(sleeps), 0.5)
+
+    # a bulk call to more recipients than the bucket holds is charged for every recipient
+    def test_consume_more_than_capacity_is_charged_in_full(self):
+        now = [0.0]
+        sleeps = []
+
+        def fake_sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        bucket = TokenBucket(14, clock=lambda: now[0], sleep=fake_sleep)
+
+        bucket.consume(50)
+        self.assertEqual(sleeps, [])
+
+        bucket.consume(1)
+        # the 51 emails sent take as long as the send rate allows, after the first second's worth
+        self.assertAlmostEqual(now[0], (51 - 14) / 14)
+
+
+# Tests the bulk email queue batches across restaurants and reports failed destinations
+class TestBulkEmailQueue(unittest.TestCase):
+    def setUp(self):
+        self.bucket = Mock()
+        self.ses_client = Mock()
+
+    def test_flush_batches_across_restaurants(self):
+        queue = BulkEmailQueue()
+        for index in range(MAX_DESTINATIONS_PER_CALL + 1):
+            queue.add('template', [f'chef{index}@example.com', None], {'restaurant_name': str(index)}, str(index))
+
+        self.ses_client.send_bulk_templated_email.side_effect = lambda **kwargs: {
+            'Status': [{'Status': 'Success'}] * len(kwargs['Destinations'])
+        }
+
+        failures = queue.flush(self.ses_client, 'sender@example.com', self.bucket)
+
+        self.assertEqual(failures, [])
+        self.assertEqual(self.ses_client.send_bulk_templated_email.call_count, 2)
+        first_call = self.ses_client.send_bulk_templated_email.call_args_list[0].kwargs
+        self.assertEqual(len(first_call['Destinations']), MAX_DESTINATIONS_PER_CALL)
+        self.assertEqual(first_call['Destinations'][0]['Destination'], {'ToAddresses': ['chef0@example.com']})
+        self.assertEqual(len(queue), 0)
+
+    def test_flush_full_batches_only_keeps_partial_batch(self):
+        queue = BulkEmailQueue()
+        queue.add('template', ['chef@example.com'], {}, 'restaurant')
+
+        queue.flush(self.ses_client, 'sender@example.com', self.bucket, full_batches_only=True)
+
+        self.ses_client.send_bulk_templated_email.assert_not_called()
+        self.assertEqual(len(queue), 1)
+
+    def test_flush_collects_failures(self):
+        queue = BulkEmailQueue()
+        queue.add('template', ['good@example.com'], {}, 'restaurant_1')
+        queue.add('template', ['bad@example.com'], {}, 'restaurant_2')
+        self.ses_client.send_bulk_templated_email.return_value = {'Status': [
+            {'Status': 'Success'},
+            {'Status': 'MessageRejected', 'Error': 'Email address is not verified.'}
+        ]}
+
+        failures = queue.flush(self.ses_client, 'sender@example.com', self.bucket)
+
+        self.assertEqual(failures, [{
+            'restaurant_id': 'restaurant_2',
+            'template': 'template',
+            'destinations': ['bad@example.com'],
+            'error': 'MessageRejected',
+            'details': 'Email address is not verified.'
+        }])
+
+
+# Tests the recipient cache on the users entry is used, and built when missing
+class TestGetEmails(unittest.TestCase):
+    @patch('src.utils.get_cognito_user_email')
+    def test_cached_recipients(self, mock_get_cognito_user_email):
+        table = MagicMock()
+        table.query.return_value = {'Items': [{
+            'users': [{'username': 'chef', 'role': 'Head Chef'}],
+            'recipients': [
+                {'username': 'restaurant', 'email': 'admin@example.com', 'role': 'Admin'},
+                {'username': 'chef', 'email': 'chef@example.com', 'role': 'Head Chef'}
+            ]
+        }]}
+
+        result = get_emails({'pk': 'restaurant'}, table)
+
+        self.assertEqual(result, ['admin@example.com', 'chef@example.com'])
+        mock_get_cognito_user_email.assert_not_called()
+        table.update_item.assert_not_called()
+
+    @patch('src.utils.get_cognito_user_email')
+    def test_builds_and_saves_missing_cache(self, mock_get_cognito_user_email):
+        table = MagicMock()
+        users = [{'username': 'chef', 'role': 'Head Chef'}]
+        table.query.return_value = {'Items': [{'users': users}]}
+        mock_get_cognito_user_email.side_effect = lambda username: f'{username}@example.com'
+
+        result = get_emails({'pk': 'restaurant'}, table)
+
+        self.assertEqual(result, ['restaurant@example.com', 'chef@example.com'])
+        saved = table.update_item.call_args.kwargs
+        self.assertEqual(saved['ConditionExpression'], '#usr = :users')
+        self.assertEqual(saved['ExpressionAttributeValues'][':users'], users)
+        self.assertEqual(saved['ExpressionAttributeValues'][':recipients'][1],
+                         {'username': 'chef', 'email': 'chef@example.com', 'role': 'Head Chef'})
+
+
+# Tests stored emails are used without Cognito, and only admins and head chefs are emailed
+class TestGetEmailsStoredEmails(unittest.TestCase):
+    @patch('src.utils.get_cognito_user_email')
+    def test_stored_emails_filtered_by_role(self, mock_get_cognito_user_email):
+        table = MagicMock()
+        table.query.return_value = {'Items': [{
+            'admin_email': 'admin@example.com',
+            'users': [
+                {'username': 'head', 'role': 'Head Chef', 'email': 'head@example.com'},
+                {'username': 'chef', 'role': 'Chef', 'email': 'chef@example.com'}
+            ]
+        }]}
+
+        result = get_emails({'pk': 'restaurant'}, table)
+
+        self.assertEqual(result, ['admin@example.com', 'head@example.com'])
+        mock_get_cognito_user_email.assert_not_called()
+
+
+# Tests the expiry sweep reads the day partitions of the global expiry index across restaurants
+class TestExpirySweep(unittest.TestCase):
+    def test_sweep_splits_expired_and_going_to_expire(self):
+        current_time = 10 * 86400
+        table = MagicMock()
+        partitions = {
+            'expiry#1970-01-10': [{'type': 'a', 'batches': [[current_time - 100, 'milk', 1, 2]]},
+                                  {'type': 'b', 'batches': [[current_time - 2 * 86400, 'ham', 1, 1]]}],
+            'expiry#1970-01-11': [{'type': 'a', 'batches': [[current_time + 100, 'milk', 1, 3]]}]
+        }
+        table = MagicMock()
+        table.query.side_effect = lambda **kwargs: {
+            'Items': partitions.get(kwargs['KeyConditionExpression'].get_expression()['values'][1], [])
+        }
+
+        sweep = get_expiry_sweep(table, current_time)
+
+        self.assertEqual(table.query.call_count, 5)
+        self.assertEqual(sweep, {'a': {'expired_items': [{'item_name': 'milk', 'quantity': 2}],
+                                       'going_to_expire': [{'item_name': 'milk', 'quantity': 3}]}})
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
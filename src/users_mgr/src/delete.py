@@ -45,7 +45,7 @@ def delete_user(event, table):
                 'pk': restaurant_name,
                 'type': 'users'
             },
-            UpdateExpression="SET #usr = :val",
+            UpdateExpression="SET #usr = :val REMOVE recipients",
             ExpressionAttributeNames={
                 '#usr': 'users'
             },
@@ -1,17 +1,23 @@
 from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
-from .custom_exceptions import BadRequestException
+from .custom_exceptions import BadRequestException, NotFoundException
+
+# the fields of each user returned by get_all_users when none are asked for
+DEFAULT_USER_FIELDS = ['username', 'role', 'email']
 
 
 def get_all_users(event, table):
     """
-    Returns all the users given a restaurant_id.
+    Returns all the users given a restaurant_id, optionally filtered and paginated.
+
+    The body can contain role, name_prefix or username to filter the users, limit and start_after to page through
+    them in username order, and fields to choose which user fields are returned.
 
     :param event: Event passed to lambda.
     :param table: Client for Master DB.
     :raises BadRequestException: Thrown if format is not as expected.
-    :return: 200 - list of items containing all the users.
-        404 - User not found.
+    :return: 200 - list of items containing the users, and the start_after for the next page (None on the last page).
+        404 - Restaurant not found, or the given username was not found.
         500 - Internal error.
     """
 
@@ -22,32 +28,52 @@ def get_all_users(event, table):
 
     restaurant_name = event['body']['restaurant_id']
     username = event['body'].get('username')  # Use get to handle potential absence of 'username'
+    role = event['body'].get('role')
+    name_prefix = event['body'].get('name_prefix')
+    start_after = event['body'].get('start_after')
+    limit = event['body'].get('limit')
+    fields = event['body'].get('fields', DEFAULT_USER_FIELDS)
+
+    if limit is not None and (not isinstance(limit, int) or limit < 1):
+        raise BadRequestException('Bad request limit must be a positive integer.')
 
     try:
+        # only the users list is needed, not the cached recipients stored alongside it
         table_response = table.query(
-            KeyConditionExpression=Key('pk').eq(restaurant_name) & Key('type').eq('users')
+            KeyConditionExpression=Key('pk').eq(restaurant_name) & Key('type').eq('users'),
+            ProjectionExpression='#usr',
+            ExpressionAttributeNames={
+                '#usr': 'users'
+            }
         )
 
         if 'Items' in table_response and len(table_response['Items']) > 0:
             users = table_response['Items'][0].get('users', [])
 
-            user_in_question = None
-            for user in users:
-                if 'username' in user and user['username'] == username:
-                    user_in_question = user
-                    break
+            matching_users = sorted((user for user in users
+                                     if (username is None or user['username'] == username) and
+                                     (role is None or user['role'] == role) and
+                                     (name_prefix is None or user['username'].startswith(name_prefix)) and
+                                     (start_after is None or user['username'] > start_after)),
+                                    key=lambda user: user['username'])
 
-            if user_in_question is not None:
+            next_start_after = None
+            if limit is not None and len(matching_users) > limit:
+                matching_users = matching_users[:limit]
+                next_start_after = matching_users[-1]['username']
+
+            if username is not None and not matching_users:
                 response = {
-                    'statusCode': 200,
-                    'body': {
-                        'items': [user_in_question]
-                    }
+                    'statusCode': 404,
+                    'body': 'User not found.'
                 }
             else:
                 response = {
-                    'statusCode': 404,
-                    'body': 'User not found.'
+                    'statusCode': 200,
+                    'body': {
+                        'items': [{field: user.get(field) for field in fields} for user in matching_users],
+                        'next_start_after': next_start_after
+                    }
                 }
         else:
             response = {
@@ -137,3 +163,116 @@ def get_user(event, table):
         }
 
     return response
+
+
+def get_users_by_role(event, table):
+    """
+    Gets the username, role and email of every user with one of the given roles, plus the restaurant's admin account,
+    all from a single read.
+
+    :param event: Event passed to lambda, roles defaults to Head Chef and include_admin defaults to True.
+    :param table: Client for Master DB.
+    :raises BadRequestException: Thrown if format is not as expected.
+    :return: 200 - list of matching users, email is None for users stored before emails were kept.
+        404 - Restaurant not found.
+        500 - Internal error.
+    """
+    response = None
+
+    if 'body' not in event or 'restaurant_id' not in event['body']:
+        raise BadRequestException('Bad request restaurant_id not found in body.')
+
+    restaurant_name = event['body']['restaurant_id']
+    roles = event['body'].get('roles', ['Head Chef'])
+    include_admin = event['body'].get('include_admin', True)
+
+    try:
+        table_response = table.get_item(Key={'pk': restaurant_name, 'type': 'users'})
+
+        if 'Item' not in table_response:
+            raise NotFoundException('Restaurant does not exist.')
+
+        users_entry = table_response['Item']
+
+        users = []
+        if include_admin:
+            users.append({
+                'username': restaurant_name,
+                'role': 'Admin',
+                'email': users_entry.get('admin_email') or None
+            })
+
+        for user in users_entry.get('users', []):
+            if user['role'] in roles:
+                users.append({
+                    'username': user['username'],
+                    'role': user['role'],
+                    'email': user.get('email')
+                })
+
+        response = {
+            'statusCode': 200,
+            'body': {
+                'items': users
+            }
+        }
+
+    except NotFoundException as e:
+        response = {
+            'statusCode': 404,
+            'body': str(e)
+        }
+
+    except ClientError as e:
+        response = {
+            'statusCode': 500,
+            'body': 'Error accessing DynamoDB: ' + str(e)
+        }
+
+    return response
+
+
+def get_admin_settings(event, table):
+    """
+    Gets the admin settings for a given restaurant_id.
+
+    :param event: Event passed to lambda.
+    :param table: Client for Master DB.
+    :raises BadRequestException: Thrown if format is not as expected.
+    :return: 200 - The admin settings.
+        404 - Restaurant not found.
+        500 - Internal error.
+    """
+    response = None
+
+    if 'body' not in event or 'restaurant_id' not in event['body']:
+        raise BadRequestException('Bad request restaurant_id not found in body.')
+
+    restaurant_name = event['body']['restaurant_id']
+
+    try:
+        table_response = table.get_item(Key={'pk': restaurant_name, 'type': 'admin_settings'})
+
+        if 'Item' not in table_response:
+            raise NotFoundException('Restaurant does not exist.')
+
+        response = {
+            'statusCode': 200,
+            'body': {
+                'admin_settings': table_response['Item']
+            }
+        }
+
+    except NotFoundException as e:
+        response = {
+            'statusCode': 404,
+            'body': str(e)
+        }
+
+    except ClientError as e:
+        response = {
+            'statusCode': 500,
+            'body': 'Error accessing DynamoDB: ' + str(e)
+        }
+
+    return response
@@ -3,7 +3,7 @@ import os
 import boto3
 from .custom_exceptions import BadRequestException
 from .post import create_new_restaurant_dynamodb_entries, create_user, update_user, update_admin_settings
-from .get import get_all_users, get_user, get_admin_settings
+from .get import get_all_users, get_user, get_admin_settings, get_users_by_role
 from .delete import delete_user
 
 
@@ -47,6 +47,8 @@ def handler(event, context):
                 response = get_user(event_dict, table)
             elif action == 'get_admin_settings':
                 response = get_admin_settings(event_dict, table)
+            elif action == 'get_users_by_role':
+                response = get_users_by_role(event_dict, table)
         elif httpMethod == 'DELETE':
             if action == 'delete_user':
                 response = delete_user(event_dict, table)
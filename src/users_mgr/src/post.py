@@ -19,6 +19,8 @@ def create_new_restaurant_dynamodb_entries(dynamodb_client, event, table_name):
         raise BadRequestException('Bad request restaurant_id not found in body.')
 
     restaurant_name = event['body']['restaurant_name']
+    # the restaurant account's email, kept so recipients can be found without asking cognito
+    admin_email = event['body'].get('email', '')
 
     try:
         dynamodb_client.transact_write_items(
@@ -29,9 +31,23 @@ def create_new_restaurant_dynamodb_entries(dynamodb_client, event, table_name):
                         'Item': {
                             'pk': {'S': restaurant_name},
                             'type': {'S': 'fridge'},
+                            'items': {'L': []}
+                        },
+                        'ConditionExpression': 'attribute_not_exists(pk) AND attribute_not_exists(#type)',
+                        'ExpressionAttributeNames': {
+                            '#type': 'type'
+                        }
+                    }
+                },
+                {
+                    'Put': {
+                        'TableName': table_name,
+                        'Item': {
+                            'pk': {'S': restaurant_name},
+                            'type': {'S': 'door_state'},
                             'is_front_door_open': {'BOOL': False},
                             'is_back_door_open': {'BOOL': False},
-                            'items': {'L': []}
+                            'last_changed': {'N': '0'}
                         },
                         'ConditionExpression': 'attribute_not_exists(pk) AND attribute_not_exists(#type)',
                         'ExpressionAttributeNames': {
@@ -59,7 +75,8 @@ def create_new_restaurant_dynamodb_entries(dynamodb_client, event, table_name):
                         'Item': {
                             'pk': {'S': restaurant_name},
                             'type': {'S': 'users'},
-                            'users': {'L': []}
+                            'users': {'L': []},
+                            'admin_email': {'S': admin_email}
                         },
                         'ConditionExpression': 'attribute_not_exists(pk) AND attribute_not_exists(#type)',
                         'ExpressionAttributeNames': {
@@ -141,7 +158,7 @@ def create_new_restaurant_dynamodb_entries(dynamodb_client, event, table_name):
 
 def create_user(dynamodb_client, event, table_name):
     """
-    Creates a new user entry for a given restaurant_id.
+    Creates a new user entry for a given restaurant_id, the user's email is stored alongside them if given.
 
     :param dynamodb_client: The MasterDB client.
     :param event: Event passed to lambda.
@@ -168,6 +185,14 @@ def create_user(dynamodb_client, event, table_name):
     username = event['body']['username']
     role = event['body']['role']
 
+    new_user = {
+        'username': {'S': username},
+        'role': {'S': role}
+    }
+
+    if event['body'].get('email'):
+        new_user['email'] = {'S': event['body']['email']}
+
     try:
         dynamodb_client.update_item(
             TableName=table_name,
@@ -175,7 +200,8 @@ def create_user(dynamodb_client, event, table_name):
                 'pk': {'S': restaurant_id},
                 'type': {'S': 'users'}
             },
-            UpdateExpression="SET #usr = list_append(#usr, :new_user)",
+            # recipients is update_orders' cache of user emails, dropping it means it is rebuilt with this user
+            UpdateExpression="SET #usr = list_append(#usr, :new_user) REMOVE recipients",
             ExpressionAttributeNames={
                 '#usr': 'users'
             },
@@ -183,10 +209,7 @@ def create_user(dynamodb_client, event, table_name):
                 ':new_user': {
                     'L': [
                         {
-                            'M': {
-                                'username': {'S': username},
-                                'role': {'S': role}
-                            }
+                            'M': new_user
                         }
                     ]
                 }
@@ -213,7 +236,7 @@ def create_user(dynamodb_client, event, table_name):
 
 def update_user(event, table):
     """
-    Updates the contents of a user entry for a given username and restaurant_id.
+    Updates the contents of a user entry for a given username and restaurant_id, new_email is optional.
     :param event: Event passed to lambda.
     :param table: Table resource for MasterDB.
     :raises BadRequestException: Thrown if format is not as expected.
@@ -258,6 +281,8 @@ def update_user(event, table):
         for user in users:
             if user['username'] == username:
                 user['role'] = new_role
+                if event['body'].get('new_email'):
+                    user['email'] = event['body']['new_email']
                 break
 
         else:
@@ -268,7 +293,7 @@ def update_user(event, table):
                 'pk': restaurant_id,
                 'type': 'users'
             },
-            UpdateExpression="SET #usr = :val",
+            UpdateExpression="SET #usr = :val REMOVE recipients",
             ExpressionAttributeNames={
                 '#usr': 'users'
             },
@@ -1,7 +1,7 @@
 import unittest
 from unittest.mock import patch, MagicMock
-from ..src.get import get_all_users, BadRequestException, get_user
-from ..src.post import create_new_restaurant_dynamodb_entries, BadRequestException
+from ..src.get import get_all_users, BadRequestException, get_user, get_users_by_role
+from ..src.post import create_new_restaurant_dynamodb_entries, BadRequestException, create_user
 from ..src.delete import delete_user
 from botocore.exceptions import ClientError
 from boto3.dynamodb.conditions import Key
@@ -274,5 +274,111 @@ class TestDeleteUserLambda(unittest.TestCase):
         self.assertIn('Error accessing DynamoDB', response['body'])
 
 
+# Testing that removing a user drops the cached recipient emails used by update_orders
+class TestDeleteUserRecipientCache(unittest.TestCase):
+    def test_delete_user_removes_recipient_cache(self):
+        mock_table = MagicMock()
+        mock_table.get_item.return_value = {'Item': {'users': [{'username': 'chef', 'role': 'Chef'}]}}
+
+        result = delete_user({'body': {'restaurant_id': 'house', 'username': 'chef'}}, mock_table)
+
+        self.assertEqual(result, {'statusCode': 200})
+        self.assertEqual(mock_table.update_item.call_args.kwargs['UpdateExpression'],
+                         'SET #usr = :val REMOVE recipients')
+
+
+#Testing the head chefs and admin are returned with their stored emails
+class TestGetUsersByRole(unittest.TestCase):
+    def test_head_chefs_and_admin(self):
+        mock_table = MagicMock()
+        mock_table.get_item.return_value = {'Item': {
+            'admin_email': 'admin@example.com',
+            'users': [
+                {'username': 'head', 'role': 'Head Chef', 'email': 'head@example.com'},
+                {'username': 'chef', 'role': 'Chef', 'email': 'chef@example.com'},
+                {'username': 'old_head', 'role': 'Head Chef'}
+            ]
+        }}
+
+        result = get_users_by_role({'body': {'restaurant_id': 'house'}}, mock_table)
+
+        self.assertEqual(result, {
+            'statusCode': 200,
+            'body': {
+                'items': [
+                    {'username': 'house', 'role': 'Admin', 'email': 'admin@example.com'},
+                    {'username': 'head', 'role': 'Head Chef', 'email': 'head@example.com'},
+                    {'username': 'old_head', 'role': 'Head Chef', 'email': None}
+                ]
+            }
+        })
+
+    def test_restaurant_not_found(self):
+        mock_table = MagicMock()
+        mock_table.get_item.return_value = {}
+
+        result = get_users_by_role({'body': {'restaurant_id': 'house'}}, mock_table)
+
+        self.assertEqual(result, {'statusCode': 404, 'body': 'Restaurant does not exist.'})
+
+
+#Testing the email is stored with the new user
+class TestCreateUserEmail(unittest.TestCase):
+    def test_create_user_stores_email(self):
+        mock_client = MagicMock()
+        event = {'body': {'restaurant_id': 'house', 'username': 'chef', 'role': 'Chef', 'email': 'chef@example.com'}}
+
+        result = create_user(mock_client, event, 'master_db')
+
+        self.assertEqual(result, {'statusCode': 200})
+        new_user = mock_client.update_item.call_args.kwargs['ExpressionAttributeValues'][':new_user']['L'][0]['M']
+        self.assertEqual(new_user, {
+            'username': {'S': 'chef'},
+            'role': {'S': 'Chef'},
+            'email': {'S': 'chef@example.com'}
+        })
+
+
+#Testing get_all_users returns the whole staff list, filtered and paged on the server
+class TestGetAllUsersList(unittest.TestCase):
+    def setUp(self):
+        self.mock_table = MagicMock()
+        self.mock_table.query.return_value = {'Items': [{'users': [
+            {'username': 'sam', 'role': 'Chef', 'email': 'sam@example.com'},
+            {'username': 'alex', 'role': 'Head Chef', 'email': 'alex@example.com'},
+            {'username': 'sally', 'role': 'Chef'}
+        ]}]}
+
+    def test_returns_all_users(self):
+        result = get_all_users({'body': {'restaurant_id': 'house'}}, self.mock_table)
+
+        self.assertEqual(result['statusCode'], 200)
+        self.assertEqual([user['username'] for user in result['body']['items']], ['alex', 'sally', 'sam'])
+        self.assertEqual(result['body']['items'][1], {'username': 'sally', 'role': 'Chef', 'email': None})
+        self.assertIsNone(result['body']['next_start_after'])
+
+    def test_filters_and_projection(self):
+        event = {'body': {'restaurant_id': 'house', 'role': 'Chef', 'name_prefix': 'sa', 'fields': ['username']}}
+
+        result = get_all_users(event, self.mock_table)
+
+        self.assertEqual(result['body']['items'], [{'username': 'sally'}, {'username': 'sam'}])
+
+    def test_pagination(self):
+        first_page = get_all_users({'body': {'restaurant_id': 'house', 'limit': 2}}, self.mock_table)
+        second_page = get_all_users({'body': {'restaurant_id': 'house', 'limit': 2,
+                                              'start_after': first_page['body']['next_start_after']}},
+                                    self.mock_table)
+
+        self.assertEqual([user['username'] for user in first_page['body']['items']], ['alex', 'sally'])
+        self.assertEqual(first_page['body']['next_start_after'], 'sally')
+        self.assertEqual([user['username'] for user in second_page['body']['items']], ['sam'])
+        self.assertIsNone(second_page['body']['next_start_after'])
+
+    def test_invalid_limit(self):
+        with self.assertRaises(BadRequestException):
+            get_all_users({'body': {'restaurant_id': 'house', 'limit': 0}}, self.mock_table)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file